@@ -5,8 +5,14 @@ from torch.utils.data.sampler import RandomSampler, SequentialSampler
 
 from invoke_training._shared.data.data_loaders.image_caption_sd_dataloader import (
     build_aspect_ratio_bucket_manager,
+    get_cached_vae_output_fields,
+    get_partial_batch_strategy,
+    has_random_augmentations,
     sd_image_caption_collate_fn,
+    wrap_collate_fn_for_batch_sampler,
 )
+from invoke_training._shared.data.data_loaders.sharded_data_loader import ShardedDataLoader, get_batch_sampler_shard
+from invoke_training._shared.data.datasets.aspect_ratio_bucket_field_dataset import AspectRatioBucketFieldDataset
 from invoke_training._shared.data.datasets.image_dir_dataset import ImageDirDataset
 from invoke_training._shared.data.datasets.transform_dataset import TransformDataset
 from invoke_training._shared.data.samplers.aspect_ratio_bucket_batch_sampler import AspectRatioBucketBatchSampler
@@ -14,15 +20,18 @@ from invoke_training._shared.data.samplers.batch_offset_sampler import BatchOffs
 from invoke_training._shared.data.samplers.concat_sampler import ConcatSampler
 from invoke_training._shared.data.samplers.interleaved_sampler import InterleavedSampler
 from invoke_training._shared.data.samplers.offset_sampler import OffsetSampler
+from invoke_training._shared.data.transforms.caption_cache_key_transform import CaptionCacheKeyTransform
 from invoke_training._shared.data.transforms.constant_field_transform import ConstantFieldTransform
 from invoke_training._shared.data.transforms.drop_field_transform import DropFieldTransform
 from invoke_training._shared.data.transforms.load_cache_transform import LoadCacheTransform
 from invoke_training._shared.data.transforms.sd_image_transform import SDImageTransform
-from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+from invoke_training._shared.data.transforms.select_random_variant_transform import SelectRandomVariantTransform
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import open_tensor_disk_cache
+from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketAssignment
 from invoke_training.config.data.data_loader_config import DreamboothSDDataLoaderConfig
 
 
-def build_dreambooth_sd_dataloader(
+def build_dreambooth_sd_dataloader(  # noqa: C901
     config: DreamboothSDDataLoaderConfig,
     batch_size: int,
     text_encoder_output_cache_dir: typing.Optional[str] = None,
@@ -30,20 +39,24 @@ def build_dreambooth_sd_dataloader(
     vae_output_cache_dir: typing.Optional[str] = None,
     shuffle: bool = True,
     sequential_batching: bool = False,
-) -> DataLoader:
+    generate_augmentation_variants: bool = False,
+) -> DataLoader | ShardedDataLoader:
     """Construct a DataLoader for a DreamBooth dataset for Stable Diffusion XL.
 
     Args:
         config (DreamboothSDDataLoaderConfig):
         batch_size (int):
         text_encoder_output_cache_dir (str, optional): The directory where text encoder outputs are cached and should be
-            loaded from.
+            loaded from. Entries are keyed by caption (see `get_caption_cache_key(...)`).
         vae_output_cache_dir (str, optional): The directory where VAE outputs are cached and should be loaded from. If
             set, then the image augmentation transforms will be skipped, and the image will not be copied to VRAM.
         shuffle (bool, optional): Whether to shuffle the dataset order.
         sequential_batching (bool, optional): If True, the internal dataset will be processed sequentially rather than
             interleaving class and instance examples. This is intended to be used when processing the entire dataset for
             caching purposes. Defaults to False.
+        generate_augmentation_variants (bool, optional): If True, and random augmentations are enabled, produce all of
+            the cached augmentation variants of each image rather than a single randomly-augmented image. This is
+            intended to be used when populating a VAE output cache.
 
     Returns:
         DataLoader
@@ -53,6 +66,11 @@ def build_dreambooth_sd_dataloader(
         config.instance_dataset.dataset_dir,
         id_prefix="instance_",
         keep_in_memory=config.instance_dataset.keep_in_memory,
+        keep_in_memory_max_mb=config.instance_dataset.keep_in_memory_max_mb,
+        keep_in_memory_format=config.instance_dataset.keep_in_memory_format,
+        keep_in_memory_shared=config.instance_dataset.keep_in_memory_shared,
+        image_probe_num_workers=config.instance_dataset.image_probe_num_workers,
+        image_probe_executor=config.instance_dataset.image_probe_executor,
     )
     instance_dataset = TransformDataset(
         base_instance_dataset,
@@ -68,7 +86,14 @@ def build_dreambooth_sd_dataloader(
     class_dataset = None
     if config.class_dataset is not None:
         base_class_dataset = ImageDirDataset(
-            config.class_dataset.dataset_dir, id_prefix="class_", keep_in_memory=config.class_dataset.keep_in_memory
+            config.class_dataset.dataset_dir,
+            id_prefix="class_",
+            keep_in_memory=config.class_dataset.keep_in_memory,
+            keep_in_memory_max_mb=config.class_dataset.keep_in_memory_max_mb,
+            keep_in_memory_format=config.class_dataset.keep_in_memory_format,
+            keep_in_memory_shared=config.class_dataset.keep_in_memory_shared,
+            image_probe_num_workers=config.class_dataset.image_probe_num_workers,
+            image_probe_executor=config.class_dataset.image_probe_executor,
         )
         class_dataset = TransformDataset(
             base_class_dataset,
@@ -87,6 +112,7 @@ def build_dreambooth_sd_dataloader(
     aspect_ratio_bucket_manager = None
     instance_sampler = None
     class_sampler = None
+    bucket_assignment = None
     if config.aspect_ratio_buckets is None:
         target_resolution = config.resolution
         # TODO(ryand): Provide a seeded generator.
@@ -96,6 +122,7 @@ def build_dreambooth_sd_dataloader(
             class_sampler = OffsetSampler(class_sampler, offset=len(base_instance_dataset))
     else:
         aspect_ratio_bucket_manager = build_aspect_ratio_bucket_manager(config=config.aspect_ratio_buckets)
+        num_replicas, rank = get_batch_sampler_shard(shuffle)
         # TODO(ryand): Drill-down the seed parameter rather than hard-coding to 0 here.
         instance_sampler = AspectRatioBucketBatchSampler.from_image_sizes(
             bucket_manager=aspect_ratio_bucket_manager,
@@ -103,7 +130,12 @@ def build_dreambooth_sd_dataloader(
             batch_size=batch_size,
             shuffle=shuffle,
             seed=0,
+            max_pixels_per_batch=config.aspect_ratio_buckets.max_pixels_per_batch,
+            partial_batches=get_partial_batch_strategy(config.aspect_ratio_buckets, shuffle),
+            num_replicas=num_replicas,
+            rank=rank,
         )
+        bucket_assignments = [instance_sampler.bucket_assignment]
         if base_class_dataset is not None:
             class_sampler = AspectRatioBucketBatchSampler.from_image_sizes(
                 bucket_manager=aspect_ratio_bucket_manager,
@@ -111,8 +143,14 @@ def build_dreambooth_sd_dataloader(
                 batch_size=batch_size,
                 shuffle=shuffle,
                 seed=0,
+                max_pixels_per_batch=config.aspect_ratio_buckets.max_pixels_per_batch,
+                partial_batches=get_partial_batch_strategy(config.aspect_ratio_buckets, shuffle),
+                num_replicas=num_replicas,
+                rank=rank,
             )
+            bucket_assignments.append(class_sampler.bucket_assignment)
             class_sampler = BatchOffsetSampler(class_sampler, offset=len(base_instance_dataset))
+        bucket_assignment = AspectRatioBucketAssignment.concatenate(bucket_assignments)
 
     # Add transforms to the merged dataset.
     all_transforms = []
@@ -125,10 +163,13 @@ def build_dreambooth_sd_dataloader(
                 aspect_ratio_bucket_manager=aspect_ratio_bucket_manager,
                 center_crop=config.center_crop,
                 random_flip=config.random_flip,
+                num_crop_variants=config.num_cached_random_crops
+                if generate_augmentation_variants and has_random_augmentations(config)
+                else None,
             )
         )
     else:
-        vae_cache = TensorDiskCache(vae_output_cache_dir)
+        vae_cache = open_tensor_disk_cache(vae_output_cache_dir)
         all_transforms.append(
             LoadCacheTransform(
                 cache=vae_cache,
@@ -138,22 +179,29 @@ def build_dreambooth_sd_dataloader(
                     "original_size_hw": "original_size_hw",
                     "crop_top_left_yx": "crop_top_left_yx",
                 },
+                optional_cache_field_to_output_field={"vae_output_std": "vae_output_std"},
             )
         )
+        if has_random_augmentations(config):
+            all_transforms.append(SelectRandomVariantTransform(get_cached_vae_output_fields(use_masks=False)))
         # We drop the image to avoid having to either convert from PIL, or handle PIL batch collation.
         all_transforms.append(DropFieldTransform("image"))
 
     if text_encoder_output_cache_dir is not None:
         assert text_encoder_cache_field_to_output_field is not None
-        text_encoder_cache = TensorDiskCache(text_encoder_output_cache_dir)
+        text_encoder_cache = open_tensor_disk_cache(text_encoder_output_cache_dir)
+        all_transforms.append(CaptionCacheKeyTransform())
         all_transforms.append(
             LoadCacheTransform(
                 cache=text_encoder_cache,
-                cache_key_field="id",
+                cache_key_field="caption_cache_key",
                 cache_field_to_output_field=text_encoder_cache_field_to_output_field,
             )
         )
 
+    if bucket_assignment is not None and vae_output_cache_dir is None:
+        # Pass the bucket that the samplers assigned to each example to the image transform.
+        merged_dataset = AspectRatioBucketFieldDataset(merged_dataset, bucket_assignment)
     merged_dataset = TransformDataset(merged_dataset, all_transforms)
 
     # Choose between sequential vs. interleaved merging of the instance and class samplers.
@@ -177,9 +225,15 @@ def build_dreambooth_sd_dataloader(
         )
     else:
         # If config.aspect_ratio_buckets is not None, then we are using a batch sampler.
-        return DataLoader(
+        data_loader = DataLoader(
             merged_dataset,
             batch_sampler=sampler,
-            collate_fn=sd_image_caption_collate_fn,
+            # The instance and class samplers use the same per-bucket batch sizes.
+            collate_fn=wrap_collate_fn_for_batch_sampler(sd_image_caption_collate_fn, instance_sampler, batch_size),
             num_workers=config.dataloader_num_workers,
         )
+        if instance_sampler.num_replicas > 1:
+            # The instance and class samplers are split between processes in the same way, so interleaving them keeps
+            # the processes in lockstep.
+            return ShardedDataLoader(data_loader)
+        return data_loader
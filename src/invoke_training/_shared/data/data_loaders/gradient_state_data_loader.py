@@ -0,0 +1,37 @@
+import typing
+
+from accelerate.data_loader import DataLoaderStateMixin
+from accelerate.state import GradientState
+
+T = typing.TypeVar("T")
+
+
+class GradientStateDataLoaderMixin(DataLoaderStateMixin):
+    """A mixin for data loaders that are intentionally not passed through `accelerator.prepare(...)`.
+
+    accelerate forces a gradient sync (and optimizer step) on the last batch of a prepared DataLoader, even if
+    `gradient_accumulation_steps` has not been reached. This relies on the DataLoader registering itself with the
+    `GradientState` and flagging its last batch. This mixin does the same, so that the number of optimizer steps per
+    epoch is `ceil(len(data_loader) / gradient_accumulation_steps)`, as assumed by the trainers.
+    """
+
+    def _iter_with_gradient_state(self, batches: typing.Iterable[T]) -> typing.Iterator[T]:
+        """Yield from `batches` while registered with the GradientState. `end_of_dataloader` is set before the last
+        batch is yielded.
+        """
+        self.gradient_state = GradientState()
+        self.begin()
+        try:
+            batch_iter = iter(batches)
+            try:
+                batch = next(batch_iter)
+            except StopIteration:
+                return
+            # Look one batch ahead, so that the last batch can be flagged before it is yielded.
+            for next_batch in batch_iter:
+                yield batch
+                batch = next_batch
+            self.end_of_dataloader = True
+            yield batch
+        finally:
+            self.end()
@@ -1,27 +1,41 @@
 import typing
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, default_collate
 
 from invoke_training._shared.data.data_loaders.image_caption_sd_dataloader import (
+    attach_pre_resized_image_cache,
     build_aspect_ratio_bucket_manager,
+    check_merge_adjacent_image_sizing,
+    enable_reduced_size_decoding,
+    get_partial_batch_strategy,
+    sd_image_caption_collate_fn,
+    set_image_decode_backend,
+    wrap_collate_fn_for_batch_sampler,
 )
-from invoke_training._shared.data.data_loaders.image_caption_sd_dataloader import (
-    sd_image_caption_collate_fn as flux_image_caption_collate_fn,
+from invoke_training._shared.data.data_loaders.sharded_data_loader import ShardedDataLoader, get_batch_sampler_shard
+from invoke_training._shared.data.data_loaders.streaming_data_loader import (
+    StreamingDataLoader,
+    build_streaming_data_loader,
 )
+from invoke_training._shared.data.datasets.aspect_ratio_bucket_field_dataset import AspectRatioBucketFieldDataset
 from invoke_training._shared.data.datasets.build_dataset import (
     build_hf_hub_image_caption_dataset,
     build_image_caption_dir_dataset,
     build_image_caption_jsonl_dataset,
+    build_streaming_image_caption_dataset,
+    get_streaming_bucket_buffer_size,
+    is_streaming_dataset_config,
 )
 from invoke_training._shared.data.datasets.transform_dataset import TransformDataset
 from invoke_training._shared.data.samplers.aspect_ratio_bucket_batch_sampler import (
     AspectRatioBucketBatchSampler,
 )
+from invoke_training._shared.data.transforms.caption_cache_key_transform import CaptionCacheKeyTransform
 from invoke_training._shared.data.transforms.caption_prefix_transform import CaptionPrefixTransform
 from invoke_training._shared.data.transforms.drop_field_transform import DropFieldTransform
 from invoke_training._shared.data.transforms.flux_image_transform import FluxImageTransform
 from invoke_training._shared.data.transforms.load_cache_transform import LoadCacheTransform
-from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import open_tensor_disk_cache
 from invoke_training.config.data.data_loader_config import ImageCaptionFluxDataLoaderConfig
 from invoke_training.config.data.dataset_config import (
     HFHubImageCaptionDatasetConfig,
@@ -30,6 +44,23 @@ from invoke_training.config.data.dataset_config import (
 )
 
 
+def flux_image_caption_collate_fn(examples):
+    """A batch collation function for the image-caption Flux data loader.
+
+    Extends `sd_image_caption_collate_fn(...)` with the Flux-specific fields that are loaded from the VAE and text
+    encoder output caches.
+    """
+    out_examples = sd_image_caption_collate_fn(examples)
+
+    if "latent_size_hw" in examples[0]:
+        out_examples["latent_size_hw"] = [example["latent_size_hw"] for example in examples]
+
+    if "text_ids" in examples[0]:
+        out_examples["text_ids"] = default_collate([example["text_ids"] for example in examples])
+
+    return out_examples
+
+
 def build_image_caption_flux_dataloader(  # noqa: C901
     config: ImageCaptionFluxDataLoaderConfig,
     batch_size: int,
@@ -38,21 +69,38 @@ def build_image_caption_flux_dataloader(  # noqa: C901
     text_encoder_cache_field_to_output_field: typing.Optional[dict[str, str]] = None,
     vae_output_cache_dir: typing.Optional[str] = None,
     shuffle: bool = True,
-) -> DataLoader:
+) -> DataLoader | StreamingDataLoader | ShardedDataLoader:
     """Construct a DataLoader for an image-caption dataset for Flux.1-dev.
 
+    If the dataset is a streaming dataset, then a StreamingDataLoader is returned instead (see
+    `build_streaming_data_loader(...)`). Caching is not supported for streaming datasets. If aspect ratio buckets are
+    used in distributed training, then a ShardedDataLoader is returned instead, with a batch sampler that is split
+    between the processes.
+
     Args:
         config (ImageCaptionFluxDataLoaderConfig): The dataset config.
         batch_size (int): The DataLoader batch size.
         text_encoder_output_cache_dir (str, optional): The directory where text encoder outputs are cached and should be
-            loaded from. If set, then the TokenizeTransform will not be applied.
+            loaded from. Entries are keyed by caption (see `get_caption_cache_key(...)`). If set, then the
+            TokenizeTransform will not be applied.
         vae_output_cache_dir (str, optional): The directory where VAE outputs are cached and should be loaded from. If
             set, then the image augmentation transforms will be skipped, and the image will not be copied to VRAM.
         shuffle (bool, optional): Whether to shuffle the dataset order.
     Returns:
-        DataLoader
+        DataLoader | StreamingDataLoader
     """
-    if isinstance(config.dataset, HFHubImageCaptionDatasetConfig):
+    if config.resolution is None:
+        # FluxImageTransform ignores the aspect ratio buckets when a fixed resolution is set.
+        check_merge_adjacent_image_sizing(
+            config.aspect_ratio_buckets, config.pre_resize_cache_dir, config.reduced_size_jpeg_decoding
+        )
+    is_streaming = is_streaming_dataset_config(config.dataset)
+    if is_streaming:
+        if text_encoder_output_cache_dir is not None or vae_output_cache_dir is not None:
+            raise ValueError("Caching is not supported for streaming datasets.")
+        # TODO(ryand): Drill-down the seed parameter rather than hard-coding to 0 here.
+        base_dataset = build_streaming_image_caption_dataset(config.dataset, shuffle=shuffle, seed=0)
+    elif isinstance(config.dataset, HFHubImageCaptionDatasetConfig):
         base_dataset = build_hf_hub_image_caption_dataset(config.dataset)
     elif isinstance(config.dataset, ImageCaptionJsonlDatasetConfig):
         base_dataset = build_image_caption_jsonl_dataset(config.dataset)
@@ -65,8 +113,18 @@ def build_image_caption_flux_dataloader(  # noqa: C901
     if config.aspect_ratio_buckets is None:
         aspect_ratio_bucket_manager = None
         batch_sampler = None
+    elif is_streaming:
+        # The image dimensions of a streaming dataset are not known up front, so examples are grouped into buckets as
+        # they are loaded (see `build_streaming_data_loader(...)`).
+        if config.aspect_ratio_buckets.max_pixels_per_batch is not None:
+            raise ValueError("`max_pixels_per_batch` is not supported for streaming datasets.")
+        if config.aspect_ratio_buckets.partial_batches != "keep":
+            raise ValueError("`partial_batches` is not supported for streaming datasets.")
+        aspect_ratio_bucket_manager = build_aspect_ratio_bucket_manager(config=config.aspect_ratio_buckets)
+        batch_sampler = None
     else:
         aspect_ratio_bucket_manager = build_aspect_ratio_bucket_manager(config=config.aspect_ratio_buckets)
+        num_replicas, rank = get_batch_sampler_shard(shuffle)
         # TODO(ryand): Drill-down the seed parameter rather than hard-coding to 0 here.
         batch_sampler = AspectRatioBucketBatchSampler.from_image_sizes(
             bucket_manager=aspect_ratio_bucket_manager,
@@ -74,6 +132,10 @@ def build_image_caption_flux_dataloader(  # noqa: C901
             batch_size=batch_size,
             shuffle=shuffle,
             seed=0,
+            max_pixels_per_batch=config.aspect_ratio_buckets.max_pixels_per_batch,
+            partial_batches=get_partial_batch_strategy(config.aspect_ratio_buckets, shuffle),
+            num_replicas=num_replicas,
+            rank=rank,
         )
 
     all_transforms = []
@@ -82,6 +144,17 @@ def build_image_caption_flux_dataloader(  # noqa: C901
         all_transforms.append(CaptionPrefixTransform(caption_field_name="caption", prefix=config.caption_prefix + " "))
 
     if vae_output_cache_dir is None:
+        # FluxImageTransform uses the fixed resolution whenever it is set, even if aspect ratio buckets are configured.
+        # Pre-resized and reduced-size images must target the same resolution.
+        image_bucket_manager = aspect_ratio_bucket_manager if config.resolution is None else None
+        if config.pre_resize_cache_dir is not None:
+            attach_pre_resized_image_cache(
+                base_dataset, config.pre_resize_cache_dir, config.resolution, image_bucket_manager
+            )
+        if config.reduced_size_jpeg_decoding:
+            enable_reduced_size_decoding(base_dataset, config.resolution, image_bucket_manager)
+        set_image_decode_backend(base_dataset, config.image_decode_backend, config.reduced_size_jpeg_decoding)
+
         image_field_names = ["image"]
         if use_masks:
             image_field_names.append("mask")
@@ -103,12 +176,11 @@ def build_image_caption_flux_dataloader(  # noqa: C901
         all_transforms.append(DropFieldTransform("image"))
         all_transforms.append(DropFieldTransform("mask"))
 
-        vae_cache = TensorDiskCache(vae_output_cache_dir)
+        vae_cache = open_tensor_disk_cache(vae_output_cache_dir)
 
         cache_field_to_output_field = {
             "vae_output": "vae_output",
-            "original_size_hw": "original_size_hw",
-            "crop_top_left_yx": "crop_top_left_yx",
+            "latent_size_hw": "latent_size_hw",
         }
         if use_masks:
             cache_field_to_output_field["mask"] = "mask"
@@ -117,19 +189,35 @@ def build_image_caption_flux_dataloader(  # noqa: C901
                 cache=vae_cache,
                 cache_key_field="id",
                 cache_field_to_output_field=cache_field_to_output_field,
+                optional_cache_field_to_output_field={"vae_output_std": "vae_output_std"},
             )
         )
 
     if text_encoder_output_cache_dir is not None:
         assert text_encoder_cache_field_to_output_field is not None
-        text_encoder_cache = TensorDiskCache(text_encoder_output_cache_dir)
+        text_encoder_cache = open_tensor_disk_cache(text_encoder_output_cache_dir)
+        all_transforms.append(CaptionCacheKeyTransform())
         all_transforms.append(
             LoadCacheTransform(
                 cache=text_encoder_cache,
-                cache_key_field="id",
+                cache_key_field="caption_cache_key",
                 cache_field_to_output_field=text_encoder_cache_field_to_output_field,
             )
         )
+
+    if is_streaming:
+        return build_streaming_data_loader(
+            base_dataset,
+            all_transforms,
+            batch_size=batch_size,
+            collate_fn=flux_image_caption_collate_fn,
+            bucket_buffer_size=get_streaming_bucket_buffer_size(config.dataset),
+            num_workers=config.dataloader_num_workers,
+        )
+
+    if batch_sampler is not None and vae_output_cache_dir is None:
+        # Pass the bucket that the sampler assigned to each example to the image transform.
+        base_dataset = AspectRatioBucketFieldDataset(base_dataset, batch_sampler.bucket_assignment)
     dataset = TransformDataset(base_dataset, all_transforms)
 
     if batch_sampler is None:
@@ -141,9 +229,12 @@ def build_image_caption_flux_dataloader(  # noqa: C901
             num_workers=config.dataloader_num_workers,
         )
     else:
-        return DataLoader(
+        data_loader = DataLoader(
             dataset,
             batch_sampler=batch_sampler,
-            collate_fn=flux_image_caption_collate_fn,
+            collate_fn=wrap_collate_fn_for_batch_sampler(flux_image_caption_collate_fn, batch_sampler, batch_size),
             num_workers=config.dataloader_num_workers,
         )
+        if batch_sampler.num_replicas > 1:
+            return ShardedDataLoader(data_loader)
+        return data_loader
@@ -1,21 +1,40 @@
 import typing
 
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, default_collate
 
+from invoke_training._shared.data.data_loaders.sharded_data_loader import ShardedDataLoader, get_batch_sampler_shard
+from invoke_training._shared.data.data_loaders.streaming_data_loader import (
+    StreamingDataLoader,
+    build_streaming_data_loader,
+)
+from invoke_training._shared.data.datasets.aspect_ratio_bucket_field_dataset import AspectRatioBucketFieldDataset
 from invoke_training._shared.data.datasets.build_dataset import (
     build_hf_hub_image_caption_dataset,
     build_image_caption_dir_dataset,
     build_image_caption_jsonl_dataset,
+    build_streaming_image_caption_dataset,
+    get_streaming_bucket_buffer_size,
+    is_streaming_dataset_config,
 )
 from invoke_training._shared.data.datasets.transform_dataset import TransformDataset
-from invoke_training._shared.data.samplers.aspect_ratio_bucket_batch_sampler import AspectRatioBucketBatchSampler
+from invoke_training._shared.data.samplers.aspect_ratio_bucket_batch_sampler import (
+    AspectRatioBucketBatchSampler,
+    PartialBatchStrategy,
+)
+from invoke_training._shared.data.transforms.caption_cache_key_transform import CaptionCacheKeyTransform
 from invoke_training._shared.data.transforms.caption_prefix_transform import CaptionPrefixTransform
 from invoke_training._shared.data.transforms.drop_field_transform import DropFieldTransform
 from invoke_training._shared.data.transforms.load_cache_transform import LoadCacheTransform
 from invoke_training._shared.data.transforms.sd_image_transform import SDImageTransform
-from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+from invoke_training._shared.data.transforms.select_random_variant_transform import SelectRandomVariantTransform
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import open_tensor_disk_cache
 from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketManager
+from invoke_training._shared.data.utils.image_decode_backend import ImageDecodeBackend
+from invoke_training._shared.data.utils.pre_resized_image_cache import (
+    build_pre_resized_image_cache,
+    get_target_resolution_fn,
+)
 from invoke_training.config.data.data_loader_config import AspectRatioBucketConfig, ImageCaptionSDDataLoaderConfig
 from invoke_training.config.data.dataset_config import (
     HFHubImageCaptionDatasetConfig,
@@ -24,14 +43,19 @@ from invoke_training.config.data.dataset_config import (
 )
 
 
-def sd_image_caption_collate_fn(examples):
-    """A batch collation function for the image-caption SDXL data loader."""
+def sd_image_caption_collate_fn(examples):  # noqa: C901
+    """A batch collation function for the image-caption SDXL data loader.
+
+    Tensors are stacked with `default_collate(...)` rather than `torch.stack(...)`. When called from a DataLoader
+    worker, `default_collate(...)` stacks directly into a shared memory buffer. This avoids a second copy when the batch
+    is passed to the main process, which is significant when the examples are memory-mapped cache entries.
+    """
     out_examples = {
         "id": [example["id"] for example in examples],
     }
 
     if "image" in examples[0]:
-        out_examples["image"] = torch.stack([example["image"] for example in examples])
+        out_examples["image"] = default_collate([example["image"] for example in examples])
 
     if "original_size_hw" in examples[0]:
         out_examples["original_size_hw"] = [example["original_size_hw"] for example in examples]
@@ -46,21 +70,60 @@ def sd_image_caption_collate_fn(examples):
         out_examples["loss_weight"] = torch.tensor([example["loss_weight"] for example in examples])
 
     if "prompt_embeds" in examples[0]:
-        out_examples["prompt_embeds"] = torch.stack([example["prompt_embeds"] for example in examples])
-        out_examples["pooled_prompt_embeds"] = torch.stack([example["pooled_prompt_embeds"] for example in examples])
+        out_examples["prompt_embeds"] = default_collate([example["prompt_embeds"] for example in examples])
+        out_examples["pooled_prompt_embeds"] = default_collate(
+            [example["pooled_prompt_embeds"] for example in examples]
+        )
 
     if "text_encoder_output" in examples[0]:
-        out_examples["text_encoder_output"] = torch.stack([example["text_encoder_output"] for example in examples])
+        out_examples["text_encoder_output"] = default_collate([example["text_encoder_output"] for example in examples])
 
     if "vae_output" in examples[0]:
-        out_examples["vae_output"] = torch.stack([example["vae_output"] for example in examples])
+        out_examples["vae_output"] = default_collate([example["vae_output"] for example in examples])
+
+    if "vae_output_std" in examples[0]:
+        out_examples["vae_output_std"] = default_collate([example["vae_output_std"] for example in examples])
 
     if "mask" in examples[0]:
-        out_examples["mask"] = torch.stack([example["mask"] for example in examples])
+        out_examples["mask"] = default_collate([example["mask"] for example in examples])
 
     return out_examples
 
 
+class BatchSizeLossWeightCollateFn:
+    """Wraps a batch collation function to scale the "loss_weight" of each example by
+    `len(examples) / reference_batch_size`.
+
+    This is used when batch sizes vary between aspect ratio buckets. The trainers mean-reduce the loss over the batch,
+    so without this scaling an example in a small batch would contribute more to the gradient than an example in a
+    large batch. With it, every example contributes as it would in a batch of `reference_batch_size` examples.
+    """
+
+    def __init__(self, collate_fn: typing.Callable[[list[dict]], dict], reference_batch_size: int):
+        self._collate_fn = collate_fn
+        self._reference_batch_size = reference_batch_size
+
+    def __call__(self, examples: list[dict]) -> dict:
+        out_examples = self._collate_fn(examples)
+        scale = len(examples) / self._reference_batch_size
+        if "loss_weight" in out_examples:
+            out_examples["loss_weight"] = out_examples["loss_weight"] * scale
+        else:
+            out_examples["loss_weight"] = torch.full((len(examples),), scale)
+        return out_examples
+
+
+def wrap_collate_fn_for_batch_sampler(
+    collate_fn: typing.Callable[[list[dict]], dict],
+    batch_sampler: AspectRatioBucketBatchSampler | None,
+    reference_batch_size: int,
+) -> typing.Callable[[list[dict]], dict]:
+    """Wrap `collate_fn` with a BatchSizeLossWeightCollateFn if `batch_sampler` uses per-bucket batch sizes."""
+    if batch_sampler is None or not batch_sampler.has_bucket_batch_sizes:
+        return collate_fn
+    return BatchSizeLossWeightCollateFn(collate_fn, reference_batch_size)
+
+
 def build_aspect_ratio_bucket_manager(config: AspectRatioBucketConfig):
     return AspectRatioBucketManager.from_constraints(
         target_resolution=config.target_resolution,
@@ -70,6 +133,118 @@ def build_aspect_ratio_bucket_manager(config: AspectRatioBucketConfig):
     )
 
 
+def get_partial_batch_strategy(config: AspectRatioBucketConfig, shuffle: bool) -> PartialBatchStrategy:
+    """Get the partial batch strategy for a data loader.
+
+    "carry_over" and "drop_last" leave examples out of an epoch, so they are only used by shuffled (i.e. training) data
+    loaders. Unshuffled data loaders are used to populate caches, which must include every example.
+    """
+    if not shuffle and config.partial_batches in ("carry_over", "drop_last"):
+        return "keep"
+    return config.partial_batches
+
+
+def check_merge_adjacent_image_sizing(
+    aspect_ratio_buckets: AspectRatioBucketConfig | None,
+    pre_resize_cache_dir: str | None,
+    reduced_size_jpeg_decoding: bool,
+):
+    """Check that `partial_batches="merge_adjacent"` is not combined with options that size images for their own
+    aspect ratio bucket.
+
+    Merged examples are resized to the resolution of the bucket that they were merged into. Pre-resized and reduced-size
+    images are sized for the bucket of their original size, so they could end up smaller than the merged bucket and be
+    upscaled.
+
+    Raises:
+        ValueError: If the options are incompatible.
+    """
+    if aspect_ratio_buckets is None or aspect_ratio_buckets.partial_batches != "merge_adjacent":
+        return
+    if pre_resize_cache_dir is not None:
+        raise ValueError("`pre_resize_cache_dir` can't be combined with `partial_batches='merge_adjacent'`.")
+    if reduced_size_jpeg_decoding:
+        raise ValueError("`reduced_size_jpeg_decoding` can't be combined with `partial_batches='merge_adjacent'`.")
+
+
+def attach_pre_resized_image_cache(
+    dataset: torch.utils.data.Dataset,
+    pre_resize_cache_dir: str,
+    resolution: int | tuple[int, int] | None,
+    aspect_ratio_bucket_manager: AspectRatioBucketManager | None,
+):
+    """Configure `dataset` to load its images through a PreResizedImageCache.
+
+    Raises:
+        ValueError: If the dataset does not support pre-resized images.
+    """
+    if not hasattr(dataset, "set_pre_resized_image_cache"):
+        raise ValueError(
+            f"`pre_resize_cache_dir` is not supported for datasets of type '{type(dataset).__name__}'. It is only "
+            "supported for image directory and jsonl datasets."
+        )
+    dataset.set_pre_resized_image_cache(
+        build_pre_resized_image_cache(
+            pre_resize_cache_dir, resolution=resolution, aspect_ratio_bucket_manager=aspect_ratio_bucket_manager
+        )
+    )
+
+
+def enable_reduced_size_decoding(
+    dataset: torch.utils.data.Dataset,
+    resolution: int | tuple[int, int] | None,
+    aspect_ratio_bucket_manager: AspectRatioBucketManager | None,
+):
+    """Configure `dataset` to decode JPEG images at a reduced size when they are larger than their target resolution.
+
+    Raises:
+        ValueError: If the dataset does not support reduced-size decoding.
+    """
+    if not hasattr(dataset, "set_reduced_size_decoding"):
+        raise ValueError(
+            f"`reduced_size_jpeg_decoding` is not supported for datasets of type '{type(dataset).__name__}'. It is "
+            "only supported for image directory and jsonl datasets."
+        )
+    dataset.set_reduced_size_decoding(get_target_resolution_fn(resolution, aspect_ratio_bucket_manager))
+
+
+def set_image_decode_backend(
+    dataset: torch.utils.data.Dataset, image_decode_backend: ImageDecodeBackend, reduced_size_jpeg_decoding: bool
+):
+    """Configure the backend that `dataset` uses to decode image files.
+
+    Raises:
+        ValueError: If the backend is not supported by the dataset, or can't be combined with reduced-size decoding.
+    """
+    if image_decode_backend == "pil":
+        return
+    if reduced_size_jpeg_decoding:
+        raise ValueError(f"`reduced_size_jpeg_decoding` is not supported with the '{image_decode_backend}' backend.")
+    if not hasattr(dataset, "set_image_decode_backend"):
+        raise ValueError(
+            f"The '{image_decode_backend}' image decode backend is not supported for datasets of type "
+            f"'{type(dataset).__name__}'."
+        )
+    dataset.set_image_decode_backend(image_decode_backend)
+
+
+def has_random_augmentations(config: typing.Any) -> bool:
+    """Check whether a data loader config enables any non-deterministic image augmentations.
+
+    If so, a VAE output cache must store multiple augmentation variants of each image (see
+    `SDImageTransform(num_crop_variants=...)`).
+    """
+    return config.random_flip or not config.center_crop
+
+
+def get_cached_vae_output_fields(use_masks: bool) -> list[str]:
+    """Get the list of VAE output cache fields that hold one value per augmentation variant."""
+    field_names = ["vae_output", "vae_output_std", "crop_top_left_yx"]
+    if use_masks:
+        field_names.append("mask")
+    return field_names
+
+
 def build_image_caption_sd_dataloader(  # noqa: C901
     config: ImageCaptionSDDataLoaderConfig,
     batch_size: int,
@@ -78,21 +253,44 @@ def build_image_caption_sd_dataloader(  # noqa: C901
     text_encoder_cache_field_to_output_field: typing.Optional[dict[str, str]] = None,
     vae_output_cache_dir: typing.Optional[str] = None,
     shuffle: bool = True,
-) -> DataLoader:
+    generate_augmentation_variants: bool = False,
+) -> DataLoader | StreamingDataLoader | ShardedDataLoader:
     """Construct a DataLoader for an image-caption dataset for Stable Diffusion XL.
 
+    If the dataset is a streaming dataset, then a StreamingDataLoader is returned instead (see
+    `build_streaming_data_loader(...)`). Caching is not supported for streaming datasets. If aspect ratio buckets are
+    used in distributed training, then a ShardedDataLoader is returned instead, with a batch sampler that is split
+    between the processes.
+
     Args:
         config (ImageCaptionSDDataLoaderConfig): The dataset config.
         batch_size (int): The DataLoader batch size.
         text_encoder_output_cache_dir (str, optional): The directory where text encoder outputs are cached and should be
-            loaded from. If set, then the TokenizeTransform will not be applied.
+            loaded from. Entries are keyed by caption (see `get_caption_cache_key(...)`). If set, then the
+            TokenizeTransform will not be applied.
         vae_output_cache_dir (str, optional): The directory where VAE outputs are cached and should be loaded from. If
             set, then the image augmentation transforms will be skipped, and the image will not be copied to VRAM.
         shuffle (bool, optional): Whether to shuffle the dataset order.
+        generate_augmentation_variants (bool, optional): If True, and random augmentations are enabled, produce all of
+            the cached augmentation variants of each image rather than a single randomly-augmented image. This is
+            intended to be used when populating a VAE output cache.
     Returns:
-        DataLoader
+        DataLoader | StreamingDataLoader
     """
-    if isinstance(config.dataset, HFHubImageCaptionDatasetConfig):
+    check_merge_adjacent_image_sizing(
+        config.aspect_ratio_buckets, config.pre_resize_cache_dir, config.reduced_size_jpeg_decoding
+    )
+    is_streaming = is_streaming_dataset_config(config.dataset)
+    if is_streaming:
+        if (
+            text_encoder_output_cache_dir is not None
+            or vae_output_cache_dir is not None
+            or generate_augmentation_variants
+        ):
+            raise ValueError("Caching is not supported for streaming datasets.")
+        # TODO(ryand): Drill-down the seed parameter rather than hard-coding to 0 here.
+        base_dataset = build_streaming_image_caption_dataset(config.dataset, shuffle=shuffle, seed=0)
+    elif isinstance(config.dataset, HFHubImageCaptionDatasetConfig):
         base_dataset = build_hf_hub_image_caption_dataset(config.dataset)
     elif isinstance(config.dataset, ImageCaptionJsonlDatasetConfig):
         base_dataset = build_image_caption_jsonl_dataset(config.dataset)
@@ -106,9 +304,20 @@ def build_image_caption_sd_dataloader(  # noqa: C901
         target_resolution = config.resolution
         aspect_ratio_bucket_manager = None
         batch_sampler = None
+    elif is_streaming:
+        # The image dimensions of a streaming dataset are not known up front, so examples are grouped into buckets as
+        # they are loaded (see `build_streaming_data_loader(...)`).
+        if config.aspect_ratio_buckets.max_pixels_per_batch is not None:
+            raise ValueError("`max_pixels_per_batch` is not supported for streaming datasets.")
+        if config.aspect_ratio_buckets.partial_batches != "keep":
+            raise ValueError("`partial_batches` is not supported for streaming datasets.")
+        target_resolution = None
+        aspect_ratio_bucket_manager = build_aspect_ratio_bucket_manager(config=config.aspect_ratio_buckets)
+        batch_sampler = None
     else:
         target_resolution = None
         aspect_ratio_bucket_manager = build_aspect_ratio_bucket_manager(config=config.aspect_ratio_buckets)
+        num_replicas, rank = get_batch_sampler_shard(shuffle)
         # TODO(ryand): Drill-down the seed parameter rather than hard-coding to 0 here.
         batch_sampler = AspectRatioBucketBatchSampler.from_image_sizes(
             bucket_manager=aspect_ratio_bucket_manager,
@@ -116,6 +325,10 @@ def build_image_caption_sd_dataloader(  # noqa: C901
             batch_size=batch_size,
             shuffle=shuffle,
             seed=0,
+            max_pixels_per_batch=config.aspect_ratio_buckets.max_pixels_per_batch,
+            partial_batches=get_partial_batch_strategy(config.aspect_ratio_buckets, shuffle),
+            num_replicas=num_replicas,
+            rank=rank,
         )
 
     all_transforms = []
@@ -124,6 +337,14 @@ def build_image_caption_sd_dataloader(  # noqa: C901
         all_transforms.append(CaptionPrefixTransform(caption_field_name="caption", prefix=config.caption_prefix + " "))
 
     if vae_output_cache_dir is None:
+        if config.pre_resize_cache_dir is not None:
+            attach_pre_resized_image_cache(
+                base_dataset, config.pre_resize_cache_dir, target_resolution, aspect_ratio_bucket_manager
+            )
+        if config.reduced_size_jpeg_decoding:
+            enable_reduced_size_decoding(base_dataset, target_resolution, aspect_ratio_bucket_manager)
+        set_image_decode_backend(base_dataset, config.image_decode_backend, config.reduced_size_jpeg_decoding)
+
         image_field_names = ["image"]
         if use_masks:
             image_field_names.append("mask")
@@ -138,6 +359,9 @@ def build_image_caption_sd_dataloader(  # noqa: C901
                 aspect_ratio_bucket_manager=aspect_ratio_bucket_manager,
                 center_crop=config.center_crop,
                 random_flip=config.random_flip,
+                num_crop_variants=config.num_cached_random_crops
+                if generate_augmentation_variants and has_random_augmentations(config)
+                else None,
             )
         )
     else:
@@ -145,7 +369,7 @@ def build_image_caption_sd_dataloader(  # noqa: C901
         all_transforms.append(DropFieldTransform("image"))
         all_transforms.append(DropFieldTransform("mask"))
 
-        vae_cache = TensorDiskCache(vae_output_cache_dir)
+        vae_cache = open_tensor_disk_cache(vae_output_cache_dir)
 
         cache_field_to_output_field = {
             "vae_output": "vae_output",
@@ -159,20 +383,37 @@ def build_image_caption_sd_dataloader(  # noqa: C901
                 cache=vae_cache,
                 cache_key_field="id",
                 cache_field_to_output_field=cache_field_to_output_field,
+                optional_cache_field_to_output_field={"vae_output_std": "vae_output_std"},
             )
         )
+        if has_random_augmentations(config):
+            all_transforms.append(SelectRandomVariantTransform(get_cached_vae_output_fields(use_masks)))
 
     if text_encoder_output_cache_dir is not None:
         assert text_encoder_cache_field_to_output_field is not None
-        text_encoder_cache = TensorDiskCache(text_encoder_output_cache_dir)
+        text_encoder_cache = open_tensor_disk_cache(text_encoder_output_cache_dir)
+        all_transforms.append(CaptionCacheKeyTransform())
         all_transforms.append(
             LoadCacheTransform(
                 cache=text_encoder_cache,
-                cache_key_field="id",
+                cache_key_field="caption_cache_key",
                 cache_field_to_output_field=text_encoder_cache_field_to_output_field,
             )
         )
 
+    if is_streaming:
+        return build_streaming_data_loader(
+            base_dataset,
+            all_transforms,
+            batch_size=batch_size,
+            collate_fn=sd_image_caption_collate_fn,
+            bucket_buffer_size=get_streaming_bucket_buffer_size(config.dataset),
+            num_workers=config.dataloader_num_workers,
+        )
+
+    if batch_sampler is not None and vae_output_cache_dir is None:
+        # Pass the bucket that the sampler assigned to each example to the image transform.
+        base_dataset = AspectRatioBucketFieldDataset(base_dataset, batch_sampler.bucket_assignment)
     dataset = TransformDataset(base_dataset, all_transforms)
 
     if batch_sampler is None:
@@ -184,9 +425,12 @@ def build_image_caption_sd_dataloader(  # noqa: C901
             num_workers=config.dataloader_num_workers,
         )
     else:
-        return DataLoader(
+        data_loader = DataLoader(
             dataset,
             batch_sampler=batch_sampler,
-            collate_fn=sd_image_caption_collate_fn,
+            collate_fn=wrap_collate_fn_for_batch_sampler(sd_image_caption_collate_fn, batch_sampler, batch_size),
             num_workers=config.dataloader_num_workers,
         )
+        if batch_sampler.num_replicas > 1:
+            return ShardedDataLoader(data_loader)
+        return data_loader
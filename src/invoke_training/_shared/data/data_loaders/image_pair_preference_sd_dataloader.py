@@ -1,14 +1,16 @@
 import typing
 
-import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, default_collate
 
+from invoke_training._shared.data.data_loaders.image_caption_sd_dataloader import set_image_decode_backend
 from invoke_training._shared.data.datasets.build_dataset import build_hf_image_pair_preference_dataset
 from invoke_training._shared.data.datasets.image_pair_preference_dataset import ImagePairPreferenceDataset
 from invoke_training._shared.data.datasets.transform_dataset import TransformDataset
+from invoke_training._shared.data.transforms.caption_cache_key_transform import CaptionCacheKeyTransform
 from invoke_training._shared.data.transforms.load_cache_transform import LoadCacheTransform
 from invoke_training._shared.data.transforms.sd_image_transform import SDImageTransform
-from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import open_tensor_disk_cache
+from invoke_training._shared.data.utils.pre_resized_image_cache import get_target_resolution_fn
 from invoke_training.pipelines._experimental.sd_dpo_lora.config import ImagePairPreferenceSDDataLoaderConfig
 
 
@@ -33,10 +35,10 @@ def sd_image_pair_preference_collate_fn(examples):
 
     out_examples = {}
 
-    # torch.stack(...)
+    # Stack tensors. default_collate(...) stacks directly into shared memory when called from a DataLoader worker.
     for k in stack_keys:
         if k in examples[0]:
-            out_examples[k] = torch.stack([example[k] for example in examples])
+            out_examples[k] = default_collate([example[k] for example in examples])
 
     # Basic list.
     for k in list_keys:
@@ -60,7 +62,8 @@ def build_image_pair_preference_sd_dataloader(
         config (ImageCaptionSDDataLoaderConfig): The dataset config.
         batch_size (int): The DataLoader batch size.
         text_encoder_output_cache_dir (str, optional): The directory where text encoder outputs are cached and should be
-            loaded from. If set, then the TokenizeTransform will not be applied.
+            loaded from. Entries are keyed by caption (see `get_caption_cache_key(...)`). If set, then the
+            TokenizeTransform will not be applied.
         vae_output_cache_dir (str, optional): The directory where VAE outputs are cached and should be loaded from. If
             set, then the image augmentation transforms will be skipped, and the image will not be copied to VRAM.
         shuffle (bool, optional): Whether to shuffle the dataset order.
@@ -78,6 +81,14 @@ def build_image_pair_preference_sd_dataloader(
 
     all_transforms = []
     if vae_output_cache_dir is None:
+        if config.reduced_size_jpeg_decoding:
+            if not isinstance(base_dataset, ImagePairPreferenceDataset):
+                raise ValueError(
+                    "`reduced_size_jpeg_decoding` is only supported for IMAGE_PAIR_PREFERENCE_DATASET datasets."
+                )
+            base_dataset.set_reduced_size_decoding(get_target_resolution_fn(target_resolution, None))
+        set_image_decode_backend(base_dataset, config.image_decode_backend, config.reduced_size_jpeg_decoding)
+
         # TODO(ryand): Should I process both images in a single SDImageTransform so that they undergo the same
         # transformations?
         all_transforms.append(
@@ -123,11 +134,12 @@ def build_image_pair_preference_sd_dataloader(
 
     if text_encoder_output_cache_dir is not None:
         assert text_encoder_cache_field_to_output_field is not None
-        text_encoder_cache = TensorDiskCache(text_encoder_output_cache_dir)
+        text_encoder_cache = open_tensor_disk_cache(text_encoder_output_cache_dir)
+        all_transforms.append(CaptionCacheKeyTransform())
         all_transforms.append(
             LoadCacheTransform(
                 cache=text_encoder_cache,
-                cache_key_field="id",
+                cache_key_field="caption_cache_key",
                 cache_field_to_output_field=text_encoder_cache_field_to_output_field,
             )
         )
@@ -0,0 +1,62 @@
+import typing
+
+import torch
+from accelerate import PartialState
+from accelerate.utils import send_to_device
+from torch.utils.data import DataLoader
+
+from invoke_training._shared.data.data_loaders.gradient_state_data_loader import GradientStateDataLoaderMixin
+
+
+class ShardedDataLoader(GradientStateDataLoaderMixin):
+    """A data loader whose batch sampler already splits the batches between distributed processes (e.g. an
+    AspectRatioBucketBatchSampler with `num_replicas > 1`).
+
+    Like StreamingDataLoader, this intentionally does not subclass DataLoader, so that `accelerator.prepare(...)`
+    returns it unchanged. accelerate would otherwise wrap the batch sampler in a generic `BatchSamplerShard`, which
+    splits the batches between processes a second time without regard for their resolutions. Instead, batches are moved
+    to the device of the current process as they are loaded, and the last batch of each epoch is flagged to accelerate's
+    GradientState (see `GradientStateDataLoaderMixin`).
+    """
+
+    def __init__(self, data_loader: DataLoader, device: torch.device | str | None = None):
+        """Initialize ShardedDataLoader.
+
+        Args:
+            data_loader (DataLoader): The underlying DataLoader, which yields the batches of the current process.
+            device (torch.device | str, optional): The device to move batches to. Defaults to the device of the
+                current accelerate process.
+        """
+        self._data_loader = data_loader
+        self._device = device
+
+    @property
+    def batch_sampler(self):
+        return self._data_loader.batch_sampler
+
+    @property
+    def dataset(self):
+        return self._data_loader.dataset
+
+    def __len__(self) -> int:
+        return len(self._data_loader)
+
+    def __iter__(self) -> typing.Iterator[typing.Any]:
+        return self._iter_with_gradient_state(self._iter_batches())
+
+    def _iter_batches(self) -> typing.Iterator[typing.Any]:
+        device = self._device if self._device is not None else PartialState().device
+        for data_batch in self._data_loader:
+            yield send_to_device(data_batch, device)
+
+
+def get_batch_sampler_shard(shuffle: bool) -> tuple[int, int]:
+    """Get the `(num_replicas, rank)` to split a batch sampler between the accelerate processes.
+
+    Only shuffled (i.e. training) data loaders are split. Unshuffled data loaders are used to populate caches, which
+    split the batches between processes themselves (see `populate_tensor_disk_caches(...)`).
+    """
+    if not shuffle:
+        return 1, 0
+    state = PartialState()
+    return state.num_processes, state.process_index
@@ -0,0 +1,113 @@
+import math
+import typing
+
+import torch
+from accelerate import PartialState
+from accelerate.utils import send_to_device
+from torch.utils.data import DataLoader
+
+from invoke_training._shared.data.data_loaders.gradient_state_data_loader import GradientStateDataLoaderMixin
+from invoke_training._shared.data.datasets.bucket_batch_iterable_dataset import BucketBatchIterableDataset
+from invoke_training._shared.data.datasets.hf_streaming_image_caption_dataset import HFStreamingImageCaptionDataset
+from invoke_training._shared.data.datasets.image_caption_tar_shard_dataset import ImageCaptionTarShardDataset
+from invoke_training._shared.data.datasets.transform_dataset import TransformIterableDataset, TransformType
+
+# The streaming datasets that are supported by StreamingDataLoader.
+StreamingDataset = HFStreamingImageCaptionDataset | ImageCaptionTarShardDataset
+
+
+class StreamingDataLoader(GradientStateDataLoaderMixin):
+    """A data loader for a streaming dataset that is already split between distributed processes.
+
+    This intentionally does not subclass DataLoader, so that `accelerator.prepare(...)` returns it unchanged. For an
+    IterableDataset, accelerate would otherwise either load every batch on the main process and dispatch it to the other
+    processes, or have every process read the full stream and discard the examples of the other processes. Instead,
+    batches are moved to the device of the current process as they are loaded.
+
+    The number of batches in a pass over a stream is not known exactly up front, and can differ between processes. So,
+    each epoch yields exactly `num_batches` batches: the stream is truncated, or restarted (with the next shuffle order)
+    if it runs out early. This ensures that all processes take the same number of steps, which is required to keep
+    their gradient synchronization in lockstep. The last batch of each epoch is flagged to accelerate's GradientState
+    (see `GradientStateDataLoaderMixin`).
+    """
+
+    # There is no batch sampler, since batches are formed while streaming. This attribute mirrors DataLoader.
+    batch_sampler = None
+
+    def __init__(
+        self,
+        data_loader: DataLoader,
+        dataset: StreamingDataset,
+        num_batches: int,
+        device: torch.device | str | None = None,
+    ):
+        """Initialize StreamingDataLoader.
+
+        Args:
+            data_loader (DataLoader): The underlying DataLoader, which yields complete batches.
+            dataset (StreamingDataset): The streaming dataset, so that its epoch can be advanced.
+            num_batches (int): The number of batches per epoch.
+            device (torch.device | str, optional): The device to move batches to. Defaults to the device of the
+                current accelerate process.
+        """
+        self._data_loader = data_loader
+        self._dataset = dataset
+        self._num_batches = num_batches
+        self._device = device
+        self._epoch = 0
+
+    def __len__(self) -> int:
+        return self._num_batches
+
+    def __iter__(self) -> typing.Iterator[typing.Any]:
+        return self._iter_with_gradient_state(self._iter_batches())
+
+    def _iter_batches(self) -> typing.Iterator[typing.Any]:
+        device = self._device if self._device is not None else PartialState().device
+        num_yielded = 0
+        while num_yielded < self._num_batches:
+            # Each pass over the stream uses a new shuffle order.
+            self._dataset.set_epoch(self._epoch)
+            self._epoch += 1
+
+            num_yielded_in_pass = 0
+            for data_batch in self._data_loader:
+                yield send_to_device(data_batch, device)
+                num_yielded += 1
+                num_yielded_in_pass += 1
+                if num_yielded == self._num_batches:
+                    return
+
+            if num_yielded_in_pass == 0:
+                raise RuntimeError("The streaming dataset is empty.")
+
+
+def build_streaming_data_loader(
+    dataset: StreamingDataset,
+    transforms: list[TransformType],
+    batch_size: int,
+    collate_fn: typing.Callable[[list[typing.Any]], typing.Any],
+    bucket_buffer_size: int,
+    num_workers: int = 0,
+) -> StreamingDataLoader:
+    """Build a StreamingDataLoader that applies `transforms` to each example of a streaming dataset, and then groups the
+    examples into batches of examples with the same image resolution (see `BucketBatchIterableDataset`).
+
+    The number of batches per epoch is estimated from the number of examples in the dataset, assuming full batches.
+
+    Raises:
+        ValueError: If the number of examples in the dataset is unknown.
+    """
+    if dataset.num_examples is None:
+        raise ValueError(
+            "The number of examples in the streaming dataset is unknown, so the number of batches per epoch can't be "
+            "determined. Set `streaming_num_examples` in the dataset config."
+        )
+
+    batched_dataset = BucketBatchIterableDataset(
+        TransformIterableDataset(dataset, transforms),
+        batch_size=batch_size,
+        buffer_size=max(bucket_buffer_size, batch_size),
+    )
+    data_loader = DataLoader(batched_dataset, batch_size=None, collate_fn=collate_fn, num_workers=num_workers)
+    return StreamingDataLoader(data_loader, dataset=dataset, num_batches=math.ceil(dataset.num_examples / batch_size))
@@ -4,8 +4,14 @@ from torch.utils.data import DataLoader
 
 from invoke_training._shared.data.data_loaders.image_caption_sd_dataloader import (
     build_aspect_ratio_bucket_manager,
+    get_cached_vae_output_fields,
+    get_partial_batch_strategy,
+    has_random_augmentations,
     sd_image_caption_collate_fn,
+    wrap_collate_fn_for_batch_sampler,
 )
+from invoke_training._shared.data.data_loaders.sharded_data_loader import ShardedDataLoader, get_batch_sampler_shard
+from invoke_training._shared.data.datasets.aspect_ratio_bucket_field_dataset import AspectRatioBucketFieldDataset
 from invoke_training._shared.data.datasets.build_dataset import (
     build_hf_hub_image_caption_dataset,
     build_image_caption_dir_dataset,
@@ -18,9 +24,10 @@ from invoke_training._shared.data.transforms.concat_fields_transform import Conc
 from invoke_training._shared.data.transforms.drop_field_transform import DropFieldTransform
 from invoke_training._shared.data.transforms.load_cache_transform import LoadCacheTransform
 from invoke_training._shared.data.transforms.sd_image_transform import SDImageTransform
+from invoke_training._shared.data.transforms.select_random_variant_transform import SelectRandomVariantTransform
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import open_tensor_disk_cache
 from invoke_training._shared.data.transforms.shuffle_caption_transform import ShuffleCaptionTransform
 from invoke_training._shared.data.transforms.template_caption_transform import TemplateCaptionTransform
-from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
 from invoke_training.config.data.data_loader_config import TextualInversionSDDataLoaderConfig
 from invoke_training.config.data.dataset_config import (
     HFHubImageCaptionDatasetConfig,
@@ -101,7 +108,8 @@ def build_textual_inversion_sd_dataloader(  # noqa: C901
     use_masks: bool = False,
     vae_output_cache_dir: Optional[str] = None,
     shuffle: bool = True,
-) -> DataLoader:
+    generate_augmentation_variants: bool = False,
+) -> DataLoader | ShardedDataLoader:
     """Construct a DataLoader for a Textual Inversion dataset for Stable Diffusion.
 
     Args:
@@ -111,6 +119,9 @@ def build_textual_inversion_sd_dataloader(  # noqa: C901
         vae_output_cache_dir (str, optional): The directory where VAE outputs are cached and should be loaded from. If
             set, then the image augmentation transforms will be skipped, and the image will not be copied to VRAM.
         shuffle (bool, optional): Whether to shuffle the dataset order.
+        generate_augmentation_variants (bool, optional): If True, and random augmentations are enabled, produce all of
+            the cached augmentation variants of each image rather than a single randomly-augmented image. This is
+            intended to be used when populating a VAE output cache.
     Returns:
         DataLoader
     """
@@ -122,7 +133,13 @@ def build_textual_inversion_sd_dataloader(  # noqa: C901
         base_dataset = build_image_caption_dir_dataset(config.dataset)
     elif isinstance(config.dataset, ImageDirDatasetConfig):
         base_dataset = ImageDirDataset(
-            image_dir=config.dataset.dataset_dir, keep_in_memory=config.dataset.keep_in_memory
+            image_dir=config.dataset.dataset_dir,
+            keep_in_memory=config.dataset.keep_in_memory,
+            keep_in_memory_max_mb=config.dataset.keep_in_memory_max_mb,
+            keep_in_memory_format=config.dataset.keep_in_memory_format,
+            keep_in_memory_shared=config.dataset.keep_in_memory_shared,
+            image_probe_num_workers=config.dataset.image_probe_num_workers,
+            image_probe_executor=config.dataset.image_probe_executor,
         )
     else:
         raise ValueError(f"Unexpected dataset config type: '{type(config.dataset)}'.")
@@ -135,6 +152,7 @@ def build_textual_inversion_sd_dataloader(  # noqa: C901
     else:
         target_resolution = None
         aspect_ratio_bucket_manager = build_aspect_ratio_bucket_manager(config=config.aspect_ratio_buckets)
+        num_replicas, rank = get_batch_sampler_shard(shuffle)
         # TODO(ryand): Drill-down the seed parameter rather than hard-coding to 0 here.
         batch_sampler = AspectRatioBucketBatchSampler.from_image_sizes(
             bucket_manager=aspect_ratio_bucket_manager,
@@ -142,6 +160,10 @@ def build_textual_inversion_sd_dataloader(  # noqa: C901
             batch_size=batch_size,
             shuffle=shuffle,
             seed=0,
+            max_pixels_per_batch=config.aspect_ratio_buckets.max_pixels_per_batch,
+            partial_batches=get_partial_batch_strategy(config.aspect_ratio_buckets, shuffle),
+            num_replicas=num_replicas,
+            rank=rank,
         )
 
     if sum([config.caption_templates is not None, config.caption_preset is not None]) != 1:
@@ -192,6 +214,9 @@ def build_textual_inversion_sd_dataloader(  # noqa: C901
                 aspect_ratio_bucket_manager=aspect_ratio_bucket_manager,
                 center_crop=config.center_crop,
                 random_flip=config.random_flip,
+                num_crop_variants=config.num_cached_random_crops
+                if generate_augmentation_variants and has_random_augmentations(config)
+                else None,
             )
         )
     else:
@@ -199,7 +224,7 @@ def build_textual_inversion_sd_dataloader(  # noqa: C901
         all_transforms.append(DropFieldTransform("image"))
         all_transforms.append(DropFieldTransform("mask"))
 
-        vae_cache = TensorDiskCache(vae_output_cache_dir)
+        vae_cache = open_tensor_disk_cache(vae_output_cache_dir)
 
         cache_field_to_output_field = {
             "vae_output": "vae_output",
@@ -214,9 +239,15 @@ def build_textual_inversion_sd_dataloader(  # noqa: C901
                 cache=vae_cache,
                 cache_key_field="id",
                 cache_field_to_output_field=cache_field_to_output_field,
+                optional_cache_field_to_output_field={"vae_output_std": "vae_output_std"},
             )
         )
+        if has_random_augmentations(config):
+            all_transforms.append(SelectRandomVariantTransform(get_cached_vae_output_fields(use_masks)))
 
+    if batch_sampler is not None and vae_output_cache_dir is None:
+        # Pass the bucket that the sampler assigned to each example to the image transform.
+        base_dataset = AspectRatioBucketFieldDataset(base_dataset, batch_sampler.bucket_assignment)
     dataset = TransformDataset(base_dataset, all_transforms)
 
     if batch_sampler is None:
@@ -229,10 +260,13 @@ def build_textual_inversion_sd_dataloader(  # noqa: C901
             persistent_workers=config.dataloader_num_workers > 0,
         )
     else:
-        return DataLoader(
+        data_loader = DataLoader(
             dataset,
             batch_sampler=batch_sampler,
-            collate_fn=sd_image_caption_collate_fn,
+            collate_fn=wrap_collate_fn_for_batch_sampler(sd_image_caption_collate_fn, batch_sampler, batch_size),
             num_workers=config.dataloader_num_workers,
             persistent_workers=config.dataloader_num_workers > 0,
         )
+        if batch_sampler.num_replicas > 1:
+            return ShardedDataLoader(data_loader)
+        return data_loader
@@ -0,0 +1,41 @@
+import typing
+
+import torch.utils.data
+
+from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketAssignment
+
+# The default field name for the aspect ratio bucket resolution of an example. This is the field read by
+# SDImageTransform and FluxImageTransform.
+ASPECT_RATIO_BUCKET_FIELD_NAME = "aspect_ratio_bucket"
+
+
+class AspectRatioBucketFieldDataset(torch.utils.data.Dataset):
+    """A Dataset that wraps a base dataset and adds the pre-computed aspect ratio bucket resolution of each example.
+
+    This lets the image transforms use the bucket that was assigned by the batch sampler, rather than re-computing it
+    from the image size. It also guarantees that the transforms and the sampler agree on each example's bucket.
+    """
+
+    def __init__(
+        self,
+        base_dataset: torch.utils.data.Dataset,
+        bucket_assignment: AspectRatioBucketAssignment,
+        field_name: str = ASPECT_RATIO_BUCKET_FIELD_NAME,
+    ):
+        super().__init__()
+        if len(base_dataset) != len(bucket_assignment):
+            raise ValueError(
+                f"The bucket assignment has {len(bucket_assignment)} entries, but the dataset has {len(base_dataset)} "
+                "examples."
+            )
+        self._base_dataset = base_dataset
+        self._bucket_assignment = bucket_assignment
+        self._field_name = field_name
+
+    def __len__(self) -> int:
+        return len(self._base_dataset)
+
+    def __getitem__(self, idx: int) -> typing.Dict[str, typing.Any]:
+        example = self._base_dataset[idx]
+        example[self._field_name] = self._bucket_assignment[idx]
+        return example
@@ -0,0 +1,76 @@
+import typing
+
+import torch.utils.data
+
+from invoke_training._shared.data.datasets.transform_dataset import DataType
+
+
+def get_image_shape_bucket(example: DataType) -> typing.Hashable:
+    """Get the bucket of an example from the shape of its (transformed) image tensor."""
+    return tuple(example["image"].shape[-2:])
+
+
+class BucketBatchIterableDataset(torch.utils.data.IterableDataset):
+    """An IterableDataset that groups the examples of a base iterable dataset into batches of examples that belong to
+    the same bucket (e.g. the same aspect ratio bucket resolution).
+
+    This is an approximation of AspectRatioBucketBatchSampler for streaming datasets, where the full bucket map can't be
+    built up front. Examples are held in a buffer, grouped by bucket, and a batch is yielded as soon as a bucket holds
+    `batch_size` examples. If the buffer fills up before any bucket does, the fullest bucket is yielded as a partial
+    batch, so that examples from rare buckets don't accumulate indefinitely. At the end of the stream, the remaining
+    examples are yielded as partial batches.
+
+    Each item yielded by this dataset is a list of examples, so it should be used with `DataLoader(batch_size=None)`.
+    """
+
+    def __init__(
+        self,
+        base_dataset: torch.utils.data.IterableDataset,
+        batch_size: int,
+        buffer_size: int,
+        get_bucket_fn: typing.Callable[[DataType], typing.Hashable] = get_image_shape_bucket,
+        drop_last: bool = False,
+    ):
+        """Initialize BucketBatchIterableDataset.
+
+        Args:
+            base_dataset (torch.utils.data.IterableDataset): The dataset to batch.
+            batch_size (int): The batch size.
+            buffer_size (int): The maximum number of examples to hold in the buffer. Must be at least `batch_size`.
+                Larger buffers produce fewer partial batches, at the cost of memory.
+            get_bucket_fn (typing.Callable[[DataType], typing.Hashable], optional): A function that returns the bucket
+                of an example.
+            drop_last (bool, optional): If True, partial batches are dropped rather than yielded.
+        """
+        super().__init__()
+        if buffer_size < batch_size:
+            raise ValueError(f"buffer_size ({buffer_size}) must be at least batch_size ({batch_size}).")
+        self._base_dataset = base_dataset
+        self._batch_size = batch_size
+        self._buffer_size = buffer_size
+        self._get_bucket_fn = get_bucket_fn
+        self._drop_last = drop_last
+
+    def __iter__(self) -> typing.Iterator[list[DataType]]:
+        buckets: dict[typing.Hashable, list[DataType]] = {}
+        num_buffered = 0
+
+        for example in self._base_dataset:
+            key = self._get_bucket_fn(example)
+            buckets.setdefault(key, []).append(example)
+            num_buffered += 1
+
+            if len(buckets[key]) < self._batch_size:
+                if num_buffered < self._buffer_size:
+                    continue
+                # The buffer is full, so flush the fullest bucket.
+                key = max(buckets, key=lambda k: len(buckets[k]))
+
+            batch = buckets.pop(key)
+            num_buffered -= len(batch)
+            if len(batch) == self._batch_size or not self._drop_last:
+                yield batch
+
+        if not self._drop_last:
+            for batch in buckets.values():
+                yield batch
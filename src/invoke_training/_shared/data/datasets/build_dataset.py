@@ -1,26 +1,62 @@
+import typing
+
+from accelerate import PartialState
 from datasets import VerificationMode
 
 from invoke_training._shared.data.datasets.hf_image_caption_dataset import HFImageCaptionDataset
 from invoke_training._shared.data.datasets.hf_image_pair_preference_dataset import HFImagePairPreferenceDataset
+from invoke_training._shared.data.datasets.hf_streaming_image_caption_dataset import HFStreamingImageCaptionDataset
 from invoke_training._shared.data.datasets.image_caption_dir_dataset import ImageCaptionDirDataset
 from invoke_training._shared.data.datasets.image_caption_jsonl_dataset import ImageCaptionJsonlDataset
+from invoke_training._shared.data.datasets.image_caption_tar_shard_dataset import (
+    ImageCaptionTarShardDataset,
+    expand_shard_paths,
+)
 from invoke_training.config.data.dataset_config import (
     HFHubImageCaptionDatasetConfig,
     ImageCaptionDirDatasetConfig,
     ImageCaptionJsonlDatasetConfig,
+    ImageCaptionTarShardDatasetConfig,
 )
 from invoke_training.pipelines._experimental.sd_dpo_lora.config import HFHubImagePairPreferenceDatasetConfig
 
 
 def build_hf_hub_image_caption_dataset(config: HFHubImageCaptionDatasetConfig) -> HFImageCaptionDataset:
+    if config.streaming:
+        raise ValueError("Streaming datasets are not supported by this pipeline.")
     return HFImageCaptionDataset.from_hub(
         dataset_name=config.dataset_name,
+        hf_load_dataset_kwargs={
+            "name": config.dataset_config_name,
+            "revision": config.revision,
+            "cache_dir": config.hf_cache_dir,
+        },
+        image_column=config.image_column,
+        caption_column=config.caption_column,
+        image_probe_num_workers=config.image_probe_num_workers,
+        image_probe_executor=config.image_probe_executor,
+    )
+
+
+def build_hf_hub_streaming_image_caption_dataset(
+    config: HFHubImageCaptionDatasetConfig, shuffle: bool = True, seed: int = 0
+) -> HFStreamingImageCaptionDataset:
+    """Build a HFStreamingImageCaptionDataset that is split between all accelerate processes."""
+    state = PartialState()
+    return HFStreamingImageCaptionDataset.from_hub(
+        dataset_name=config.dataset_name,
+        revision=config.revision,
         hf_load_dataset_kwargs={
             "name": config.dataset_config_name,
             "cache_dir": config.hf_cache_dir,
         },
         image_column=config.image_column,
         caption_column=config.caption_column,
+        rank=state.process_index,
+        world_size=state.num_processes,
+        num_examples=config.streaming_num_examples,
+        shuffle_buffer_size=config.streaming_shuffle_buffer_size if shuffle else None,
+        seed=seed,
     )
 
 
@@ -30,6 +66,58 @@ def build_image_caption_jsonl_dataset(config: ImageCaptionJsonlDatasetConfig) ->
         image_column=config.image_column,
         caption_column=config.caption_column,
         keep_in_memory=config.keep_in_memory,
+        keep_in_memory_max_mb=config.keep_in_memory_max_mb,
+        keep_in_memory_format=config.keep_in_memory_format,
+        keep_in_memory_shared=config.keep_in_memory_shared,
+        image_probe_num_workers=config.image_probe_num_workers,
+        image_probe_executor=config.image_probe_executor,
+        lazy_load=config.lazy_load,
+    )
+
+
+def build_image_caption_tar_shard_dataset(
+    config: ImageCaptionTarShardDatasetConfig, shuffle: bool = True, seed: int = 0
+) -> ImageCaptionTarShardDataset:
+    """Build an ImageCaptionTarShardDataset that is split between all accelerate processes."""
+    state = PartialState()
+    return ImageCaptionTarShardDataset(
+        shard_paths=expand_shard_paths(config.shards),
+        image_extensions=config.image_extensions,
+        caption_extension=config.caption_extension,
+        mask_extension=config.mask_extension,
+        rank=state.process_index,
+        world_size=state.num_processes,
+        num_examples=config.num_examples,
+        shuffle=shuffle,
+        shuffle_buffer_size=config.shuffle_buffer_size,
+        prefetch_size=config.prefetch_size,
+        seed=seed,
+    )
+
+
+def build_streaming_image_caption_dataset(
+    config: HFHubImageCaptionDatasetConfig | ImageCaptionTarShardDatasetConfig, shuffle: bool = True, seed: int = 0
+) -> HFStreamingImageCaptionDataset | ImageCaptionTarShardDataset:
+    """Build the streaming dataset for a config for which `is_streaming_dataset_config(config)` is True."""
+    if isinstance(config, ImageCaptionTarShardDatasetConfig):
+        return build_image_caption_tar_shard_dataset(config, shuffle=shuffle, seed=seed)
+    return build_hf_hub_streaming_image_caption_dataset(config, shuffle=shuffle, seed=seed)
+
+
+def get_streaming_bucket_buffer_size(config: HFHubImageCaptionDatasetConfig | ImageCaptionTarShardDatasetConfig) -> int:
+    """Get the aspect ratio bucketing buffer size of a streaming dataset config."""
+    if isinstance(config, ImageCaptionTarShardDatasetConfig):
+        return config.bucket_buffer_size
+    return config.streaming_bucket_buffer_size
+
+
+def is_streaming_dataset_config(config: typing.Any) -> bool:
+    """Check whether a dataset config produces a streaming (i.e. iterable, rather than random-access) dataset.
+
+    Streaming datasets do not support output caching, and are batched with `build_streaming_data_loader(...)`.
+    """
+    return isinstance(config, ImageCaptionTarShardDatasetConfig) or (
+        isinstance(config, HFHubImageCaptionDatasetConfig) and config.streaming
     )
 
 
@@ -37,6 +125,11 @@ def build_image_caption_dir_dataset(config: ImageCaptionDirDatasetConfig) -> Ima
     return ImageCaptionDirDataset(
         dataset_dir=config.dataset_dir,
         keep_in_memory=config.keep_in_memory,
+        keep_in_memory_max_mb=config.keep_in_memory_max_mb,
+        keep_in_memory_format=config.keep_in_memory_format,
+        keep_in_memory_shared=config.keep_in_memory_shared,
+        image_probe_num_workers=config.image_probe_num_workers,
+        image_probe_executor=config.image_probe_executor,
     )
 
 
@@ -3,8 +3,9 @@ import typing
 
 import datasets
 import torch.utils.data
-from PIL.Image import Image
 
+from invoke_training._shared.data.utils.image_dimension_index import ImageDimensionIndex
+from invoke_training._shared.data.utils.image_probing import ImageProbeExecutor, ImageSource, probe_image_dimensions
 from invoke_training._shared.data.utils.resolution import Resolution
 
 
@@ -15,7 +16,14 @@ class HFImageCaptionDataset(torch.utils.data.Dataset):
     (https://huggingface.co/docs/datasets/v2.4.0/en/image_load#imagefolder).
     """
 
-    def __init__(self, hf_dataset, image_column: str = "image", caption_column: str = "text"):
+    def __init__(
+        self,
+        hf_dataset,
+        image_column: str = "image",
+        caption_column: str = "text",
+        image_probe_num_workers: int | None = None,
+        image_probe_executor: ImageProbeExecutor = "thread",
+    ):
         column_names = hf_dataset["train"].column_names
         if image_column not in column_names:
             raise ValueError(
@@ -28,6 +36,9 @@ class HFImageCaptionDataset(torch.utils.data.Dataset):
             )
 
         self._image_column = image_column
+        self._raw_hf_dataset = hf_dataset["train"]
+        self._image_probe_num_workers = image_probe_num_workers
+        self._image_probe_executor = image_probe_executor
 
         def preprocess(examples):
             images = [image.convert("RGB") for image in examples[image_column]]
@@ -45,6 +56,8 @@ class HFImageCaptionDataset(torch.utils.data.Dataset):
         hf_load_dataset_kwargs: typing.Optional[dict[str, typing.Any]] = None,
         image_column: str = "image",
         caption_column: str = "text",
+        image_probe_num_workers: int | None = None,
+        image_probe_executor: ImageProbeExecutor = "thread",
     ):
         """Initialize a HFImageCaptionDataset from a Hugging Face ImageFolder dataset directory
         (https://huggingface.co/docs/datasets/v2.4.0/en/image_load#imagefolder).
@@ -54,6 +67,10 @@ class HFImageCaptionDataset(torch.utils.data.Dataset):
             hf_load_dataset_kwargs (dict[str, typing.Any], optional): kwargs to forward to `datasets.load_dataset(...)`.
             image_column (str, optional): The name of the image column in the dataset. Defaults to "image".
             caption_column (str, optional): The name of the caption column in the dataset. Defaults to "text".
+            image_probe_num_workers (int, optional): The number of workers used to read image headers in
+                `get_image_dimensions()`.
+            image_probe_executor (ImageProbeExecutor, optional): The type of worker pool used to read image headers in
+                `get_image_dimensions()`.
         """
         hf_load_dataset_kwargs = hf_load_dataset_kwargs or {}
         data_files = {"train": os.path.join(dataset_dir, "**")}
@@ -61,7 +78,13 @@ class HFImageCaptionDataset(torch.utils.data.Dataset):
         # https://huggingface.co/docs/datasets/v2.4.0/en/image_load#imagefolder
         hf_dataset = datasets.load_dataset("imagefolder", data_files=data_files, **hf_load_dataset_kwargs)
 
-        return cls(hf_dataset=hf_dataset, image_column=image_column, caption_column=caption_column)
+        return cls(
+            hf_dataset=hf_dataset,
+            image_column=image_column,
+            caption_column=caption_column,
+            image_probe_num_workers=image_probe_num_workers,
+            image_probe_executor=image_probe_executor,
+        )
 
     @classmethod
     def from_hub(
@@ -70,6 +93,8 @@ class HFImageCaptionDataset(torch.utils.data.Dataset):
         hf_load_dataset_kwargs: typing.Optional[dict[str, typing.Any]] = None,
         image_column: str = "image",
         caption_column: str = "text",
+        image_probe_num_workers: int | None = None,
+        image_probe_executor: ImageProbeExecutor = "thread",
     ):
         """Initialize a HFImageCaptionDataset from a Hugging Face Hub dataset.
 
@@ -78,26 +103,76 @@ class HFImageCaptionDataset(torch.utils.data.Dataset):
             hf_load_dataset_kwargs (dict[str, typing.Any], optional): kwargs to forward to `datasets.load_dataset(...)`.
             image_column (str, optional): The name of the image column in the dataset. Defaults to "image".
             caption_column (str, optional): The name of the caption column in the dataset. Defaults to "text".
+            image_probe_num_workers (int, optional): The number of workers used to read image headers in
+                `get_image_dimensions()`.
+            image_probe_executor (ImageProbeExecutor, optional): The type of worker pool used to read image headers in
+                `get_image_dimensions()`.
         """
         hf_load_dataset_kwargs = hf_load_dataset_kwargs or {}
         hf_dataset = datasets.load_dataset(dataset_name, **hf_load_dataset_kwargs)
 
-        return cls(hf_dataset=hf_dataset, image_column=image_column, caption_column=caption_column)
+        return cls(
+            hf_dataset=hf_dataset,
+            image_column=image_column,
+            caption_column=caption_column,
+            image_probe_num_workers=image_probe_num_workers,
+            image_probe_executor=image_probe_executor,
+        )
 
     def get_image_dimensions(self) -> list[Resolution]:
         """Get the dimensions of all images in the dataset.
 
-        TODO(ryand): Re-think this approach. For large datasets (e.g. streaming from S3) it doesn't make sense to
-        calculate this dynamically every time.
+        The dimensions are read from the image headers, without decoding the images. If the dataset is backed by cache
+        files, then the dimensions are stored in a sidecar index file next to them (keyed by the dataset fingerprint),
+        so that the images only have to be probed the first time.
         """
-        image_dims: list[Resolution] = []
-        for i in range(len(self._hf_dataset)):
-            example = self._hf_dataset[i]
-            image: Image = example[self._image_column]
-            image_dims.append(Resolution(image.height, image.width))
-
+        index_path = self._get_image_dimension_index_path()
+        index = None if index_path is None else ImageDimensionIndex(index_path)
+
+        image_dims: list[Resolution | None] = [
+            None if index is None else index.lookup(str(i)) for i in range(len(self._raw_hf_dataset))
+        ]
+
+        missing = [i for i, resolution in enumerate(image_dims) if resolution is None]
+        probed_dims = probe_image_dimensions(
+            self._iter_encoded_images(missing),
+            num_workers=self._image_probe_num_workers,
+            executor=self._image_probe_executor,
+        )
+        for i, resolution in zip(missing, probed_dims):
+            image_dims[i] = resolution
+            if index is not None:
+                index.update(str(i), resolution)
+
+        if index is not None:
+            index.save()
         return image_dims
 
+    def _iter_encoded_images(self, indices: list[int], batch_size: int = 1024) -> typing.Iterator[ImageSource]:
+        """Iterate over the images at `indices` without decoding them, yielding their encoded bytes or file paths."""
+        if len(indices) == 0:
+            return
+
+        # The arrow format skips the decoding that is applied by the datasets.Image feature.
+        subset = self._raw_hf_dataset.select(indices).select_columns([self._image_column]).with_format("arrow")
+        for table in subset.iter(batch_size=batch_size):
+            for image in table.column(self._image_column).to_pylist():
+                if isinstance(image, dict):
+                    # datasets.Image features are stored as {"bytes": ..., "path": ...}.
+                    yield image["bytes"] if image["bytes"] is not None else image["path"]
+                else:
+                    yield image
+
+    def _get_image_dimension_index_path(self) -> str | None:
+        cache_files = self._raw_hf_dataset.cache_files
+        if len(cache_files) == 0:
+            # The dataset is in memory, so there is nowhere to persist the index.
+            return None
+        return os.path.join(
+            os.path.dirname(cache_files[0]["filename"]),
+            f".image_dimensions_{self._raw_hf_dataset._fingerprint}_{self._image_column}.jsonl",
+        )
+
     def __len__(self) -> int:
         """Get the dataset length.
 
@@ -0,0 +1,132 @@
+import logging
+import math
+import os
+import typing
+
+import datasets
+import torch.utils.data
+from datasets.distributed import split_dataset_by_node
+
+logger = logging.getLogger(__name__)
+
+
+class HFStreamingImageCaptionDataset(torch.utils.data.IterableDataset):
+    """An image-caption dataset that streams examples from a Hugging Face dataset, rather than downloading and preparing
+    the whole dataset up front.
+
+    The stream is split between distributed processes: if the number of dataset shards (i.e. files) is divisible by the
+    number of processes, then each process reads a disjoint subset of the shards. Otherwise, each process reads all of
+    the shards and keeps every `world_size`-th example (see `datasets.distributed.split_dataset_by_node(...)`). Within a
+    process, `datasets` further splits the shards between DataLoader workers.
+    """
+
+    def __init__(
+        self,
+        hf_dataset: datasets.IterableDataset,
+        image_column: str = "image",
+        caption_column: str = "text",
+        rank: int = 0,
+        world_size: int = 1,
+        num_examples: int | None = None,
+        shuffle_buffer_size: int | None = None,
+        seed: int = 0,
+    ):
+        """Initialize HFStreamingImageCaptionDataset.
+
+        Args:
+            hf_dataset (datasets.IterableDataset): The streaming HF dataset.
+            image_column (str, optional): The name of the image column in the dataset.
+            caption_column (str, optional): The name of the caption column in the dataset.
+            rank (int, optional): The index of this process.
+            world_size (int, optional): The number of processes that the stream is split between.
+            num_examples (int, optional): The total number of examples in the dataset (across all processes), if known.
+            shuffle_buffer_size (int, optional): If set, shuffle the stream with a buffer of this many examples.
+            seed (int, optional): The shuffle seed. It is combined with the epoch (see `set_epoch(...)`).
+        """
+        super().__init__()
+        column_names = hf_dataset.column_names
+        # The column names of a streaming dataset are not always known before it is iterated.
+        if column_names is not None:
+            if image_column not in column_names:
+                raise ValueError(
+                    f"The image_column='{image_column}' is not in the set of dataset column names: '{column_names}'."
+                )
+            if caption_column not in column_names:
+                raise ValueError(
+                    f"The caption_column='{caption_column}' is not in the set of dataset column names: "
+                    f"'{column_names}'."
+                )
+
+        if world_size > 1:
+            hf_dataset = split_dataset_by_node(hf_dataset, rank=rank, world_size=world_size)
+        if shuffle_buffer_size is not None:
+            hf_dataset = hf_dataset.shuffle(seed=seed, buffer_size=shuffle_buffer_size)
+
+        self._hf_dataset = hf_dataset
+        self._image_column = image_column
+        self._caption_column = caption_column
+        self._rank = rank
+        self._world_size = world_size
+        self._num_examples = num_examples
+
+    @classmethod
+    def from_hub(
+        cls,
+        dataset_name: str,
+        revision: str | None = None,
+        hf_load_dataset_kwargs: typing.Optional[dict[str, typing.Any]] = None,
+        image_column: str = "image",
+        caption_column: str = "text",
+        **kwargs,
+    ):
+        """Initialize a HFStreamingImageCaptionDataset from the 'train' split of a Hugging Face Hub dataset.
+
+        Args:
+            dataset_name (str): The HF Hub dataset name (a.k.a. path).
+            revision (str, optional): The dataset revision to stream. Examples are read from the Hub while training, so
+                this should be a commit hash for every process (and every epoch) to read the same snapshot of the
+                dataset. If None, the latest revision of the default branch is streamed.
+            hf_load_dataset_kwargs (dict[str, typing.Any], optional): kwargs to forward to `datasets.load_dataset(...)`.
+            image_column (str, optional): The name of the image column in the dataset. Defaults to "image".
+            caption_column (str, optional): The name of the caption column in the dataset. Defaults to "text".
+            **kwargs: Forwarded to `HFStreamingImageCaptionDataset(...)`. If `num_examples` is not set, it is read from
+                the dataset info (when available).
+        """
+        if revision is None and not os.path.exists(dataset_name):
+            logger.warning(
+                f"Streaming the Hugging Face Hub dataset '{dataset_name}' without a pinned `revision`. If the dataset "
+                "is updated during training, then different processes or epochs may read different versions of it."
+            )
+        hf_load_dataset_kwargs = hf_load_dataset_kwargs or {}
+        hf_dataset = datasets.load_dataset(
+            dataset_name, split="train", streaming=True, revision=revision, **hf_load_dataset_kwargs
+        )
+
+        if kwargs.get("num_examples", None) is None and hf_dataset.info.splits is not None:
+            split_info = hf_dataset.info.splits.get("train", None)
+            if split_info is not None and split_info.num_examples > 0:
+                kwargs["num_examples"] = split_info.num_examples
+
+        return cls(hf_dataset=hf_dataset, image_column=image_column, caption_column=caption_column, **kwargs)
+
+    @property
+    def num_examples(self) -> int | None:
+        """The approximate number of examples streamed by this process, or None if unknown."""
+        if self._num_examples is None:
+            return None
+        return math.ceil(self._num_examples / self._world_size)
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch. This changes the shuffle order of the stream."""
+        self._hf_dataset.set_epoch(epoch)
+
+    def __iter__(self) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        for idx, example in enumerate(self._hf_dataset):
+            yield {
+                # Ids are unique within an epoch, but are not stable across epochs if the stream is shuffled.
+                "id": f"{self._rank}_{worker_id}_{idx}",
+                "image": example[self._image_column].convert("RGB"),
+                "caption": example[self._caption_column],
+            }
@@ -2,8 +2,20 @@ import os
 import typing
 
 import torch.utils.data
-from PIL import Image
 
+from invoke_training._shared.data.utils.image_decode_backend import (
+    DecodedImage,
+    ImageDecodeBackend,
+    decode_image_tensor,
+)
+from invoke_training._shared.data.utils.image_dimension_index import (
+    IMAGE_DIMENSION_INDEX_FILE_NAME,
+    get_image_file_dimensions,
+)
+from invoke_training._shared.data.utils.image_memory_cache import ImageMemoryCacheFormat, build_image_memory_cache
+from invoke_training._shared.data.utils.image_probing import ImageProbeExecutor
+from invoke_training._shared.data.utils.pre_resized_image_cache import PreResizedImageCache
+from invoke_training._shared.data.utils.reduced_size_decoding import open_image_reduced
 from invoke_training._shared.data.utils.resolution import Resolution
 
 
@@ -17,6 +29,11 @@ class ImageCaptionDirDataset(torch.utils.data.Dataset):
         image_extensions: typing.Optional[list[str]] = None,
         caption_extension: str = ".txt",
         keep_in_memory: bool = False,
+        keep_in_memory_max_mb: int | None = None,
+        keep_in_memory_format: ImageMemoryCacheFormat = "decoded",
+        keep_in_memory_shared: bool = False,
+        image_probe_num_workers: int | None = None,
+        image_probe_executor: ImageProbeExecutor = "thread",
     ):
         """Initialize an ImageDirDataset
 
@@ -27,9 +44,22 @@ class ImageCaptionDirDataset(torch.utils.data.Dataset):
                 case-sensitive). Defaults to [".jpg", ".jpeg", ".png"].
             keep_in_memory (bool, optional): If True, keep all images loaded in memory. This improves performance for
                 datasets that are small enough to be kept in memory.
+            keep_in_memory_max_mb (int, optional): The memory budget (in MiB) for the images that are kept in memory.
+                When it is exceeded, images are evicted. If None, all images are kept in memory.
+            keep_in_memory_format (ImageMemoryCacheFormat, optional): Whether images are kept in memory as decoded
+                pixels or as encoded image file bytes.
+            keep_in_memory_shared (bool, optional): If True, the images are kept in shared memory, so that they are
+                shared by all DataLoader worker processes. Requires `keep_in_memory_max_mb` to be set.
+            image_probe_num_workers (int, optional): The number of workers used to read image headers in
+                `get_image_dimensions()`.
+            image_probe_executor (ImageProbeExecutor, optional): The type of worker pool used to read image headers in
+                `get_image_dimensions()`.
         """
         super().__init__()
+        self._dataset_dir = dataset_dir
         self._id_prefix = id_prefix
+        self._image_probe_num_workers = image_probe_num_workers
+        self._image_probe_executor = image_probe_executor
         if image_extensions is None:
             image_extensions = [".jpg", ".jpeg", ".png"]
         image_extensions = [ext.lower() for ext in image_extensions]
@@ -55,34 +85,73 @@ class ImageCaptionDirDataset(torch.utils.data.Dataset):
         if len(missing_captions) > 0:
             raise Exception(f"The following expected caption files are missing: {missing_captions}")
 
-        self._images = None
+        self._image_cache = None
         if keep_in_memory:
-            self._images = []
-            for image_path in self._image_paths:
-                self._images.append(self._load_image(image_path))
+            self._image_cache = build_image_memory_cache(
+                num_entries=len(self._image_paths),
+                max_bytes=None if keep_in_memory_max_mb is None else keep_in_memory_max_mb * 2**20,
+                cache_format=keep_in_memory_format,
+                shared=keep_in_memory_shared,
+            )
+        self._pre_resized_image_cache: PreResizedImageCache | None = None
+        self._reduced_size_decoding_target: typing.Callable[[Resolution], Resolution] | None = None
+        self._image_decode_backend: ImageDecodeBackend = "pil"
 
-    def _load_image(self, image_path: str) -> Image.Image:
-        # We call `convert("RGB")` to drop the alpha channel from RGBA images, or to repeat channels for greyscale
-        # images.
-        return Image.open(image_path).convert("RGB")
+    def set_pre_resized_image_cache(self, pre_resized_image_cache: PreResizedImageCache | None):
+        """Load images through a PreResizedImageCache, rather than decoding the full-resolution source images.
+
+        Raises:
+            ValueError: If the dataset keeps images in memory, since the two caches can't be combined.
+        """
+        if pre_resized_image_cache is not None and self._image_cache is not None:
+            raise ValueError("A pre-resized image cache can't be used with `keep_in_memory`.")
+        self._pre_resized_image_cache = pre_resized_image_cache
+
+    def set_reduced_size_decoding(self, get_target_resolution: typing.Callable[[Resolution], Resolution] | None):
+        """Decode JPEG images at a reduced size when they are larger than their target resolution (see
+        `open_image_reduced(...)`).
+
+        Raises:
+            ValueError: If the dataset keeps images in memory, since in-memory images must be full-resolution.
+        """
+        if get_target_resolution is not None and self._image_cache is not None:
+            raise ValueError("Reduced-size decoding can't be used with `keep_in_memory`.")
+        self._reduced_size_decoding_target = get_target_resolution
+
+    def set_image_decode_backend(self, image_decode_backend: ImageDecodeBackend):
+        """Set the backend used to decode image files. With the "torchvision" backend, images are returned as uint8
+        tensors rather than PIL images. Images that are kept in memory or loaded from a pre-resized image cache are
+        always returned as PIL images.
+        """
+        self._image_decode_backend = image_decode_backend
+
+    def _load_image(self, idx: int) -> DecodedImage:
+        image_path = self._image_paths[idx]
+        if self._image_cache is not None:
+            return self._image_cache.load(idx, image_path, "RGB")
+        if self._pre_resized_image_cache is not None:
+            return self._pre_resized_image_cache.load(image_path, "RGB")
+        if self._image_decode_backend == "torchvision":
+            return decode_image_tensor(image_path, "RGB")
+        return open_image_reduced(image_path, "RGB", self._reduced_size_decoding_target)
 
     def get_image_dimensions(self) -> list[Resolution]:
         """Get the dimensions of all images in the dataset.
 
-        TODO(ryand): Re-think this approach. For large datasets (e.g. streaming from S3) it doesn't make sense to
-        calculate this dynamically every time.
+        The dimensions are stored in a sidecar index file in the dataset directory, so that only new or modified images
+        have to be opened on subsequent calls.
         """
-        image_dims: list[Resolution] = []
-        for i in range(len(self._image_paths)):
-            image_path = self._image_paths[i]
-            image = Image.open(image_path)
-            image_dims.append(Resolution(image.height, image.width))
-
-        return image_dims
+        index_path = os.path.join(self._dataset_dir, IMAGE_DIMENSION_INDEX_FILE_NAME)
+        return get_image_file_dimensions(
+            self._image_paths,
+            index_path=index_path,
+            num_workers=self._image_probe_num_workers,
+            executor=self._image_probe_executor,
+        )
 
     def __len__(self) -> int:
         return len(self._image_paths)
 
     def __getitem__(self, idx: int) -> typing.Dict[str, typing.Any]:
-        image = self._images[idx] if self._images is not None else self._load_image(self._image_paths[idx])
+        image = self._load_image(idx)
         return {"id": f"{self._id_prefix}{idx}", "image": image, "caption": self._captions[idx]}
@@ -1,12 +1,23 @@
+import collections.abc
 import typing
 from pathlib import Path
 
 import torch.utils.data
-from PIL import Image
 from pydantic import BaseModel
 
+from invoke_training._shared.data.utils.compact_string_array import CompactStringArrayBuilder
+from invoke_training._shared.data.utils.image_decode_backend import (
+    DecodedImage,
+    ImageDecodeBackend,
+    decode_image_tensor,
+)
+from invoke_training._shared.data.utils.image_dimension_index import get_image_file_dimensions
+from invoke_training._shared.data.utils.image_memory_cache import ImageMemoryCacheFormat, build_image_memory_cache
+from invoke_training._shared.data.utils.image_probing import ImageProbeExecutor
+from invoke_training._shared.data.utils.pre_resized_image_cache import PreResizedImageCache
+from invoke_training._shared.data.utils.reduced_size_decoding import open_image_reduced, open_mask_reduced
 from invoke_training._shared.data.utils.resolution import Resolution
-from invoke_training._shared.utils.jsonl import load_jsonl, save_jsonl
+from invoke_training._shared.utils.jsonl import IndexedJsonlFile, iter_jsonl, save_jsonl
 
 IMAGE_COLUMN_DEFAULT = "image"
 CAPTION_COLUMN_DEFAULT = "text"
@@ -19,6 +30,69 @@ class ImageCaptionExample(BaseModel):
     caption: str
 
 
+class ImageCaptionExampleList(collections.abc.Sequence):
+    """A compact list of ImageCaptionExamples.
+
+    The image paths, mask paths and captions are stored in CompactStringArrays rather than as one Python object per
+    example, so that the memory used by a dataset does not grow with the number of forked DataLoader workers. Examples
+    are created on access, so modifying a returned example does not modify the list. Instead, replace it with
+    `examples[idx] = ...`.
+
+    Examples that are replaced or appended after the list is built are stored as regular objects. This is intended for
+    small numbers of edits (e.g. in the Data UI).
+    """
+
+    def __init__(self, examples: typing.Iterable[ImageCaptionExample] = ()):
+        image_paths = CompactStringArrayBuilder()
+        mask_paths = CompactStringArrayBuilder()
+        captions = CompactStringArrayBuilder()
+        for example in examples:
+            image_paths.append(example.image_path)
+            mask_paths.append(example.mask_path)
+            captions.append(example.caption)
+        self._image_paths = image_paths.build()
+        self._mask_paths = mask_paths.build()
+        self._captions = captions.build()
+
+        self._replaced: dict[int, ImageCaptionExample] = {}
+        self._appended: list[ImageCaptionExample] = []
+
+    def _normalize_index(self, idx: int) -> int:
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Index {idx} is out of range for a list of {len(self)} examples.")
+        return idx
+
+    def __len__(self) -> int:
+        return len(self._captions) + len(self._appended)
+
+    def __getitem__(self, idx: int) -> ImageCaptionExample:
+        idx = self._normalize_index(idx)
+        if idx >= len(self._captions):
+            return self._appended[idx - len(self._captions)]
+        if idx in self._replaced:
+            return self._replaced[idx]
+        return ImageCaptionExample(
+            image_path=self._image_paths[idx], mask_path=self._mask_paths[idx], caption=self._captions[idx]
+        )
+
+    def __setitem__(self, idx: int, example: ImageCaptionExample):
+        idx = self._normalize_index(idx)
+        if idx >= len(self._captions):
+            self._appended[idx - len(self._captions)] = example
+        else:
+            self._replaced[idx] = example
+
+    def __eq__(self, other: typing.Any) -> bool:
+        if not isinstance(other, collections.abc.Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other, strict=True))
+
+    def append(self, example: ImageCaptionExample):
+        self._appended.append(example)
+
+
 class ImageCaptionJsonlDataset(torch.utils.data.Dataset):
     """A dataset that loads images and captions from a directory of image files and .txt files."""
 
@@ -28,29 +102,79 @@ class ImageCaptionJsonlDataset(torch.utils.data.Dataset):
         image_column: str = IMAGE_COLUMN_DEFAULT,
         caption_column: str = CAPTION_COLUMN_DEFAULT,
         keep_in_memory: bool = False,
+        keep_in_memory_max_mb: int | None = None,
+        keep_in_memory_format: ImageMemoryCacheFormat = "decoded",
+        keep_in_memory_shared: bool = False,
+        image_probe_num_workers: int | None = None,
+        image_probe_executor: ImageProbeExecutor = "thread",
+        lazy_load: bool = False,
     ):
+        """Initialize ImageCaptionJsonlDataset.
+
+        Args:
+            lazy_load (bool, optional): If True, rows are parsed from the jsonl file on demand (see IndexedJsonlFile),
+                rather than all being parsed up front. This makes startup much faster and uses much less memory for
+                very large jsonl files. `examples` is still available, but accessing it parses all rows.
+        """
         super().__init__()
         self._jsonl_path = Path(jsonl_path)
         self._image_column = image_column
         self._caption_column = caption_column
 
-        data = load_jsonl(jsonl_path)
-        examples: list[ImageCaptionExample] = []
-        for d in data:
-            # Clear error messages here are helpful in the Gradio UI.
-            if image_column not in d:
-                raise ValueError(f"Column '{image_column}' not found in jsonl file '{jsonl_path}'.")
-            if caption_column not in d:
-                raise ValueError(f"Column '{caption_column}' not found in jsonl file '{jsonl_path}'.")
-            examples.append(
-                ImageCaptionExample(
-                    image_path=d[image_column], mask_path=d.get(MASK_COLUMN_DEFAULT, None), caption=d[caption_column]
-                )
+        self._rows: IndexedJsonlFile | None = None
+        self._examples: ImageCaptionExampleList | None = None
+        if lazy_load:
+            self._rows = IndexedJsonlFile(jsonl_path)
+            if len(self._rows) > 0:
+                # Check the first row, so that a wrong column name fails early. Other rows are checked on access.
+                self._parse_example(self._rows[0])
+        else:
+            self._examples = ImageCaptionExampleList(self._parse_example(d) for d in iter_jsonl(jsonl_path))
+
+        # Masks are cached under the keys [len(self), 2 * len(self)).
+        self._image_cache = None
+        if keep_in_memory:
+            self._image_cache = build_image_memory_cache(
+                num_entries=2 * len(self),
+                max_bytes=None if keep_in_memory_max_mb is None else keep_in_memory_max_mb * 2**20,
+                cache_format=keep_in_memory_format,
+                shared=keep_in_memory_shared,
             )
-        self.examples = examples
+        self._pre_resized_image_cache: PreResizedImageCache | None = None
+        self._reduced_size_decoding_target: typing.Callable[[Resolution], Resolution] | None = None
+        self._image_decode_backend: ImageDecodeBackend = "pil"
+        self._image_probe_num_workers = image_probe_num_workers
+        self._image_probe_executor = image_probe_executor
+
+    def _parse_example(self, d: dict[str, typing.Any]) -> ImageCaptionExample:
+        # Clear error messages here are helpful in the Gradio UI.
+        if self._image_column not in d:
+            raise ValueError(f"Column '{self._image_column}' not found in jsonl file '{self._jsonl_path}'.")
+        if self._caption_column not in d:
+            raise ValueError(f"Column '{self._caption_column}' not found in jsonl file '{self._jsonl_path}'.")
+        return ImageCaptionExample(
+            image_path=d[self._image_column],
+            mask_path=d.get(MASK_COLUMN_DEFAULT, None),
+            caption=d[self._caption_column],
+        )
+
+    @property
+    def examples(self) -> ImageCaptionExampleList:
+        """All examples in the dataset. If the dataset was lazy-loaded, then all rows are parsed on first access."""
+        if self._examples is None:
+            self._examples = ImageCaptionExampleList(self._parse_example(d) for d in self._rows)
+            self._rows = None
+        return self._examples
+
+    def _get_example(self, idx: int) -> ImageCaptionExample:
+        if self._examples is not None:
+            return self._examples[idx]
+        return self._parse_example(self._rows[idx])
 
-        self._keep_in_memory = keep_in_memory
-        self._example_cache: dict[int, dict[str, typing.Any]] = {}
+    def _iter_examples(self) -> typing.Iterator[ImageCaptionExample]:
+        if self._examples is not None:
+            return iter(self._examples)
+        return (self._parse_example(d) for d in self._rows)
 
     def save_jsonl(self):
         data = []
@@ -64,65 +188,101 @@ class ImageCaptionJsonlDataset(torch.utils.data.Dataset):
             )
         save_jsonl(data, self._jsonl_path)
 
-    def _get_image_path(self, idx: int) -> str:
-        image_path = self.examples[idx].image_path
-        image_path = Path(image_path)
+    def _resolve_path(self, path: str) -> Path:
+        path = Path(path)
+        # Paths could be either absolute, or relative to the jsonl file.
+        if not path.is_absolute():
+            path = self._jsonl_path.parent / path
+        return path
 
-        # image_path could be either absolute, or relative to the jsonl file.
-        if not image_path.is_absolute():
-            image_path = self._jsonl_path.parent / image_path
+    def _get_image_path(self, idx: int) -> Path:
+        return self._resolve_path(self._get_example(idx).image_path)
 
-        return image_path
+    def _get_mask_path(self, idx: int) -> Path:
+        return self._resolve_path(self._get_example(idx).mask_path)
 
-    def _get_mask_path(self, idx: int) -> str:
-        mask_path = self.examples[idx].mask_path
-        mask_path = Path(mask_path)
+    def set_pre_resized_image_cache(self, pre_resized_image_cache: PreResizedImageCache | None):
+        """Load images through a PreResizedImageCache, rather than decoding the full-resolution source images.
 
-        # mask_path could be either absolute, or relative to the jsonl file.
-        if not mask_path.is_absolute():
-            mask_path = self._jsonl_path.parent / mask_path
+        Raises:
+            ValueError: If the dataset keeps images in memory, since the two caches can't be combined.
+        """
+        if pre_resized_image_cache is not None and self._image_cache is not None:
+            raise ValueError("A pre-resized image cache can't be used with `keep_in_memory`.")
+        self._pre_resized_image_cache = pre_resized_image_cache
+
+    def set_reduced_size_decoding(self, get_target_resolution: typing.Callable[[Resolution], Resolution] | None):
+        """Decode JPEG images at a reduced size when they are larger than their target resolution (see
+        `open_image_reduced(...)`).
+
+        Raises:
+            ValueError: If the dataset keeps images in memory, since in-memory images must be full-resolution.
+        """
+        if get_target_resolution is not None and self._image_cache is not None:
+            raise ValueError("Reduced-size decoding can't be used with `keep_in_memory`.")
+        self._reduced_size_decoding_target = get_target_resolution
 
-        return mask_path
+    def set_image_decode_backend(self, image_decode_backend: ImageDecodeBackend):
+        """Set the backend used to decode image files. With the "torchvision" backend, images are returned as uint8
+        tensors rather than PIL images. Images that are kept in memory or loaded from a pre-resized image cache are
+        always returned as PIL images.
+        """
+        self._image_decode_backend = image_decode_backend
 
-    def _load_image(self, image_path: str) -> Image.Image:
-        # We call `convert("RGB")` to drop the alpha channel from RGBA images, or to repeat channels for greyscale
-        # images.
-        return Image.open(image_path).convert("RGB")
+    def _load_image(self, idx: int) -> DecodedImage:
+        image_path = self._get_image_path(idx)
+        if self._image_cache is not None:
+            return self._image_cache.load(idx, image_path, "RGB")
+        if self._pre_resized_image_cache is not None:
+            return self._pre_resized_image_cache.load(image_path, "RGB")
+        if self._image_decode_backend == "torchvision":
+            return decode_image_tensor(image_path, "RGB")
+        return open_image_reduced(image_path, "RGB", self._reduced_size_decoding_target)
 
-    def _load_mask(self, mask_path: str) -> Image.Image:
-        return Image.open(mask_path).convert("L")
+    def _load_mask(self, idx: int, image: DecodedImage) -> DecodedImage:
+        mask_path = self._get_mask_path(idx)
+        if self._image_cache is not None:
+            return self._image_cache.load(len(self) + idx, mask_path, "L")
+        if self._pre_resized_image_cache is not None:
+            return self._pre_resized_image_cache.load(mask_path, "L")
+        if self._image_decode_backend == "torchvision":
+            return decode_image_tensor(mask_path, "L")
+        if self._reduced_size_decoding_target is not None:
+            # The image may have been decoded at a reduced size, so decode the mask at the same size.
+            return open_mask_reduced(mask_path, image, "L")
+        return open_image_reduced(mask_path, "L")
 
     def _load_example(self, idx: int) -> dict[str, typing.Any]:
+        image_caption_example = self._get_example(idx)
+        image = self._load_image(idx)
         example = {
             "id": str(idx),
-            "image": self._load_image(self._get_image_path(idx)),
-            "caption": self.examples[idx].caption,
+            "image": image,
+            "caption": image_caption_example.caption,
         }
-        if self.examples[idx].mask_path:
-            example["mask"] = self._load_mask(self._get_mask_path(idx))
+        if image_caption_example.mask_path:
+            example["mask"] = self._load_mask(idx, image)
         return example
 
     def get_image_dimensions(self) -> list[Resolution]:
         """Get the dimensions of all images in the dataset.
 
-        TODO(ryand): Re-think this approach. For large datasets (e.g. streaming from S3) it doesn't make sense to
-        calculate this dynamically every time.
+        The dimensions are stored in a sidecar index file next to the jsonl file, so that only new or modified images
+        have to be opened on subsequent calls.
         """
-        image_dims: list[Resolution] = []
-        for i in range(len(self.examples)):
-            image = Image.open(self._get_image_path(i))
-            image_dims.append(Resolution(image.height, image.width))
-
-        return image_dims
+        index_path = self._jsonl_path.parent / f".{self._jsonl_path.stem}.image_dimensions.jsonl"
+        image_paths = [self._resolve_path(example.image_path) for example in self._iter_examples()]
+        return get_image_file_dimensions(
+            image_paths,
+            index_path=str(index_path),
+            num_workers=self._image_probe_num_workers,
+            executor=self._image_probe_executor,
+        )
 
     def __len__(self) -> int:
-        return len(self.examples)
+        if self._examples is not None:
+            return len(self._examples)
+        return len(self._rows)
 
     def __getitem__(self, idx: int) -> typing.Dict[str, typing.Any]:
-        if self._keep_in_memory:
-            if idx not in self._example_cache:
-                self._example_cache[idx] = self._load_example(idx)
-            # Return a shallow copy of the example to prevent the caller from modifying the cached example.
-            # Shallow rather than deep, because we don't want to copy the image data.
-            return self._example_cache[idx].copy()
         return self._load_example(idx)
@@ -0,0 +1,304 @@
+import concurrent.futures
+import glob
+import io
+import logging
+import math
+import os
+import queue
+import random
+import re
+import tarfile
+import threading
+import time
+import typing
+
+import torch.utils.data
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# A raw sample from a tar shard: the sample id, and a map from file extension to file contents.
+_RawSample = tuple[str, dict[str, bytes]]
+
+_BRACE_RANGE_PATTERN = re.compile(r"\{(\d+)\.\.(\d+)\}")
+
+
+def expand_shard_paths(shard_patterns: list[str]) -> list[str]:
+    """Expand a list of shard path patterns into a list of shard paths.
+
+    Each pattern can contain a numeric brace range (e.g. 'shard-{0000..0099}.tar', following the WebDataset convention)
+    and/or glob wildcards (e.g. 'shards/*.tar'). The zero-padding of a brace range is preserved.
+
+    Raises:
+        ValueError: If a pattern does not match any files.
+    """
+    shard_paths: list[str] = []
+    for shard_pattern in shard_patterns:
+        patterns = [shard_pattern]
+        # Expand brace ranges one at a time, since a pattern could contain more than one.
+        while _BRACE_RANGE_PATTERN.search(patterns[0]):
+            expanded = []
+            for pattern in patterns:
+                match = _BRACE_RANGE_PATTERN.search(pattern)
+                start, end = match.group(1), match.group(2)
+                for i in range(int(start), int(end) + 1):
+                    expanded.append(pattern[: match.start()] + str(i).zfill(len(start)) + pattern[match.end() :])
+            patterns = expanded
+
+        for pattern in patterns:
+            if glob.has_magic(pattern):
+                matches = sorted(glob.glob(pattern))
+                if len(matches) == 0:
+                    raise ValueError(f"The shard pattern '{pattern}' did not match any files.")
+                shard_paths.extend(matches)
+            else:
+                shard_paths.append(pattern)
+    return shard_paths
+
+
+def _split_member_name(member_name: str) -> tuple[str, str]:
+    """Split a tar member name into a sample key and a file extension, following the WebDataset convention. The
+    extension is everything after the first '.' in the file name (e.g. 'a/b.mask.png' -> ('a/b', 'mask.png')).
+    """
+    dir_name, file_name = os.path.split(member_name)
+    stem, _, extension = file_name.partition(".")
+    return os.path.join(dir_name, stem), extension.lower()
+
+
+def _iter_raw_samples(shard_path: str) -> typing.Iterator[_RawSample]:
+    """Iterate over the samples in a tar shard. The files of a sample must be stored consecutively in the shard.
+
+    Sample ids are prefixed with the shard file name, since sample keys are often only unique within a shard.
+    """
+    shard_name = os.path.basename(shard_path)
+    key = None
+    files: dict[str, bytes] = {}
+    # Open in streaming mode ('r|'), so that the shard is read sequentially without seeking.
+    with tarfile.open(shard_path, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, extension = _split_member_name(member.name)
+            if member_key != key:
+                if key is not None:
+                    yield f"{shard_name}/{key}", files
+                key = member_key
+                files = {}
+            files[extension] = tar.extractfile(member).read()
+    if key is not None:
+        yield f"{shard_name}/{key}", files
+
+
+def _count_shard_samples(shard_path: str, image_extensions: typing.Collection[str]) -> int:
+    """Count the samples with an image in a tar shard. Only the tar headers are read."""
+    keys = set()
+    with tarfile.open(shard_path, mode="r:*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, extension = _split_member_name(member.name)
+            if extension in image_extensions:
+                keys.add(member_key)
+    return len(keys)
+
+
+def count_tar_shard_samples(
+    shard_paths: list[str], image_extensions: typing.Collection[str], num_workers: int | None = None
+) -> int:
+    """Count the samples with an image in a list of tar shards. The shards are read in parallel, since this is typically
+    limited by storage latency.
+    """
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        num_samples = sum(executor.map(lambda p: _count_shard_samples(p, image_extensions), shard_paths))
+    logger.info(f"Counted {num_samples} samples in {len(shard_paths)} tar shards in {time.time() - start_time:.1f}s.")
+    return num_samples
+
+
+class _PrefetchError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_PREFETCH_END = object()
+
+
+def _prefetch(items: typing.Iterator[typing.Any], prefetch_size: int) -> typing.Iterator[typing.Any]:  # noqa: C901
+    """Read up to `prefetch_size` items ahead of the consumer on a background thread."""
+    item_queue: queue.Queue = queue.Queue(maxsize=prefetch_size)
+    stop_event = threading.Event()
+
+    def put(item) -> bool:
+        while not stop_event.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(_PREFETCH_END)
+        except BaseException as e:
+            put(_PrefetchError(e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = item_queue.get()
+            if item is _PREFETCH_END:
+                return
+            if isinstance(item, _PrefetchError):
+                raise item.error
+            yield item
+    finally:
+        # Stop the producer if the consumer exits early.
+        stop_event.set()
+
+
+def _shuffle(items: typing.Iterator[typing.Any], buffer_size: int, rng: random.Random) -> typing.Iterator[typing.Any]:
+    """Shuffle a stream of items with a buffer of `buffer_size` items."""
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        idx = rng.randrange(buffer_size)
+        yield buffer[idx]
+        buffer[idx] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class ImageCaptionTarShardDataset(torch.utils.data.IterableDataset):
+    """An image-caption dataset that reads samples sequentially from tar shards (i.e. the WebDataset format).
+
+    Each sample is a group of consecutive files in a shard that share a key (the file name up to the first '.'). E.g.
+    'a/0001.jpg', 'a/0001.txt' and 'a/0001.mask.png' form a sample with an image, a caption and a mask. Reading whole
+    shards sequentially avoids the per-file open latency of random-access datasets, which dominates data loading on
+    network storage.
+
+    The shards are split between distributed processes and DataLoader workers. If there are fewer shards than
+    `world_size * num_workers`, then every process and worker reads all of the shards and keeps every
+    `world_size * num_workers`-th sample.
+    """
+
+    def __init__(
+        self,
+        shard_paths: list[str],
+        image_extensions: typing.Collection[str] = ("jpg", "jpeg", "png", "webp"),
+        caption_extension: str = "txt",
+        mask_extension: str = "mask.png",
+        rank: int = 0,
+        world_size: int = 1,
+        num_examples: int | None = None,
+        shuffle: bool = False,
+        shuffle_buffer_size: int = 1000,
+        prefetch_size: int = 0,
+        seed: int = 0,
+    ):
+        """Initialize ImageCaptionTarShardDataset.
+
+        Args:
+            shard_paths (list[str]): The paths of the tar shards.
+            image_extensions (typing.Collection[str], optional): The file extensions of sample images.
+            caption_extension (str, optional): The file extension of sample captions.
+            mask_extension (str, optional): The file extension of (optional) sample masks.
+            rank (int, optional): The index of this process.
+            world_size (int, optional): The number of processes that the shards are split between.
+            num_examples (int, optional): The total number of samples in the shards (across all processes). If None,
+                the samples are counted from the tar headers.
+            shuffle (bool, optional): If True, shuffle the shard order and shuffle samples with a buffer of
+                `shuffle_buffer_size` samples. Both are re-shuffled each epoch (see `set_epoch(...)`).
+            shuffle_buffer_size (int, optional): The number of samples in the shuffle buffer.
+            prefetch_size (int, optional): If > 0, read up to this many samples ahead on a background thread, so that
+                storage latency overlaps with image decoding and the training step.
+            seed (int, optional): The shuffle seed.
+        """
+        super().__init__()
+        if len(shard_paths) == 0:
+            raise ValueError("At least one tar shard must be provided.")
+        self._shard_paths = shard_paths
+        self._image_extensions = tuple(e.lower() for e in image_extensions)
+        self._caption_extension = caption_extension.lower()
+        self._mask_extension = mask_extension.lower()
+        self._rank = rank
+        self._world_size = world_size
+        if num_examples is None:
+            num_examples = count_tar_shard_samples(shard_paths, self._image_extensions)
+        self._num_examples = num_examples
+        self._shuffle = shuffle
+        self._shuffle_buffer_size = shuffle_buffer_size
+        self._prefetch_size = prefetch_size
+        self._seed = seed
+        self._epoch = 0
+
+    @property
+    def num_examples(self) -> int:
+        """The approximate number of examples read by this process."""
+        return math.ceil(self._num_examples / self._world_size)
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch. This changes the shuffle order of the shards and samples."""
+        self._epoch = epoch
+
+    def _iter_split_raw_samples(
+        self, shard_paths: list[str], split: int, num_splits: int
+    ) -> typing.Iterator[_RawSample]:
+        if len(shard_paths) >= num_splits:
+            for shard_path in shard_paths[split::num_splits]:
+                yield from _iter_raw_samples(shard_path)
+        else:
+            sample_idx = 0
+            for shard_path in shard_paths:
+                for raw_sample in _iter_raw_samples(shard_path):
+                    if sample_idx % num_splits == split:
+                        yield raw_sample
+                    sample_idx += 1
+
+    def _decode_sample(self, key: str, files: dict[str, bytes]) -> dict[str, typing.Any] | None:
+        image_bytes = next((files[e] for e in self._image_extensions if e in files), None)
+        if image_bytes is None:
+            return None
+
+        example = {
+            "id": key,
+            # We call `convert("RGB")` to drop the alpha channel from RGBA images, or to repeat channels for greyscale
+            # images.
+            "image": Image.open(io.BytesIO(image_bytes)).convert("RGB"),
+            "caption": files.get(self._caption_extension, b"").decode("utf-8").strip(),
+        }
+        if self._mask_extension in files:
+            example["mask"] = Image.open(io.BytesIO(files[self._mask_extension])).convert("L")
+        return example
+
+    def __iter__(self) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        worker_id = 0 if worker_info is None else worker_info.id
+
+        # All processes and workers use the same shard order, so that the split is consistent between them.
+        rng = random.Random(self._seed + self._epoch)
+        shard_paths = list(self._shard_paths)
+        if self._shuffle:
+            rng.shuffle(shard_paths)
+
+        raw_samples = self._iter_split_raw_samples(
+            shard_paths, split=self._rank * num_workers + worker_id, num_splits=self._world_size * num_workers
+        )
+        if self._prefetch_size > 0:
+            raw_samples = _prefetch(raw_samples, self._prefetch_size)
+        if self._shuffle:
+            # Each split shuffles its samples differently.
+            sample_rng = random.Random(hash((self._seed, self._epoch, self._rank, worker_id)))
+            raw_samples = _shuffle(raw_samples, self._shuffle_buffer_size, sample_rng)
+
+        for key, files in raw_samples:
+            example = self._decode_sample(key, files)
+            if example is not None:
+                yield example
@@ -3,8 +3,14 @@ import typing
 from pathlib import Path
 
 import torch.utils.data
-from PIL import Image
 
+from invoke_training._shared.data.utils.image_decode_backend import (
+    DecodedImage,
+    ImageDecodeBackend,
+    decode_image_tensor,
+)
+from invoke_training._shared.data.utils.reduced_size_decoding import open_image_reduced
+from invoke_training._shared.data.utils.resolution import Resolution
 from invoke_training._shared.utils.jsonl import load_jsonl, save_jsonl
 
 
@@ -14,6 +20,25 @@ class ImagePairPreferenceDataset(torch.utils.data.Dataset):
         self._dataset_dir = dataset_dir
 
         self._metadata = load_jsonl(Path(dataset_dir) / "metadata.jsonl")
+        self._reduced_size_decoding_target: typing.Callable[[Resolution], Resolution] | None = None
+        self._image_decode_backend: ImageDecodeBackend = "pil"
+
+    def set_reduced_size_decoding(self, get_target_resolution: typing.Callable[[Resolution], Resolution] | None):
+        """Decode JPEG images at a reduced size when they are larger than their target resolution (see
+        `open_image_reduced(...)`).
+        """
+        self._reduced_size_decoding_target = get_target_resolution
+
+    def set_image_decode_backend(self, image_decode_backend: ImageDecodeBackend):
+        """Set the backend used to decode image files. With the "torchvision" backend, images are returned as uint8
+        tensors rather than PIL images.
+        """
+        self._image_decode_backend = image_decode_backend
+
+    def _load_image(self, image_path: str) -> DecodedImage:
+        if self._image_decode_backend == "torchvision":
+            return decode_image_tensor(image_path, "RGB")
+        return open_image_reduced(image_path, "RGB", self._reduced_size_decoding_target)
 
     @classmethod
     def save_metadata(
@@ -28,15 +53,13 @@ class ImagePairPreferenceDataset(torch.utils.data.Dataset):
         return len(self._metadata)
 
     def __getitem__(self, idx: int) -> typing.Dict[str, typing.Any]:
-        # We call `convert("RGB")` to drop the alpha channel from RGBA images, or to repeat channels for greyscale
-        # images.
         example = self._metadata[idx]
         image_0_path = os.path.join(self._dataset_dir, example["image_0"])
         image_1_path = os.path.join(self._dataset_dir, example["image_1"])
         return {
             "id": str(idx),
-            "image_0": Image.open(image_0_path).convert("RGB"),
-            "image_1": Image.open(image_1_path).convert("RGB"),
+            "image_0": self._load_image(image_0_path),
+            "image_1": self._load_image(image_1_path),
             "caption": example["prompt"],
             "prefer_0": example["prefer_0"],
             "prefer_1": example["prefer_1"],
@@ -24,3 +24,18 @@ class TransformDataset(torch.utils.data.Dataset):
         for t in self._transforms:
             example = t(example)
         return example
+
+
+class TransformIterableDataset(torch.utils.data.IterableDataset):
+    """An IterableDataset that wraps a base iterable dataset and applies callable transforms to its outputs."""
+
+    def __init__(self, base_dataset: torch.utils.data.IterableDataset, transforms: list[TransformType]) -> None:
+        super().__init__()
+        self._base_dataset = base_dataset
+        self._transforms = transforms
+
+    def __iter__(self) -> typing.Iterator[DataType]:
+        for example in self._base_dataset:
+            for t in self._transforms:
+                example = t(example)
+            yield example
@@ -2,18 +2,39 @@ import copy
 import logging
 import math
 import random
+import typing
 from typing import Iterator
 
+import numpy as np
 from torch.utils.data import Sampler
 
-from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketManager
+from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import (
+    AspectRatioBucketAssignment,
+    AspectRatioBucketManager,
+)
 from invoke_training._shared.data.utils.resolution import Resolution
 
 AspectRatioBuckets = dict[Resolution, list[int]]
 
+# How to handle the partial batch at the end of each bucket.
+# - "keep": Emit the partial batch.
+# - "carry_over": Defer the examples of the partial batch to the start of the bucket in the next epoch.
+# - "drop_last": Drop the partial batch. The dropped examples change from epoch to epoch.
+# - "merge_adjacent": Merge each bucket that cannot fill a single batch into the adjacent bucket with the closest aspect
+#   ratio.
+# With "carry_over" and "drop_last", a bucket with fewer examples than its batch size still emits a partial batch, so
+# that its examples are not excluded from training.
+PartialBatchStrategy = typing.Literal["keep", "carry_over", "drop_last", "merge_adjacent"]
+
 
 class AspectRatioBucketBatchSampler(Sampler[list[int]]):
-    """A batch sampler that adheres to aspect ratio buckets."""
+    """A batch sampler that adheres to aspect ratio buckets.
+
+    For distributed training, the sampler can be split between `num_replicas` processes. The batches of each bucket are
+    dealt out in groups of `num_replicas` batches, one batch per process, so that all processes take a step on the same
+    bucket resolution at the same time, and all processes take the same number of steps per epoch. All processes must
+    use the same seed, so that they produce the same groups in the same order.
+    """
 
     def __init__(
         self,
@@ -21,15 +42,54 @@ class AspectRatioBucketBatchSampler(Sampler[list[int]]):
         batch_size: int,
         shuffle: bool = False,
         seed: int | None = None,
+        bucket_assignment: AspectRatioBucketAssignment | None = None,
+        bucket_batch_sizes: dict[Resolution, int] | None = None,
+        partial_batches: PartialBatchStrategy = "keep",
+        num_replicas: int = 1,
+        rank: int = 0,
     ) -> None:
         """Initialize AspectRatioBucketBatchSampler.
 
         For most use cases, initialize via AspectRatioBucketBatchSampler.from_image_sizes(...).
+
+        Args:
+            bucket_assignment (AspectRatioBucketAssignment, optional): The bucket of each example. This must be
+                consistent with `buckets`. If None, it is derived from `buckets`.
+            bucket_batch_sizes (dict[Resolution, int], optional): Per-bucket batch sizes. Buckets that are not in this
+                map use `batch_size`.
+            partial_batches (PartialBatchStrategy, optional): How to handle the partial batch at the end of each
+                bucket. See `PartialBatchStrategy`.
+            num_replicas (int, optional): The number of distributed processes to split the batches between.
+            rank (int, optional): The rank of the current process.
         """
-        self._buckets = buckets
+        if num_replicas > 1 and seed is None:
+            raise ValueError("A seed is required when num_replicas > 1, so that all processes sample the same batches.")
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank} for num_replicas={num_replicas}.")
+        self._num_replicas = num_replicas
+        self._rank = rank
         self._batch_size = batch_size
         self._shuffle = shuffle
         self._random = random.Random(seed)
+        self._bucket_batch_sizes = bucket_batch_sizes or {}
+        self._partial_batches = partial_batches
+
+        # The number of partial batches per epoch if they were all kept. Used for logging.
+        self._num_unhandled_partial_batches = self._count_partial_batches(buckets, "keep")
+        if partial_batches == "merge_adjacent":
+            buckets = merge_underfilled_buckets(buckets, self.get_batch_size)
+            # The merge moves examples to other buckets, so the assignment must be re-derived.
+            bucket_assignment = None
+
+        self._buckets = buckets
+        if bucket_assignment is None:
+            bucket_assignment = self._build_bucket_assignment(buckets)
+        self._bucket_assignment = bucket_assignment
+
+        # State for partial_batches="carry_over": the examples deferred to the next epoch in each bucket.
+        self._carried_over: AspectRatioBuckets = {}
+        # State for partial_batches="drop_last": the number of completed epochs, used to rotate the dropped examples.
+        self._epoch = 0
 
     def __str__(self) -> str:
         buckets = self.get_buckets()
@@ -37,7 +97,10 @@ class AspectRatioBucketBatchSampler(Sampler[list[int]]):
         s = ""
         for bucket_resolution in bucket_resolutions:
             bucket_images = buckets[bucket_resolution]
-            s += f"  {bucket_resolution.to_tuple()}: {len(bucket_images)}\n"
+            s += f"  {bucket_resolution.to_tuple()}: {len(bucket_images)}"
+            if len(self._bucket_batch_sizes) > 0:
+                s += f" (batch size: {self.get_batch_size(bucket_resolution)})"
+            s += "\n"
         return s
 
     @classmethod
@@ -48,33 +111,157 @@ class AspectRatioBucketBatchSampler(Sampler[list[int]]):
         batch_size: int,
         shuffle: bool = False,
         seed: int | None = None,
+        max_pixels_per_batch: int | None = None,
+        partial_batches: PartialBatchStrategy = "keep",
+        num_replicas: int = 1,
+        rank: int = 0,
     ):
-        """Initialize from an AspectRatioBucketManager and the list of dataset image resolutions."""
-        buckets = cls._build_bucket_to_index_map(bucket_manager, image_sizes)
-        return cls(buckets=buckets, batch_size=batch_size, shuffle=shuffle, seed=seed)
+        """Initialize from an AspectRatioBucketManager and the list of dataset image resolutions.
+
+        Args:
+            max_pixels_per_batch (int, optional): If set, each bucket uses the largest batch size whose total number of
+                pixels is at most `max_pixels_per_batch` (see `get_pixel_budget_batch_sizes(...)`), rather than
+                `batch_size`.
+            partial_batches (PartialBatchStrategy, optional): How to handle the partial batch at the end of each
+                bucket. See `PartialBatchStrategy`.
+            num_replicas (int, optional): The number of distributed processes to split the batches between.
+            rank (int, optional): The rank of the current process.
+        """
+        bucket_assignment = bucket_manager.assign_aspect_ratio_buckets(image_sizes)
+        buckets = cls._build_bucket_to_index_map(bucket_manager, bucket_assignment)
+        bucket_batch_sizes = None
+        if max_pixels_per_batch is not None:
+            bucket_batch_sizes = get_pixel_budget_batch_sizes(bucket_manager.buckets, max_pixels_per_batch)
+        return cls(
+            buckets=buckets,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            seed=seed,
+            bucket_assignment=bucket_assignment,
+            bucket_batch_sizes=bucket_batch_sizes,
+            partial_batches=partial_batches,
+            num_replicas=num_replicas,
+            rank=rank,
+        )
 
     @classmethod
     def _build_bucket_to_index_map(
         cls,
         bucket_manager: AspectRatioBucketManager,
-        image_sizes: list[Resolution],
+        bucket_assignment: AspectRatioBucketAssignment,
     ) -> AspectRatioBuckets:
         bucket_to_indexes: AspectRatioBuckets = dict()
 
         for bucket_resolution in bucket_manager.buckets:
             bucket_to_indexes[bucket_resolution] = []
 
-        for index, image_size in enumerate(image_sizes):
-            aspect_ratio_bucket = bucket_manager.get_aspect_ratio_bucket(image_size)
-            bucket_to_indexes[aspect_ratio_bucket].append(index)
+        if len(bucket_assignment) == 0:
+            return bucket_to_indexes
+
+        # Group the image indexes by bucket (preserving their order).
+        order = np.argsort(bucket_assignment.bucket_ids, kind="stable")
+        counts = np.bincount(bucket_assignment.bucket_ids, minlength=len(bucket_assignment.buckets))
+        for bucket_resolution, indexes in zip(bucket_assignment.buckets, np.split(order, np.cumsum(counts)[:-1])):
+            bucket_to_indexes[bucket_resolution] = indexes.tolist()
 
         return bucket_to_indexes
 
+    @classmethod
+    def _build_bucket_assignment(cls, buckets: AspectRatioBuckets) -> AspectRatioBucketAssignment:
+        bucket_resolutions = sorted(buckets.keys())
+        bucket_ids = np.zeros(sum(len(indexes) for indexes in buckets.values()), dtype=np.int64)
+        for bucket_id, bucket_resolution in enumerate(bucket_resolutions):
+            bucket_ids[buckets[bucket_resolution]] = bucket_id
+        return AspectRatioBucketAssignment(bucket_ids, bucket_resolutions)
+
+    @property
+    def bucket_assignment(self) -> AspectRatioBucketAssignment:
+        """The bucket of each example. Pass this to the image transforms (see `AspectRatioBucketFieldDataset`), so that
+        they use the same bucket as the sampler.
+        """
+        return self._bucket_assignment
+
+    @property
+    def num_replicas(self) -> int:
+        return self._num_replicas
+
+    @property
+    def partial_batches(self) -> PartialBatchStrategy:
+        return self._partial_batches
+
+    @property
+    def has_bucket_batch_sizes(self) -> bool:
+        """Whether any bucket uses a batch size other than the default `batch_size`."""
+        return any(batch_size != self._batch_size for batch_size in self._bucket_batch_sizes.values())
+
+    def get_batch_size(self, bucket_resolution: Resolution) -> int:
+        """Get the batch size of a bucket."""
+        return self._bucket_batch_sizes.get(bucket_resolution, self._batch_size)
+
     def get_buckets(self) -> AspectRatioBuckets:
         return copy.deepcopy(self._buckets)
 
+    def _get_num_batches(self, bucket_resolution: Resolution, num_examples: int, partial_batches: PartialBatchStrategy):
+        """Get the number of batches per epoch of a bucket with `num_examples` examples."""
+        batch_size = self.get_batch_size(bucket_resolution)
+        if partial_batches in ("carry_over", "drop_last") and num_examples >= batch_size:
+            return num_examples // batch_size
+        return math.ceil(num_examples / batch_size)
+
+    def _count_partial_batches(self, buckets: AspectRatioBuckets, partial_batches: PartialBatchStrategy) -> int:
+        num_partial_batches = 0
+        for bucket_resolution, bucket_images in buckets.items():
+            num_full_batches = len(bucket_images) // self.get_batch_size(bucket_resolution)
+            num_partial_batches += self._get_num_batches(bucket_resolution, len(bucket_images), partial_batches)
+            num_partial_batches -= num_full_batches
+        return num_partial_batches
+
+    def get_num_partial_batches(self) -> int:
+        """Get the number of partial batches that are emitted per epoch."""
+        return self._count_partial_batches(self._buckets, self._partial_batches)
+
+    def get_num_avoided_partial_batches(self) -> int:
+        """Get the number of partial batches per epoch that are avoided by the `partial_batches` strategy."""
+        return self._num_unhandled_partial_batches - self.get_num_partial_batches()
+
+    def get_num_dropped_examples(self) -> int:
+        """Get the number of examples that are dropped per epoch (partial_batches="drop_last" only)."""
+        if self._partial_batches != "drop_last":
+            return 0
+        num_dropped_examples = 0
+        for bucket_resolution, bucket_images in self._buckets.items():
+            batch_size = self.get_batch_size(bucket_resolution)
+            if len(bucket_images) >= batch_size:
+                num_dropped_examples += len(bucket_images) % batch_size
+        return num_dropped_examples
+
+    def _order_bucket_images(self, bucket_resolution: Resolution) -> list[int]:
+        """Get the examples of a bucket for the next epoch, in batch order, without any dropped or deferred examples."""
+        ordered_bucket_images = self._buckets[bucket_resolution].copy()
+        if self._shuffle:
+            # Shuffle the images within a bucket.
+            self._random.shuffle(ordered_bucket_images)
+
+        batch_size = self.get_batch_size(bucket_resolution)
+        num_full_batch_images = len(ordered_bucket_images) // batch_size * batch_size
+        if self._partial_batches == "carry_over" and num_full_batch_images > 0:
+            # Start with the examples that were deferred from the previous epoch.
+            carried_over = self._carried_over.get(bucket_resolution, [])
+            carried_over_set = set(carried_over)
+            ordered_bucket_images = carried_over + [i for i in ordered_bucket_images if i not in carried_over_set]
+            self._carried_over[bucket_resolution] = ordered_bucket_images[num_full_batch_images:]
+            ordered_bucket_images = ordered_bucket_images[:num_full_batch_images]
+        elif self._partial_batches == "drop_last" and num_full_batch_images > 0:
+            if not self._shuffle:
+                # Rotate the images, so that different images are dropped in each epoch.
+                offset = self._epoch * (len(ordered_bucket_images) - num_full_batch_images) % len(ordered_bucket_images)
+                ordered_bucket_images = ordered_bucket_images[offset:] + ordered_bucket_images[:offset]
+            ordered_bucket_images = ordered_bucket_images[:num_full_batch_images]
+        return ordered_bucket_images
+
     def __iter__(self) -> Iterator[list[int]]:
-        batches: list[list[int]] = []
+        # Groups of `num_replicas` batches from the same bucket. Each process takes one batch from each group.
+        batch_groups: list[list[list[int]]] = []
 
         # TODO(ryand): If self._shuffle == False, should we still shuffle just with a fixed seed every time? If we
         # don't shuffle at all then all of the batches from a bucket will be grouped together. If there's a correlation
@@ -82,31 +269,77 @@ class AspectRatioBucketBatchSampler(Sampler[list[int]]):
         # over the dataset.
 
         for bucket_resolution in sorted(list(self._buckets.keys())):
-            ordered_bucket_images = self._buckets[bucket_resolution].copy()
-            if self._shuffle:
-                # Shuffle the images within a bucket.
-                self._random.shuffle(ordered_bucket_images)
+            ordered_bucket_images = self._order_bucket_images(bucket_resolution)
 
             # Prepare batches for a single bucket.
+            batch_size = self.get_batch_size(bucket_resolution)
+            bucket_batches: list[list[int]] = []
             batch_start = 0
             while batch_start < len(ordered_bucket_images):
-                batch_end = min(batch_start + self._batch_size, len(ordered_bucket_images))
-                batches.append(ordered_bucket_images[batch_start:batch_end])
-                batch_start += self._batch_size
+                batch_end = min(batch_start + batch_size, len(ordered_bucket_images))
+                bucket_batches.append(ordered_bucket_images[batch_start:batch_end])
+                batch_start += batch_size
+
+            # Deal the batches out to the processes. If the last group is incomplete, it is filled by repeating batches
+            # from the start of the bucket, so that every process takes the same number of steps.
+            for group_start in range(0, len(bucket_batches), self._num_replicas):
+                batch_groups.append(
+                    [bucket_batches[(group_start + i) % len(bucket_batches)] for i in range(self._num_replicas)]
+                )
+
+        self._epoch += 1
 
         if self._shuffle:
             # We've already shuffled the images within each bucket, now we shuffle the batches.
-            self._random.shuffle(batches)
+            self._random.shuffle(batch_groups)
 
-        yield from batches
+        for batch_group in batch_groups:
+            yield batch_group[self._rank]
 
     def __len__(self) -> int:
         num_batches = 0
-        for bucket_images in self._buckets.values():
-            num_batches += math.ceil(len(bucket_images) / self._batch_size)
+        for bucket_resolution, bucket_images in self._buckets.items():
+            num_bucket_batches = self._get_num_batches(bucket_resolution, len(bucket_images), self._partial_batches)
+            num_batches += math.ceil(num_bucket_batches / self._num_replicas)
         return num_batches
 
 
+def get_pixel_budget_batch_sizes(
+    buckets: typing.Iterable[Resolution], max_pixels_per_batch: int
+) -> dict[Resolution, int]:
+    """Get the largest batch size of each bucket whose total number of pixels is at most `max_pixels_per_batch`. The
+    batch size of a bucket is always at least 1, even if a single image exceeds the budget.
+    """
+    return {bucket: max(1, max_pixels_per_batch // (bucket.height * bucket.width)) for bucket in buckets}
+
+
+def merge_underfilled_buckets(
+    buckets: AspectRatioBuckets, get_batch_size: typing.Callable[[Resolution], int]
+) -> AspectRatioBuckets:
+    """Merge each under-filled bucket (i.e. a bucket with fewer examples than its batch size) into the adjacent
+    non-empty bucket with the closest aspect ratio. Under-filled buckets are merged smallest-first until every non-empty
+    bucket can fill at least one batch, or only a single non-empty bucket remains.
+
+    The returned map has the same keys as `buckets`. Merged buckets are left empty.
+    """
+    merged_buckets = {bucket_resolution: list(bucket_images) for bucket_resolution, bucket_images in buckets.items()}
+
+    while True:
+        non_empty_buckets = sorted(
+            [b for b, bucket_images in merged_buckets.items() if len(bucket_images) > 0], key=lambda b: b.aspect_ratio()
+        )
+        underfilled_buckets = [b for b in non_empty_buckets if len(merged_buckets[b]) < get_batch_size(b)]
+        if len(non_empty_buckets) <= 1 or len(underfilled_buckets) == 0:
+            return merged_buckets
+
+        bucket = min(underfilled_buckets, key=lambda b: (len(merged_buckets[b]), b.to_tuple()))
+        bucket_idx = non_empty_buckets.index(bucket)
+        neighbors = [non_empty_buckets[i] for i in (bucket_idx - 1, bucket_idx + 1) if 0 <= i < len(non_empty_buckets)]
+        target = min(neighbors, key=lambda b: abs(math.log(b.aspect_ratio() / bucket.aspect_ratio())))
+        merged_buckets[target].extend(merged_buckets[bucket])
+        merged_buckets[bucket] = []
+
+
 def log_aspect_ratio_buckets(logger: logging.Logger, batch_sampler: AspectRatioBucketBatchSampler):
     """Utility function for logging the aspect ratio buckets."""
     if not isinstance(batch_sampler, AspectRatioBucketBatchSampler):
@@ -114,4 +347,12 @@ def log_aspect_ratio_buckets(logger: logging.Logger, batch_sampler: AspectRatioB
 
     log = "Aspect Ratio Buckets:\n"
     log += str(batch_sampler)
+    log += f"Partial batches per epoch: {batch_sampler.get_num_partial_batches()}"
+    if batch_sampler.partial_batches != "keep":
+        log += (
+            f" ({batch_sampler.get_num_avoided_partial_batches()} avoided with "
+            f"partial_batches='{batch_sampler.partial_batches}')"
+        )
+    if batch_sampler.partial_batches == "drop_last":
+        log += f"\nExamples dropped per epoch: {batch_sampler.get_num_dropped_examples()}"
     logger.info(log)
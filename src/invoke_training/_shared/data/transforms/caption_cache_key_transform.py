@@ -0,0 +1,23 @@
+import hashlib
+import typing
+
+
+def get_caption_cache_key(caption: str) -> str:
+    """Get the cache key under which the text encoder outputs for `caption` are stored."""
+    return hashlib.sha256(caption.encode("utf-8")).hexdigest()
+
+
+class CaptionCacheKeyTransform:
+    """A transform that adds the cache key of an example's caption (see `get_caption_cache_key(...)`).
+
+    Text encoder outputs are cached by caption rather than by example id, so that examples with the same caption (e.g.
+    all instance examples of a DreamBooth dataset) share a single cache entry.
+    """
+
+    def __init__(self, caption_field_name: str = "caption", cache_key_field_name: str = "caption_cache_key"):
+        self._caption_field_name = caption_field_name
+        self._cache_key_field_name = cache_key_field_name
+
+    def __call__(self, data: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        data[self._cache_key_field_name] = get_caption_cache_key(data[self._caption_field_name])
+        return data
@@ -2,12 +2,18 @@ import typing
 
 from torchvision import transforms
 
+from invoke_training._shared.data.datasets.aspect_ratio_bucket_field_dataset import ASPECT_RATIO_BUCKET_FIELD_NAME
 from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketManager, Resolution
+from invoke_training._shared.data.utils.image_decode_backend import to_float_tensor
+from invoke_training._shared.data.utils.pre_resized_image_cache import get_original_size_hw
 from invoke_training._shared.data.utils.resize import resize_to_cover
 
 
 class FluxImageTransform:
-    """A transform that prepares and augments images for Flux.1-dev training."""
+    """A transform that prepares and augments images for Flux.1-dev training.
+
+    Input images can be either PIL images or uint8 image tensors (see `ImageDecodeBackend`).
+    """
 
     def __init__(
         self,
@@ -17,6 +23,7 @@ class FluxImageTransform:
         aspect_ratio_bucket_manager: AspectRatioBucketManager | None = None,
         random_flip: bool = True,
         center_crop: bool = True,
+        aspect_ratio_bucket_field_name: str = ASPECT_RATIO_BUCKET_FIELD_NAME,
     ):
         """Initialize FluxImageTransform.
 
@@ -30,6 +37,9 @@ class FluxImageTransform:
             center_crop (bool, optional): If True, crop to the center of the image to achieve the target resolution. If
                 False, crop at a random location.
             random_flip (bool, optional): Whether to apply a random horizontal flip to the images.
+            aspect_ratio_bucket_field_name (str, optional): If an example has this field (see
+                AspectRatioBucketFieldDataset), then its value is used as the example's aspect ratio bucket, rather than
+                looking up the bucket with `aspect_ratio_bucket_manager`. The field is removed from the example.
         """
         self.image_field_names = image_field_names
         self.fields_to_normalize_to_range_minus_one_to_one = fields_to_normalize_to_range_minus_one_to_one
@@ -37,30 +47,33 @@ class FluxImageTransform:
         self.aspect_ratio_bucket_manager = aspect_ratio_bucket_manager
         self.random_flip = random_flip
         self.center_crop = center_crop
+        self.aspect_ratio_bucket_field_name = aspect_ratio_bucket_field_name
 
     def __call__(self, data: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:  # noqa: C901
         image_fields: dict = {}
         for field_name in self.image_field_names:
             image_fields[field_name] = data[field_name]
 
+        aspect_ratio_bucket = data.pop(self.aspect_ratio_bucket_field_name, None)
         for field_name, image in image_fields.items():
             # Determine the target image resolution.
             if self.resolution is not None:
-                resolution = self.resolution
-                resolution_obj = Resolution(resolution, resolution)
+                resolution_obj = Resolution.parse(self.resolution)
+            elif aspect_ratio_bucket is not None:
+                resolution_obj = aspect_ratio_bucket
             else:
-                original_size_hw = (image.height, image.width)
+                original_size_hw = get_original_size_hw(image)
                 resolution_obj = self.aspect_ratio_bucket_manager.get_aspect_ratio_bucket(
                     Resolution.parse(original_size_hw)
                 )
 
             image = resize_to_cover(image, resolution_obj)
             if self.center_crop:
-                image = transforms.CenterCrop(resolution)(image)
+                image = transforms.CenterCrop(resolution_obj.to_tuple())(image)
             else:
-                image = transforms.RandomCrop(resolution)(image)
+                image = transforms.RandomCrop(resolution_obj.to_tuple())(image)
 
-            image = transforms.ToTensor()(image)
+            image = to_float_tensor(image)
 
             if self.random_flip:
                 image = transforms.RandomHorizontalFlip(p=0.5)(image)
@@ -7,7 +7,11 @@ class LoadCacheTransform:
     """A transform that loads data from a TensorDiskCache."""
 
     def __init__(
-        self, cache: TensorDiskCache, cache_key_field: str, cache_field_to_output_field: typing.Dict[str, str]
+        self,
+        cache: TensorDiskCache,
+        cache_key_field: str,
+        cache_field_to_output_field: typing.Dict[str, str],
+        optional_cache_field_to_output_field: typing.Optional[typing.Dict[str, str]] = None,
     ):
         """Initialize LoadCacheTransform.
 
@@ -16,10 +20,14 @@ class LoadCacheTransform:
             cache_key_field (str): The name of the field to use as the cache key.
             cache_field_to_output_field (typing.Dict[str, str]): A map of field names in the cached data to the field
                 names where they should be inserted in the example data.
+            optional_cache_field_to_output_field (typing.Dict[str, str], optional): Like `cache_field_to_output_field`,
+                but for fields that are only present in some caches (e.g. depending on the options that the cache was
+                populated with). Missing fields are skipped.
         """
         self._cache = cache
         self._cache_key_field = cache_key_field
         self._cache_field_to_output_field = cache_field_to_output_field
+        self._optional_cache_field_to_output_field = optional_cache_field_to_output_field or {}
 
     def __call__(self, data: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
         key = data[self._cache_key_field]
@@ -28,5 +36,8 @@ class LoadCacheTransform:
 
         for src, dst in self._cache_field_to_output_field.items():
             data[dst] = cache_data[src]
+        for src, dst in self._optional_cache_field_to_output_field.items():
+            if src in cache_data:
+                data[dst] = cache_data[src]
 
         return data
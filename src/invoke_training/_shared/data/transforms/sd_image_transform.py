@@ -1,15 +1,22 @@
 import random
 import typing
 
+import torch
 from torchvision import transforms
 from torchvision.transforms.functional import crop
 
+from invoke_training._shared.data.datasets.aspect_ratio_bucket_field_dataset import ASPECT_RATIO_BUCKET_FIELD_NAME
 from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketManager, Resolution
+from invoke_training._shared.data.utils.image_decode_backend import DecodedImage, get_image_size_hw, to_float_tensor
+from invoke_training._shared.data.utils.pre_resized_image_cache import get_original_size_hw
 from invoke_training._shared.data.utils.resize import resize_to_cover
 
 
 class SDImageTransform:
-    """A transform that prepares and augments images for Stable Diffusion training."""
+    """A transform that prepares and augments images for Stable Diffusion training.
+
+    Input images can be either PIL images or uint8 image tensors (see `ImageDecodeBackend`).
+    """
 
     def __init__(
         self,
@@ -21,6 +28,8 @@ class SDImageTransform:
         random_flip: bool = False,
         orig_size_field_name: str = "original_size_hw",
         crop_field_name: str = "crop_top_left_yx",
+        num_crop_variants: int | None = None,
+        aspect_ratio_bucket_field_name: str = ASPECT_RATIO_BUCKET_FIELD_NAME,
     ):
         """Initialize SDImageTransform.
 
@@ -34,6 +43,15 @@ class SDImageTransform:
             center_crop (bool, optional): If True, crop to the center of the image to achieve the target resolution. If
                 False, crop at a random location.
             random_flip (bool, optional): Whether to apply a random horizontal flip to the images.
+            num_crop_variants (int, optional): If set, then rather than producing a single randomly-augmented version of
+                each image, produce a fixed set of augmentation variants (e.g. to populate a VAE output cache that
+                supports augmentation). The variants are `num_crop_variants` random crops (or the single center crop,
+                if `center_crop` is True), each both unflipped and flipped (if `random_flip` is True). The variants of
+                each image field are stacked along a new leading dimension, and the crop field is set to the list of
+                the variants' crop positions.
+            aspect_ratio_bucket_field_name (str, optional): If an example has this field (see
+                AspectRatioBucketFieldDataset), then its value is used as the example's aspect ratio bucket, rather than
+                looking up the bucket with `aspect_ratio_bucket_manager`. The field is removed from the example.
         """
         self._image_field_names = image_field_names
         self._fields_to_normalize_to_range_minus_one_to_one = fields_to_normalize_to_range_minus_one_to_one
@@ -48,13 +66,14 @@ class SDImageTransform:
         self._center_crop_enabled = center_crop
         self._random_flip_enabled = random_flip
         self._flip_transform = transforms.RandomHorizontalFlip(p=1.0)
-        self._to_tensor_transform = transforms.ToTensor()
         # Convert pixel values from range [0, 1.0] to range [-1.0, 1.0].
         # Normalize applies the following transform: out = (in - 0.5) / 0.5
         self._normalize_image_transform = transforms.Normalize([0.5], [0.5])
 
         self._orig_size_field_name = orig_size_field_name
         self._crop_field_name = crop_field_name
+        self._num_crop_variants = num_crop_variants
+        self._aspect_ratio_bucket_field_name = aspect_ratio_bucket_field_name
 
     def __call__(self, data: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:  # noqa: C901
         # This SDXL image pre-processing logic is adapted from:
@@ -63,7 +82,7 @@ class SDImageTransform:
         image_fields: dict = {}
         for field_name in self._image_field_names:
             image_fields[field_name] = data[field_name]
-        sizes = [image.size for image in image_fields.values()]
+        sizes = [get_image_size_hw(image) for image in image_fields.values()]
         # All images should have the same size.
         assert all(size == sizes[0] for size in sizes)
 
@@ -71,11 +90,16 @@ class SDImageTransform:
         def get_first_image():
             return next(iter(image_fields.values()))
 
-        original_size_hw = (get_first_image().height, get_first_image().width)
+        # If the images were loaded from a PreResizedImageCache, this is the size of the source images rather than the
+        # size of the loaded images.
+        original_size_hw = get_original_size_hw(get_first_image())
 
         # Determine the target image resolution.
+        aspect_ratio_bucket = data.pop(self._aspect_ratio_bucket_field_name, None)
         if self._resolution is not None:
             resolution = self._resolution
+        elif aspect_ratio_bucket is not None:
+            resolution = aspect_ratio_bucket
         else:
             resolution = self._aspect_ratio_bucket_manager.get_aspect_ratio_bucket(Resolution.parse(original_size_hw))
 
@@ -83,38 +107,78 @@ class SDImageTransform:
         for field_name, image in image_fields.items():
             image_fields[field_name] = resize_to_cover(image, resolution)
 
-        # Apply cropping, and record top left crop position.
+        # Select the crop position and flip of each variant to produce.
+        if self._num_crop_variants is None:
+            crop_positions = [self._get_crop_position(get_first_image(), resolution)]
+            # TODO(ryand): Use a seed for repeatable results.
+            flips = [self._random_flip_enabled and random.random() < 0.5]
+        else:
+            num_crops = 1 if self._center_crop_enabled else self._num_crop_variants
+            crop_positions = [self._get_crop_position(get_first_image(), resolution) for _ in range(num_crops)]
+            flips = [False, True] if self._random_flip_enabled else [False]
+
+        variants = [
+            self._crop_and_flip(image_fields, resolution, original_size_hw, top_left_y, top_left_x, flip)
+            for top_left_y, top_left_x in crop_positions
+            for flip in flips
+        ]
+
+        data[self._orig_size_field_name] = original_size_hw
+        if self._num_crop_variants is None:
+            variant_fields, crop_top_left_yx = variants[0]
+            data[self._crop_field_name] = crop_top_left_yx
+            for field_name, image in variant_fields.items():
+                data[field_name] = image
+        else:
+            data[self._crop_field_name] = [crop_top_left_yx for _, crop_top_left_yx in variants]
+            for field_name in image_fields:
+                data[field_name] = torch.stack([variant_fields[field_name] for variant_fields, _ in variants])
+
+        return data
+
+    def _get_crop_position(self, image: DecodedImage, resolution: Resolution) -> tuple[int, int]:
+        """Get the top left (y, x) position of the crop to apply to `image`."""
         if self._center_crop_enabled:
-            top_left_y = max(0, (get_first_image().height - resolution.height) // 2)
-            top_left_x = max(0, (get_first_image().width - resolution.width) // 2)
+            image_height, image_width = get_image_size_hw(image)
+            top_left_y = max(0, (image_height - resolution.height) // 2)
+            top_left_x = max(0, (image_width - resolution.width) // 2)
         else:
             crop_transform = transforms.RandomCrop(resolution.to_tuple())
-            top_left_y, top_left_x, h, w = crop_transform.get_params(get_first_image(), resolution.to_tuple())
-        for field_name, image in image_fields.items():
-            image_fields[field_name] = crop(image, top_left_y, top_left_x, resolution.height, resolution.width)
+            top_left_y, top_left_x, h, w = crop_transform.get_params(image, resolution.to_tuple())
+        return top_left_y, top_left_x
 
-        # Apply random flip and update top left crop position accordingly.
-        # TODO(ryand): Use a seed for repeatable results.
-        if self._random_flip_enabled and random.random() < 0.5:
-            top_left_x = original_size_hw[1] - get_first_image().width - top_left_x
-            for field_name, image in image_fields.items():
-                image_fields[field_name] = self._flip_transform(image)
+    def _crop_and_flip(
+        self,
+        image_fields: dict[str, DecodedImage],
+        resolution: Resolution,
+        original_size_hw: tuple[int, int],
+        top_left_y: int,
+        top_left_x: int,
+        flip: bool,
+    ) -> tuple[dict[str, torch.Tensor], tuple[int, int]]:
+        """Crop (and optionally flip) all images, and convert them to normalized tensors.
+
+        Returns:
+            tuple[dict[str, torch.Tensor], tuple[int, int]]: The transformed images, and the top left crop position.
+        """
+        out_fields: dict = {}
+        for field_name, image in image_fields.items():
+            out_fields[field_name] = crop(image, top_left_y, top_left_x, resolution.height, resolution.width)
 
-        crop_top_left_yx = (top_left_y, top_left_x)
+        # Apply flip and update top left crop position accordingly.
+        if flip:
+            top_left_x = original_size_hw[1] - resolution.width - top_left_x
+            for field_name, image in out_fields.items():
+                out_fields[field_name] = self._flip_transform(image)
 
-        # Convert to Tensors.
-        for field_name, image in image_fields.items():
-            image_fields[field_name] = self._to_tensor_transform(image)
+        # Convert to float Tensors.
+        for field_name, image in out_fields.items():
+            out_fields[field_name] = to_float_tensor(image)
 
         # Normalize to range [-1.0, 1.0].
         # HACK(ryand): We should find a better way to determine the normalization range of each image field.
-        for field_name, image in image_fields.items():
+        for field_name, image in out_fields.items():
             if field_name in self._fields_to_normalize_to_range_minus_one_to_one:
-                image_fields[field_name] = self._normalize_image_transform(image)
+                out_fields[field_name] = self._normalize_image_transform(image)
 
-        data[self._orig_size_field_name] = original_size_hw
-        data[self._crop_field_name] = crop_top_left_yx
-        for field_name, image in image_fields.items():
-            data[field_name] = image
-
-        return data
+        return out_fields, (top_left_y, top_left_x)
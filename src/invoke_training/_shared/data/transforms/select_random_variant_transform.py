@@ -0,0 +1,34 @@
+import random
+import typing
+
+
+class SelectRandomVariantTransform:
+    """A transform that selects one of several pre-computed augmentation variants of an example.
+
+    Each of the `field_names` fields must be indexable along its first dimension (e.g. a torch.Tensor or a list), and
+    all of them must have the same number of variants. The same randomly-selected variant index is applied to every
+    field, so that related fields (e.g. a cached latent and its crop position) stay consistent. The first field must be
+    present in every example. The other fields are optional, and are ignored if they are not present in an example.
+    """
+
+    def __init__(self, field_names: list[str]):
+        if len(field_names) == 0:
+            raise ValueError("At least one field name must be provided.")
+        self._field_names = field_names
+
+    def __call__(self, data: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        if self._field_names[0] not in data:
+            raise ValueError(f"Field '{self._field_names[0]}' is missing from the example.")
+        field_names = [field_name for field_name in self._field_names if field_name in data]
+        num_variants = len(data[field_names[0]])
+        for field_name in field_names:
+            if len(data[field_name]) != num_variants:
+                raise ValueError(
+                    f"Field '{field_name}' has {len(data[field_name])} variants, but field '{field_names[0]}' "
+                    f"has {num_variants} variants."
+                )
+
+        variant_idx = random.randrange(num_variants)
+        for field_name in field_names:
+            data[field_name] = data[field_name][variant_idx]
+        return data
@@ -0,0 +1,290 @@
+import glob
+import math
+import mmap
+import os
+import typing
+import zlib
+
+import torch
+
+from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+
+_INDEX_FILE_NAME = "index.pt"
+_INDEX_PART_FILE_NAME_PATTERN = "index_part_*.pt"
+
+# Tensors are written at offsets that are a multiple of this value, so that every tensor that is read back from a
+# memory-mapped shard is suitably aligned for its dtype.
+_TENSOR_ALIGNMENT_BYTES = 64
+
+# zlib compression level for compressed caches. Low levels are much faster to write, and only slightly less effective on
+# byte-shuffled floating point data.
+_COMPRESSION_LEVEL = 1
+
+
+def _compress_tensor(tensor: torch.Tensor) -> bytes:
+    """Losslessly compress the data of `tensor`.
+
+    The bytes of each element are grouped by significance before compressing (i.e. byte shuffling). The high-order
+    bytes of floating point values (sign and exponent) are highly repetitive, so this greatly improves the compression
+    ratio.
+    """
+    data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).reshape(-1, tensor.element_size())
+    return zlib.compress(data.T.contiguous().numpy().tobytes(), level=_COMPRESSION_LEVEL)
+
+
+def _decompress_tensor(data: typing.Any, dtype: torch.dtype, shape: tuple[int, ...]) -> torch.Tensor:
+    """Inverse of `_compress_tensor(...)`."""
+    element_size = torch.empty((), dtype=dtype).element_size()
+    if math.prod(shape) == 0:
+        return torch.empty(shape, dtype=dtype)
+    shuffled = torch.frombuffer(bytearray(zlib.decompress(data)), dtype=torch.uint8).reshape(element_size, -1)
+    return shuffled.T.contiguous().view(dtype).reshape(shape)
+
+
+class ShardedTensorDiskCache(TensorDiskCache):
+    """A TensorDiskCache that packs all cache entries into a small number of large shard files.
+
+    Tensor data is written as raw bytes to append-only shard files, and an index maps each cache key to the
+    (shard, offset, dtype, shape) of each of its tensors. Non-tensor values (e.g. `original_size_hw` tuples) are stored
+    directly in the index. Reads memory-map the shard files and return tensors that view the mapped pages, so no
+    unpickling or copying is required to load an entry.
+
+    Entries are not readable until `mark_complete()` has been called, which flushes the open shard and writes the
+    index.
+
+    If `compress` is True, tensors are losslessly compressed before being written. Compressed tensors are decompressed
+    into new memory when loaded, trading some CPU time for reduced disk usage and I/O bandwidth.
+
+    Multiple processes can populate the same cache concurrently, as long as each is given a unique `writer_rank` and
+    writes a disjoint set of keys. Each writer calls `write_index_part()` when it is done, and then a single process
+    calls `merge_index_parts()` once all writers have finished.
+    """
+
+    def __init__(self, cache_dir: str, shard_size_bytes: int = 2**30, writer_rank: int = 0, compress: bool = False):
+        """Initialize ShardedTensorDiskCache.
+
+        Args:
+            cache_dir (str): The cache directory.
+            shard_size_bytes (int, optional): A new shard file is started once the current shard reaches this size.
+                Defaults to 1 GiB.
+            writer_rank (int, optional): A unique ID for this writer when multiple processes populate the cache
+                concurrently. Determines the names of the shard and index part files written by this process.
+            compress (bool, optional): Whether to compress the tensors saved by this writer. Does not affect reading:
+                compressed and uncompressed entries can always be loaded.
+        """
+        super().__init__(cache_dir)
+        self._shard_size_bytes = shard_size_bytes
+        self._writer_rank = writer_rank
+        self._compress = compress
+
+        # Write state.
+        self._pending_index: dict[str, dict[str, typing.Any]] = {}
+        self._shard_idx = 0
+        self._shard_file: typing.BinaryIO | None = None
+
+        # Read state. These are populated lazily so that each DataLoader worker process opens its own memory maps.
+        self._index: dict[str, dict[str, typing.Any]] | None = None
+        self._shard_mmaps: dict[str, mmap.mmap] = {}
+
+    @classmethod
+    def is_sharded_cache_dir(cls, cache_dir: str) -> bool:
+        """Check whether `cache_dir` contains a (completed) ShardedTensorDiskCache."""
+        return os.path.exists(os.path.join(cache_dir, _INDEX_FILE_NAME))
+
+    def __getstate__(self):
+        # File handles and memory maps can't be pickled (e.g. when passing the cache to spawned DataLoader workers).
+        state = self.__dict__.copy()
+        state["_shard_file"] = None
+        state["_shard_mmaps"] = {}
+        return state
+
+    def _get_shard_name(self, shard_idx: int) -> str:
+        return f"shard_{self._writer_rank:03d}_{shard_idx:05d}.bin"
+
+    def _close_shard_file(self):
+        """Close the current shard file, after making sure that its contents have been written to disk."""
+        self._shard_file.flush()
+        os.fsync(self._shard_file.fileno())
+        self._shard_file.close()
+        self._shard_file = None
+
+    def _write_bytes(self, data: bytes) -> tuple[str, int]:
+        """Append `data` to the current shard and return its (shard_name, offset)."""
+        if self._shard_file is not None and self._shard_file.tell() >= self._shard_size_bytes:
+            self._close_shard_file()
+            self._shard_idx += 1
+        if self._shard_file is None:
+            self._shard_file = open(os.path.join(self._cache_dir, self._get_shard_name(self._shard_idx)), "ab")
+
+        offset = self._shard_file.tell()
+        padding = -offset % _TENSOR_ALIGNMENT_BYTES
+        if padding > 0:
+            self._shard_file.write(b"\0" * padding)
+            offset += padding
+
+        self._shard_file.write(data)
+        return self._get_shard_name(self._shard_idx), offset
+
+    def save(self, key: int, data: typing.Dict[str, typing.Any]):
+        """Save data in the cache.
+        Raises:
+            AssertionError: If an entry already exists in the cache for this `key`.
+        Args:
+            key (int): The cache key.
+            data (typing.Dict[str, typing.Any]): The data to save.
+        """
+        assert isinstance(data, dict)
+        key = str(key)
+        assert key not in self._pending_index
+
+        entry: dict[str, typing.Any] = {"tensors": {}, "compressed_tensors": {}, "values": {}}
+        for name, value in data.items():
+            if isinstance(value, torch.Tensor) and self._compress:
+                compressed = _compress_tensor(value)
+                shard_name, offset = self._write_bytes(compressed)
+                entry["compressed_tensors"][name] = (
+                    shard_name,
+                    offset,
+                    len(compressed),
+                    value.dtype,
+                    tuple(value.shape),
+                )
+            elif isinstance(value, torch.Tensor):
+                # Reinterpret the tensor as raw bytes. This works for all dtypes, including those that numpy does not
+                # support (e.g. bfloat16).
+                shard_name, offset = self._write_bytes(
+                    value.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes()
+                )
+                entry["tensors"][name] = (shard_name, offset, value.dtype, tuple(value.shape))
+            else:
+                entry["values"][name] = value
+        self._pending_index[key] = entry
+
+    def _get_index(self) -> dict[str, dict[str, typing.Any]]:
+        if self._index is None:
+            index_path = os.path.join(self._cache_dir, _INDEX_FILE_NAME)
+            if not os.path.exists(index_path):
+                raise RuntimeError(
+                    f"The cache in '{self._cache_dir}' has no index. `mark_complete()` (or `merge_index_parts()`) "
+                    "must be called after the cache is populated."
+                )
+            self._index = torch.load(index_path)
+        return self._index
+
+    def __len__(self) -> int:
+        """Get the number of entries in the cache. The cache must be complete."""
+        return len(self._get_index())
+
+    def keys(self) -> list[str]:
+        """Get the keys of all entries in the cache. The cache must be complete."""
+        return list(self._get_index().keys())
+
+    def _get_shard_mmap(self, shard_name: str) -> mmap.mmap:
+        shard_mmap = self._shard_mmaps.get(shard_name, None)
+        if shard_mmap is None:
+            with open(os.path.join(self._cache_dir, shard_name), "rb") as f:
+                # ACCESS_COPY produces a writable (copy-on-write) mapping. Pages are shared with the OS page cache until
+                # they are written to, and torch.frombuffer(...) does not warn about non-writable buffers.
+                shard_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            self._shard_mmaps[shard_name] = shard_mmap
+        return shard_mmap
+
+    def load(self, key: int) -> typing.Dict[str, typing.Any]:
+        """Load data from the cache.
+
+        Uncompressed tensors in the returned dict are views of the memory-mapped shard files.
+
+        Args:
+            key (int): The cache key to load.
+        Returns:
+            typing.Dict[str, typing.Any]: Data loaded from the cache.
+        """
+        entry = self._get_index()[str(key)]
+
+        data = dict(entry["values"])
+        for name, (shard_name, offset, dtype, shape) in entry["tensors"].items():
+            numel = 1
+            for dim in shape:
+                numel *= dim
+            if numel == 0:
+                data[name] = torch.empty(shape, dtype=dtype)
+                continue
+            data[name] = torch.frombuffer(
+                self._get_shard_mmap(shard_name), dtype=dtype, count=numel, offset=offset
+            ).view(shape)
+        for name, (shard_name, offset, num_bytes, dtype, shape) in entry.get("compressed_tensors", {}).items():
+            compressed = memoryview(self._get_shard_mmap(shard_name))[offset : offset + num_bytes]
+            data[name] = _decompress_tensor(compressed, dtype, shape)
+        return data
+
+    def _save_atomic(self, obj: typing.Any, file_name: str):
+        # Write to a temporary file first so that a partially-written file is never mistaken for a complete one.
+        path = os.path.join(self._cache_dir, file_name)
+        with open(path + ".tmp", "wb") as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def write_index_part(self):
+        """Flush the open shard and write the index of all entries saved by this writer."""
+        if self._shard_file is not None:
+            self._close_shard_file()
+
+        self._save_atomic(self._pending_index, f"index_part_{self._writer_rank:03d}.pt")
+
+    def merge_index_parts(self, allow_duplicate_keys: bool = False):
+        """Merge the index parts written by all writers into a single index, and mark the cache as fully populated.
+
+        Must only be called by a single process, after every writer has called `write_index_part()`.
+
+        Args:
+            allow_duplicate_keys (bool, optional): If True, the same key may be saved by more than one writer (e.g. for
+                content-addressed entries that every writer computes identically). The entry written by the writer
+                with the lowest rank is kept.
+
+        Raises:
+            AssertionError: If the same key was saved by more than one writer, and `allow_duplicate_keys` is False.
+        """
+        index: dict[str, dict[str, typing.Any]] = {}
+        index_part_paths = sorted(glob.glob(os.path.join(self._cache_dir, _INDEX_PART_FILE_NAME_PATTERN)))
+        for index_part_path in index_part_paths:
+            index_part = torch.load(index_part_path)
+            if allow_duplicate_keys:
+                index_part = {k: v for k, v in index_part.items() if k not in index}
+            assert index.keys().isdisjoint(index_part.keys())
+            index.update(index_part)
+
+        self._save_atomic(index, _INDEX_FILE_NAME)
+        for index_part_path in index_part_paths:
+            os.remove(index_part_path)
+        self._index = index
+
+        super().mark_complete()
+
+    def mark_complete(self):
+        """Flush the open shard, write the index, and mark the cache as fully populated.
+
+        This is a shorthand for `write_index_part()` followed by `merge_index_parts()` when there is a single writer.
+        """
+        self.write_index_part()
+        self.merge_index_parts()
+
+    def clear(self):
+        """Delete all entries from the cache (including the complete marker)."""
+        if self._shard_file is not None:
+            self._shard_file.close()
+            self._shard_file = None
+        self._shard_mmaps = {}
+        self._pending_index = {}
+        self._shard_idx = 0
+        self._index = None
+
+        super().clear()
+
+
+def open_tensor_disk_cache(cache_dir: str) -> TensorDiskCache:
+    """Open an existing cache for reading, using the appropriate TensorDiskCache implementation for its format."""
+    if ShardedTensorDiskCache.is_sharded_cache_dir(cache_dir):
+        return ShardedTensorDiskCache(cache_dir)
+    return TensorDiskCache(cache_dir)
@@ -1,8 +1,12 @@
 import os
+import shutil
 import typing
 
 import torch
 
+# The name of the marker file that is written once a cache has been fully populated.
+_COMPLETE_MARKER_FILE_NAME = "_complete"
+
 
 class TensorDiskCache:
     """A data cache that caches `torch.Tensor`s on disk."""
@@ -40,9 +44,31 @@ class TensorDiskCache:
 
     def load(self, key: int) -> typing.Dict[str, torch.Tensor]:
         """Load data from the cache.
+
+        The cache file is memory-mapped rather than read into memory, so the returned tensors share the OS page cache
+        with all other processes that load the same entry (e.g. DataLoader workers, or other ranks on the same node).
+
         Args:
             key (int): The cache key to load.
         Returns:
             typing.Dict[str, torch.Tensor]: Data loaded from the cache.
         """
-        return torch.load(self._get_path(key))
+        return torch.load(self._get_path(key), mmap=True)
+
+    def is_complete(self) -> bool:
+        """Check whether the cache has been marked as complete by `mark_complete()`.
+
+        A cache directory that exists but is not complete was left behind by an interrupted run, and should not be
+        trusted.
+        """
+        return os.path.exists(os.path.join(self._cache_dir, _COMPLETE_MARKER_FILE_NAME))
+
+    def mark_complete(self):
+        """Mark the cache as fully populated, so that it can be re-used by future runs."""
+        with open(os.path.join(self._cache_dir, _COMPLETE_MARKER_FILE_NAME), "w"):
+            pass
+
+    def clear(self):
+        """Delete all entries from the cache (including the complete marker)."""
+        shutil.rmtree(self._cache_dir)
+        os.makedirs(self._cache_dir, exist_ok=True)
@@ -1,10 +1,54 @@
+import bisect
+
+import numpy as np
+
 from invoke_training._shared.data.utils.resolution import Resolution
 
 
+class AspectRatioBucketAssignment:
+    """The aspect ratio bucket of each example in a dataset, stored compactly as an array of bucket ids."""
+
+    def __init__(self, bucket_ids: np.ndarray, buckets: list[Resolution]):
+        """Initialize AspectRatioBucketAssignment.
+
+        Args:
+            bucket_ids (np.ndarray): The bucket id of each example (i.e. an index into `buckets`).
+            buckets (list[Resolution]): The bucket resolutions.
+        """
+        # int16 is enough for any realistic number of buckets, and keeps the array small for very large datasets.
+        dtype = np.int16 if len(buckets) <= np.iinfo(np.int16).max else np.int32
+        self.bucket_ids = np.asarray(bucket_ids).astype(dtype, copy=False)
+        self.buckets = buckets
+
+    @classmethod
+    def concatenate(cls, assignments: list["AspectRatioBucketAssignment"]) -> "AspectRatioBucketAssignment":
+        """Concatenate the assignments of multiple datasets that use the same buckets (e.g. for a ConcatDataset)."""
+        buckets = assignments[0].buckets
+        if any(a.buckets != buckets for a in assignments):
+            raise ValueError("All concatenated AspectRatioBucketAssignments must have the same buckets.")
+        return cls(np.concatenate([a.bucket_ids for a in assignments]), buckets)
+
+    def __len__(self) -> int:
+        return len(self.bucket_ids)
+
+    def __getitem__(self, idx: int) -> Resolution:
+        """Get the bucket resolution of the example at `idx`."""
+        return self.buckets[self.bucket_ids[idx]]
+
+
 class AspectRatioBucketManager:
     def __init__(self, buckets: set[Resolution]):
         self.buckets = buckets
 
+        # The buckets sorted by aspect ratio, for bisect lookups. If multiple buckets have the same aspect ratio, only
+        # the first (in (height, width) order) is ever selected, so the others are excluded.
+        self._sorted_buckets: list[Resolution] = []
+        for bucket in sorted(buckets, key=lambda b: (b.aspect_ratio(), b.to_tuple())):
+            if len(self._sorted_buckets) == 0 or bucket.aspect_ratio() != self._sorted_buckets[-1].aspect_ratio():
+                self._sorted_buckets.append(bucket)
+        self._sorted_aspect_ratios = [b.aspect_ratio() for b in self._sorted_buckets]
+        self._sorted_aspect_ratios_np = np.array(self._sorted_aspect_ratios, dtype=np.float64)
+
     @classmethod
     def from_constraints(cls, target_resolution: int, start_dim: int, end_dim: int, divisible_by: int) -> None:
         buckets = cls.build_aspect_ratio_buckets(
@@ -53,7 +97,54 @@ class AspectRatioBucketManager:
 
         return buckets
 
+    @property
+    def sorted_buckets(self) -> list[Resolution]:
+        """The buckets that can be selected, sorted by aspect ratio. This is the order of the bucket indices returned
+        by `get_aspect_ratio_bucket_indices(...)`.
+        """
+        return self._sorted_buckets
+
     def get_aspect_ratio_bucket(self, resolution: Resolution):
-        """Get the bucket with the closest aspect ratio to 'resolution'."""
-        # Note: If this is ever found to be a bottleneck, there is a clearly-more-efficient implementation using bisect.
-        return min(self.buckets, key=lambda x: abs(x.aspect_ratio() - resolution.aspect_ratio()))
+        """Get the bucket with the closest aspect ratio to 'resolution'. If two buckets are equally close, the one with
+        the smaller aspect ratio is selected.
+        """
+        aspect_ratio = resolution.aspect_ratio()
+        idx = bisect.bisect_left(self._sorted_aspect_ratios, aspect_ratio)
+        if idx == len(self._sorted_aspect_ratios):
+            return self._sorted_buckets[-1]
+        if idx > 0 and (
+            aspect_ratio - self._sorted_aspect_ratios[idx - 1] <= self._sorted_aspect_ratios[idx] - aspect_ratio
+        ):
+            return self._sorted_buckets[idx - 1]
+        return self._sorted_buckets[idx]
+
+    def get_aspect_ratio_bucket_indices(self, image_sizes: list[Resolution] | np.ndarray) -> np.ndarray:
+        """Get the bucket of each of a list of image sizes. This is equivalent to calling `get_aspect_ratio_bucket(...)`
+        for each image size, but is much faster for large datasets.
+
+        Args:
+            image_sizes (list[Resolution] | np.ndarray): The image sizes, either as a list of Resolutions or as an
+                array of shape (N, 2) with the (height, width) of each image.
+
+        Returns:
+            np.ndarray: An int64 array with the index of each image's bucket in `sorted_buckets`.
+        """
+        if isinstance(image_sizes, np.ndarray):
+            sizes = image_sizes.reshape(-1, 2)
+        else:
+            sizes = np.array([image_size.to_tuple() for image_size in image_sizes], dtype=np.int64).reshape(-1, 2)
+        aspect_ratios = sizes[:, 0] / sizes[:, 1]
+
+        ratios = self._sorted_aspect_ratios_np
+        idx = np.searchsorted(ratios, aspect_ratios, side="left")
+        lower_idx = np.clip(idx - 1, 0, len(ratios) - 1)
+        upper_idx = np.clip(idx, 0, len(ratios) - 1)
+        # Same tie-break as get_aspect_ratio_bucket(...): prefer the bucket with the smaller aspect ratio.
+        use_lower = (idx > 0) & (
+            (idx == len(ratios)) | (aspect_ratios - ratios[lower_idx] <= ratios[upper_idx] - aspect_ratios)
+        )
+        return np.where(use_lower, lower_idx, upper_idx).astype(np.int64)
+
+    def assign_aspect_ratio_buckets(self, image_sizes: list[Resolution] | np.ndarray) -> AspectRatioBucketAssignment:
+        """Assign each of a list of image sizes to a bucket (see `get_aspect_ratio_bucket_indices(...)`)."""
+        return AspectRatioBucketAssignment(self.get_aspect_ratio_bucket_indices(image_sizes), self.sorted_buckets)
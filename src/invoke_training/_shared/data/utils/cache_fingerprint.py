@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import re
+import typing
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from invoke_training._shared.data.utils.image_dimension_index import IMAGE_DIMENSION_INDEX_FILE_NAME
+from invoke_training._shared.utils.jsonl import iter_jsonl
+from invoke_training.config.data.dataset_config import HFHubImageCaptionDatasetConfig, ImageCaptionJsonlDatasetConfig
+
+# Data loader config fields that do not affect the contents of a cache.
+_IGNORED_DATA_LOADER_FIELDS = {"dataloader_num_workers"}
+
+# The config fields (and cache key components) that hold local paths of cache inputs: dataset files, and local model
+# files or directories. Strings in these fields are replaced with the fingerprint of the path that they refer to (see
+# `get_path_fingerprint(...)`). All other strings are used as-is.
+_PATH_FIELDS = {
+    "dataset_dir",
+    "jsonl_path",
+    "dataset_name",
+    "model",
+    "vae_model",
+    "text_encoder_1_path",
+    "text_encoder_2_path",
+    "base_embeddings",
+}
+
+_COMMIT_HASH_PATTERN = re.compile(r"[0-9a-f]{40}")
+
+
+def _hash_file_stats(paths: typing.Iterable[str]) -> str:
+    """Hash the (path, size, modification time) of each file in `paths`."""
+    hasher = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        hasher.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return hasher.hexdigest()
+
+
+def get_path_fingerprint(path: str) -> str:
+    """Get a fingerprint of the file or directory at `path`.
+
+    The fingerprint is based on the path, size and modification time of every file, so it changes whenever a file is
+    added, removed, or modified. File contents are not read, so this is cheap even for very large directories.
+
+    Image dimension index files (see `ImageDimensionIndex`) are skipped. They are written to dataset directories by the
+    datasets themselves, and don't affect the dataset contents.
+
+    If `path` does not exist (e.g. it is a Hugging Face Hub model name), then `path` is returned unchanged.
+    """
+    if not os.path.exists(path):
+        return path
+
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+        file_paths = [path]
+    else:
+        file_paths = []
+        for dir_path, dir_names, file_names in os.walk(path):
+            # Sort in-place so that os.walk(...) visits sub-directories in a deterministic order.
+            dir_names.sort()
+            file_paths.extend(
+                os.path.join(dir_path, file_name)
+                for file_name in sorted(file_names)
+                if not file_name.startswith(IMAGE_DIMENSION_INDEX_FILE_NAME)
+            )
+
+    return f"{path}:{_hash_file_stats(file_paths)}"
+
+
+def _get_jsonl_dataset_fingerprint(config: ImageCaptionJsonlDatasetConfig) -> str:
+    """Get a fingerprint of a JSONL dataset that covers both the .jsonl file and all of the files that it references."""
+    jsonl_path = Path(config.jsonl_path)
+    paths = [str(jsonl_path)]
+    for row in iter_jsonl(jsonl_path):
+        for column in (config.image_column, "mask"):
+            file_path = row.get(column, None)
+            if file_path:
+                file_path = Path(file_path)
+                # Paths can be either absolute, or relative to the jsonl file.
+                if not file_path.is_absolute():
+                    file_path = jsonl_path.parent / file_path
+                paths.append(str(file_path))
+
+    return _hash_file_stats(paths)
+
+
+def _get_path_field_fingerprint(value: typing.Any) -> typing.Any:
+    """Get the fingerprint of the value of a path field, which is either a path or a collection of paths."""
+    if isinstance(value, str):
+        return get_path_fingerprint(value)
+    elif isinstance(value, dict):
+        return {str(k): _get_path_field_fingerprint(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_get_path_field_fingerprint(v) for v in value]
+    return value
+
+
+def _check_hf_hub_dataset_is_pinned(config: HFHubImageCaptionDatasetConfig):
+    """Check that a Hugging Face Hub dataset refers to a fixed version of the dataset.
+
+    The contents of an unpinned Hub dataset can change without any change to its config, which would cause a stale
+    persistent cache to be re-used.
+
+    Raises:
+        ValueError: If the dataset is loaded from the Hub, and its `revision` is not a commit hash.
+    """
+    if os.path.exists(config.dataset_name):
+        # The dataset is loaded from a local directory, which is fingerprinted like any other dataset directory.
+        return
+    if config.revision is None or _COMMIT_HASH_PATTERN.fullmatch(config.revision) is None:
+        raise ValueError(
+            f"Persistent caches can't be used with the Hugging Face Hub dataset '{config.dataset_name}', because it is "
+            f"not pinned to a fixed version (revision={config.revision!r}). Set the dataset `revision` to a commit "
+            "hash, or unset `cache_dir` to use a temporary cache."
+        )
+
+
+def get_config_fingerprint(value: typing.Any) -> typing.Any:
+    """Convert `value` into a JSON-serializable fingerprint.
+
+    Config models are converted to dicts, and the strings in path fields (dataset directories, JSONL files and local
+    model paths) are replaced with the fingerprint of the path that they refer to. As a result, the fingerprint of a
+    data loader config changes if any of the dataset files that it refers to are modified.
+
+    Raises:
+        ValueError: If `value` contains a Hugging Face Hub dataset that is not pinned to a commit hash.
+    """
+    if isinstance(value, ImageCaptionJsonlDatasetConfig):
+        fingerprint = get_config_fingerprint(dict(value))
+        fingerprint["jsonl_files"] = _get_jsonl_dataset_fingerprint(value)
+        return fingerprint
+    elif isinstance(value, HFHubImageCaptionDatasetConfig):
+        _check_hf_hub_dataset_is_pinned(value)
+        return get_config_fingerprint(dict(value))
+    elif isinstance(value, (BaseModel, dict)):
+        items = dict(value).items()
+        if isinstance(value, BaseModel):
+            items = [(k, v) for k, v in items if k not in _IGNORED_DATA_LOADER_FIELDS]
+        return {
+            str(k): _get_path_field_fingerprint(v) if k in _PATH_FIELDS else get_config_fingerprint(v) for k, v in items
+        }
+    elif isinstance(value, (list, tuple)):
+        return [get_config_fingerprint(v) for v in value]
+    return value
+
+
+def compute_cache_key(**components: typing.Any) -> str:
+    """Compute a content-addressed cache key from a set of named components (model, dtype, data loader config, etc.)."""
+    fingerprint = get_config_fingerprint(components)
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_persistent_cache_dir(cache_root: str, cache_name: str, **components: typing.Any) -> str:
+    """Get the directory for a persistent cache under `cache_root`.
+
+    The directory name is a content-addressed key computed from `components`, so a cache populated by a previous run is
+    re-used if (and only if) all of its inputs are unchanged. Changing any input (e.g. editing a dataset image, or
+    changing the model or dtype) results in a new cache directory.
+
+    Args:
+        cache_root (str): The root directory for all persistent caches.
+        cache_name (str): The cache name (e.g. "vae_output"). Used as a sub-directory of `cache_root`.
+        **components: All of the inputs that affect the cache contents.
+
+    Returns:
+        str: The cache directory path.
+    """
+    return os.path.join(cache_root, cache_name, compute_cache_key(cache_name=cache_name, **components))
@@ -0,0 +1,301 @@
+import queue
+import tempfile
+import threading
+import typing
+
+import torch
+from accelerate import Accelerator
+from accelerate.utils import broadcast_object_list
+from torch.utils.data import DataLoader
+from tqdm.auto import tqdm
+
+from invoke_training._shared.data.transforms.caption_cache_key_transform import get_caption_cache_key
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import ShardedTensorDiskCache
+
+# A function that takes a data batch and returns a dict of batched outputs to be cached. Each output value must be
+# indexable by the example's position in the batch (e.g. a torch.Tensor with a leading batch dimension, or a list).
+CacheBuilderFn = typing.Callable[[dict[str, typing.Any]], dict[str, typing.Any]]
+
+# A function that takes a data batch and returns the cache key of each example in the batch.
+CacheKeyFn = typing.Callable[[dict[str, typing.Any]], list[str]]
+
+
+def get_caption_cache_keys(data_batch: dict[str, typing.Any]) -> list[str]:
+    """A CacheKeyFn that keys each example by its caption (see `get_caption_cache_key(...)`)."""
+    return [get_caption_cache_key(caption) for caption in data_batch["caption"]]
+
+
+def make_temporary_cache_dir(accelerator: Accelerator) -> tuple[tempfile.TemporaryDirectory | None, str]:
+    """Create a temporary cache directory that is shared by all processes.
+
+    The directory is created by the main process, and its path is broadcast to all other processes.
+
+    Returns:
+        tuple[tempfile.TemporaryDirectory | None, str]: The TemporaryDirectory (None on all processes other than the
+            main process) and the directory path. The caller must hold a reference to the TemporaryDirectory for as
+            long as the cache is needed, because the directory is deleted when it is destroyed.
+    """
+    tmp_dir = tempfile.TemporaryDirectory() if accelerator.is_main_process else None
+    tmp_dir_name = broadcast_object_list([tmp_dir.name if tmp_dir is not None else None])[0]
+    return tmp_dir, tmp_dir_name
+
+
+class _AsyncCacheWriter:
+    """Saves batches of cache entries on a background thread, so that writing one batch overlaps with computing the
+    next.
+
+    At most `max_pending_batches` batches are queued at a time. This bounds the memory held by outputs that are waiting
+    to be written, and applies back-pressure if writing is slower than computing.
+    """
+
+    def __init__(self, max_pending_batches: int):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending_batches)
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def num_pending_batches(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                # Keep draining the queue so that submit(...) never blocks after a failure.
+                continue
+            try:
+                self._save_batch(*item)
+            except BaseException as e:
+                self._error = e
+
+    @staticmethod
+    def _save_batch(cache: ShardedTensorDiskCache, keys: list, outputs: dict[str, typing.Any]):
+        # Copy tensors to the CPU once per batch rather than once per example.
+        outputs = {k: v.detach().cpu() if isinstance(v, torch.Tensor) else v for k, v in outputs.items()}
+        # Split batch before caching.
+        for i, key in enumerate(keys):
+            cache.save(key, {k: v[i] for k, v in outputs.items()})
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError("Failed to write to the cache.") from self._error
+
+    def submit(self, cache: ShardedTensorDiskCache, keys: list, outputs: dict[str, typing.Any]):
+        """Queue a batch of outputs to be saved in `cache` under `keys`. Blocks if the queue is full."""
+        self._raise_if_failed()
+        self._queue.put((cache, keys, outputs))
+
+    def close(self, raise_if_failed: bool = True):
+        """Wait for all queued batches to be written, and stop the background thread.
+
+        Args:
+            raise_if_failed (bool, optional): Whether to raise if any write failed. Set to False when closing the
+                writer while another error is propagating, so that the original error isn't masked.
+
+        Raises:
+            RuntimeError: If any write failed (and `raise_if_failed` is True).
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if raise_if_failed:
+            self._raise_if_failed()
+
+
+def _shard_data_loader(data_loader: DataLoader, process_index: int, num_processes: int) -> DataLoader:
+    """Get a DataLoader that yields every `num_processes`-th batch of `data_loader`, starting at `process_index`."""
+    # data_loader must iterate deterministically, so that all processes agree on the batch assignment.
+    batches = list(data_loader.batch_sampler)
+    return DataLoader(
+        data_loader.dataset,
+        batch_sampler=batches[process_index::num_processes],
+        collate_fn=data_loader.collate_fn,
+        num_workers=data_loader.num_workers,
+    )
+
+
+def _select_examples(data_batch: dict[str, typing.Any], indices: list[int]) -> dict[str, typing.Any]:
+    """Select a subset of the examples in a data batch."""
+    selected = {}
+    for k, v in data_batch.items():
+        if isinstance(v, torch.Tensor):
+            selected[k] = v[indices]
+        elif isinstance(v, list):
+            selected[k] = [v[i] for i in indices]
+        else:
+            selected[k] = v
+    return selected
+
+
+def _get_examples_to_cache(
+    data_batch: dict[str, typing.Any], key_fn: CacheKeyFn | None, written_keys: set[str] | None
+) -> tuple[list[str], dict[str, typing.Any]]:
+    """Get the keys and the examples of `data_batch` that should be cached.
+
+    If `key_fn` is None, all examples are cached, keyed by their id. Otherwise, only the examples whose keys are not in
+    `written_keys` are cached (keeping only the first example with each key), and their keys are added to
+    `written_keys`.
+    """
+    if key_fn is None:
+        return data_batch["id"], data_batch
+
+    keys = key_fn(data_batch)
+    indices = []
+    for i, key in enumerate(keys):
+        if key not in written_keys:
+            written_keys.add(key)
+            indices.append(i)
+
+    if len(indices) == len(keys):
+        return keys, data_batch
+    return [keys[i] for i in indices], _select_examples(data_batch, indices)
+
+
+def _wait_for_everyone_and_check_errors(accelerator: Accelerator | None, error: Exception | None):
+    """Wait for all processes to reach this point, and then raise if any of them failed.
+
+    This replaces `accelerator.wait_for_everyone()` for steps that can fail. A process that fails must still reach this
+    point rather than raising immediately, otherwise the other processes would wait for it forever. Instead, the
+    failure is shared with all processes here, and every process raises.
+
+    Args:
+        accelerator (Accelerator | None): The accelerator used to synchronize the processes.
+        error (Exception | None): The error raised by this process since the last synchronization point, if any.
+
+    Raises:
+        Exception: `error`, if it is not None.
+        RuntimeError: If another process failed.
+    """
+    num_failed = 0 if error is None else 1
+    if accelerator is not None:
+        num_failed = int(
+            accelerator.reduce(torch.tensor([num_failed], device=accelerator.device), reduction="sum").item()
+        )
+    if error is not None:
+        raise error
+    if num_failed > 0:
+        raise RuntimeError(f"Failed to populate the caches on {num_failed} other process(es).")
+
+
+def _write_cache_entries(
+    data_loader: DataLoader,
+    cache_builders: dict[str, CacheBuilderFn],
+    caches: dict[str, ShardedTensorDiskCache],
+    cache_key_fns: dict[str, CacheKeyFn],
+    max_pending_batches: int,
+    show_progress: bool,
+):
+    """Compute and save the cache entries for every batch in `data_loader`, and then write the index part of each
+    cache.
+    """
+    written_keys: dict[str, set[str]] = {cache_dir: set() for cache_dir in cache_key_fns}
+    writer = _AsyncCacheWriter(max_pending_batches=max_pending_batches)
+    try:
+        progress_bar = tqdm(data_loader, disable=not show_progress)
+        for data_batch in progress_bar:
+            for cache_dir, build_fn in cache_builders.items():
+                keys, cache_batch = _get_examples_to_cache(
+                    data_batch, cache_key_fns.get(cache_dir, None), written_keys.get(cache_dir, None)
+                )
+                if len(keys) == 0:
+                    continue
+                writer.submit(caches[cache_dir], keys, build_fn(cache_batch))
+            progress_bar.set_postfix(pending_writes=writer.num_pending_batches)
+    except BaseException:
+        # Stop the writer thread, without masking the original error with a write error.
+        writer.close(raise_if_failed=False)
+        raise
+    # Wait for all pending writes to finish.
+    writer.close()
+
+    for cache in caches.values():
+        cache.write_index_part()
+
+
+def populate_tensor_disk_caches(
+    data_loader: DataLoader,
+    cache_builders: dict[str, CacheBuilderFn],
+    accelerator: Accelerator | None = None,
+    cache_key_fns: dict[str, CacheKeyFn] | None = None,
+    compressed_cache_dirs: typing.Collection[str] = (),
+    max_pending_batches: int = 2,
+):
+    """Populate one or more tensor disk caches in a single pass over a data loader.
+
+    Each batch is only loaded once (i.e. every image is only decoded and resized once), and is then passed to every
+    cache builder. The results are split into individual examples and saved under the example's "id". Results are
+    written to disk on a background thread, so that computing the outputs for one batch overlaps with writing the
+    previous one. All writes are flushed to disk before this function returns.
+
+    If `accelerator` is provided, then this function must be called by all processes. The batches are split between the
+    processes so that each process encodes a disjoint slice of the dataset, and the per-process results are merged
+    into a single index once all processes are done. If any process fails, then all processes raise (rather than
+    waiting for the failed process). All processes must have access to the cache directories (e.g. they run on a single
+    node, or the directories are on a shared filesystem).
+
+    By default, entries are keyed by example id. Caches with an entry in `cache_key_fns` are instead keyed by the
+    returned keys, and are deduplicated: the outputs for each key are only computed and saved once (per process), and
+    the first entry for each key is kept when the per-process results are merged. This is intended for
+    content-addressed caches, e.g. text encoder outputs keyed by caption.
+
+    Args:
+        data_loader (DataLoader): The data loader to iterate over. Each example in the dataset should be visited exactly
+            once, in a deterministic order.
+        cache_builders (dict[str, CacheBuilderFn]): A map of cache directories to the functions that compute the
+            data to be cached in them.
+        accelerator (Accelerator, optional): The accelerator used to split the work between processes.
+        cache_key_fns (dict[str, CacheKeyFn], optional): A map of cache directories to the functions that compute the
+            cache keys of the examples in a batch.
+        compressed_cache_dirs (typing.Collection[str], optional): The cache directories whose tensors should be
+            losslessly compressed (see `ShardedTensorDiskCache(compress=...)`).
+        max_pending_batches (int, optional): The maximum number of computed batches that can be waiting to be written
+            at any time.
+    """
+    process_index = 0 if accelerator is None else accelerator.process_index
+    num_processes = 1 if accelerator is None else accelerator.num_processes
+    cache_key_fns = cache_key_fns or {}
+
+    caches: dict[str, ShardedTensorDiskCache] = {}
+    error = None
+    try:
+        for cache_dir in cache_builders:
+            cache = ShardedTensorDiskCache(
+                cache_dir, writer_rank=process_index, compress=cache_dir in compressed_cache_dirs
+            )
+            if process_index == 0:
+                # Discard any partial results left behind by an interrupted run.
+                cache.clear()
+            caches[cache_dir] = cache
+    except Exception as e:
+        error = e
+
+    # Wait for the caches to be cleared before any process starts writing to them.
+    _wait_for_everyone_and_check_errors(accelerator, error)
+
+    try:
+        if num_processes > 1:
+            data_loader = _shard_data_loader(data_loader, process_index, num_processes)
+        _write_cache_entries(
+            data_loader,
+            cache_builders,
+            caches,
+            cache_key_fns,
+            max_pending_batches=max_pending_batches,
+            show_progress=process_index == 0,
+        )
+    except Exception as e:
+        error = e
+
+    # Wait for all processes to finish writing before merging their results.
+    _wait_for_everyone_and_check_errors(accelerator, error)
+
+    try:
+        if process_index == 0:
+            for cache_dir, cache in caches.items():
+                cache.merge_index_parts(allow_duplicate_keys=cache_dir in cache_key_fns)
+    except Exception as e:
+        error = e
+
+    _wait_for_everyone_and_check_errors(accelerator, error)
@@ -0,0 +1,47 @@
+import logging
+import os
+import random
+import time
+
+import torch
+
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import ShardedTensorDiskCache
+
+
+def get_dir_size_bytes(dir_path: str) -> int:
+    """Get the total size of all files in `dir_path` (recursively)."""
+    size = 0
+    for dir_name, _, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            size += os.path.getsize(os.path.join(dir_name, file_name))
+    return size
+
+
+def measure_cache_load_time(cache: ShardedTensorDiskCache, num_samples: int = 32, seed: int = 0) -> float:
+    """Measure the mean time to load and decode a cache entry, in seconds.
+
+    A random sample of entries is loaded, and every tensor is copied into new memory, so that the measurement includes
+    the cost of reading memory-mapped pages and of decompressing compressed entries.
+    """
+    keys = cache.keys()
+    keys = random.Random(seed).sample(keys, min(num_samples, len(keys)))
+    if len(keys) == 0:
+        return 0.0
+
+    start = time.perf_counter()
+    for key in keys:
+        for value in cache.load(key).values():
+            if isinstance(value, torch.Tensor):
+                value.clone()
+    return (time.perf_counter() - start) / len(keys)
+
+
+def log_cache_stats(logger: logging.Logger, cache_name: str, cache_dir: str):
+    """Log the size of a cache, and the cost of loading its entries."""
+    cache = ShardedTensorDiskCache(cache_dir)
+    size_mib = get_dir_size_bytes(cache_dir) / 2**20
+    load_time_ms = measure_cache_load_time(cache) * 1000
+    logger.info(
+        f"{cache_name} cache: {len(cache)} entries, {size_mib:.1f} MiB on disk, {load_time_ms:.2f} ms to load and "
+        "decode each entry."
+    )
@@ -0,0 +1,15 @@
+import torch
+
+
+def sample_cached_latents(data_batch: dict, dtype: torch.dtype) -> torch.Tensor:
+    """Get the latents for a data batch whose VAE outputs were loaded from a cache.
+
+    If the cache stores the latent distribution (i.e. the batch has a 'vae_output_std' field in addition to the
+    'vae_output' mean), then a new latent sample is drawn from it. The latents are cast to `dtype`, because the cache
+    may store them at a reduced precision.
+    """
+    latents = data_batch["vae_output"].to(dtype=dtype)
+    latents_std = data_batch.get("vae_output_std", None)
+    if latents_std is not None:
+        latents = latents + latents_std.to(dtype=dtype) * torch.randn_like(latents)
+    return latents
@@ -0,0 +1,73 @@
+import array
+import typing
+
+import numpy as np
+
+
+class CompactStringArray:
+    """An immutable array of optional strings, stored as a single contiguous UTF-8 byte buffer plus an offset array.
+
+    A list of N strings is N + 1 Python objects. Reading any of them updates its refcount, which writes to the memory
+    page that holds it. In forked DataLoader workers, this gradually copies the whole list into each worker (defeating
+    copy-on-write). A CompactStringArray is a fixed, small number of objects regardless of its length, so it stays
+    shared between workers.
+    """
+
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray, is_none: np.ndarray):
+        """Initialize CompactStringArray. Use `CompactStringArray.from_strings(...)` or CompactStringArrayBuilder to
+        construct an array from a sequence of strings.
+
+        Args:
+            buffer (np.ndarray): A uint8 array with the concatenated UTF-8 encoded strings.
+            offsets (np.ndarray): An int64 array of length N + 1. String i is `buffer[offsets[i]:offsets[i + 1]]`.
+            is_none (np.ndarray): A bool array of length N that is True for None values.
+        """
+        self._buffer = buffer
+        self._offsets = offsets
+        self._is_none = is_none
+
+    @classmethod
+    def from_strings(cls, values: typing.Iterable[str | None]) -> "CompactStringArray":
+        builder = CompactStringArrayBuilder()
+        for value in values:
+            builder.append(value)
+        return builder.build()
+
+    @property
+    def num_bytes(self) -> int:
+        """The total size of the arrays that back this CompactStringArray."""
+        return self._buffer.nbytes + self._offsets.nbytes + self._is_none.nbytes
+
+    def __len__(self) -> int:
+        return len(self._is_none)
+
+    def __getitem__(self, idx: int) -> str | None:
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Index {idx} is out of range for a CompactStringArray of length {len(self)}.")
+        if self._is_none[idx]:
+            return None
+        return self._buffer[self._offsets[idx] : self._offsets[idx + 1]].tobytes().decode("utf-8")
+
+
+class CompactStringArrayBuilder:
+    """Builds a CompactStringArray one value at a time, without holding a list of the values."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offsets = array.array("q", [0])
+        self._is_none = array.array("b")
+
+    def append(self, value: str | None):
+        if value is not None:
+            self._buffer += value.encode("utf-8")
+        self._offsets.append(len(self._buffer))
+        self._is_none.append(value is None)
+
+    def build(self) -> CompactStringArray:
+        return CompactStringArray(
+            buffer=np.frombuffer(bytes(self._buffer), dtype=np.uint8),
+            offsets=np.frombuffer(self._offsets, dtype=np.int64).copy(),
+            is_none=np.frombuffer(self._is_none, dtype=np.int8).astype(bool),
+        )
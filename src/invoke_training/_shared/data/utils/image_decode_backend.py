@@ -0,0 +1,45 @@
+import typing
+from pathlib import Path
+
+import torch
+from PIL import Image
+from torchvision.io import ImageReadMode, decode_image
+from torchvision.transforms.functional import convert_image_dtype, to_tensor
+
+# The backend used to decode image files.
+# - "pil": Decode to PIL images.
+# - "torchvision": Decode directly to uint8 tensors with `torchvision.io.decode_image(...)` (libjpeg-turbo / libpng),
+#   so that the subsequent resize, crop and normalization are all done in tensor space.
+ImageDecodeBackend = typing.Literal["pil", "torchvision"]
+
+# A decoded image. uint8 tensors have shape (C, H, W).
+DecodedImage = Image.Image | torch.Tensor
+
+_PIL_MODE_TO_READ_MODE = {"RGB": ImageReadMode.RGB, "L": ImageReadMode.GRAY}
+
+
+def decode_image_tensor(image_path: str | Path, mode: str = "RGB") -> torch.Tensor:
+    """Decode an image file to a uint8 tensor with shape (C, H, W).
+
+    Args:
+        image_path (str | Path): The image path.
+        mode (str, optional): The PIL mode that the image would be converted to with the "pil" backend. One of "RGB" or
+            "L".
+    """
+    if mode not in _PIL_MODE_TO_READ_MODE:
+        raise ValueError(f"Unsupported image mode for the torchvision decode backend: '{mode}'.")
+    return decode_image(str(image_path), mode=_PIL_MODE_TO_READ_MODE[mode])
+
+
+def get_image_size_hw(image: DecodedImage) -> tuple[int, int]:
+    """Get the (height, width) of a PIL image or a (C, H, W) image tensor."""
+    if isinstance(image, torch.Tensor):
+        return (image.shape[-2], image.shape[-1])
+    return (image.height, image.width)
+
+
+def to_float_tensor(image: DecodedImage) -> torch.Tensor:
+    """Convert a PIL image or a uint8 image tensor to a float32 tensor with shape (C, H, W) and range [0.0, 1.0]."""
+    if isinstance(image, torch.Tensor):
+        return convert_image_dtype(image, torch.float32)
+    return to_tensor(image)
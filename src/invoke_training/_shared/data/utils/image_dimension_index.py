@@ -0,0 +1,142 @@
+import logging
+import os
+import tempfile
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from invoke_training._shared.data.utils.image_probing import ImageProbeExecutor, probe_image_dimensions
+from invoke_training._shared.data.utils.resolution import Resolution
+from invoke_training._shared.utils.jsonl import load_jsonl, save_jsonl
+
+logger = logging.getLogger(__name__)
+
+# The name of the sidecar index file that is written to an image directory.
+IMAGE_DIMENSION_INDEX_FILE_NAME = ".image_dimensions.jsonl"
+
+
+class ImageDimensionIndex:
+    """A persistent index of image dimensions, stored in a sidecar JSONL file.
+
+    Each entry records the height and width of an image under a string key (e.g. the image path). Entries for image
+    files also record the file size and modification time that were observed when the image was measured, and are only
+    re-used while both are unchanged. This allows the index to be updated incrementally when images are added to or
+    modified in a dataset.
+    """
+
+    def __init__(self, index_path: str):
+        self._index_path = index_path
+        self._entries: dict[str, dict[str, typing.Any]] = {}
+        self._is_modified = False
+
+        if os.path.isfile(index_path):
+            try:
+                for entry in load_jsonl(index_path):
+                    self._entries[entry["key"]] = entry
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring unreadable image dimension index '{index_path}': {e}")
+                self._entries = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, key: str, file_size: int | None = None, mtime_ns: int | None = None) -> Resolution | None:
+        """Get the dimensions stored for `key`, or None if there is no up-to-date entry."""
+        entry = self._entries.get(key, None)
+        if entry is None or entry.get("file_size", None) != file_size or entry.get("mtime_ns", None) != mtime_ns:
+            return None
+        return Resolution(entry["height"], entry["width"])
+
+    def update(self, key: str, resolution: Resolution, file_size: int | None = None, mtime_ns: int | None = None):
+        """Add or replace the entry for `key`."""
+        entry = {"key": key, "height": resolution.height, "width": resolution.width}
+        if file_size is not None:
+            entry["file_size"] = file_size
+        if mtime_ns is not None:
+            entry["mtime_ns"] = mtime_ns
+        self._entries[key] = entry
+        self._is_modified = True
+
+    def retain(self, keys: typing.Iterable[str]):
+        """Drop all entries whose keys are not in `keys` (e.g. entries for images that were removed from a dataset)."""
+        keys = set(keys)
+        stale_keys = [key for key in self._entries if key not in keys]
+        for key in stale_keys:
+            del self._entries[key]
+        self._is_modified = self._is_modified or len(stale_keys) > 0
+
+    def save(self):
+        """Write the index to disk, if it has been modified.
+
+        The index is written to a temporary file that is then renamed, so that concurrent readers (e.g. other training
+        processes) never observe a partially-written index. Failing to write the index (e.g. because the dataset is on
+        a read-only filesystem) is not an error, since it only affects the startup time of future runs.
+        """
+        if not self._is_modified:
+            return
+
+        index_dir = os.path.dirname(os.path.abspath(self._index_path))
+        tmp_path = None
+        try:
+            # The temporary file name starts with the index file name, so that it is also skipped when fingerprinting
+            # the dataset directory (see `get_path_fingerprint(...)`).
+            with tempfile.NamedTemporaryFile(
+                dir=index_dir, prefix=os.path.basename(self._index_path) + ".", suffix=".tmp", delete=False
+            ) as f:
+                tmp_path = f.name
+            save_jsonl(list(self._entries.values()), tmp_path)
+            os.replace(tmp_path, self._index_path)
+        except OSError as e:
+            logger.warning(f"Failed to write image dimension index '{self._index_path}': {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._is_modified = False
+
+
+def get_image_file_dimensions(
+    image_paths: typing.Sequence[str],
+    index_path: str | None = None,
+    num_workers: int | None = None,
+    executor: ImageProbeExecutor = "thread",
+) -> list[Resolution]:
+    """Get the dimensions of a list of image files, using a persistent ImageDimensionIndex.
+
+    The index is stored at `index_path` (typically a sidecar file in the dataset directory). Only images that are
+    missing from the index, or that have changed since they were indexed, are probed (see
+    `probe_image_dimensions(...)`).
+
+    Args:
+        image_paths (typing.Sequence[str]): The image file paths.
+        index_path (str, optional): The path of the index file. If None, no index is used.
+        num_workers (int, optional): The number of workers used to stat files and read image headers.
+        executor (ImageProbeExecutor, optional): The type of worker pool used to read image headers.
+
+    Returns:
+        list[Resolution]: The dimensions of each image, in the same order as `image_paths`.
+    """
+    if index_path is None:
+        return probe_image_dimensions(image_paths, num_workers=num_workers, executor=executor)
+
+    index = ImageDimensionIndex(index_path)
+    # Paths are stored relative to the index, so that the dataset can be moved without invalidating it.
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    keys = [os.path.relpath(os.path.abspath(image_path), index_dir) for image_path in image_paths]
+
+    # Checking whether files have been modified is latency-bound on network filesystems, so it is also parallelized.
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        stats = list(pool.map(os.stat, image_paths))
+
+    image_dims: list[Resolution | None] = [
+        index.lookup(key, file_size=stat.st_size, mtime_ns=stat.st_mtime_ns) for key, stat in zip(keys, stats)
+    ]
+
+    missing = [i for i, resolution in enumerate(image_dims) if resolution is None]
+    probed_dims = probe_image_dimensions((image_paths[i] for i in missing), num_workers=num_workers, executor=executor)
+    for i, resolution in zip(missing, probed_dims):
+        image_dims[i] = resolution
+        index.update(keys[i], resolution, file_size=stats[i].st_size, mtime_ns=stats[i].st_mtime_ns)
+
+    index.retain(keys)
+    index.save()
+
+    return image_dims
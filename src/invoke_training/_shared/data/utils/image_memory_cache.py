@@ -0,0 +1,192 @@
+import collections
+import io
+import multiprocessing
+import typing
+
+import torch
+from PIL import Image
+
+# How images are stored in an image memory cache. 'decoded' images are fastest to access. 'encoded' images (i.e. the raw
+# image file bytes) typically take several times less memory, but must be decoded on every access.
+ImageMemoryCacheFormat = typing.Literal["decoded", "encoded"]
+
+
+def _read_image_file(image_path: str) -> bytes:
+    with open(image_path, "rb") as f:
+        return f.read()
+
+
+def _decode_image(data: bytes, mode: str) -> Image.Image:
+    # We call `convert(mode)` to e.g. drop the alpha channel from RGBA images, or to repeat channels for greyscale
+    # images.
+    return Image.open(io.BytesIO(data)).convert(mode)
+
+
+def _load_image(image_path: str, mode: str) -> Image.Image:
+    return Image.open(image_path).convert(mode)
+
+
+def _get_image_num_bytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+class LRUImageCache:
+    """An in-process cache of images with a byte budget.
+
+    When the budget is exceeded, the least-recently-used images are evicted. Note that each DataLoader worker process
+    holds its own copy of the cache. See SharedMemoryImageCache for a cache that is shared between workers.
+    """
+
+    def __init__(self, max_bytes: int | None = None, cache_format: ImageMemoryCacheFormat = "decoded"):
+        """Initialize LRUImageCache.
+
+        Args:
+            max_bytes (int, optional): The maximum total size of the cached images. If None, the cache is unbounded.
+            cache_format (ImageMemoryCacheFormat, optional): How images are stored in the cache.
+        """
+        self._max_bytes = max_bytes
+        self._cache_format = cache_format
+        self._entries: collections.OrderedDict[typing.Hashable, tuple[Image.Image | bytes, int]] = (
+            collections.OrderedDict()
+        )
+        self._num_bytes = 0
+
+    @property
+    def num_bytes(self) -> int:
+        """The total size of the cached images."""
+        return self._num_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._entries
+
+    def load(self, key: typing.Hashable, image_path: str, mode: str = "RGB") -> Image.Image:
+        """Load an image from the cache, or from `image_path` if it is not cached.
+
+        Decoded images are returned as-is from the cache, so the caller must not modify them in-place.
+        """
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            value = entry[0]
+        else:
+            value = _read_image_file(image_path) if self._cache_format == "encoded" else _load_image(image_path, mode)
+            self._insert(key, value)
+
+        return _decode_image(value, mode) if self._cache_format == "encoded" else value
+
+    def _insert(self, key: typing.Hashable, value: Image.Image | bytes):
+        num_bytes = len(value) if isinstance(value, bytes) else _get_image_num_bytes(value)
+        if self._max_bytes is not None and num_bytes > self._max_bytes:
+            return
+
+        self._entries[key] = (value, num_bytes)
+        self._num_bytes += num_bytes
+        while self._max_bytes is not None and self._num_bytes > self._max_bytes:
+            _, (_, evicted_num_bytes) = self._entries.popitem(last=False)
+            self._num_bytes -= evicted_num_bytes
+
+
+class SharedMemoryImageCache:
+    """A cache of images in shared memory, with a byte budget.
+
+    The cache is shared by all processes that it is passed to (e.g. all DataLoader worker processes), so each image is
+    only loaded and stored once. Images are stored in a fixed-size ring buffer that is allocated up front, and are
+    evicted in first-in-first-out order when the buffer wraps around.
+
+    The buffer is allocated with torch shared memory, which is typically backed by /dev/shm. Make sure that /dev/shm is
+    large enough to hold `max_bytes` (e.g. Docker containers default to 64MB).
+    """
+
+    # The columns of the per-entry metadata table.
+    _OFFSET, _NUM_BYTES, _HEIGHT, _WIDTH = range(4)
+
+    def __init__(self, num_entries: int, max_bytes: int, cache_format: ImageMemoryCacheFormat = "decoded"):
+        """Initialize SharedMemoryImageCache.
+
+        Args:
+            num_entries (int): The number of keys. Keys must be integers in the range [0, num_entries).
+            max_bytes (int): The size of the shared buffer.
+            cache_format (ImageMemoryCacheFormat, optional): How images are stored in the cache.
+        """
+        self._max_bytes = max_bytes
+        self._cache_format = cache_format
+        self._buffer = torch.empty(max_bytes, dtype=torch.uint8).share_memory_()
+        # An entry with _NUM_BYTES == 0 is not in the cache.
+        self._entries = torch.zeros((num_entries, 4), dtype=torch.int64).share_memory_()
+        self._write_offset = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self._lock = multiprocessing.Lock()
+
+    def __contains__(self, key: int) -> bool:
+        return self._entries[key, self._NUM_BYTES].item() > 0
+
+    def load(self, key: int, image_path: str, mode: str = "RGB") -> Image.Image:
+        """Load an image from the cache, or from `image_path` if it is not cached."""
+        entry = self._get(key)
+        if entry is None:
+            if self._cache_format == "encoded":
+                entry = (_read_image_file(image_path), 0, 0)
+            else:
+                image = _load_image(image_path, mode)
+                entry = (image.tobytes(), image.height, image.width)
+            self._put(key, *entry)
+
+        data, height, width = entry
+        if self._cache_format == "encoded":
+            return _decode_image(data, mode)
+        return Image.frombytes(mode, (width, height), data)
+
+    def _get(self, key: int) -> tuple[bytes, int, int] | None:
+        with self._lock:
+            offset, num_bytes, height, width = self._entries[key].tolist()
+            if num_bytes == 0:
+                return None
+            # Copy the data while holding the lock, since the buffer region could be overwritten once it is released.
+            return self._buffer[offset : offset + num_bytes].numpy().tobytes(), height, width
+
+    def _put(self, key: int, data: bytes, height: int, width: int):
+        num_bytes = len(data)
+        if num_bytes == 0 or num_bytes > self._max_bytes:
+            return
+
+        with self._lock:
+            if self._entries[key, self._NUM_BYTES].item() > 0:
+                # Another process cached this entry since we checked.
+                return
+
+            offset = self._write_offset.item()
+            if offset + num_bytes > self._max_bytes:
+                offset = 0
+
+            # Evict all entries that overlap with the region that is about to be overwritten.
+            starts = self._entries[:, self._OFFSET]
+            ends = starts + self._entries[:, self._NUM_BYTES]
+            overlapping = (self._entries[:, self._NUM_BYTES] > 0) & (starts < offset + num_bytes) & (ends > offset)
+            self._entries[overlapping, self._NUM_BYTES] = 0
+
+            self._buffer[offset : offset + num_bytes] = torch.frombuffer(bytearray(data), dtype=torch.uint8)
+            self._entries[key] = torch.tensor([offset, num_bytes, height, width], dtype=torch.int64)
+            self._write_offset[0] = offset + num_bytes
+
+
+ImageMemoryCache = LRUImageCache | SharedMemoryImageCache
+
+
+def build_image_memory_cache(
+    num_entries: int,
+    max_bytes: int | None = None,
+    cache_format: ImageMemoryCacheFormat = "decoded",
+    shared: bool = False,
+) -> ImageMemoryCache:
+    """Build an image memory cache for a dataset whose images are keyed by integers in the range [0, num_entries).
+
+    Raises:
+        ValueError: If `shared` is True, but `max_bytes` is not set.
+    """
+    if shared:
+        if max_bytes is None:
+            raise ValueError("A memory budget must be set to keep images in shared memory.")
+        return SharedMemoryImageCache(num_entries=num_entries, max_bytes=max_bytes, cache_format=cache_format)
+    return LRUImageCache(max_bytes=max_bytes, cache_format=cache_format)
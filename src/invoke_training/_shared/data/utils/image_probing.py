@@ -0,0 +1,73 @@
+import io
+import itertools
+import logging
+import time
+import typing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+from invoke_training._shared.data.utils.resolution import Resolution
+
+logger = logging.getLogger(__name__)
+
+# The type of worker pool used to probe image headers. Threads are best suited for I/O-bound probing (e.g. images on a
+# network filesystem). Processes avoid contention on the GIL when probing is CPU-bound (e.g. many small local images).
+ImageProbeExecutor = typing.Literal["thread", "process"]
+
+# An image file path, or the encoded bytes of an image.
+ImageSource = str | bytes
+
+
+def read_image_header_dimensions(image: ImageSource) -> Resolution:
+    """Read the dimensions of an image from its header, without decoding the pixel data."""
+    with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as pil_image:
+        return Resolution(pil_image.height, pil_image.width)
+
+
+def _make_executor(executor: ImageProbeExecutor, num_workers: int | None) -> Executor:
+    if executor == "thread":
+        return ThreadPoolExecutor(max_workers=num_workers)
+    elif executor == "process":
+        return ProcessPoolExecutor(max_workers=num_workers)
+    else:
+        raise ValueError(f"Unsupported image probe executor: '{executor}'.")
+
+
+def probe_image_dimensions(
+    images: typing.Iterable[ImageSource],
+    num_workers: int | None = None,
+    executor: ImageProbeExecutor = "thread",
+    chunk_size: int = 1024,
+) -> list[Resolution]:
+    """Read the dimensions of many images in parallel, by reading only their headers.
+
+    `images` is consumed lazily, `chunk_size` images at a time, so that it can be a generator over a dataset that is
+    too large to hold in memory (e.g. a dataset of encoded image bytes). The probing throughput is logged on completion.
+
+    Args:
+        images (typing.Iterable[ImageSource]): The image file paths or encoded image bytes.
+        num_workers (int, optional): The number of workers in the pool. Defaults to the default of the
+            concurrent.futures executor.
+        executor (ImageProbeExecutor, optional): The type of worker pool to use.
+        chunk_size (int, optional): The number of images that are submitted to the pool at a time.
+
+    Returns:
+        list[Resolution]: The dimensions of each image, in the same order as `images`.
+    """
+    image_dims: list[Resolution] = []
+    start_time = time.perf_counter()
+    with _make_executor(executor, num_workers) as pool:
+        # Sending images to worker processes one at a time has a high overhead, so they are sent in small batches.
+        map_chunksize = 16 if executor == "process" else 1
+        images = iter(images)
+        while chunk := list(itertools.islice(images, chunk_size)):
+            image_dims.extend(pool.map(read_image_header_dimensions, chunk, chunksize=map_chunksize))
+    elapsed = time.perf_counter() - start_time
+
+    if len(image_dims) > 0:
+        logger.info(
+            f"Read {len(image_dims)} image headers in {elapsed:.2f}s ({len(image_dims) / max(elapsed, 1e-9):.0f} "
+            f"images/s) using a {executor} pool."
+        )
+    return image_dims
@@ -0,0 +1,75 @@
+import math
+import typing
+from pathlib import Path
+
+from PIL import Image
+
+from invoke_training._shared.data.utils.pre_resized_image_cache import ORIGINAL_SIZE_HW_INFO_KEY
+from invoke_training._shared.data.utils.resolution import Resolution
+
+
+def open_image_reduced(
+    image_path: str | Path,
+    mode: str = "RGB",
+    get_target_resolution: typing.Callable[[Resolution], Resolution] | None = None,
+) -> Image.Image:
+    """Open and decode an image. For JPEG images, decode at a reduced size if the image is larger than needed.
+
+    JPEG images can be decoded at 1/2, 1/4 or 1/8 scale at a fraction of the cost of a full decode (see
+    `PIL.Image.Image.draft(...)`). The largest reduction is chosen whose result still covers the target resolution, so
+    the result of a subsequent `resize_to_cover(...)` has the same size as for a full-resolution decode. Other image
+    formats are always decoded at full resolution.
+
+    If the image was decoded at a reduced size, the size of the source image is available via
+    `get_original_size_hw(...)`.
+
+    Args:
+        image_path (str | Path): The image path.
+        mode (str, optional): The mode to convert the image to.
+        get_target_resolution (typing.Callable[[Resolution], Resolution], optional): Maps the size of the source image
+            to its target training resolution. If None, the image is decoded at full resolution.
+    """
+    image = Image.open(image_path)
+    if get_target_resolution is None:
+        return image.convert(mode)
+
+    original_size_hw = (image.height, image.width)
+    target_resolution = get_target_resolution(Resolution(*original_size_hw))
+    scale = max(target_resolution.height / image.height, target_resolution.width / image.width)
+    if scale < 1.0:
+        # This is a no-op for non-JPEG images.
+        image.draft(mode, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+
+    # We call `convert(mode)` to e.g. drop the alpha channel from RGBA images, or to repeat channels for greyscale
+    # images.
+    image = image.convert(mode)
+    if (image.height, image.width) != original_size_hw:
+        image.info[ORIGINAL_SIZE_HW_INFO_KEY] = original_size_hw
+    return image
+
+
+def open_mask_reduced(mask_path: str | Path, image: Image.Image, mode: str = "L") -> Image.Image:
+    """Open and decode the mask of an image that was opened with `open_image_reduced(...)`, at the same size as the
+    decoded image.
+
+    The image and its mask may not be reducible in the same way (e.g. a JPEG image with a PNG mask), since only JPEGs
+    are decoded at a reduced size. JPEG masks are decoded at a reduced size where possible, and the mask is then resized
+    to match the image if necessary.
+
+    Args:
+        mask_path (str | Path): The mask path.
+        image (Image.Image): The image that the mask belongs to, as returned by `open_image_reduced(...)`.
+        mode (str, optional): The mode to convert the mask to.
+    """
+    mask = Image.open(mask_path)
+    original_size_hw = (mask.height, mask.width)
+    if mask.size != image.size:
+        # This is a no-op for non-JPEG masks.
+        mask.draft(mode, image.size)
+
+    mask = mask.convert(mode)
+    if mask.size != image.size:
+        mask = mask.resize(image.size, Image.Resampling.BILINEAR)
+    if (mask.height, mask.width) != original_size_hw:
+        mask.info[ORIGINAL_SIZE_HW_INFO_KEY] = original_size_hw
+    return mask
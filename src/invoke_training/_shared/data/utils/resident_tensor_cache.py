@@ -0,0 +1,50 @@
+import torch
+
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import (
+    ShardedTensorDiskCache,
+    open_tensor_disk_cache,
+)
+from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+
+
+class ResidentTensorCache:
+    """Keeps the entries of a TensorDiskCache resident on a device, so that each entry is only read from disk (and
+    copied to the device) once, no matter how many times it is used.
+
+    This is intended for small caches whose entries are shared by many examples, e.g. the text encoder outputs of a
+    dataset with only a handful of distinct captions.
+    """
+
+    def __init__(self, cache: TensorDiskCache, device: torch.device | str):
+        self._cache = cache
+        self._device = device
+        self._entries: dict[str, dict[str, torch.Tensor]] = {}
+
+    def _get_entry(self, key: str) -> dict[str, torch.Tensor]:
+        entry = self._entries.get(key, None)
+        if entry is None:
+            entry = {k: v.to(self._device) for k, v in self._cache.load(key).items()}
+            self._entries[key] = entry
+        return entry
+
+    def load_batch(self, keys: list[str]) -> dict[str, torch.Tensor]:
+        """Load the entries for `keys` and stack each of their fields into a batch."""
+        entries = [self._get_entry(key) for key in keys]
+        return {field_name: torch.stack([entry[field_name] for entry in entries]) for field_name in entries[0]}
+
+
+def build_resident_tensor_cache(
+    cache_dir: str, device: torch.device | str, max_entries: int = 256
+) -> ResidentTensorCache | None:
+    """Build a ResidentTensorCache for the cache in `cache_dir`, if it has at most `max_entries` entries.
+
+    The default `max_entries` bounds the device memory used by SDXL text encoder outputs to a few hundred MB.
+
+    Returns:
+        ResidentTensorCache | None: The ResidentTensorCache, or None if the cache is too large to keep resident (in
+            which case, its entries should be loaded by the DataLoader instead).
+    """
+    cache = open_tensor_disk_cache(cache_dir)
+    if not isinstance(cache, ShardedTensorDiskCache) or len(cache) > max_entries:
+        return None
+    return ResidentTensorCache(cache, device)
@@ -1,6 +1,22 @@
 import json
+import logging
+import os
+import tempfile
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# The size of the chunks that a JSONL file is read in when building a line index.
+_LINE_INDEX_CHUNK_SIZE = 16 * 2**20
+
+# The version of the cached line index format. Cached indexes with a different version are rebuilt.
+_LINE_INDEX_VERSION = 2
+
+# The bytes that are treated as whitespace when skipping blank lines (the same set as `bytes.strip()`).
+_WHITESPACE_BYTES = np.frombuffer(b" \t\n\r\x0b\x0c", dtype=np.uint8)
 
 
 def load_jsonl(jsonl_path: Path | str) -> list[Any]:
@@ -12,8 +28,136 @@ def load_jsonl(jsonl_path: Path | str) -> list[Any]:
     return data
 
 
+def iter_jsonl(jsonl_path: Path | str) -> Iterator[Any]:
+    """Iterate over the rows of a JSONL file without loading the whole file into memory. Blank lines are skipped."""
+    with open(jsonl_path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
 def save_jsonl(data: list[Any], jsonl_path: Path | str) -> None:
     """Save a list of objects to a JSONL file."""
     with open(jsonl_path, "w") as f:
         for line in data:
             f.write(json.dumps(line) + "\n")
+
+
+def build_jsonl_line_index(jsonl_path: Path | str) -> np.ndarray:
+    """Build an index of the non-blank lines in a JSONL file. Lines that only contain whitespace (e.g. the "\r" left
+    behind by a blank line with CRLF line endings) are skipped, consistent with `iter_jsonl(...)`.
+
+    Returns:
+        np.ndarray: An int64 array of shape (num_lines, 2), with the [start, end) byte offsets of each line.
+    """
+    starts = []
+    ends = []
+    # The running count of non-whitespace bytes in the file, at the end of each line.
+    non_whitespace_counts = []
+    offset = 0
+    line_start = 0
+    non_whitespace_count = 0
+    with open(jsonl_path, "rb") as f:
+        while chunk := f.read(_LINE_INDEX_CHUNK_SIZE):
+            chunk_bytes = np.frombuffer(chunk, dtype=np.uint8)
+            local_newlines = np.flatnonzero(chunk_bytes == ord("\n"))
+            chunk_non_whitespace_counts = np.cumsum(~np.isin(chunk_bytes, _WHITESPACE_BYTES)) + non_whitespace_count
+            if len(local_newlines) > 0:
+                newlines = local_newlines + offset
+                starts.append(np.concatenate([[line_start], newlines[:-1] + 1]))
+                ends.append(newlines)
+                non_whitespace_counts.append(chunk_non_whitespace_counts[local_newlines])
+                line_start = newlines[-1] + 1
+            non_whitespace_count = int(chunk_non_whitespace_counts[-1])
+            offset += len(chunk)
+    # The last line may not end with a newline.
+    starts.append([line_start])
+    ends.append([offset])
+    non_whitespace_counts.append([non_whitespace_count])
+
+    spans = np.stack([np.concatenate(starts), np.concatenate(ends)], axis=1).astype(np.int64)
+    # Drop blank lines (including the empty "line" after a trailing newline), i.e. the lines that don't add to the
+    # count of non-whitespace bytes.
+    is_blank = np.diff(np.concatenate(non_whitespace_counts), prepend=0) == 0
+    return spans[~is_blank]
+
+
+class IndexedJsonlFile:
+    """Random access to the rows of a JSONL file, without loading the whole file into memory.
+
+    Rows are parsed on demand, using an index of the byte offsets of each line. Only the index (16 bytes per row) is
+    held in memory, as a single array, so it is cheap to copy into DataLoader worker processes.
+
+    The index is cached in a binary sidecar file, and is re-used while the size and modification time of the JSONL file
+    are unchanged.
+    """
+
+    def __init__(self, jsonl_path: Path | str, index_path: Path | str | None = None):
+        """Initialize IndexedJsonlFile.
+
+        Args:
+            jsonl_path (Path | str): The path to the JSONL file.
+            index_path (Path | str, optional): The path of the cached index file. Defaults to
+                '.{jsonl file stem}.line_index.npz' next to the JSONL file.
+        """
+        self._jsonl_path = Path(jsonl_path)
+        if index_path is None:
+            index_path = self._jsonl_path.parent / f".{self._jsonl_path.stem}.line_index.npz"
+        self._index_path = Path(index_path)
+        self._spans = self._load_or_build_index()
+
+        # The file handle is opened lazily, and is re-opened in forked processes so that they don't share a file
+        # position.
+        self._file = None
+        self._file_pid = None
+
+    def _load_or_build_index(self) -> np.ndarray:
+        stat = os.stat(self._jsonl_path)
+        if self._index_path.is_file():
+            try:
+                with np.load(self._index_path, allow_pickle=False) as index:
+                    if (
+                        "version" in index.files
+                        and int(index["version"]) == _LINE_INDEX_VERSION
+                        and int(index["file_size"]) == stat.st_size
+                        and int(index["mtime_ns"]) == stat.st_mtime_ns
+                    ):
+                        return index["spans"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring unreadable JSONL line index '{self._index_path}': {e}")
+
+        spans = build_jsonl_line_index(self._jsonl_path)
+        try:
+            # Write to a temporary file and then rename it, so that readers never see a partially-written index.
+            fd, tmp_path = tempfile.mkstemp(dir=self._index_path.parent, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, spans=spans, version=_LINE_INDEX_VERSION, file_size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            os.replace(tmp_path, self._index_path)
+        except OSError as e:
+            logger.warning(f"Failed to write JSONL line index '{self._index_path}': {e}")
+        return spans
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def __getitem__(self, idx: int) -> Any:
+        start, end = self._spans[idx]
+        f = self._get_file()
+        f.seek(start)
+        return json.loads(f.read(end - start))
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter_jsonl(self._jsonl_path)
+
+    def _get_file(self):
+        if self._file is None or self._file_pid != os.getpid():
+            self._file = open(self._jsonl_path, "rb")
+            self._file_pid = os.getpid()
+        return self._file
+
+    def __getstate__(self) -> dict[str, Any]:
+        # File handles can't be pickled (e.g. when passed to spawned DataLoader workers).
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_file_pid"] = None
+        return state
@@ -38,6 +38,34 @@ class AspectRatioBucketConfig(ConfigBaseModel):
     [`start_dim`][invoke_training.config.data.data_loader_config.AspectRatioBucketConfig.start_dim].
     """
 
+    max_pixels_per_batch: int | None = None
+    """If set, each bucket gets its own batch size: the largest batch size whose total number of pixels
+    (`batch_size * height * width`) is at most `max_pixels_per_batch` (and at least 1). This keeps memory use and GPU
+    utilization roughly uniform across buckets, e.g. `max_pixels_per_batch = train_batch_size * target_resolution**2`.
+
+    The training batch size is still used as the reference batch size: the loss of each example is scaled by
+    `bucket_batch_size / train_batch_size`, so that every example contributes equally to the gradient, and the learning
+    rate keeps its meaning for a batch of `train_batch_size` examples. The number of steps per epoch accounts for the
+    per-bucket batch sizes.
+    """
+
+    partial_batches: Literal["keep", "carry_over", "drop_last", "merge_adjacent"] = "keep"
+    """How to handle the partial batch at the end of each bucket. Fragmented buckets produce many partial batches, which
+    are less efficient than full batches.
+
+    - `"keep"`: Train on the partial batches.
+    - `"carry_over"`: Defer the examples of each partial batch to the start of the same bucket in the next epoch. Every
+    example is still trained on once per epoch on average.
+    - `"drop_last"`: Drop the partial batches. The dropped examples change from epoch to epoch.
+    - `"merge_adjacent"`: Merge each bucket with fewer examples than its batch size into the adjacent bucket with the
+    closest aspect ratio. Merged examples are resized and cropped to the resolution of the bucket they are merged into.
+    Can't be combined with `pre_resize_cache_dir` or `reduced_size_jpeg_decoding`, which size images for their original
+    bucket.
+
+    With `"carry_over"` and `"drop_last"`, a bucket with fewer examples than its batch size still trains on its partial
+    batch. The number of partial batches avoided per epoch is logged at the start of training.
+    """
+
 
 class ImageCaptionSDDataLoaderConfig(ConfigBaseModel):
     type: Literal["IMAGE_CAPTION_SD_DATA_LOADER"] = "IMAGE_CAPTION_SD_DATA_LOADER"
@@ -61,6 +89,35 @@ class ImageCaptionSDDataLoaderConfig(ConfigBaseModel):
     """Whether random flip augmentations should be applied to input images.
     """
 
+    num_cached_random_crops: int = 4
+    """The number of random crops of each image to cache when VAE outputs are cached and `center_crop` is False. Each
+    time an image is loaded, one of its cached crops is selected at random (along with its flipped or unflipped
+    variant, if `random_flip` is True). Higher values preserve more of the random crop augmentation, at the cost of
+    more cache storage and a longer caching step.
+    """
+
+    pre_resize_cache_dir: str | None = None
+    """If set, images are resized to cover their target resolution once, and the resized images are cached in this
+    directory. Subsequent loads decode the (much smaller) resized image rather than the full-resolution source image,
+    which can substantially reduce data loading time for high-resolution datasets. Resized images are stored losslessly,
+    and random crop and flip augmentations are still applied on each load. Only supported for image directory and
+    jsonl datasets that do not use `keep_in_memory`. Ignored when VAE outputs are cached.
+    """
+
+    reduced_size_jpeg_decoding: bool = False
+    """If True, JPEG images that are larger than their target resolution are decoded at 1/2, 1/4 or 1/8 scale (the
+    largest reduction that still covers the target resolution), rather than decoded at full resolution and then
+    downscaled. This makes data loading several times faster for high-resolution photo datasets, with a small change in
+    image quality. Only supported for image directory and jsonl datasets that do not use `keep_in_memory`.
+    """
+
+    image_decode_backend: Literal["pil", "torchvision"] = "pil"
+    """The backend used to decode image files. "pil" decodes to PIL images. "torchvision" decodes directly to uint8
+    tensors with `torchvision.io.decode_image(...)`, and then does the resize, crop and normalization in tensor space,
+    which is typically faster. Images are resized with antialiased bilinear interpolation in both cases, but the results
+    are not bit-identical. "torchvision" can't be combined with `reduced_size_jpeg_decoding`.
+    """
+
     caption_prefix: str | None = None
     """A prefix that will be prepended to all captions. If None, no prefix will be added.
     """
@@ -92,6 +149,28 @@ class ImageCaptionFluxDataLoaderConfig(ConfigBaseModel):
     """Whether random flip augmentations should be applied to input images.
     """
 
+    pre_resize_cache_dir: str | None = None
+    """If set, images are resized to cover their target resolution once, and the resized images are cached in this
+    directory. Subsequent loads decode the (much smaller) resized image rather than the full-resolution source image,
+    which can substantially reduce data loading time for high-resolution datasets. Resized images are stored losslessly,
+    and random crop and flip augmentations are still applied on each load. Only supported for image directory and
+    jsonl datasets that do not use `keep_in_memory`. Ignored when VAE outputs are cached.
+    """
+
+    reduced_size_jpeg_decoding: bool = False
+    """If True, JPEG images that are larger than their target resolution are decoded at 1/2, 1/4 or 1/8 scale (the
+    largest reduction that still covers the target resolution), rather than decoded at full resolution and then
+    downscaled. This makes data loading several times faster for high-resolution photo datasets, with a small change in
+    image quality. Only supported for image directory and jsonl datasets that do not use `keep_in_memory`.
+    """
+
+    image_decode_backend: Literal["pil", "torchvision"] = "pil"
+    """The backend used to decode image files. "pil" decodes to PIL images. "torchvision" decodes directly to uint8
+    tensors with `torchvision.io.decode_image(...)`, and then does the resize, crop and normalization in tensor space,
+    which is typically faster. Images are resized with antialiased bilinear interpolation in both cases, but the results
+    are not bit-identical. "torchvision" can't be combined with `reduced_size_jpeg_decoding`.
+    """
+
     caption_prefix: str | None = None
     """A prefix that will be prepended to all captions. If None, no prefix will be added.
     """
@@ -134,6 +213,13 @@ class DreamboothSDDataLoaderConfig(ConfigBaseModel):
     """Whether random flip augmentations should be applied to input images.
     """
 
+    num_cached_random_crops: int = 4
+    """The number of random crops of each image to cache when VAE outputs are cached and `center_crop` is False. Each
+    time an image is loaded, one of its cached crops is selected at random (along with its flipped or unflipped
+    variant, if `random_flip` is True). Higher values preserve more of the random crop augmentation, at the cost of
+    more cache storage and a longer caching step.
+    """
+
     dataloader_num_workers: int = 0
     """Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process.
     """
@@ -180,6 +266,13 @@ class TextualInversionSDDataLoaderConfig(ConfigBaseModel):
     """Whether random flip augmentations should be applied to input images.
     """
 
+    num_cached_random_crops: int = 4
+    """The number of random crops of each image to cache when VAE outputs are cached and `center_crop` is False. Each
+    time an image is loaded, one of its cached crops is selected at random (along with its flipped or unflipped
+    variant, if `random_flip` is True). Higher values preserve more of the random crop augmentation, at the cost of
+    more cache storage and a longer caching step.
+    """
+
     shuffle_caption_delimiter: str | None = None
     """If `None`, then no caption shuffling is applied. If set, then captions are split on this delimiter and shuffled.
     """
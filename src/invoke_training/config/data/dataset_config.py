@@ -16,6 +16,15 @@ class HFHubImageCaptionDatasetConfig(ConfigBaseModel):
     """The Hugging Face dataset config name. Leave as None if there's only one config.
     """
 
+    revision: Optional[str] = None
+    """The revision of the Hugging Face dataset to load (a commit hash, branch name or tag). If None, the latest
+    revision of the default branch is used.
+
+    Persistent caches (i.e. a pipeline `cache_dir`) can only be used if this is pinned to a commit hash, so that a cache
+    is never re-used after the dataset has been updated on the Hub. Pinning is also recommended for `streaming`
+    datasets, so that all processes and epochs read the same version of the dataset.
+    """
+
     hf_cache_dir: Optional[str] = None
     """The Hugging Face cache directory to use for dataset downloads.
     If None, the default value will be used (usually '~/.cache/huggingface/datasets').
@@ -29,6 +38,43 @@ class HFHubImageCaptionDatasetConfig(ConfigBaseModel):
     """The name of the dataset column that contains captions.
     """
 
+    streaming: bool = False
+    """If True, stream the dataset from the Hugging Face Hub during training, rather than downloading and preparing the
+    whole dataset before training starts. This is intended for datasets that are too large to download up front.
+
+    Streaming datasets have some limitations:
+    - They can't be combined with VAE output or text encoder output caching.
+    - Aspect ratio bucketing is approximate (see `streaming_bucket_buffer_size`).
+    - They are currently only supported by the SD LoRA, SDXL LoRA and SDXL finetune pipelines.
+    """
+
+    streaming_num_examples: Optional[int] = None
+    """The number of examples in the streaming dataset. This is used to determine the number of steps per epoch. If
+    None, it is read from the dataset info on the Hugging Face Hub (if available).
+    """
+
+    streaming_shuffle_buffer_size: int = 1000
+    """The number of examples in the buffer that is used to shuffle a streaming dataset. Larger buffers produce a more
+    random order, at the cost of memory.
+    """
+
+    streaming_bucket_buffer_size: int = 256
+    """The maximum number of examples that are held while grouping a streaming dataset into aspect ratio buckets. If
+    the buffer fills up before any bucket has a full batch, then a partial batch is produced from the fullest bucket.
+    Larger buffers produce fewer partial batches, at the cost of memory.
+    """
+
+    image_probe_num_workers: Optional[int] = None
+    """The number of workers used to read image headers when measuring the image dimensions for aspect ratio bucketing.
+    If None, a default based on the number of CPUs is used. Increasing this can speed up startup for datasets on
+    high-latency storage (e.g. a network filesystem).
+    """
+
+    image_probe_executor: Literal["thread", "process"] = "thread"
+    """The type of worker pool used to read image headers. 'thread' is best when reading headers is limited by storage
+    latency (the common case). 'process' can be faster when it is limited by CPU (e.g. many small, local images).
+    """
+
 
 class ImageCaptionJsonlDatasetConfig(ConfigBaseModel):
     type: Literal["IMAGE_CAPTION_JSONL_DATASET"] = "IMAGE_CAPTION_JSONL_DATASET"
@@ -44,10 +90,44 @@ class ImageCaptionJsonlDatasetConfig(ConfigBaseModel):
     """The name of the dataset column that contains captions.
     """
 
+    lazy_load: bool = False
+    """If `True`, rows are parsed from the JSONL file on demand, rather than all being parsed when training starts. This
+    speeds up startup and reduces memory usage for very large JSONL files (e.g. millions of rows). An index of the
+    line offsets in the JSONL file is cached in a '.{jsonl file name}.line_index.npz' file next to it.
+    """
+
     keep_in_memory: bool = False
-    """If `True`, load all images into memory on initialization so that they can be accessed quickly. If `False`, images
-    are loaded from disk each time they are accessed. Setting to `True` improves performance for datasets that are small
-    enough to be kept in memory.
+    """If `True`, keep images in memory after they are first loaded so that they can be accessed quickly. If `False`,
+    images are loaded from disk each time they are accessed. Setting to `True` improves performance for datasets that
+    are small enough to be kept in memory (or see `keep_in_memory_max_mb` to bound the memory usage).
+    """
+
+    keep_in_memory_max_mb: Optional[int] = None
+    """The memory budget (in MiB) for the images that are kept in memory when `keep_in_memory` is `True`. When it is
+    exceeded, images are evicted from memory and will be re-loaded from disk the next time that they are accessed. If
+    None, all images are kept in memory.
+    """
+
+    keep_in_memory_format: Literal["decoded", "encoded"] = "decoded"
+    """How images are kept in memory when `keep_in_memory` is `True`. 'decoded' images are fastest to access. 'encoded'
+    images (i.e. the raw image file bytes) typically take several times less memory, but are decoded on every access.
+    """
+
+    keep_in_memory_shared: bool = False
+    """If `True`, the images that are kept in memory are stored in shared memory, so that a single copy is shared by
+    all DataLoader workers (rather than each worker keeping its own copy). The shared memory is allocated up front, so
+    `keep_in_memory_max_mb` must be set. Images are evicted in first-in-first-out order.
+    """
+
+    image_probe_num_workers: Optional[int] = None
+    """The number of workers used to read image headers when measuring the image dimensions for aspect ratio bucketing.
+    If None, a default based on the number of CPUs is used. Increasing this can speed up startup for datasets on
+    high-latency storage (e.g. a network filesystem).
+    """
+
+    image_probe_executor: Literal["thread", "process"] = "thread"
+    """The type of worker pool used to read image headers. 'thread' is best when reading headers is limited by storage
+    latency (the common case). 'process' can be faster when it is limited by CPU (e.g. many small, local images).
     """
 
 
@@ -58,9 +138,37 @@ class ImageDirDatasetConfig(ConfigBaseModel):
     """The directory to load images from."""
 
     keep_in_memory: bool = False
-    """If `True`, load all images into memory on initialization so that they can be accessed quickly. If `False`, images
-    are loaded from disk each time they are accessed. Setting to `True` improves performance for datasets that are small
-    enough to be kept in memory.
+    """If `True`, keep images in memory after they are first loaded so that they can be accessed quickly. If `False`,
+    images are loaded from disk each time they are accessed. Setting to `True` improves performance for datasets that
+    are small enough to be kept in memory (or see `keep_in_memory_max_mb` to bound the memory usage).
+    """
+
+    keep_in_memory_max_mb: Optional[int] = None
+    """The memory budget (in MiB) for the images that are kept in memory when `keep_in_memory` is `True`. When it is
+    exceeded, images are evicted from memory and will be re-loaded from disk the next time that they are accessed. If
+    None, all images are kept in memory.
+    """
+
+    keep_in_memory_format: Literal["decoded", "encoded"] = "decoded"
+    """How images are kept in memory when `keep_in_memory` is `True`. 'decoded' images are fastest to access. 'encoded'
+    images (i.e. the raw image file bytes) typically take several times less memory, but are decoded on every access.
+    """
+
+    keep_in_memory_shared: bool = False
+    """If `True`, the images that are kept in memory are stored in shared memory, so that a single copy is shared by
+    all DataLoader workers (rather than each worker keeping its own copy). The shared memory is allocated up front, so
+    `keep_in_memory_max_mb` must be set. Images are evicted in first-in-first-out order.
+    """
+
+    image_probe_num_workers: Optional[int] = None
+    """The number of workers used to read image headers when measuring the image dimensions for aspect ratio bucketing.
+    If None, a default based on the number of CPUs is used. Increasing this can speed up startup for datasets on
+    high-latency storage (e.g. a network filesystem).
+    """
+
+    image_probe_executor: Literal["thread", "process"] = "thread"
+    """The type of worker pool used to read image headers. 'thread' is best when reading headers is limited by storage
+    latency (the common case). 'process' can be faster when it is limited by CPU (e.g. many small, local images).
     """
 
 
@@ -71,14 +179,97 @@ class ImageCaptionDirDatasetConfig(ConfigBaseModel):
     """The directory to load images from."""
 
     keep_in_memory: bool = False
-    """If `True`, load all images into memory on initialization so that they can be accessed quickly. If `False`, images
-    are loaded from disk each time they are accessed. Setting to `True` improves performance for datasets that are small
-    enough to be kept in memory.
+    """If `True`, keep images in memory after they are first loaded so that they can be accessed quickly. If `False`,
+    images are loaded from disk each time they are accessed. Setting to `True` improves performance for datasets that
+    are small enough to be kept in memory (or see `keep_in_memory_max_mb` to bound the memory usage).
+    """
+
+    keep_in_memory_max_mb: Optional[int] = None
+    """The memory budget (in MiB) for the images that are kept in memory when `keep_in_memory` is `True`. When it is
+    exceeded, images are evicted from memory and will be re-loaded from disk the next time that they are accessed. If
+    None, all images are kept in memory.
+    """
+
+    keep_in_memory_format: Literal["decoded", "encoded"] = "decoded"
+    """How images are kept in memory when `keep_in_memory` is `True`. 'decoded' images are fastest to access. 'encoded'
+    images (i.e. the raw image file bytes) typically take several times less memory, but are decoded on every access.
+    """
+
+    keep_in_memory_shared: bool = False
+    """If `True`, the images that are kept in memory are stored in shared memory, so that a single copy is shared by
+    all DataLoader workers (rather than each worker keeping its own copy). The shared memory is allocated up front, so
+    `keep_in_memory_max_mb` must be set. Images are evicted in first-in-first-out order.
+    """
+
+    image_probe_num_workers: Optional[int] = None
+    """The number of workers used to read image headers when measuring the image dimensions for aspect ratio bucketing.
+    If None, a default based on the number of CPUs is used. Increasing this can speed up startup for datasets on
+    high-latency storage (e.g. a network filesystem).
+    """
+
+    image_probe_executor: Literal["thread", "process"] = "thread"
+    """The type of worker pool used to read image headers. 'thread' is best when reading headers is limited by storage
+    latency (the common case). 'process' can be faster when it is limited by CPU (e.g. many small, local images).
+    """
+
+
+class ImageCaptionTarShardDatasetConfig(ConfigBaseModel):
+    type: Literal["IMAGE_CAPTION_TAR_SHARD_DATASET"] = "IMAGE_CAPTION_TAR_SHARD_DATASET"
+
+    shards: list[str]
+    """The paths to the .tar shards of the dataset (i.e. the WebDataset format). Each path can contain glob wildcards
+    (e.g. 'data/*.tar') or a numeric brace range (e.g. 'data/shard-{0000..0099}.tar').
+
+    Each sample in a shard is a group of consecutive files that share a key (the file name up to the first '.'), e.g.
+    '0001.jpg', '0001.txt' and (optionally) '0001.mask.png'.
+
+    Samples are read sequentially, which avoids the per-file open latency of the other dataset types on network
+    storage. Tar-shard datasets have some limitations:
+    - They can't be combined with VAE output or text encoder output caching.
+    - Aspect ratio bucketing is approximate (see `bucket_buffer_size`).
+    """
+
+    image_extensions: list[str] = ["jpg", "jpeg", "png", "webp"]
+    """The file extensions of sample images.
+    """
+
+    caption_extension: str = "txt"
+    """The file extension of sample captions.
+    """
+
+    mask_extension: str = "mask.png"
+    """The file extension of (optional) sample masks.
+    """
+
+    num_examples: Optional[int] = None
+    """The number of samples in the dataset. This is used to determine the number of steps per epoch. If None, the
+    samples are counted from the tar headers when training starts.
+    """
+
+    shuffle_buffer_size: int = 1000
+    """The number of samples in the buffer that is used to shuffle samples (the shard order is also shuffled). Larger
+    buffers produce a more random order, at the cost of memory.
+    """
+
+    bucket_buffer_size: int = 256
+    """The maximum number of examples that are held while grouping the dataset into aspect ratio buckets. If the buffer
+    fills up before any bucket has a full batch, then a partial batch is produced from the fullest bucket. Larger
+    buffers produce fewer partial batches, at the cost of memory.
+    """
+
+    prefetch_size: int = 64
+    """The number of samples to read ahead of image decoding on a background thread (per DataLoader worker), so that
+    storage latency overlaps with the rest of data loading. Set to 0 to disable prefetching.
     """
 
 
 # Datasets that produce image-caption pairs.
 ImageCaptionDatasetConfig = Annotated[
-    Union[HFHubImageCaptionDatasetConfig, ImageCaptionJsonlDatasetConfig, ImageCaptionDirDatasetConfig],
+    Union[
+        HFHubImageCaptionDatasetConfig,
+        ImageCaptionJsonlDatasetConfig,
+        ImageCaptionDirDatasetConfig,
+        ImageCaptionTarShardDatasetConfig,
+    ],
     Field(discriminator="type"),
 ]
@@ -1,9 +1,9 @@
+import functools
 import itertools
 import json
 import logging
 import math
 import os
-import tempfile
 import time
 from pathlib import Path
 from typing import Literal, Optional, Union
@@ -29,7 +29,17 @@ from invoke_training._shared.accelerator.accelerator_utils import (
 )
 from invoke_training._shared.checkpoints.checkpoint_tracker import CheckpointTracker
 from invoke_training._shared.data.data_loaders.image_caption_flux_dataloader import build_image_caption_flux_dataloader
+from invoke_training._shared.data.datasets.build_dataset import is_streaming_dataset_config
 from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+from invoke_training._shared.data.utils.cache_fingerprint import get_persistent_cache_dir
+from invoke_training._shared.data.utils.cache_population import (
+    get_caption_cache_keys,
+    make_temporary_cache_dir,
+    populate_tensor_disk_caches,
+)
+from invoke_training._shared.data.utils.cache_stats import log_cache_stats
+from invoke_training._shared.data.utils.cached_latents import sample_cached_latents
+from invoke_training._shared.data.utils.resident_tensor_cache import build_resident_tensor_cache
 from invoke_training._shared.flux.encoding_utils import encode_prompt
 from invoke_training._shared.flux.lora_checkpoint_utils import (
     save_flux_kohya_checkpoint,
@@ -38,7 +48,6 @@ from invoke_training._shared.flux.lora_checkpoint_utils import (
 from invoke_training._shared.flux.model_loading_utils import load_models_flux
 from invoke_training._shared.flux.validation import generate_validation_images_flux
 from invoke_training._shared.optimizer.optimizer_utils import initialize_optimizer
-from invoke_training._shared.stable_diffusion.tokenize_captions import tokenize_captions
 from invoke_training.config.data.data_loader_config import ImageCaptionSDDataLoaderConfig
 from invoke_training.pipelines.callbacks import ModelCheckpoint, ModelType, PipelineCallbacks, TrainingCheckpoint
 from invoke_training.pipelines.flux.lora.config import FluxLoraConfig
@@ -98,7 +107,11 @@ def _build_data_loader(
             batch_size=batch_size,
             use_masks=use_masks,
             text_encoder_output_cache_dir=text_encoder_output_cache_dir,
-            text_encoder_cache_field_to_output_field={"text_encoder_output": "text_encoder_output"},
+            text_encoder_cache_field_to_output_field={
+                "prompt_embeds": "prompt_embeds",
+                "pooled_prompt_embeds": "pooled_prompt_embeds",
+                "text_ids": "text_ids",
+            },
             vae_output_cache_dir=vae_output_cache_dir,
             shuffle=shuffle,
         )
@@ -106,51 +119,64 @@ def _build_data_loader(
         raise ValueError(f"Unsupported data loader config type: '{data_loader_config.type}'.")
 
 
-def cache_text_encoder_outputs(
-    cache_dir: str, config: FluxLoraConfig, tokenizer: CLIPTokenizer, text_encoder: CLIPTextModel
-):
-    """Run the text encoder on all captions in the dataset and cache the results to disk.
-
-    Args:
-        cache_dir (str): The directory where the results will be cached.
-        config (FluxLoraConfig): Training config.
-        tokenizer (CLIPTokenizer): The tokenizer.
-        text_encoder (CLIPTextModel): The text_encoder.
-    """
-    data_loader = _build_data_loader(
-        data_loader_config=config.data_loader,
-        batch_size=config.train_batch_size,
-        shuffle=False,
-        sequential_batching=True,
+def compute_text_encoder_outputs(
+    data_batch: dict,
+    config: FluxLoraConfig,
+    tokenizer_1: CLIPTokenizer,
+    tokenizer_2: T5Tokenizer,
+    text_encoder_1: CLIPTextModel,
+    text_encoder_2: T5EncoderModel,
+) -> dict[str, torch.Tensor]:
+    """Run the CLIP and T5 text encoders on a batch of captions and return the batched outputs to be cached."""
+    prompt_embeds, pooled_prompt_embeds, text_ids = encode_prompt(
+        prompt=data_batch["caption"],
+        prompt_2=data_batch.get("caption_2", None),
+        clip_tokenizer=tokenizer_1,
+        t5_tokenizer=tokenizer_2,
+        clip_text_encoder=text_encoder_1,
+        t5_text_encoder=text_encoder_2,
+        device=text_encoder_1.device,
+        num_images_per_prompt=1,
+        lora_scale=config.lora_scale,
+        clip_tokenizer_max_length=config.clip_tokenizer_max_length,
+        t5_tokenizer_max_length=config.t5_tokenizer_max_length,
     )
+    # text_ids is shared by all examples in the batch. It is repeated so that every cache entry is self-contained.
+    text_ids = text_ids.expand(prompt_embeds.shape[0], -1, -1)
+    return {"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled_prompt_embeds, "text_ids": text_ids}
 
-    cache = TensorDiskCache(cache_dir)
-
-    for data_batch in tqdm(data_loader):
-        caption_token_ids = tokenize_captions(tokenizer, data_batch["caption"]).to(text_encoder.device)
-        text_encoder_output_batch = text_encoder(caption_token_ids)[0]
-        # Split batch before caching.
-        for i in range(len(data_batch["id"])):
-            cache.save(data_batch["id"][i], {"text_encoder_output": text_encoder_output_batch[i]})
 
+def compute_vae_outputs(
+    data_batch: dict,
+    vae: AutoencoderKL,
+    cache_dtype: torch.dtype | None = None,
+    cache_latent_distribution: bool = False,
+) -> dict:
+    """Run the VAE on a batch of images and return the batched, packed latents to be cached.
 
-def cache_vae_outputs(cache_dir: str, data_loader: DataLoader, vae: AutoencoderKL):
-    """Run the VAE on all images in the dataset and cache the results to disk."""
-    cache = TensorDiskCache(cache_dir)
-
-    for data_batch in tqdm(data_loader):
-        latents = vae.encode(data_batch["image"].to(device=vae.device, dtype=vae.dtype)).latent_dist.sample()
-        latents = latents * vae.config.scaling_factor
-        # Split batch before caching.
-        for i in range(len(data_batch["id"])):
-            data = {
-                "vae_output": latents[i],
-                "original_size_hw": data_batch["original_size_hw"][i],
-                "crop_top_left_yx": data_batch["crop_top_left_yx"][i],
-            }
-            if "mask" in data_batch:
-                data["mask"] = data_batch["mask"][i]
-            cache.save(data_batch["id"][i], data)
+    See `invoke_training.pipelines.stable_diffusion.lora.train.compute_vae_outputs(...)` for `cache_dtype` and
+    `cache_latent_distribution`.
+    """
+    latent_dist = vae.encode(data_batch["image"].to(device=vae.device, dtype=vae.dtype)).latent_dist
+    latents = latent_dist.mean if cache_latent_distribution else latent_dist.sample()
+    batch_size, num_channels, height, width = latents.shape
+
+    def pack(x: torch.Tensor) -> torch.Tensor:
+        x = x * vae.config.scaling_factor
+        x = FluxPipeline._pack_latents(x, batch_size, num_channels, height, width)
+        return x if cache_dtype is None else x.to(dtype=cache_dtype)
+
+    outputs = {
+        "vae_output": pack(latents),
+        # The spatial size of the latents can't be recovered from the packed latents, so it is cached alongside them.
+        "latent_size_hw": [(height, width)] * batch_size,
+    }
+    if cache_latent_distribution:
+        # Packing is a permutation of the latent elements, so the packed std matches the packed mean element-wise.
+        outputs["vae_output_std"] = pack(latent_dist.std)
+    if "mask" in data_batch:
+        outputs["mask"] = data_batch["mask"]
+    return outputs
 
 
 def get_sigmas(noise_scheduler, timesteps, device, n_dim=4, dtype=torch.float32):
@@ -250,7 +276,10 @@ def train_forward(  # noqa: C901
         latents = latents * vae.config.scaling_factor
         latents = FluxPipeline._pack_latents(latents, batch_size, num_channels, height, width)
     else:
-        batch_size, num_channels, height, width = latents.shape
+        # The cached latents are already packed.
+        latents = sample_cached_latents(data_batch, weight_dtype)
+        batch_size = latents.shape[0]
+        height, width = data_batch["latent_size_hw"][0]
     # Sample noise that we'll add to the latents.
     latent_image_ids = FluxPipeline._prepare_latent_image_ids(
         batch_size, height // 2, width // 2, latents.device, latents.dtype
@@ -265,6 +294,8 @@ def train_forward(  # noqa: C901
     if "prompt_embeds" in data_batch:
         prompt_embeds = data_batch["prompt_embeds"]
         pooled_prompt_embeds = data_batch["pooled_prompt_embeds"]
+        # text_ids is identical for all examples in the batch.
+        text_ids = data_batch["text_ids"][0]
     else:
         prompt_embeds, pooled_prompt_embeds, text_ids = encode_prompt(
             prompt=data_batch["caption"],
@@ -298,6 +329,11 @@ def train_forward(  # noqa: C901
 
     loss = torch.nn.functional.mse_loss(model_pred.float(), target.float(), reduction="none")
     loss = loss.mean(dim=list(range(1, len(loss.shape))))
+
+    # Apply per-example loss weights.
+    if "loss_weight" in data_batch:
+        loss = loss * data_batch["loss_weight"]
+
     return loss.mean()
 
 
@@ -339,61 +375,130 @@ def train(config: FluxLoraConfig, callbacks: list[PipelineCallbacks] | None = No
         logger=logger,
     )
 
+    # Maps the directory of each cache that must be populated to the function that computes its contents.
+    cache_builders = {}
+
+    if is_streaming_dataset_config(config.data_loader.dataset) and (
+        config.cache_text_encoder_outputs or config.cache_vae_outputs
+    ):
+        raise ValueError("Caching text encoder or VAE outputs is not supported for streaming datasets.")
+
     # Prepare text encoder output cache.
     text_encoder_output_cache_dir_name = None
     if config.cache_text_encoder_outputs:
         # TODO(ryand): Think about how to better check if it is safe to cache the text encoder outputs. Currently, there
         # are a number of configurations that would cause variation in the text encoder outputs and should not be used
         # with caching.
+        if config.train_text_encoder:
+            raise ValueError("'cache_text_encoder_outputs' and 'train_text_encoder' cannot both be True.")
 
-        # We use a temporary directory for the cache. The directory will automatically be cleaned up when
-        # tmp_text_encoder_output_cache_dir is destroyed.
-        tmp_text_encoder_output_cache_dir = tempfile.TemporaryDirectory()
-        text_encoder_output_cache_dir_name = tmp_text_encoder_output_cache_dir.name
-        if accelerator.is_local_main_process:
-            # Only the main process should populate the cache.
-            logger.info(f"Generating text encoder output cache ('{text_encoder_output_cache_dir_name}').")
-            text_encoder_1.to(accelerator.device, dtype=weight_dtype)
-            text_encoder_2.to(accelerator.device, dtype=weight_dtype)
-            # TODO(ryan): Move cache_text_encoder_outputs to a shared location so that it is not imported from another
-            # pipeline.
-            cache_text_encoder_outputs(
-                text_encoder_output_cache_dir_name, config, tokenizer_1, tokenizer_2, text_encoder_1, text_encoder_2
+        if config.cache_dir is None:
+            # We use a temporary directory for the cache. The directory will automatically be cleaned up when
+            # tmp_text_encoder_output_cache_dir is destroyed.
+            tmp_text_encoder_output_cache_dir, text_encoder_output_cache_dir_name = make_temporary_cache_dir(
+                accelerator
+            )
+        else:
+            text_encoder_output_cache_dir_name = get_persistent_cache_dir(
+                config.cache_dir,
+                "text_encoder_output",
+                cache_key="caption",
+                model=config.model,
+                text_encoder_1_path=config.text_encoder_1_path,
+                text_encoder_2_path=config.text_encoder_2_path,
+                weight_dtype=config.weight_dtype,
+                lora_scale=config.lora_scale,
+                clip_tokenizer_max_length=config.clip_tokenizer_max_length,
+                t5_tokenizer_max_length=config.t5_tokenizer_max_length,
+                data_loader=config.data_loader,
+            )
+        if TensorDiskCache(text_encoder_output_cache_dir_name).is_complete():
+            logger.info(f"Using existing text encoder output cache ('{text_encoder_output_cache_dir_name}').")
+        else:
+            cache_builders[text_encoder_output_cache_dir_name] = functools.partial(
+                compute_text_encoder_outputs,
+                config=config,
+                tokenizer_1=tokenizer_1,
+                tokenizer_2=tokenizer_2,
+                text_encoder_1=text_encoder_1,
+                text_encoder_2=text_encoder_2,
             )
-        # Move the text_encoders back to the CPU, because they are not needed for training.
-        text_encoder_1.to("cpu")
-        text_encoder_2.to("cpu")
-        accelerator.wait_for_everyone()
-    else:
-        text_encoder_1.to(accelerator.device, dtype=weight_dtype)
-        text_encoder_2.to(accelerator.device, dtype=weight_dtype)
 
     # Prepare VAE output cache.
-    # vae_output_cache_dir_name = None
+    vae_output_cache_dir_name = None
     if config.cache_vae_outputs:
         if config.data_loader.random_flip:
             raise ValueError("'cache_vae_outputs' cannot be True if 'random_flip' is True.")
         if not config.data_loader.center_crop:
             raise ValueError("'cache_vae_outputs' cannot be True if 'center_crop' is False.")
 
-        # We use a temporary directory for the cache. The directory will automatically be cleaned up when
-        # tmp_vae_output_cache_dir is destroyed.
-        tmp_vae_output_cache_dir = tempfile.TemporaryDirectory()
-        vae_output_cache_dir_name = tmp_vae_output_cache_dir.name
-        if accelerator.is_local_main_process:
-            # Only the main process should populate the cache.
+        if config.cache_dir is None:
+            # We use a temporary directory for the cache. The directory will automatically be cleaned up when
+            # tmp_vae_output_cache_dir is destroyed.
+            tmp_vae_output_cache_dir, vae_output_cache_dir_name = make_temporary_cache_dir(accelerator)
+        else:
+            vae_output_cache_dir_name = get_persistent_cache_dir(
+                config.cache_dir,
+                "vae_output",
+                vae_output_cache_dtype=config.vae_output_cache_dtype,
+                cache_vae_latent_distribution=config.cache_vae_latent_distribution,
+                model=config.model,
+                weight_dtype=config.weight_dtype,
+                use_masks=config.use_masks,
+                data_loader=config.data_loader,
+            )
+        if TensorDiskCache(vae_output_cache_dir_name).is_complete():
+            logger.info(f"Using existing VAE output cache ('{vae_output_cache_dir_name}').")
+        else:
+            cache_builders[vae_output_cache_dir_name] = functools.partial(
+                compute_vae_outputs,
+                vae=vae,
+                cache_dtype=None
+                if config.vae_output_cache_dtype is None
+                else get_dtype_from_str(config.vae_output_cache_dtype),
+                cache_latent_distribution=config.cache_vae_latent_distribution,
+            )
+
+    # Populate all of the incomplete caches in a single pass over the dataset, so that each image is only loaded once.
+    # All processes take part in populating the caches, each encoding a disjoint slice of the dataset.
+    if len(cache_builders) > 0:
+        if text_encoder_output_cache_dir_name in cache_builders:
+            logger.info(f"Generating text encoder output cache ('{text_encoder_output_cache_dir_name}').")
+            text_encoder_1.to(accelerator.device, dtype=weight_dtype)
+            text_encoder_2.to(accelerator.device, dtype=weight_dtype)
+        if vae_output_cache_dir_name in cache_builders:
             logger.info(f"Generating VAE output cache ('{vae_output_cache_dir_name}').")
             vae.to(accelerator.device, dtype=weight_dtype)
-            data_loader = _build_data_loader(
-                data_loader_config=config.data_loader,
-                batch_size=config.train_batch_size,
-                shuffle=False,
-                sequential_batching=True,
-            )
-            cache_vae_outputs(vae_output_cache_dir_name, data_loader, vae)
-        # Move the VAE back to the CPU, because it is not needed for training.
+        data_loader = _build_data_loader(
+            data_loader_config=config.data_loader,
+            batch_size=config.train_batch_size,
+            # Masks are only cached alongside the VAE outputs.
+            use_masks=config.use_masks and vae_output_cache_dir_name in cache_builders,
+            shuffle=False,
+            sequential_batching=True,
+        )
+        populate_tensor_disk_caches(
+            data_loader,
+            cache_builders,
+            accelerator,
+            # Text encoder outputs are keyed by caption, so that they are only computed once per distinct caption.
+            cache_key_fns={text_encoder_output_cache_dir_name: get_caption_cache_keys},
+            compressed_cache_dirs=[vae_output_cache_dir_name] if config.compress_vae_output_cache else [],
+        )
+
+    if vae_output_cache_dir_name is not None:
+        log_cache_stats(logger, "VAE output", vae_output_cache_dir_name)
+
+    # Models whose outputs are cached are moved back to the CPU, because they are not needed for training. In
+    # particular, this keeps the (large) T5 text encoder out of VRAM.
+    if config.cache_text_encoder_outputs:
+        text_encoder_1.to("cpu")
+        text_encoder_2.to("cpu")
+    else:
+        text_encoder_1.to(accelerator.device, dtype=weight_dtype)
+        text_encoder_2.to(accelerator.device, dtype=weight_dtype)
+    if config.cache_vae_outputs:
         vae.to("cpu")
-        accelerator.wait_for_everyone()
     else:
         vae.to(accelerator.device, dtype=weight_dtype)
 
@@ -465,11 +570,22 @@ def train(config: FluxLoraConfig, callbacks: list[PipelineCallbacks] | None = No
 
     optimizer = initialize_optimizer(config.optimizer, trainable_param_groups)
 
+    # If there are only a few distinct captions (e.g. in a DreamBooth dataset), then keep their text encoder outputs
+    # resident on the device rather than having the DataLoader read them from disk for every example.
+    text_encoder_output_resident_cache = None
+    if text_encoder_output_cache_dir_name is not None:
+        text_encoder_output_resident_cache = build_resident_tensor_cache(
+            text_encoder_output_cache_dir_name, accelerator.device
+        )
+
     data_loader = _build_data_loader(
         data_loader_config=config.data_loader,
         batch_size=config.train_batch_size,
-        # text_encoder_output_cache_dir=text_encoder_output_cache_dir_name,
-        # vae_output_cache_dir=vae_output_cache_dir_name,
+        use_masks=config.use_masks,
+        text_encoder_output_cache_dir=text_encoder_output_cache_dir_name
+        if text_encoder_output_resident_cache is None
+        else None,
+        vae_output_cache_dir=vae_output_cache_dir_name,
     )
 
     assert sum([config.max_train_steps is not None, config.max_train_epochs is not None]) == 1
@@ -595,6 +711,8 @@ def train(config: FluxLoraConfig, callbacks: list[PipelineCallbacks] | None = No
     for epoch in range(first_epoch, num_train_epochs):
         train_loss = 0.0
         for data_batch_idx, data_batch in enumerate(data_loader):
+            if text_encoder_output_resident_cache is not None:
+                data_batch.update(text_encoder_output_resident_cache.load_batch(get_caption_cache_keys(data_batch)))
             # (Pdb) data_batch['image'].shape
             # torch.Size([4, 3, 512, 512])
             with accelerator.accumulate(transformer, text_encoder_1, text_encoder_2):
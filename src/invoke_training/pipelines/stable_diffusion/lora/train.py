@@ -1,9 +1,9 @@
+import functools
 import itertools
 import json
 import logging
 import math
 import os
-import tempfile
 import time
 from pathlib import Path
 from typing import Literal, Optional, Union
@@ -11,6 +11,7 @@ from typing import Literal, Optional, Union
 import peft
 import torch
 import torch.utils.data
+from accelerate import Accelerator
 from accelerate.utils import set_seed
 from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
 from diffusers.optimization import get_scheduler
@@ -26,8 +27,18 @@ from invoke_training._shared.accelerator.accelerator_utils import (
 from invoke_training._shared.checkpoints.checkpoint_tracker import CheckpointTracker
 from invoke_training._shared.data.data_loaders.dreambooth_sd_dataloader import build_dreambooth_sd_dataloader
 from invoke_training._shared.data.data_loaders.image_caption_sd_dataloader import build_image_caption_sd_dataloader
+from invoke_training._shared.data.datasets.build_dataset import is_streaming_dataset_config
 from invoke_training._shared.data.samplers.aspect_ratio_bucket_batch_sampler import log_aspect_ratio_buckets
 from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+from invoke_training._shared.data.utils.cache_fingerprint import get_persistent_cache_dir
+from invoke_training._shared.data.utils.cache_population import (
+    get_caption_cache_keys,
+    make_temporary_cache_dir,
+    populate_tensor_disk_caches,
+)
+from invoke_training._shared.data.utils.cache_stats import log_cache_stats
+from invoke_training._shared.data.utils.cached_latents import sample_cached_latents
+from invoke_training._shared.data.utils.resident_tensor_cache import build_resident_tensor_cache
 from invoke_training._shared.optimizer.optimizer_utils import initialize_optimizer
 from invoke_training._shared.stable_diffusion.lora_checkpoint_utils import (
     save_sd_kohya_checkpoint,
@@ -85,6 +96,7 @@ def _build_data_loader(
     vae_output_cache_dir: Optional[str] = None,
     shuffle: bool = True,
     sequential_batching: bool = False,
+    generate_augmentation_variants: bool = False,
 ) -> DataLoader:
     if data_loader_config.type == "IMAGE_CAPTION_SD_DATA_LOADER":
         return build_image_caption_sd_dataloader(
@@ -95,6 +107,7 @@ def _build_data_loader(
             text_encoder_cache_field_to_output_field={"text_encoder_output": "text_encoder_output"},
             vae_output_cache_dir=vae_output_cache_dir,
             shuffle=shuffle,
+            generate_augmentation_variants=generate_augmentation_variants,
         )
     elif data_loader_config.type == "DREAMBOOTH_SD_DATA_LOADER":
         if use_masks:
@@ -107,13 +120,71 @@ def _build_data_loader(
             vae_output_cache_dir=vae_output_cache_dir,
             shuffle=shuffle,
             sequential_batching=sequential_batching,
+            generate_augmentation_variants=generate_augmentation_variants,
         )
     else:
         raise ValueError(f"Unsupported data loader config type: '{data_loader_config.type}'.")
 
 
+def compute_text_encoder_outputs(
+    data_batch: dict, tokenizer: CLIPTokenizer, text_encoder: CLIPTextModel
+) -> dict[str, torch.Tensor]:
+    """Run the text encoder on a batch of captions and return the batched outputs to be cached."""
+    caption_token_ids = tokenize_captions(tokenizer, data_batch["caption"]).to(text_encoder.device)
+    return {"text_encoder_output": text_encoder(caption_token_ids)[0]}
+
+
+def compute_vae_outputs(
+    data_batch: dict,
+    vae: AutoencoderKL,
+    cache_dtype: torch.dtype | None = None,
+    cache_latent_distribution: bool = False,
+) -> dict:
+    """Run the VAE on a batch of images and return the batched outputs to be cached.
+
+    If the images have an augmentation variant dimension (i.e. shape (B, V, C, H, W)), then each variant is encoded
+    separately (to bound VRAM usage), and the latents are returned with the same variant dimension.
+
+    Args:
+        data_batch (dict): The data batch.
+        vae (AutoencoderKL): The VAE.
+        cache_dtype (torch.dtype, optional): If set, the latents are cast to this dtype before they are cached.
+        cache_latent_distribution (bool, optional): If True, the mean ('vae_output') and standard deviation
+            ('vae_output_std') of the latent distribution are cached, so that a new latent sample can be drawn each
+            time the example is loaded. Otherwise, a single latent sample is cached.
+    """
+
+    def encode(image: torch.Tensor) -> dict[str, torch.Tensor]:
+        latent_dist = vae.encode(image.to(device=vae.device, dtype=vae.dtype)).latent_dist
+        if cache_latent_distribution:
+            return {
+                "vae_output": latent_dist.mean * vae.config.scaling_factor,
+                "vae_output_std": latent_dist.std * vae.config.scaling_factor,
+            }
+        return {"vae_output": latent_dist.sample() * vae.config.scaling_factor}
+
+    image = data_batch["image"]
+    if image.dim() == 5:
+        variant_outputs = [encode(image[:, variant_idx]) for variant_idx in range(image.shape[1])]
+        outputs = {k: torch.stack([o[k] for o in variant_outputs], dim=1) for k in variant_outputs[0]}
+    else:
+        outputs = encode(image)
+    if cache_dtype is not None:
+        outputs = {k: v.to(dtype=cache_dtype) for k, v in outputs.items()}
+
+    outputs["original_size_hw"] = data_batch["original_size_hw"]
+    outputs["crop_top_left_yx"] = data_batch["crop_top_left_yx"]
+    if "mask" in data_batch:
+        outputs["mask"] = data_batch["mask"]
+    return outputs
+
+
 def cache_text_encoder_outputs(
-    cache_dir: str, config: SdLoraConfig, tokenizer: CLIPTokenizer, text_encoder: CLIPTextModel
+    cache_dir: str,
+    config: SdLoraConfig,
+    tokenizer: CLIPTokenizer,
+    text_encoder: CLIPTextModel,
+    accelerator: Accelerator | None = None,
 ):
     """Run the text encoder on all captions in the dataset and cache the results to disk.
 
@@ -122,6 +193,8 @@ def cache_text_encoder_outputs(
         config (SdLoraConfig): Training config.
         tokenizer (CLIPTokenizer): The tokenizer.
         text_encoder (CLIPTextModel): The text_encoder.
+        accelerator (Accelerator, optional): If set, the work is split between all processes. In this case, this
+            function must be called by all processes.
     """
     data_loader = _build_data_loader(
         data_loader_config=config.data_loader,
@@ -129,34 +202,42 @@ def cache_text_encoder_outputs(
         shuffle=False,
         sequential_batching=True,
     )
-
-    cache = TensorDiskCache(cache_dir)
-
-    for data_batch in tqdm(data_loader):
-        caption_token_ids = tokenize_captions(tokenizer, data_batch["caption"]).to(text_encoder.device)
-        text_encoder_output_batch = text_encoder(caption_token_ids)[0]
-        # Split batch before caching.
-        for i in range(len(data_batch["id"])):
-            cache.save(data_batch["id"][i], {"text_encoder_output": text_encoder_output_batch[i]})
+    populate_tensor_disk_caches(
+        data_loader,
+        {cache_dir: functools.partial(compute_text_encoder_outputs, tokenizer=tokenizer, text_encoder=text_encoder)},
+        accelerator,
+        cache_key_fns={cache_dir: get_caption_cache_keys},
+    )
 
 
-def cache_vae_outputs(cache_dir: str, data_loader: DataLoader, vae: AutoencoderKL):
-    """Run the VAE on all images in the dataset and cache the results to disk."""
-    cache = TensorDiskCache(cache_dir)
+def cache_vae_outputs(
+    cache_dir: str,
+    data_loader: DataLoader,
+    vae: AutoencoderKL,
+    accelerator: Accelerator | None = None,
+    cache_dtype: torch.dtype | None = None,
+    cache_latent_distribution: bool = False,
+    compress: bool = False,
+):
+    """Run the VAE on all images in the dataset and cache the results to disk.
 
-    for data_batch in tqdm(data_loader):
-        latents = vae.encode(data_batch["image"].to(device=vae.device, dtype=vae.dtype)).latent_dist.sample()
-        latents = latents * vae.config.scaling_factor
-        # Split batch before caching.
-        for i in range(len(data_batch["id"])):
-            data = {
-                "vae_output": latents[i],
-                "original_size_hw": data_batch["original_size_hw"][i],
-                "crop_top_left_yx": data_batch["crop_top_left_yx"][i],
-            }
-            if "mask" in data_batch:
-                data["mask"] = data_batch["mask"][i]
-            cache.save(data_batch["id"][i], data)
+    If `accelerator` is set, the work is split between all processes. In this case, this function must be called by all
+    processes. See `compute_vae_outputs(...)` for `cache_dtype` and `cache_latent_distribution`. If `compress` is True,
+    the cached tensors are losslessly compressed.
+    """
+    populate_tensor_disk_caches(
+        data_loader,
+        {
+            cache_dir: functools.partial(
+                compute_vae_outputs,
+                vae=vae,
+                cache_dtype=cache_dtype,
+                cache_latent_distribution=cache_latent_distribution,
+            )
+        },
+        accelerator,
+        compressed_cache_dirs=[cache_dir] if compress else [],
+    )
 
 
 def train_forward(  # noqa: C901
@@ -182,6 +263,8 @@ def train_forward(  # noqa: C901
     if latents is None:
         latents = vae.encode(data_batch["image"].to(dtype=weight_dtype)).latent_dist.sample()
         latents = latents * vae.config.scaling_factor
+    else:
+        latents = sample_cached_latents(data_batch, weight_dtype)
 
     # Sample noise that we'll add to the latents.
     noise = torch.randn_like(latents)
@@ -317,6 +400,14 @@ def train(config: SdLoraConfig, callbacks: list[PipelineCallbacks] | None = None
         unet.enable_xformers_memory_efficient_attention()
         vae.enable_xformers_memory_efficient_attention()
 
+    # Maps the directory of each cache that must be populated to the function that computes its contents.
+    cache_builders = {}
+
+    if is_streaming_dataset_config(config.data_loader.dataset) and (
+        config.cache_text_encoder_outputs or config.cache_vae_outputs
+    ):
+        raise ValueError("Caching text encoder or VAE outputs is not supported for streaming datasets.")
+
     # Prepare text encoder output cache.
     text_encoder_output_cache_dir_name = None
     if config.cache_text_encoder_outputs:
@@ -326,48 +417,98 @@ def train(config: SdLoraConfig, callbacks: list[PipelineCallbacks] | None = None
         if config.train_text_encoder:
             raise ValueError("'cache_text_encoder_outputs' and 'train_text_encoder' cannot both be True.")
 
-        # We use a temporary directory for the cache. The directory will automatically be cleaned up when
-        # tmp_text_encoder_output_cache_dir is destroyed.
-        tmp_text_encoder_output_cache_dir = tempfile.TemporaryDirectory()
-        text_encoder_output_cache_dir_name = tmp_text_encoder_output_cache_dir.name
-        if accelerator.is_local_main_process:
-            # Only the main process should populate the cache.
-            logger.info(f"Generating text encoder output cache ('{text_encoder_output_cache_dir_name}').")
-            text_encoder.to(accelerator.device, dtype=weight_dtype)
-            cache_text_encoder_outputs(text_encoder_output_cache_dir_name, config, tokenizer, text_encoder)
-        # Move the text_encoder back to the CPU, because it is not needed for training.
-        text_encoder.to("cpu")
-        accelerator.wait_for_everyone()
-    else:
-        text_encoder.to(accelerator.device, dtype=weight_dtype)
+        if config.cache_dir is None:
+            # We use a temporary directory for the cache. The directory will automatically be cleaned up when
+            # tmp_text_encoder_output_cache_dir is destroyed.
+            tmp_text_encoder_output_cache_dir, text_encoder_output_cache_dir_name = make_temporary_cache_dir(
+                accelerator
+            )
+        else:
+            text_encoder_output_cache_dir_name = get_persistent_cache_dir(
+                config.cache_dir,
+                "text_encoder_output",
+                cache_key="caption",
+                model=config.model,
+                hf_variant=config.hf_variant,
+                base_embeddings=config.base_embeddings,
+                weight_dtype=config.weight_dtype,
+                data_loader=config.data_loader,
+            )
+        if TensorDiskCache(text_encoder_output_cache_dir_name).is_complete():
+            logger.info(f"Using existing text encoder output cache ('{text_encoder_output_cache_dir_name}').")
+        else:
+            cache_builders[text_encoder_output_cache_dir_name] = functools.partial(
+                compute_text_encoder_outputs, tokenizer=tokenizer, text_encoder=text_encoder
+            )
 
     # Prepare VAE output cache.
     vae_output_cache_dir_name = None
     if config.cache_vae_outputs:
-        if config.data_loader.random_flip:
-            raise ValueError("'cache_vae_outputs' cannot be True if 'random_flip' is True.")
-        if not config.data_loader.center_crop:
-            raise ValueError("'cache_vae_outputs' cannot be True if 'center_crop' is False.")
-
-        # We use a temporary directory for the cache. The directory will automatically be cleaned up when
-        # tmp_vae_output_cache_dir is destroyed.
-        tmp_vae_output_cache_dir = tempfile.TemporaryDirectory()
-        vae_output_cache_dir_name = tmp_vae_output_cache_dir.name
-        if accelerator.is_local_main_process:
-            # Only the main process should populate the cache.
-            logger.info(f"Generating VAE output cache ('{vae_output_cache_dir_name}').")
-            vae.to(accelerator.device, dtype=weight_dtype)
-            data_loader = _build_data_loader(
-                data_loader_config=config.data_loader,
-                batch_size=config.train_batch_size,
+        if config.cache_dir is None:
+            # We use a temporary directory for the cache. The directory will automatically be cleaned up when
+            # tmp_vae_output_cache_dir is destroyed.
+            tmp_vae_output_cache_dir, vae_output_cache_dir_name = make_temporary_cache_dir(accelerator)
+        else:
+            vae_output_cache_dir_name = get_persistent_cache_dir(
+                config.cache_dir,
+                "vae_output",
+                vae_output_cache_dtype=config.vae_output_cache_dtype,
+                cache_vae_latent_distribution=config.cache_vae_latent_distribution,
+                model=config.model,
+                hf_variant=config.hf_variant,
+                weight_dtype=config.weight_dtype,
                 use_masks=config.use_masks,
-                shuffle=False,
-                sequential_batching=True,
+                data_loader=config.data_loader,
+            )
+        if TensorDiskCache(vae_output_cache_dir_name).is_complete():
+            logger.info(f"Using existing VAE output cache ('{vae_output_cache_dir_name}').")
+        else:
+            cache_builders[vae_output_cache_dir_name] = functools.partial(
+                compute_vae_outputs,
+                vae=vae,
+                cache_dtype=None
+                if config.vae_output_cache_dtype is None
+                else get_dtype_from_str(config.vae_output_cache_dtype),
+                cache_latent_distribution=config.cache_vae_latent_distribution,
             )
-            cache_vae_outputs(vae_output_cache_dir_name, data_loader, vae)
-        # Move the VAE back to the CPU, because it is not needed for training.
+
+    # Populate all of the incomplete caches in a single pass over the dataset, so that each image is only loaded once.
+    # All processes take part in populating the caches, each encoding a disjoint slice of the dataset.
+    if len(cache_builders) > 0:
+        if text_encoder_output_cache_dir_name in cache_builders:
+            logger.info(f"Generating text encoder output cache ('{text_encoder_output_cache_dir_name}').")
+            text_encoder.to(accelerator.device, dtype=weight_dtype)
+        if vae_output_cache_dir_name in cache_builders:
+            logger.info(f"Generating VAE output cache ('{vae_output_cache_dir_name}').")
+            vae.to(accelerator.device, dtype=weight_dtype)
+        data_loader = _build_data_loader(
+            data_loader_config=config.data_loader,
+            batch_size=config.train_batch_size,
+            # Masks are only cached alongside the VAE outputs.
+            use_masks=config.use_masks and vae_output_cache_dir_name in cache_builders,
+            shuffle=False,
+            sequential_batching=True,
+            generate_augmentation_variants=vae_output_cache_dir_name in cache_builders,
+        )
+        populate_tensor_disk_caches(
+            data_loader,
+            cache_builders,
+            accelerator,
+            # Text encoder outputs are keyed by caption, so that they are only computed once per distinct caption.
+            cache_key_fns={text_encoder_output_cache_dir_name: get_caption_cache_keys},
+            compressed_cache_dirs=[vae_output_cache_dir_name] if config.compress_vae_output_cache else [],
+        )
+
+    if vae_output_cache_dir_name is not None:
+        log_cache_stats(logger, "VAE output", vae_output_cache_dir_name)
+
+    # Models whose outputs are cached are moved back to the CPU, because they are not needed for training.
+    if config.cache_text_encoder_outputs:
+        text_encoder.to("cpu")
+    else:
+        text_encoder.to(accelerator.device, dtype=weight_dtype)
+    if config.cache_vae_outputs:
         vae.to("cpu")
-        accelerator.wait_for_everyone()
     else:
         vae.to(accelerator.device, dtype=weight_dtype)
 
@@ -444,11 +585,21 @@ def train(config: SdLoraConfig, callbacks: list[PipelineCallbacks] | None = None
 
     optimizer = initialize_optimizer(config.optimizer, trainable_param_groups)
 
+    # If there are only a few distinct captions (e.g. in a DreamBooth dataset), then keep their text encoder outputs
+    # resident on the device rather than having the DataLoader read them from disk for every example.
+    text_encoder_output_resident_cache = None
+    if text_encoder_output_cache_dir_name is not None:
+        text_encoder_output_resident_cache = build_resident_tensor_cache(
+            text_encoder_output_cache_dir_name, accelerator.device
+        )
+
     data_loader = _build_data_loader(
         data_loader_config=config.data_loader,
         batch_size=config.train_batch_size,
         use_masks=config.use_masks,
-        text_encoder_output_cache_dir=text_encoder_output_cache_dir_name,
+        text_encoder_output_cache_dir=text_encoder_output_cache_dir_name
+        if text_encoder_output_resident_cache is None
+        else None,
         vae_output_cache_dir=vae_output_cache_dir_name,
     )
 
@@ -565,6 +716,8 @@ def train(config: SdLoraConfig, callbacks: list[PipelineCallbacks] | None = None
     for epoch in range(first_epoch, num_train_epochs):
         train_loss = 0.0
         for data_batch_idx, data_batch in enumerate(data_loader):
+            if text_encoder_output_resident_cache is not None:
+                data_batch.update(text_encoder_output_resident_cache.load_batch(get_caption_cache_keys(data_batch)))
             with accelerator.accumulate(unet, text_encoder):
                 loss = train_forward(
                     config=config,
@@ -102,8 +102,37 @@ class SdTextualInversionConfig(BasePipelineConfig):
     will be cached to disk. This reduces the VRAM requirements during training (don't have to keep the VAE in VRAM), and
     speeds up training (don't have to run the VAE encoding step).
 
-    This option can only be enabled if all non-deterministic image augmentations are disabled (i.e. `center_crop=True`,
-    `random_flip=False`, etc.).
+    If random augmentations are enabled (i.e. `center_crop=False` or `random_flip=True`), then a fixed set of
+    augmentation variants of each image is cached, and one of them is selected at random each time the image is loaded
+    (see `data_loader.num_cached_random_crops`).
+    """
+
+    vae_output_cache_dtype: Literal["float16", "bfloat16"] | None = None
+    """The dtype that cached VAE outputs are stored in. If `None`, they are stored in `weight_dtype`. Storing them in a
+    16-bit dtype halves the size of the cache (and the I/O needed to read it) when `weight_dtype` is "float32". Only
+    used if `cache_vae_outputs` is True.
+    """
+
+    compress_vae_output_cache: bool = False
+    """If True, cached VAE outputs are losslessly compressed. This reduces the size of the cache and the I/O needed to
+    read it, at the cost of decompressing each entry when it is loaded (the measured cost is logged at the start of
+    training). Only used if `cache_vae_outputs` is True.
+    """
+
+    cache_vae_latent_distribution: bool = False
+    """If True, the mean and standard deviation of each image's latent distribution are cached rather than a single
+    latent sample, and a new latent is sampled each time the image is loaded (as is the case when the VAE is run during
+    training). This doubles the size of the cache. Only used if `cache_vae_outputs` is True.
+    """
+
+    cache_dir: str | None = None
+    """The directory where the `cache_vae_outputs` cache is stored. If `None`, the cache is written to a temporary
+    directory that is deleted at the end of training.
+
+    If set, the cache persists across runs. The cache is stored under a key computed from all of its inputs (the model,
+    `weight_dtype`, the data loader config, and the size and modification time of every dataset file). Later runs with
+    the same inputs (e.g. a hyperparameter sweep over the same dataset) re-use the cache rather than re-encoding the
+    dataset. Changing any of the inputs automatically invalidates the cache.
     """
 
     enable_cpu_offload_during_validation: bool = False
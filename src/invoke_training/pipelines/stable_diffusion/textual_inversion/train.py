@@ -2,7 +2,6 @@ import json
 import logging
 import math
 import os
-import tempfile
 import time
 
 import torch
@@ -23,6 +22,10 @@ from invoke_training._shared.data.data_loaders.textual_inversion_sd_dataloader i
     build_textual_inversion_sd_dataloader,
 )
 from invoke_training._shared.data.samplers.aspect_ratio_bucket_batch_sampler import log_aspect_ratio_buckets
+from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+from invoke_training._shared.data.utils.cache_fingerprint import get_persistent_cache_dir
+from invoke_training._shared.data.utils.cache_population import make_temporary_cache_dir
+from invoke_training._shared.data.utils.cache_stats import log_cache_stats
 from invoke_training._shared.optimizer.optimizer_utils import initialize_optimizer
 from invoke_training._shared.stable_diffusion.model_loading_utils import load_models_sd
 from invoke_training._shared.stable_diffusion.textual_inversion import (
@@ -200,17 +203,26 @@ def train(config: SdTextualInversionConfig, callbacks: list[PipelineCallbacks] |
     # Prepare VAE output cache.
     vae_output_cache_dir_name = None
     if config.cache_vae_outputs:
-        if config.data_loader.random_flip:
-            raise ValueError("'cache_vae_outputs' cannot be True if 'random_flip' is True.")
-        if not config.data_loader.center_crop:
-            raise ValueError("'cache_vae_outputs' cannot be True if 'center_crop' is False.")
-
-        # We use a temporary directory for the cache. The directory will automatically be cleaned up when
-        # tmp_vae_output_cache_dir is destroyed.
-        tmp_vae_output_cache_dir = tempfile.TemporaryDirectory()
-        vae_output_cache_dir_name = tmp_vae_output_cache_dir.name
-        if accelerator.is_local_main_process:
-            # Only the main process should populate the cache.
+        if config.cache_dir is None:
+            # We use a temporary directory for the cache. The directory will automatically be cleaned up when
+            # tmp_vae_output_cache_dir is destroyed.
+            tmp_vae_output_cache_dir, vae_output_cache_dir_name = make_temporary_cache_dir(accelerator)
+        else:
+            vae_output_cache_dir_name = get_persistent_cache_dir(
+                config.cache_dir,
+                "vae_output",
+                vae_output_cache_dtype=config.vae_output_cache_dtype,
+                cache_vae_latent_distribution=config.cache_vae_latent_distribution,
+                model=config.model,
+                hf_variant=config.hf_variant,
+                weight_dtype=config.weight_dtype,
+                use_masks=config.use_masks,
+                data_loader=config.data_loader,
+            )
+        if TensorDiskCache(vae_output_cache_dir_name).is_complete():
+            logger.info(f"Using existing VAE output cache ('{vae_output_cache_dir_name}').")
+        else:
+            # All processes take part in populating the cache, each encoding a disjoint slice of the dataset.
             logger.info(f"Generating VAE output cache ('{vae_output_cache_dir_name}').")
             vae.to(accelerator.device, dtype=weight_dtype)
             data_loader = build_textual_inversion_sd_dataloader(
@@ -219,11 +231,22 @@ def train(config: SdTextualInversionConfig, callbacks: list[PipelineCallbacks] |
                 batch_size=config.train_batch_size,
                 use_masks=config.use_masks,
                 shuffle=False,
+                generate_augmentation_variants=True,
             )
-            cache_vae_outputs(vae_output_cache_dir_name, data_loader, vae)
+            cache_vae_outputs(
+                vae_output_cache_dir_name,
+                data_loader,
+                vae,
+                accelerator,
+                cache_dtype=None
+                if config.vae_output_cache_dtype is None
+                else get_dtype_from_str(config.vae_output_cache_dtype),
+                cache_latent_distribution=config.cache_vae_latent_distribution,
+                compress=config.compress_vae_output_cache,
+            )
+        log_cache_stats(logger, "VAE output", vae_output_cache_dir_name)
         # Move the VAE back to the CPU, because it is not needed for training.
         vae.to("cpu")
-        accelerator.wait_for_everyone()
     else:
         vae.to(accelerator.device, dtype=weight_dtype)
 
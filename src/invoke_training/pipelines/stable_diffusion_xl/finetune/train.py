@@ -1,9 +1,9 @@
+import functools
 import itertools
 import json
 import logging
 import math
 import os
-import tempfile
 import time
 from typing import Literal
 
@@ -22,7 +22,17 @@ from invoke_training._shared.accelerator.accelerator_utils import (
     initialize_logging,
 )
 from invoke_training._shared.checkpoints.checkpoint_tracker import CheckpointTracker
+from invoke_training._shared.data.datasets.build_dataset import is_streaming_dataset_config
 from invoke_training._shared.data.samplers.aspect_ratio_bucket_batch_sampler import log_aspect_ratio_buckets
+from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+from invoke_training._shared.data.utils.cache_fingerprint import get_persistent_cache_dir
+from invoke_training._shared.data.utils.cache_population import (
+    get_caption_cache_keys,
+    make_temporary_cache_dir,
+    populate_tensor_disk_caches,
+)
+from invoke_training._shared.data.utils.cache_stats import log_cache_stats
+from invoke_training._shared.data.utils.resident_tensor_cache import build_resident_tensor_cache
 from invoke_training._shared.optimizer.optimizer_utils import initialize_optimizer
 from invoke_training._shared.stable_diffusion.checkpoint_utils import (
     save_sdxl_diffusers_checkpoint,
@@ -32,11 +42,11 @@ from invoke_training._shared.stable_diffusion.model_loading_utils import load_mo
 from invoke_training._shared.stable_diffusion.validation import generate_validation_images_sdxl
 from invoke_training._shared.utils.import_xformers import import_xformers
 from invoke_training.pipelines.callbacks import ModelCheckpoint, ModelType, PipelineCallbacks, TrainingCheckpoint
-from invoke_training.pipelines.stable_diffusion.lora.train import cache_vae_outputs
+from invoke_training.pipelines.stable_diffusion.lora.train import compute_vae_outputs
 from invoke_training.pipelines.stable_diffusion_xl.finetune.config import SdxlFinetuneConfig
 from invoke_training.pipelines.stable_diffusion_xl.lora.train import (
     _build_data_loader,
-    cache_text_encoder_outputs,
+    compute_text_encoder_outputs,
     train_forward,
 )
 
@@ -147,6 +157,16 @@ def train(config: SdxlFinetuneConfig, callbacks: list[PipelineCallbacks] | None
         unet.enable_xformers_memory_efficient_attention()
         vae.enable_xformers_memory_efficient_attention()
 
+    # Maps the directory of each cache that must be populated to the function that computes its contents.
+    # TODO(ryan): Move compute_text_encoder_outputs and compute_vae_outputs to a shared location so that they are not
+    # imported from another pipeline.
+    cache_builders = {}
+
+    if is_streaming_dataset_config(config.data_loader.dataset) and (
+        config.cache_text_encoder_outputs or config.cache_vae_outputs
+    ):
+        raise ValueError("Caching text encoder or VAE outputs is not supported for streaming datasets.")
+
     # Prepare text encoder output cache.
     text_encoder_output_cache_dir_name = None
     if config.cache_text_encoder_outputs:
@@ -154,57 +174,105 @@ def train(config: SdxlFinetuneConfig, callbacks: list[PipelineCallbacks] | None
         # are a number of configurations that would cause variation in the text encoder outputs and should not be used
         # with caching.
 
-        # We use a temporary directory for the cache. The directory will automatically be cleaned up when
-        # tmp_text_encoder_output_cache_dir is destroyed.
-        tmp_text_encoder_output_cache_dir = tempfile.TemporaryDirectory()
-        text_encoder_output_cache_dir_name = tmp_text_encoder_output_cache_dir.name
-        if accelerator.is_local_main_process:
-            # Only the main process should populate the cache.
+        if config.cache_dir is None:
+            # We use a temporary directory for the cache. The directory will automatically be cleaned up when
+            # tmp_text_encoder_output_cache_dir is destroyed.
+            tmp_text_encoder_output_cache_dir, text_encoder_output_cache_dir_name = make_temporary_cache_dir(
+                accelerator
+            )
+        else:
+            text_encoder_output_cache_dir_name = get_persistent_cache_dir(
+                config.cache_dir,
+                "text_encoder_output",
+                cache_key="caption",
+                model=config.model,
+                hf_variant=config.hf_variant,
+                weight_dtype=config.weight_dtype,
+                data_loader=config.data_loader,
+            )
+        if TensorDiskCache(text_encoder_output_cache_dir_name).is_complete():
+            logger.info(f"Using existing text encoder output cache ('{text_encoder_output_cache_dir_name}').")
+        else:
+            cache_builders[text_encoder_output_cache_dir_name] = functools.partial(
+                compute_text_encoder_outputs,
+                tokenizer_1=tokenizer_1,
+                tokenizer_2=tokenizer_2,
+                text_encoder_1=text_encoder_1,
+                text_encoder_2=text_encoder_2,
+            )
+
+    # Prepare VAE output cache.
+    vae_output_cache_dir_name = None
+    if config.cache_vae_outputs:
+        if config.cache_dir is None:
+            # We use a temporary directory for the cache. The directory will automatically be cleaned up when
+            # tmp_vae_output_cache_dir is destroyed.
+            tmp_vae_output_cache_dir, vae_output_cache_dir_name = make_temporary_cache_dir(accelerator)
+        else:
+            vae_output_cache_dir_name = get_persistent_cache_dir(
+                config.cache_dir,
+                "vae_output",
+                vae_output_cache_dtype=config.vae_output_cache_dtype,
+                cache_vae_latent_distribution=config.cache_vae_latent_distribution,
+                model=config.model,
+                hf_variant=config.hf_variant,
+                vae_model=config.vae_model,
+                weight_dtype=config.weight_dtype,
+                use_masks=config.use_masks,
+                data_loader=config.data_loader,
+            )
+        if TensorDiskCache(vae_output_cache_dir_name).is_complete():
+            logger.info(f"Using existing VAE output cache ('{vae_output_cache_dir_name}').")
+        else:
+            cache_builders[vae_output_cache_dir_name] = functools.partial(
+                compute_vae_outputs,
+                vae=vae,
+                cache_dtype=None
+                if config.vae_output_cache_dtype is None
+                else get_dtype_from_str(config.vae_output_cache_dtype),
+                cache_latent_distribution=config.cache_vae_latent_distribution,
+            )
+
+    # Populate all of the incomplete caches in a single pass over the dataset, so that each image is only loaded once.
+    # All processes take part in populating the caches, each encoding a disjoint slice of the dataset.
+    if len(cache_builders) > 0:
+        if text_encoder_output_cache_dir_name in cache_builders:
             logger.info(f"Generating text encoder output cache ('{text_encoder_output_cache_dir_name}').")
             text_encoder_1.to(accelerator.device, dtype=weight_dtype)
             text_encoder_2.to(accelerator.device, dtype=weight_dtype)
-            # TODO(ryan): Move cache_text_encoder_outputs to a shared location so that it is not imported from another
-            # pipeline.
-            cache_text_encoder_outputs(
-                text_encoder_output_cache_dir_name, config, tokenizer_1, tokenizer_2, text_encoder_1, text_encoder_2
-            )
-        # Move the text_encoders back to the CPU, because they are not needed for training.
+        if vae_output_cache_dir_name in cache_builders:
+            logger.info(f"Generating VAE output cache ('{vae_output_cache_dir_name}').")
+            vae.to(accelerator.device, dtype=weight_dtype)
+        data_loader = _build_data_loader(
+            data_loader_config=config.data_loader,
+            batch_size=config.train_batch_size,
+            # Masks are only cached alongside the VAE outputs.
+            use_masks=config.use_masks and vae_output_cache_dir_name in cache_builders,
+            shuffle=False,
+            sequential_batching=True,
+            generate_augmentation_variants=vae_output_cache_dir_name in cache_builders,
+        )
+        populate_tensor_disk_caches(
+            data_loader,
+            cache_builders,
+            accelerator,
+            # Text encoder outputs are keyed by caption, so that they are only computed once per distinct caption.
+            cache_key_fns={text_encoder_output_cache_dir_name: get_caption_cache_keys},
+            compressed_cache_dirs=[vae_output_cache_dir_name] if config.compress_vae_output_cache else [],
+        )
+
+    if vae_output_cache_dir_name is not None:
+        log_cache_stats(logger, "VAE output", vae_output_cache_dir_name)
+
+    # Models whose outputs are cached are moved back to the CPU, because they are not needed for training.
+    if config.cache_text_encoder_outputs:
         text_encoder_1.to("cpu")
         text_encoder_2.to("cpu")
-        accelerator.wait_for_everyone()
     else:
         text_encoder_1.to(accelerator.device, dtype=weight_dtype)
         text_encoder_2.to(accelerator.device, dtype=weight_dtype)
-
-    # Prepare VAE output cache.
-    vae_output_cache_dir_name = None
     if config.cache_vae_outputs:
-        if config.data_loader.random_flip:
-            raise ValueError("'cache_vae_outputs' cannot be True if 'random_flip' is True.")
-        if not config.data_loader.center_crop:
-            raise ValueError("'cache_vae_outputs' cannot be True if 'center_crop' is False.")
-
-        # We use a temporary directory for the cache. The directory will automatically be cleaned up when
-        # tmp_vae_output_cache_dir is destroyed.
-        tmp_vae_output_cache_dir = tempfile.TemporaryDirectory()
-        vae_output_cache_dir_name = tmp_vae_output_cache_dir.name
-        if accelerator.is_local_main_process:
-            # Only the main process should to populate the cache.
-            logger.info(f"Generating VAE output cache ('{vae_output_cache_dir_name}').")
-            vae.to(accelerator.device, dtype=weight_dtype)
-            # TODO(ryan): Move cache_text_encoder_outputs to a shared location so that it is not imported from another
-            # pipeline.
-            data_loader = _build_data_loader(
-                data_loader_config=config.data_loader,
-                batch_size=config.train_batch_size,
-                use_masks=config.use_masks,
-                shuffle=False,
-                sequential_batching=True,
-            )
-            cache_vae_outputs(vae_output_cache_dir_name, data_loader, vae)
-        # Move the VAE back to the CPU, because it is not needed for training.
         vae.to("cpu")
-        accelerator.wait_for_everyone()
     else:
         vae.to(accelerator.device, dtype=weight_dtype)
 
@@ -232,11 +300,21 @@ def train(config: SdxlFinetuneConfig, callbacks: list[PipelineCallbacks] | None
 
     optimizer = initialize_optimizer(config.optimizer, unet.parameters())
 
+    # If there are only a few distinct captions (e.g. in a DreamBooth dataset), then keep their text encoder outputs
+    # resident on the device rather than having the DataLoader read them from disk for every example.
+    text_encoder_output_resident_cache = None
+    if text_encoder_output_cache_dir_name is not None:
+        text_encoder_output_resident_cache = build_resident_tensor_cache(
+            text_encoder_output_cache_dir_name, accelerator.device
+        )
+
     data_loader = _build_data_loader(
         data_loader_config=config.data_loader,
         batch_size=config.train_batch_size,
         use_masks=config.use_masks,
-        text_encoder_output_cache_dir=text_encoder_output_cache_dir_name,
+        text_encoder_output_cache_dir=text_encoder_output_cache_dir_name
+        if text_encoder_output_resident_cache is None
+        else None,
         vae_output_cache_dir=vae_output_cache_dir_name,
     )
 
@@ -367,6 +445,8 @@ def train(config: SdxlFinetuneConfig, callbacks: list[PipelineCallbacks] | None
     for epoch in range(first_epoch, num_train_epochs):
         train_loss = 0.0
         for data_batch_idx, data_batch in enumerate(data_loader):
+            if text_encoder_output_resident_cache is not None:
+                data_batch.update(text_encoder_output_resident_cache.load_batch(get_caption_cache_keys(data_batch)))
             with accelerator.accumulate(unet, text_encoder_1, text_encoder_2):
                 loss = train_forward(
                     accelerator=accelerator,
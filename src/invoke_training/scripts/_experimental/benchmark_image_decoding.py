@@ -0,0 +1,95 @@
+import argparse
+import time
+import typing
+
+import torch
+
+from invoke_training._shared.data.datasets.image_dir_dataset import ImageDirDataset
+from invoke_training._shared.data.transforms.sd_image_transform import SDImageTransform
+from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketManager
+from invoke_training._shared.data.utils.pre_resized_image_cache import get_target_resolution_fn
+
+# The benchmarked configurations: (name, image decode backend, reduced-size JPEG decoding).
+_CONFIGURATIONS: list[tuple[str, typing.Literal["pil", "torchvision"], bool]] = [
+    ("pil", "pil", False),
+    ("pil + reduced-size JPEG decoding", "pil", True),
+    ("torchvision", "torchvision", False),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the throughput of image loading and SD image transforms for each image decode backend. "
+        "All images are loaded on the main process, so the results are images/sec per DataLoader worker."
+    )
+    parser.add_argument("--image-dir", type=str, required=True, help="A directory of images to load.")
+    parser.add_argument("--resolution", type=int, default=1024, help="The target resolution.")
+    parser.add_argument(
+        "--aspect-ratio-buckets",
+        action="store_true",
+        help="Use aspect ratio buckets (from 0.5x to 2x `--resolution`) rather than a fixed square resolution.",
+    )
+    parser.add_argument("--num-images", type=int, default=None, help="Limit the number of images per pass.")
+    parser.add_argument("--num-passes", type=int, default=2, help="The number of passes over the images.")
+    return parser.parse_args()
+
+
+def benchmark(
+    dataset: ImageDirDataset, transform: SDImageTransform, num_images: int, num_passes: int
+) -> tuple[float, float]:
+    """Benchmark loading and transforming `num_images` images `num_passes` times.
+
+    Returns:
+        tuple[float, float]: The mean and best images/sec over all passes.
+    """
+    images_per_sec = []
+    for _ in range(num_passes):
+        start_time = time.perf_counter()
+        for idx in range(num_images):
+            transform(dataset[idx])
+        images_per_sec.append(num_images / (time.perf_counter() - start_time))
+    return sum(images_per_sec) / len(images_per_sec), max(images_per_sec)
+
+
+def main():
+    args = parse_args()
+    # Benchmark a single DataLoader worker, which loads images on a single thread.
+    torch.set_num_threads(1)
+
+    if args.aspect_ratio_buckets:
+        divisible_by = 64
+        aspect_ratio_bucket_manager = AspectRatioBucketManager.from_constraints(
+            target_resolution=args.resolution,
+            start_dim=args.resolution // 2 // divisible_by * divisible_by,
+            end_dim=args.resolution * 2,
+            divisible_by=divisible_by,
+        )
+        resolution = None
+    else:
+        aspect_ratio_bucket_manager = None
+        resolution = args.resolution
+
+    transform = SDImageTransform(
+        image_field_names=["image"],
+        fields_to_normalize_to_range_minus_one_to_one=["image"],
+        resolution=resolution,
+        aspect_ratio_bucket_manager=aspect_ratio_bucket_manager,
+        center_crop=False,
+        random_flip=True,
+    )
+
+    baseline = None
+    for name, image_decode_backend, reduced_size_jpeg_decoding in _CONFIGURATIONS:
+        dataset = ImageDirDataset(args.image_dir)
+        dataset.set_image_decode_backend(image_decode_backend)
+        if reduced_size_jpeg_decoding:
+            dataset.set_reduced_size_decoding(get_target_resolution_fn(resolution, aspect_ratio_bucket_manager))
+
+        num_images = len(dataset) if args.num_images is None else min(args.num_images, len(dataset))
+        mean, best = benchmark(dataset, transform, num_images, args.num_passes)
+        baseline = baseline or mean
+        print(f"{name:>34}: {mean:8.1f} images/sec (best: {best:8.1f}, speedup: {mean / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -280,7 +280,7 @@ class DataPage:
 
         print(f"Updating caption for example {idx} of '{self._jsonl_path}'.")
         caption = data[self._cur_caption]
-        self._dataset.examples[idx].caption = caption
+        self._dataset.examples[idx] = self._dataset.examples[idx].model_copy(update={"caption": caption})
         self._dataset.save_jsonl()
 
         return self._update_state(idx + idx_change)
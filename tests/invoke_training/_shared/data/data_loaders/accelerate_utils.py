@@ -0,0 +1,24 @@
+import typing
+
+import torch
+from accelerate import Accelerator
+from accelerate.state import AcceleratorState, GradientState
+
+
+def get_sync_gradients_per_batch(data_loader: typing.Iterable, gradient_accumulation_steps: int) -> list[bool]:
+    """Run a training-loop-style pass over `data_loader` with an `Accelerator`, and return whether the gradients were
+    synced (i.e. an optimizer step was taken) on each batch.
+    """
+    accelerator = Accelerator(gradient_accumulation_steps=gradient_accumulation_steps, cpu=True)
+    try:
+        model = accelerator.prepare(torch.nn.Linear(1, 1))
+        # Mirror the trainers, which call `accelerator.prepare(...)` on the data loader.
+        data_loader = accelerator.prepare(data_loader)
+        sync_gradients = []
+        for _ in data_loader:
+            with accelerator.accumulate(model):
+                sync_gradients.append(accelerator.sync_gradients)
+        return sync_gradients
+    finally:
+        AcceleratorState._reset_state(reset_partial_state=True)
+        GradientState._reset_state()
@@ -0,0 +1,97 @@
+from pathlib import Path
+
+import torch
+
+from invoke_training._shared.data.data_loaders.image_caption_flux_dataloader import (
+    build_image_caption_flux_dataloader,
+)
+from invoke_training._shared.data.utils.cache_population import get_caption_cache_keys, populate_tensor_disk_caches
+from invoke_training.config.data.data_loader_config import ImageCaptionFluxDataLoaderConfig
+from invoke_training.config.data.dataset_config import ImageCaptionJsonlDatasetConfig, ImageCaptionTarShardDatasetConfig
+
+from ..dataset_fixtures import image_caption_jsonl, image_caption_tar_shards  # noqa: F401
+
+
+def test_build_image_caption_flux_dataloader(image_caption_jsonl):  # noqa: F811
+    """Smoke test of build_image_caption_flux_dataloader(...)."""
+    config = ImageCaptionFluxDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl)),
+    )
+    data_loader = build_image_caption_flux_dataloader(config, 4)
+
+    example = next(iter(data_loader))
+    assert set(example.keys()) == {"image", "id", "caption"}
+    assert example["image"].shape == (4, 3, 512, 512)
+
+
+def test_build_image_caption_flux_dataloader_tar_shards(image_caption_tar_shards):  # noqa: F811
+    """Smoke test of build_image_caption_flux_dataloader(...) with a tar-shard dataset."""
+    config = ImageCaptionFluxDataLoaderConfig(
+        dataset=ImageCaptionTarShardDatasetConfig(shards=[str(image_caption_tar_shards / "*.tar")]),
+    )
+    data_loader = build_image_caption_flux_dataloader(config, 4)
+
+    assert len(data_loader) == 3
+    example = next(iter(data_loader))
+    assert set(example.keys()) == {"image", "id", "caption"}
+    assert example["image"].shape == (4, 3, 512, 512)
+
+
+def test_build_image_caption_flux_dataloader_with_caches(image_caption_jsonl, tmp_path: Path):  # noqa: F811
+    """Test that build_image_caption_flux_dataloader(...) loads packed latents and all text encoder outputs from the
+    caches.
+    """
+    config = ImageCaptionFluxDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl)),
+    )
+    vae_output_cache_dir = str(tmp_path / "vae_output")
+    text_encoder_output_cache_dir = str(tmp_path / "text_encoder_output")
+
+    def build_vae_outputs(data_batch):
+        batch_size = len(data_batch["id"])
+        return {
+            "vae_output": torch.rand((batch_size, 1024, 64)),
+            "latent_size_hw": [(64, 64)] * batch_size,
+        }
+
+    def build_text_encoder_outputs(data_batch):
+        batch_size = len(data_batch["id"])
+        return {
+            "prompt_embeds": torch.rand((batch_size, 16, 32)),
+            "pooled_prompt_embeds": torch.rand((batch_size, 8)),
+            "text_ids": torch.zeros((batch_size, 16, 3)),
+        }
+
+    populate_tensor_disk_caches(
+        build_image_caption_flux_dataloader(config, 2, shuffle=False),
+        {vae_output_cache_dir: build_vae_outputs, text_encoder_output_cache_dir: build_text_encoder_outputs},
+        cache_key_fns={text_encoder_output_cache_dir: get_caption_cache_keys},
+    )
+
+    data_loader = build_image_caption_flux_dataloader(
+        config,
+        4,
+        text_encoder_output_cache_dir=text_encoder_output_cache_dir,
+        text_encoder_cache_field_to_output_field={
+            "prompt_embeds": "prompt_embeds",
+            "pooled_prompt_embeds": "pooled_prompt_embeds",
+            "text_ids": "text_ids",
+        },
+        vae_output_cache_dir=vae_output_cache_dir,
+    )
+
+    example = next(iter(data_loader))
+    assert set(example.keys()) == {
+        "id",
+        "caption",
+        "vae_output",
+        "latent_size_hw",
+        "prompt_embeds",
+        "pooled_prompt_embeds",
+        "text_ids",
+    }
+    assert example["vae_output"].shape == (4, 1024, 64)
+    assert example["latent_size_hw"] == [(64, 64)] * 4
+    assert example["prompt_embeds"].shape == (4, 16, 32)
+    assert example["pooled_prompt_embeds"].shape == (4, 8)
+    assert example["text_ids"].shape == (4, 16, 3)
@@ -1,12 +1,22 @@
 import math
+from pathlib import Path
+from unittest import mock
 
+import pytest
 import torch
 
-from invoke_training._shared.data.data_loaders.image_caption_sd_dataloader import build_image_caption_sd_dataloader
-from invoke_training.config.data.data_loader_config import ImageCaptionSDDataLoaderConfig
-from invoke_training.config.data.dataset_config import ImageCaptionJsonlDatasetConfig
+from invoke_training._shared.data.data_loaders.image_caption_sd_dataloader import (
+    BatchSizeLossWeightCollateFn,
+    build_image_caption_sd_dataloader,
+    get_partial_batch_strategy,
+    sd_image_caption_collate_fn,
+)
+from invoke_training._shared.data.utils.cache_population import populate_tensor_disk_caches
+from invoke_training.config.data.data_loader_config import AspectRatioBucketConfig, ImageCaptionSDDataLoaderConfig
+from invoke_training.config.data.dataset_config import ImageCaptionJsonlDatasetConfig, ImageCaptionTarShardDatasetConfig
 
-from ..dataset_fixtures import image_caption_jsonl  # noqa: F401
+from ..dataset_fixtures import image_caption_jsonl, image_caption_tar_shards  # noqa: F401
+from .accelerate_utils import get_sync_gradients_per_batch
 
 
 def test_build_image_caption_sd_dataloader(image_caption_jsonl):  # noqa: F811
@@ -69,3 +79,253 @@ def test_build_image_caption_sd_dataloader_with_masks(image_caption_jsonl):  # n
     crop_top_left_yx = example["crop_top_left_yx"]
     assert len(crop_top_left_yx) == 4
     assert len(crop_top_left_yx[0]) == 2
+
+
+def test_build_image_caption_sd_dataloader_with_pre_resize_cache(image_caption_jsonl, tmp_path):  # noqa: F811
+    """Test that loading images through a pre-resized image cache produces the same batches as loading the source
+    images directly, both when the cache is populated and when it is re-used.
+    """
+    dataset_config = ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl))
+    reference_batch = next(
+        iter(
+            build_image_caption_sd_dataloader(ImageCaptionSDDataLoaderConfig(dataset=dataset_config), 4, shuffle=False)
+        )
+    )
+
+    config = ImageCaptionSDDataLoaderConfig(dataset=dataset_config, pre_resize_cache_dir=str(tmp_path / "pre_resize"))
+    for _ in range(2):
+        batch = next(iter(build_image_caption_sd_dataloader(config, 4, use_masks=False, shuffle=False)))
+        assert torch.equal(batch["image"], reference_batch["image"])
+        assert batch["original_size_hw"] == reference_batch["original_size_hw"]
+        assert batch["crop_top_left_yx"] == reference_batch["crop_top_left_yx"]
+
+    # The image and mask of each of the 4 loaded examples are cached.
+    assert len(list((tmp_path / "pre_resize").glob("*/*/*.png"))) == 8
+
+
+def test_build_image_caption_sd_dataloader_reduced_size_jpeg_decoding(image_caption_jsonl):  # noqa: F811
+    """Smoke test of build_image_caption_sd_dataloader(...) with reduced-size JPEG decoding."""
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl)),
+        resolution=64,
+        reduced_size_jpeg_decoding=True,
+    )
+    data_loader = build_image_caption_sd_dataloader(config, 4)
+
+    example = next(iter(data_loader))
+    assert example["image"].shape == (4, 3, 64, 64)
+
+
+def test_build_image_caption_sd_dataloader_reduced_size_jpeg_decoding_keep_in_memory(image_caption_jsonl):  # noqa: F811
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl), keep_in_memory=True),
+        reduced_size_jpeg_decoding=True,
+    )
+    with pytest.raises(ValueError, match="keep_in_memory"):
+        build_image_caption_sd_dataloader(config, 4)
+
+
+def test_build_image_caption_sd_dataloader_torchvision_decode_backend(image_caption_jsonl):  # noqa: F811
+    """Smoke test of build_image_caption_sd_dataloader(...) with the torchvision image decode backend."""
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl)),
+        image_decode_backend="torchvision",
+    )
+    data_loader = build_image_caption_sd_dataloader(config, 4, use_masks=True)
+
+    example = next(iter(data_loader))
+    assert example["image"].shape == (4, 3, 512, 512)
+    assert example["image"].dtype == torch.float32
+    assert example["mask"].shape == (4, 1, 512, 512)
+    assert example["original_size_hw"][0] == (128, 128)
+
+
+def test_build_image_caption_sd_dataloader_torchvision_decode_backend_reduced_size(image_caption_jsonl):  # noqa: F811
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl)),
+        image_decode_backend="torchvision",
+        reduced_size_jpeg_decoding=True,
+    )
+    with pytest.raises(ValueError, match="reduced_size_jpeg_decoding"):
+        build_image_caption_sd_dataloader(config, 4)
+
+
+def test_sd_image_caption_collate_fn_shared_memory():
+    """Test that sd_image_caption_collate_fn(...) stacks tensors into shared memory when called from a DataLoader
+    worker.
+    """
+    examples = [{"id": i, "vae_output": torch.full((4, 8, 8), float(i))} for i in range(3)]
+
+    # Main process.
+    out = sd_image_caption_collate_fn(examples)
+    assert out["vae_output"].shape == (3, 4, 8, 8)
+    assert not out["vae_output"].is_shared()
+
+    # DataLoader worker process.
+    with mock.patch("torch.utils.data.get_worker_info", return_value=object()):
+        out = sd_image_caption_collate_fn(examples)
+    assert out["vae_output"].is_shared()
+    torch.testing.assert_close(out["vae_output"], torch.stack([e["vae_output"] for e in examples]))
+
+
+def test_batch_size_loss_weight_collate_fn():
+    collate_fn = BatchSizeLossWeightCollateFn(sd_image_caption_collate_fn, reference_batch_size=4)
+
+    out = collate_fn([{"id": i} for i in range(2)])
+    torch.testing.assert_close(out["loss_weight"], torch.tensor([0.5, 0.5]))
+
+    # Existing per-example loss weights are scaled.
+    out = collate_fn([{"id": i, "loss_weight": float(i + 1)} for i in range(2)])
+    torch.testing.assert_close(out["loss_weight"], torch.tensor([0.5, 1.0]))
+
+
+def test_build_image_caption_sd_dataloader_max_pixels_per_batch(image_caption_jsonl):  # noqa: F811
+    """Test that `max_pixels_per_batch` produces per-bucket batch sizes and loss weights relative to the training batch
+    size.
+    """
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl)),
+        aspect_ratio_buckets=AspectRatioBucketConfig(
+            target_resolution=256, start_dim=128, end_dim=512, divisible_by=64, max_pixels_per_batch=2 * 256 * 256
+        ),
+    )
+    data_loader = build_image_caption_sd_dataloader(config, batch_size=1)
+
+    num_examples = 0
+    for batch in data_loader:
+        batch_size, _, height, width = batch["image"].shape
+        assert batch_size * height * width <= 2 * 256 * 256
+        torch.testing.assert_close(batch["loss_weight"], torch.full((batch_size,), float(batch_size)))
+        num_examples += batch_size
+    assert num_examples == 5
+    assert any(len(batch["id"]) > 1 for batch in data_loader)
+
+
+@pytest.mark.parametrize(
+    ["partial_batches", "shuffle", "expected"],
+    [
+        ("carry_over", True, "carry_over"),
+        ("carry_over", False, "keep"),
+        ("drop_last", False, "keep"),
+        ("merge_adjacent", False, "merge_adjacent"),
+    ],
+)
+def test_get_partial_batch_strategy(partial_batches: str, shuffle: bool, expected: str):
+    """Test that unshuffled (cache population) data loaders never leave examples out of an epoch."""
+    config = AspectRatioBucketConfig(
+        target_resolution=256, start_dim=128, end_dim=512, divisible_by=64, partial_batches=partial_batches
+    )
+    assert get_partial_batch_strategy(config, shuffle) == expected
+
+
+def test_build_image_caption_sd_dataloader_merge_adjacent(image_caption_jsonl):  # noqa: F811
+    """Test that examples in merged buckets are transformed to the resolution of the bucket they were merged into."""
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl)),
+        aspect_ratio_buckets=AspectRatioBucketConfig(
+            target_resolution=256, start_dim=128, end_dim=512, divisible_by=64, partial_batches="merge_adjacent"
+        ),
+    )
+    data_loader = build_image_caption_sd_dataloader(config, batch_size=2)
+
+    assert data_loader.batch_sampler.get_num_partial_batches() <= 1
+    # Collation would fail if a batch contained images of different resolutions.
+    assert sum(len(batch["id"]) for batch in data_loader) == 5
+
+
+@pytest.mark.parametrize(
+    "image_sizing_kwargs", [{"pre_resize_cache_dir": "pre_resized"}, {"reduced_size_jpeg_decoding": True}]
+)
+def test_build_image_caption_sd_dataloader_merge_adjacent_image_sizing(
+    image_caption_jsonl,  # noqa: F811
+    image_sizing_kwargs: dict,
+):
+    """Test that merge_adjacent is rejected with options that size images for their original bucket."""
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl)),
+        aspect_ratio_buckets=AspectRatioBucketConfig(
+            target_resolution=256, start_dim=128, end_dim=512, divisible_by=64, partial_batches="merge_adjacent"
+        ),
+        **image_sizing_kwargs,
+    )
+    with pytest.raises(ValueError, match="merge_adjacent"):
+        build_image_caption_sd_dataloader(config, batch_size=2)
+
+
+def test_build_image_caption_sd_dataloader_with_augmentation_variant_cache(
+    image_caption_jsonl,  # noqa: F811
+    tmp_path: Path,
+):
+    """Test that a VAE output cache of augmentation variants can be populated and loaded when random augmentations are
+    enabled.
+    """
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionJsonlDatasetConfig(jsonl_path=str(image_caption_jsonl)),
+        resolution=64,
+        center_crop=False,
+        random_flip=True,
+        num_cached_random_crops=2,
+    )
+    vae_output_cache_dir = str(tmp_path)
+
+    def build_vae_outputs(data_batch):
+        # Each image has 2 crops x 2 flips = 4 variants.
+        assert data_batch["image"].shape[1:] == (4, 3, 64, 64)
+        return {
+            "vae_output": data_batch["image"][:, :, :, :8, :8],
+            "original_size_hw": data_batch["original_size_hw"],
+            "crop_top_left_yx": data_batch["crop_top_left_yx"],
+        }
+
+    populate_tensor_disk_caches(
+        build_image_caption_sd_dataloader(config, 2, shuffle=False, generate_augmentation_variants=True),
+        {vae_output_cache_dir: build_vae_outputs},
+    )
+
+    data_loader = build_image_caption_sd_dataloader(config, 4, vae_output_cache_dir=vae_output_cache_dir)
+
+    example = next(iter(data_loader))
+    assert set(example.keys()) == {"vae_output", "id", "caption", "original_size_hw", "crop_top_left_yx"}
+    assert example["vae_output"].shape == (4, 3, 8, 8)
+    assert len(example["crop_top_left_yx"]) == 4
+    assert all(len(crop_top_left_yx) == 2 for crop_top_left_yx in example["crop_top_left_yx"])
+
+
+def test_build_image_caption_sd_dataloader_tar_shards(image_caption_tar_shards):  # noqa: F811
+    """Test build_image_caption_sd_dataloader(...) with a tar-shard dataset."""
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionTarShardDatasetConfig(shards=[str(image_caption_tar_shards / "shard-{000..002}.tar")]),
+    )
+    data_loader = build_image_caption_sd_dataloader(config, 4, use_masks=True)
+
+    # The dataset has 10 samples, so the data loader should have 3 batches.
+    assert len(data_loader) == 3
+
+    batches = list(data_loader)
+    assert len(batches) == 3
+    assert set(batches[0].keys()) == {"image", "mask", "id", "caption", "original_size_hw", "crop_top_left_yx"}
+    assert batches[0]["image"].shape == (4, 3, 512, 512)
+    assert len({id for batch in batches for id in batch["id"]}) == 10
+
+
+def test_build_image_caption_sd_dataloader_tar_shards_gradient_accumulation(image_caption_tar_shards):  # noqa: F811
+    """Test that the gradients are synced on the last batch of an epoch of a tar-shard dataset, when the number of
+    batches is not a multiple of `gradient_accumulation_steps`.
+    """
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionTarShardDatasetConfig(shards=[str(image_caption_tar_shards / "shard-{000..002}.tar")]),
+        resolution=128,
+    )
+    data_loader = build_image_caption_sd_dataloader(config, 4)
+
+    assert len(data_loader) == 3
+    assert get_sync_gradients_per_batch(data_loader, gradient_accumulation_steps=2) == [False, True, True]
+
+
+def test_build_image_caption_sd_dataloader_tar_shards_with_cache(image_caption_tar_shards, tmp_path):  # noqa: F811
+    """Test that caching is rejected for tar-shard datasets."""
+    config = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionTarShardDatasetConfig(shards=[str(image_caption_tar_shards / "*.tar")]),
+    )
+    with pytest.raises(ValueError):
+        build_image_caption_sd_dataloader(config, 4, vae_output_cache_dir=str(tmp_path))
@@ -0,0 +1,44 @@
+import torch
+from torch.utils.data import DataLoader
+
+from invoke_training._shared.data.data_loaders.sharded_data_loader import ShardedDataLoader, get_batch_sampler_shard
+from invoke_training._shared.data.samplers.aspect_ratio_bucket_batch_sampler import AspectRatioBucketBatchSampler
+from invoke_training._shared.data.utils.resolution import Resolution
+
+from .accelerate_utils import get_sync_gradients_per_batch
+
+
+def test_sharded_data_loader():
+    batch_sampler = AspectRatioBucketBatchSampler(
+        buckets={Resolution(512, 512): [0, 1, 2, 3]}, batch_size=1, seed=0, num_replicas=2, rank=1
+    )
+    data_loader = ShardedDataLoader(
+        DataLoader([torch.tensor(float(i)) for i in range(4)], batch_sampler=batch_sampler), device="cpu"
+    )
+
+    assert data_loader.batch_sampler is batch_sampler
+    assert len(data_loader) == 2
+    assert [batch.tolist() for batch in data_loader] == [[1.0], [3.0]]
+
+
+def test_get_batch_sampler_shard():
+    # Unshuffled data loaders are never split.
+    assert get_batch_sampler_shard(shuffle=False) == (1, 0)
+    # Tests run in a single process.
+    assert get_batch_sampler_shard(shuffle=True) == (1, 0)
+
+
+def test_sharded_data_loader_gradient_accumulation():
+    """Test that the gradients are synced on the last batch of an epoch, even if the number of batches is not a multiple
+    of `gradient_accumulation_steps`.
+    """
+    batch_sampler = AspectRatioBucketBatchSampler(
+        buckets={Resolution(512, 512): list(range(6))}, batch_size=1, seed=0, num_replicas=2, rank=0
+    )
+    data_loader = ShardedDataLoader(
+        DataLoader([torch.tensor(float(i)) for i in range(6)], batch_sampler=batch_sampler), device="cpu"
+    )
+
+    assert len(data_loader) == 3
+    for _ in range(2):
+        assert get_sync_gradients_per_batch(data_loader, gradient_accumulation_steps=2) == [False, True, True]
@@ -0,0 +1,95 @@
+import datasets
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torch.utils.data import default_collate
+
+from invoke_training._shared.data.data_loaders.streaming_data_loader import build_streaming_data_loader
+from invoke_training._shared.data.datasets.hf_streaming_image_caption_dataset import HFStreamingImageCaptionDataset
+
+from .accelerate_utils import get_sync_gradients_per_batch
+
+
+def _build_dataset(num_examples: int | None) -> HFStreamingImageCaptionDataset:
+    # Alternate between two image resolutions, so that the examples fall into two buckets.
+    hf_dataset = datasets.Dataset.from_dict(
+        {
+            "image": [Image.new("RGB", (8, 8 if i % 2 == 0 else 16)) for i in range(5)],
+            "text": [f"caption {i}" for i in range(5)],
+        }
+    )
+    return HFStreamingImageCaptionDataset(hf_dataset.to_iterable_dataset(num_shards=1), num_examples=num_examples)
+
+
+def _to_tensor(example):
+    example["image"] = torch.from_numpy(np.array(example["image"])).permute(2, 0, 1)
+    return example
+
+
+def _collate_fn(examples):
+    return {"image": default_collate([example["image"] for example in examples])}
+
+
+def test_build_streaming_data_loader():
+    data_loader = build_streaming_data_loader(
+        _build_dataset(num_examples=5),
+        [_to_tensor],
+        batch_size=2,
+        collate_fn=_collate_fn,
+        bucket_buffer_size=4,
+    )
+
+    batches = list(data_loader)
+
+    assert len(data_loader) == 3
+    assert data_loader.batch_sampler is None
+    assert [tuple(batch["image"].shape) for batch in batches] == [
+        (2, 3, 8, 8),
+        (2, 3, 16, 8),
+        (1, 3, 8, 8),
+    ]
+
+
+def test_streaming_data_loader_restarts_short_stream():
+    """Test that a StreamingDataLoader restarts the stream to produce `len(data_loader)` batches, if the stream runs out
+    early.
+    """
+    data_loader = build_streaming_data_loader(
+        _build_dataset(num_examples=9),
+        [_to_tensor],
+        batch_size=2,
+        collate_fn=_collate_fn,
+        bucket_buffer_size=4,
+    )
+
+    assert len(data_loader) == 5
+    assert len(list(data_loader)) == 5
+
+
+def test_build_streaming_data_loader_unknown_num_examples():
+    with pytest.raises(ValueError):
+        build_streaming_data_loader(
+            _build_dataset(num_examples=None),
+            [_to_tensor],
+            batch_size=2,
+            collate_fn=_collate_fn,
+            bucket_buffer_size=4,
+        )
+
+
+def test_streaming_data_loader_gradient_accumulation():
+    """Test that the gradients are synced on the last batch of an epoch, even if the number of batches is not a multiple
+    of `gradient_accumulation_steps`.
+    """
+    data_loader = build_streaming_data_loader(
+        _build_dataset(num_examples=5),
+        [_to_tensor],
+        batch_size=2,
+        collate_fn=_collate_fn,
+        bucket_buffer_size=4,
+    )
+
+    assert len(data_loader) == 3
+    for _ in range(2):
+        assert get_sync_gradients_per_batch(data_loader, gradient_accumulation_steps=2) == [False, True, True]
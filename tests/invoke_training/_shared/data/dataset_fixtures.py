@@ -1,3 +1,6 @@
+import io
+import tarfile
+
 import numpy as np
 import PIL.Image
 import pytest
@@ -118,3 +121,39 @@ def image_pair_preference_dir(tmp_path_factory: pytest.TempPathFactory):
     ImagePairPreferenceDataset.save_metadata(metadata=metadata, dataset_dir=tmp_dir)
 
     return tmp_dir
+
+
+def _add_tar_file(tar: tarfile.TarFile, name: str, data: bytes):
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = len(data)
+    tar.addfile(tar_info, io.BytesIO(data))
+
+
+def _encode_image(image: PIL.Image.Image, format: str) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+@pytest.fixture(scope="session")
+def image_caption_tar_shards(tmp_path_factory: pytest.TempPathFactory):
+    """A fixture that populates a temp directory with 3 tar shards containing a total of 10 image-caption-mask samples
+    (in the WebDataset format) and returns the directory path. The shards are named 'shard-{000..002}.tar'.
+
+    Note that the 'session' scope is used to share the same directory across all tests in a session, because it is
+    costly to populate the directory.
+    """
+    tmp_dir = tmp_path_factory.mktemp("dataset")
+
+    sample_idx = 0
+    for shard_idx, num_samples in enumerate([4, 3, 3]):
+        with tarfile.open(tmp_dir / f"shard-{shard_idx:03d}.tar", "w") as tar:
+            for _ in range(num_samples):
+                rgb_pil = PIL.Image.fromarray(np.ones((128, 128, 3), dtype=np.uint8))
+                mask_pil = PIL.Image.fromarray(np.ones((128, 128), dtype=np.uint8)).convert("L")
+                _add_tar_file(tar, f"{sample_idx:04d}.jpg", _encode_image(rgb_pil, "JPEG"))
+                _add_tar_file(tar, f"{sample_idx:04d}.txt", f"caption {sample_idx}".encode())
+                _add_tar_file(tar, f"{sample_idx:04d}.mask.png", _encode_image(mask_pil, "PNG"))
+                sample_idx += 1
+
+    return tmp_dir
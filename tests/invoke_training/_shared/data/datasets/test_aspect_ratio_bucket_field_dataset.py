@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from invoke_training._shared.data.datasets.aspect_ratio_bucket_field_dataset import AspectRatioBucketFieldDataset
+from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketAssignment
+from invoke_training._shared.data.utils.resolution import Resolution
+
+
+def test_aspect_ratio_bucket_field_dataset():
+    base_dataset = [{"id": "0"}, {"id": "1"}, {"id": "2"}]
+    buckets = [Resolution(256, 512), Resolution(512, 256)]
+    bucket_assignment = AspectRatioBucketAssignment(np.array([1, 0, 1]), buckets)
+
+    dataset = AspectRatioBucketFieldDataset(base_dataset, bucket_assignment)
+
+    assert len(dataset) == 3
+    assert dataset[0] == {"id": "0", "aspect_ratio_bucket": Resolution(512, 256)}
+    assert dataset[1]["aspect_ratio_bucket"] == Resolution(256, 512)
+
+
+def test_aspect_ratio_bucket_field_dataset_length_mismatch():
+    bucket_assignment = AspectRatioBucketAssignment(np.array([0]), [Resolution(256, 256)])
+
+    with pytest.raises(ValueError):
+        AspectRatioBucketFieldDataset([{}, {}], bucket_assignment)
+
+
+def test_aspect_ratio_bucket_assignment_concatenate():
+    buckets = [Resolution(256, 512), Resolution(512, 256)]
+    bucket_assignment = AspectRatioBucketAssignment.concatenate(
+        [AspectRatioBucketAssignment(np.array([1]), buckets), AspectRatioBucketAssignment(np.array([0, 1]), buckets)]
+    )
+
+    assert [bucket_assignment[i] for i in range(len(bucket_assignment))] == [buckets[1], buckets[0], buckets[1]]
@@ -0,0 +1,55 @@
+import pytest
+
+from invoke_training._shared.data.datasets.bucket_batch_iterable_dataset import BucketBatchIterableDataset
+
+
+def _get_bucket(example):
+    return example["bucket"]
+
+
+def _make_examples(buckets: list[str]) -> list[dict]:
+    return [{"id": i, "bucket": bucket} for i, bucket in enumerate(buckets)]
+
+
+def _batch_ids(batches: list[list[dict]]) -> list[list[int]]:
+    return [[example["id"] for example in batch] for batch in batches]
+
+
+def test_bucket_batch_iterable_dataset_full_batches():
+    """Test that examples are grouped into batches from a single bucket."""
+    examples = _make_examples(["a", "b", "a", "b", "b", "a"])
+
+    dataset = BucketBatchIterableDataset(examples, batch_size=2, buffer_size=8, get_bucket_fn=_get_bucket)
+
+    assert _batch_ids(list(dataset)) == [[0, 2], [1, 3], [4], [5]]
+
+
+def test_bucket_batch_iterable_dataset_buffer_full():
+    """Test that the fullest bucket is flushed as a partial batch when the buffer fills up."""
+    examples = _make_examples(["a", "b", "a", "c", "d"])
+
+    dataset = BucketBatchIterableDataset(examples, batch_size=3, buffer_size=4, get_bucket_fn=_get_bucket)
+
+    assert _batch_ids(list(dataset)) == [[0, 2], [1], [3], [4]]
+
+
+def test_bucket_batch_iterable_dataset_drop_last():
+    """Test that partial batches are dropped when drop_last=True."""
+    examples = _make_examples(["a", "b", "a", "c", "a"])
+
+    dataset = BucketBatchIterableDataset(
+        examples, batch_size=2, buffer_size=2, get_bucket_fn=_get_bucket, drop_last=True
+    )
+
+    assert _batch_ids(list(dataset)) == []
+
+    dataset = BucketBatchIterableDataset(
+        examples, batch_size=2, buffer_size=4, get_bucket_fn=_get_bucket, drop_last=True
+    )
+
+    assert _batch_ids(list(dataset)) == [[0, 2]]
+
+
+def test_bucket_batch_iterable_dataset_buffer_too_small():
+    with pytest.raises(ValueError):
+        BucketBatchIterableDataset([], batch_size=4, buffer_size=2)
@@ -1,4 +1,5 @@
 from pathlib import Path
+from unittest import mock
 
 import numpy as np
 import PIL
@@ -111,6 +112,17 @@ def test_hf_dir_image_caption_dataset_get_image_dimensions(hf_dir_dataset: HFIma
         assert image_dim == Resolution(128, 128)
 
 
+def test_hf_dir_image_caption_dataset_get_image_dimensions_indexed(hf_dir_dataset: HFImageCaptionDataset):
+    """Test that HFImageCaptionDataset.get_image_dimensions() re-uses the persisted dimensions on subsequent calls."""
+    hf_dir_dataset.get_image_dimensions()
+
+    with mock.patch.object(type(hf_dir_dataset._raw_hf_dataset), "__getitem__") as mock_getitem:
+        image_dims = hf_dir_dataset.get_image_dimensions()
+        mock_getitem.assert_not_called()
+
+    assert image_dims == [Resolution(128, 128)] * 5
+
+
 ################################################
 # Tests for HFImageCaptionDataset.from_hub(...)
 ################################################
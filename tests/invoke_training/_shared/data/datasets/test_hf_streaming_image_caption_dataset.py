@@ -0,0 +1,77 @@
+import unittest.mock
+
+import datasets
+import numpy as np
+import pytest
+from PIL import Image
+
+from invoke_training._shared.data.datasets.hf_streaming_image_caption_dataset import HFStreamingImageCaptionDataset
+
+
+def _build_hf_iterable_dataset(num_examples: int, num_shards: int) -> datasets.IterableDataset:
+    hf_dataset = datasets.Dataset.from_dict(
+        {
+            "image": [Image.fromarray(np.full((8, 8), i, dtype=np.uint8), mode="L") for i in range(num_examples)],
+            "text": [f"caption {i}" for i in range(num_examples)],
+        }
+    )
+    return hf_dataset.to_iterable_dataset(num_shards=num_shards)
+
+
+def test_hf_streaming_image_caption_dataset_iter():
+    dataset = HFStreamingImageCaptionDataset(_build_hf_iterable_dataset(4, 2), num_examples=4)
+
+    examples = list(dataset)
+
+    assert dataset.num_examples == 4
+    assert len(examples) == 4
+    assert examples[0]["id"] == "0_0_0"
+    assert examples[0]["caption"] == "caption 0"
+    # Images are converted to RGB.
+    assert examples[0]["image"].mode == "RGB"
+
+
+@pytest.mark.parametrize("num_shards", [2, 3])
+def test_hf_streaming_image_caption_dataset_split_by_rank(num_shards: int):
+    """Test that the stream is split into disjoint subsets that cover the whole dataset, both when the number of shards
+    is divisible by the world size and when it isn't.
+    """
+    world_size = 2
+    captions_per_rank = []
+    for rank in range(world_size):
+        dataset = HFStreamingImageCaptionDataset(
+            _build_hf_iterable_dataset(6, num_shards), rank=rank, world_size=world_size, num_examples=6
+        )
+        assert dataset.num_examples == 3
+        captions_per_rank.append({example["caption"] for example in dataset})
+
+    assert captions_per_rank[0].isdisjoint(captions_per_rank[1])
+    assert captions_per_rank[0] | captions_per_rank[1] == {f"caption {i}" for i in range(6)}
+
+
+def test_hf_streaming_image_caption_dataset_shuffle_epoch():
+    """Test that the shuffle order changes with the epoch."""
+    dataset = HFStreamingImageCaptionDataset(_build_hf_iterable_dataset(32, 4), shuffle_buffer_size=32, seed=0)
+
+    dataset.set_epoch(0)
+    epoch_0 = [example["caption"] for example in dataset]
+    dataset.set_epoch(1)
+    epoch_1 = [example["caption"] for example in dataset]
+
+    assert sorted(epoch_0) == sorted(epoch_1)
+    assert epoch_0 != epoch_1
+
+
+def test_hf_streaming_image_caption_dataset_bad_column():
+    with pytest.raises(ValueError):
+        HFStreamingImageCaptionDataset(_build_hf_iterable_dataset(2, 1), caption_column="missing")
+
+
+def test_hf_streaming_image_caption_dataset_from_hub_revision():
+    """Test that the dataset revision is forwarded to `datasets.load_dataset(...)`."""
+    with unittest.mock.patch.object(
+        datasets, "load_dataset", return_value=_build_hf_iterable_dataset(4, 2)
+    ) as mock_load_dataset:
+        HFStreamingImageCaptionDataset.from_hub("owner/dataset", revision="0" * 40, num_examples=4)
+
+    mock_load_dataset.assert_called_once_with("owner/dataset", split="train", streaming=True, revision="0" * 40)
@@ -1,10 +1,18 @@
 import shutil
 from pathlib import Path
 
+import numpy as np
 import PIL.Image
+import pytest
 
-from invoke_training._shared.data.datasets.image_caption_jsonl_dataset import ImageCaptionJsonlDataset
-from invoke_training._shared.utils.jsonl import load_jsonl
+from invoke_training._shared.data.datasets.image_caption_jsonl_dataset import (
+    ImageCaptionExample,
+    ImageCaptionExampleList,
+    ImageCaptionJsonlDataset,
+)
+from invoke_training._shared.data.transforms.sd_image_transform import SDImageTransform
+from invoke_training._shared.data.utils.resolution import Resolution
+from invoke_training._shared.utils.jsonl import load_jsonl, save_jsonl
 
 from ..dataset_fixtures import image_caption_jsonl  # noqa: F401
 
@@ -50,6 +58,25 @@ def test_image_caption_jsonl_dataset_keep_in_memory(image_caption_jsonl):  # noq
     assert same_example["image"] is example["image"]
 
 
+def test_image_caption_jsonl_dataset_reduced_size_decoding_png_mask(tmp_path: Path):
+    """Test that a PNG mask is decoded at the same size as its (reduced-size) JPEG image."""
+    rng = np.random.default_rng(0)
+    PIL.Image.fromarray(rng.integers(0, 256, (1024, 1024, 3), dtype=np.uint8)).save(tmp_path / "image.jpg")
+    PIL.Image.fromarray(rng.integers(0, 256, (1024, 1024), dtype=np.uint8)).save(tmp_path / "mask.png")
+    jsonl_path = tmp_path / "data.jsonl"
+    save_jsonl([{"image": "image.jpg", "text": "caption", "mask": "mask.png"}], jsonl_path)
+
+    dataset = ImageCaptionJsonlDataset(str(jsonl_path))
+    dataset.set_reduced_size_decoding(lambda size: Resolution(256, 256))
+    example = dataset[0]
+
+    assert example["image"].size == (256, 256)
+    assert example["mask"].size == (256, 256)
+    # The reduced image and mask can be passed through the transform together.
+    example = SDImageTransform(["image", "mask"], ["image"], resolution=256)(example)
+    assert example["mask"].shape[-2:] == (256, 256)
+
+
 def test_image_caption_jsonl_dataset_get_image_dimensions(image_caption_jsonl):  # noqa: F811
     dataset = ImageCaptionJsonlDataset(str(image_caption_jsonl))
 
@@ -74,3 +101,85 @@ def test_image_caption_jsonl_dataset_save_jsonl(image_caption_jsonl, tmp_path: P
     original_jsonl = load_jsonl(image_caption_jsonl)
     roundtrip_jsonl = load_jsonl(image_caption_jsonl_copy)
     assert original_jsonl == roundtrip_jsonl
+
+
+def test_image_caption_jsonl_dataset_keep_in_memory_shared(image_caption_jsonl):  # noqa: F811
+    """Test that images and masks are loaded from a shared memory cache when keep_in_memory_shared is True."""
+    dataset = ImageCaptionJsonlDataset(
+        str(image_caption_jsonl), keep_in_memory=True, keep_in_memory_max_mb=4, keep_in_memory_shared=True
+    )
+
+    example = dataset[0]
+    same_example = dataset[0]
+
+    assert example["image"].mode == "RGB"
+    assert example["mask"].mode == "L"
+    assert same_example["image"].tobytes() == example["image"].tobytes()
+    assert same_example["mask"].tobytes() == example["mask"].tobytes()
+    assert 0 in dataset._image_cache
+    assert len(dataset) in dataset._image_cache
+
+
+def test_image_caption_jsonl_dataset_lazy_load(image_caption_jsonl):  # noqa: F811
+    """Test that a lazy-loaded dataset produces the same examples as an eagerly-loaded dataset."""
+    dataset = ImageCaptionJsonlDataset(str(image_caption_jsonl))
+    lazy_dataset = ImageCaptionJsonlDataset(str(image_caption_jsonl), lazy_load=True)
+
+    assert len(lazy_dataset) == len(dataset)
+    for idx in range(len(dataset)):
+        example = dataset[idx]
+        lazy_example = lazy_dataset[idx]
+        assert lazy_example["id"] == example["id"]
+        assert lazy_example["caption"] == example["caption"]
+        assert lazy_example["image"].size == example["image"].size
+        assert "mask" in lazy_example
+    assert lazy_dataset.get_image_dimensions() == dataset.get_image_dimensions()
+
+    # All rows are parsed when the examples are accessed (e.g. for editing in the UI).
+    assert lazy_dataset.examples == dataset.examples
+
+
+def test_image_caption_jsonl_dataset_lazy_load_bad_column(image_caption_jsonl):  # noqa: F811
+    with pytest.raises(ValueError):
+        ImageCaptionJsonlDataset(str(image_caption_jsonl), caption_column="missing", lazy_load=True)
+
+
+def test_image_caption_example_list():
+    examples = [
+        ImageCaptionExample(image_path="0.jpg", caption="caption 0"),
+        ImageCaptionExample(image_path="1.jpg", mask_path="masks/1.png", caption="caption 1"),
+    ]
+
+    example_list = ImageCaptionExampleList(examples)
+
+    assert len(example_list) == 2
+    assert list(example_list) == examples
+    assert example_list[-1] == examples[1]
+
+    # Modifying a returned example does not modify the list, but examples can be replaced or appended.
+    example_list[0].caption = "modified"
+    assert example_list[0].caption == "caption 0"
+    example_list[0] = example_list[0].model_copy(update={"caption": "replaced"})
+    example_list.append(ImageCaptionExample(image_path="2.jpg", caption="caption 2"))
+    example_list[2] = ImageCaptionExample(image_path="2.jpg", caption="replaced 2")
+
+    assert [example.caption for example in example_list] == ["replaced", "caption 1", "replaced 2"]
+    with pytest.raises(IndexError):
+        example_list[3]
+
+
+def test_image_caption_jsonl_dataset_edit_and_save(image_caption_jsonl, tmp_path: Path):  # noqa: F811
+    """Test the Data UI editing flow: replace a caption, append an example, and save the jsonl file."""
+    jsonl_path = tmp_path / "test.jsonl"
+    save_jsonl(load_jsonl(image_caption_jsonl), jsonl_path)
+    dataset = ImageCaptionJsonlDataset(str(jsonl_path))
+
+    dataset.examples[1] = dataset.examples[1].model_copy(update={"caption": "new caption"})
+    dataset.examples.append(ImageCaptionExample(image_path="new.jpg", caption=""))
+    dataset.save_jsonl()
+
+    rows = load_jsonl(jsonl_path)
+    assert len(rows) == 6
+    assert rows[1]["text"] == "new caption"
+    assert rows[1]["mask"] == "masks/1.png"
+    assert rows[5] == {"image": "new.jpg", "text": "", "mask": None}
@@ -0,0 +1,95 @@
+from pathlib import Path
+from unittest import mock
+
+import pytest
+import torch
+
+from invoke_training._shared.data.datasets.image_caption_tar_shard_dataset import (
+    ImageCaptionTarShardDataset,
+    count_tar_shard_samples,
+    expand_shard_paths,
+)
+
+from ..dataset_fixtures import image_caption_tar_shards  # noqa: F401
+
+
+def _get_shard_paths(shard_dir: Path) -> list[str]:
+    return expand_shard_paths([str(shard_dir / "shard-{000..002}.tar")])
+
+
+def test_expand_shard_paths(image_caption_tar_shards: Path):  # noqa: F811
+    expected = [str(image_caption_tar_shards / f"shard-{i:03d}.tar") for i in range(3)]
+
+    assert _get_shard_paths(image_caption_tar_shards) == expected
+    assert expand_shard_paths([str(image_caption_tar_shards / "*.tar")]) == expected
+    assert expand_shard_paths(["a-{08..10}-{0..1}.tar"]) == [
+        "a-08-0.tar",
+        "a-08-1.tar",
+        "a-09-0.tar",
+        "a-09-1.tar",
+        "a-10-0.tar",
+        "a-10-1.tar",
+    ]
+
+
+def test_expand_shard_paths_no_match(tmp_path: Path):
+    with pytest.raises(ValueError):
+        expand_shard_paths([str(tmp_path / "*.tar")])
+
+
+def test_count_tar_shard_samples(image_caption_tar_shards: Path):  # noqa: F811
+    assert count_tar_shard_samples(_get_shard_paths(image_caption_tar_shards), image_extensions=["jpg"]) == 10
+
+
+@pytest.mark.parametrize("prefetch_size", [0, 2])
+def test_image_caption_tar_shard_dataset_iter(image_caption_tar_shards: Path, prefetch_size: int):  # noqa: F811
+    dataset = ImageCaptionTarShardDataset(_get_shard_paths(image_caption_tar_shards), prefetch_size=prefetch_size)
+
+    examples = list(dataset)
+
+    assert dataset.num_examples == 10
+    assert len(examples) == 10
+    example = examples[0]
+    assert set(example.keys()) == {"id", "image", "caption", "mask"}
+    assert example["id"] == "shard-000.tar/0000"
+    assert example["caption"] == "caption 0"
+    assert example["image"].mode == "RGB"
+    assert example["image"].size == (128, 128)
+    assert example["mask"].mode == "L"
+
+
+@pytest.mark.parametrize(["world_size", "num_workers"], [(2, 1), (3, 1), (2, 2)])
+def test_image_caption_tar_shard_dataset_split(
+    image_caption_tar_shards: Path,  # noqa: F811
+    world_size: int,
+    num_workers: int,
+):
+    """Test that the samples are split into disjoint subsets that cover the whole dataset, both when there are at least
+    as many shards as splits and when there aren't.
+    """
+    shard_paths = _get_shard_paths(image_caption_tar_shards)
+    ids_per_split = []
+    for rank in range(world_size):
+        dataset = ImageCaptionTarShardDataset(
+            shard_paths, rank=rank, world_size=world_size, num_examples=10, shuffle=True, seed=1
+        )
+        for worker_id in range(num_workers):
+            worker_info = mock.MagicMock(id=worker_id, num_workers=num_workers)
+            with mock.patch.object(torch.utils.data, "get_worker_info", return_value=worker_info):
+                ids_per_split.append([example["id"] for example in dataset])
+
+    all_ids = [id for ids in ids_per_split for id in ids]
+    assert len(all_ids) == len(set(all_ids)) == 10
+
+
+def test_image_caption_tar_shard_dataset_shuffle_epoch(image_caption_tar_shards: Path):  # noqa: F811
+    """Test that the shuffle order changes with the epoch."""
+    dataset = ImageCaptionTarShardDataset(_get_shard_paths(image_caption_tar_shards), shuffle=True, seed=0)
+
+    dataset.set_epoch(0)
+    epoch_0 = [example["id"] for example in dataset]
+    dataset.set_epoch(1)
+    epoch_1 = [example["id"] for example in dataset]
+
+    assert sorted(epoch_0) == sorted(epoch_1)
+    assert epoch_0 != epoch_1
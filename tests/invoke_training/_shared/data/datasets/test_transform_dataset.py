@@ -1,6 +1,6 @@
 import unittest.mock
 
-from invoke_training._shared.data.datasets.transform_dataset import TransformDataset
+from invoke_training._shared.data.datasets.transform_dataset import TransformDataset, TransformIterableDataset
 
 
 def test_transform_dataset_len():
@@ -32,3 +32,15 @@ def test_transform_dataset_getitem():
 
     assert out_example["field1"] == field1
     assert out_example["field2"] == field2
+
+
+def test_transform_iterable_dataset():
+    """Test that TransformIterableDataset applies the transforms to each example of the base dataset."""
+
+    def mock_transform(example):
+        example["doubled"] = example["value"] * 2
+        return example
+
+    dataset = TransformIterableDataset([{"value": 1}, {"value": 2}], [mock_transform])
+
+    assert list(dataset) == [{"value": 1, "doubled": 2}, {"value": 2, "doubled": 4}]
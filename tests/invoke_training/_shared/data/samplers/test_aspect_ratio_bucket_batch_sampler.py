@@ -1,5 +1,12 @@
+import logging
+
+import pytest
+
 from invoke_training._shared.data.samplers.aspect_ratio_bucket_batch_sampler import (
     AspectRatioBucketBatchSampler,
+    get_pixel_budget_batch_sizes,
+    log_aspect_ratio_buckets,
+    merge_underfilled_buckets,
 )
 from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketManager
 from invoke_training._shared.data.utils.resolution import Resolution
@@ -96,3 +103,226 @@ def test_aspect_ratio_bucket_batch_sampler_seed():
     # Samples generated with different seeds should match, except for the example ordering.
     assert_shuffled_samples_match(base_samples, diff_seed_samples)
     assert base_samples != diff_seed_samples
+
+
+def test_aspect_ratio_bucket_batch_sampler_bucket_assignment():
+    """Test that the bucket assignment derived from a bucket map is consistent with it."""
+    buckets = {Resolution(256, 768): [1, 3, 5], Resolution(512, 512): [4], Resolution(768, 256): [0, 2]}
+    sampler = AspectRatioBucketBatchSampler(buckets=buckets, batch_size=2)
+
+    bucket_assignment = sampler.bucket_assignment
+    assert len(bucket_assignment) == 6
+    for bucket_resolution, indexes in buckets.items():
+        for index in indexes:
+            assert bucket_assignment[index] == bucket_resolution
+
+
+def test_aspect_ratio_bucket_batch_sampler_from_image_sizes_bucket_assignment():
+    """Test that the bucket assignment of a sampler built from image sizes matches its batches."""
+    bucket_manager = AspectRatioBucketManager.from_constraints(
+        target_resolution=512, start_dim=256, end_dim=768, divisible_by=128
+    )
+    image_sizes = [Resolution(100, 300), Resolution(300, 100), Resolution(200, 200), Resolution(120, 310)]
+    sampler = AspectRatioBucketBatchSampler.from_image_sizes(bucket_manager, image_sizes, batch_size=2)
+
+    bucket_assignment = sampler.bucket_assignment
+    assert bucket_assignment.bucket_ids.dtype.itemsize <= 2
+    for batch in sampler:
+        assert len({bucket_assignment[i] for i in batch}) == 1
+    for index, image_size in enumerate(image_sizes):
+        assert bucket_assignment[index] == bucket_manager.get_aspect_ratio_bucket(image_size)
+
+
+def test_aspect_ratio_bucket_batch_sampler_bucket_batch_sizes():
+    """Test that per-bucket batch sizes are used for both iteration and len()."""
+    sampler = AspectRatioBucketBatchSampler(
+        buckets={Resolution(256, 768): [1, 3, 5], Resolution(512, 512): [4, 6], Resolution(768, 256): [0, 2]},
+        batch_size=2,
+        bucket_batch_sizes={Resolution(256, 768): 3, Resolution(512, 512): 1},
+    )
+
+    assert sampler.has_bucket_batch_sizes
+    assert list(sampler) == [[1, 3, 5], [4], [6], [0, 2]]
+    assert len(sampler) == 4
+
+
+def test_get_pixel_budget_batch_sizes():
+    buckets = [Resolution(512, 512), Resolution(256, 512), Resolution(1024, 1024)]
+    batch_sizes = get_pixel_budget_batch_sizes(buckets, max_pixels_per_batch=4 * 512 * 512)
+    assert batch_sizes == {Resolution(512, 512): 4, Resolution(256, 512): 8, Resolution(1024, 1024): 1}
+
+    # A bucket that exceeds the budget on its own still gets a batch size of 1.
+    assert get_pixel_budget_batch_sizes(buckets, max_pixels_per_batch=1) == {b: 1 for b in buckets}
+
+
+def test_aspect_ratio_bucket_batch_sampler_from_image_sizes_max_pixels_per_batch():
+    bucket_manager = AspectRatioBucketManager.from_constraints(
+        target_resolution=512, start_dim=256, end_dim=768, divisible_by=128
+    )
+    image_sizes = [Resolution(512, 512)] * 5 + [Resolution(256, 768)] * 5
+    sampler = AspectRatioBucketBatchSampler.from_image_sizes(
+        bucket_manager, image_sizes, batch_size=2, max_pixels_per_batch=4 * 512 * 512
+    )
+
+    # 512x512 images are batched in 4s, 256x768 images in 5s (4 * 512 * 512 // (256 * 768) == 5).
+    assert sorted(len(batch) for batch in sampler) == [1, 4, 5]
+    assert len(sampler) == 3
+
+
+def test_aspect_ratio_bucket_batch_sampler_carry_over():
+    """Test that partial_batches="carry_over" defers the partial batch examples to the start of the next epoch."""
+    sampler = AspectRatioBucketBatchSampler(
+        buckets={Resolution(256, 768): [0, 1, 2, 3, 4], Resolution(768, 256): [5]},
+        batch_size=2,
+        partial_batches="carry_over",
+    )
+
+    assert len(sampler) == 3
+    assert list(sampler) == [[0, 1], [2, 3], [5]]
+    assert list(sampler) == [[4, 0], [1, 2], [5]]
+    assert list(sampler) == [[3, 0], [1, 2], [5]]
+    assert sampler.get_num_partial_batches() == 1
+    assert sampler.get_num_avoided_partial_batches() == 1
+
+
+def test_aspect_ratio_bucket_batch_sampler_carry_over_shuffle():
+    """Test that every example is sampled once across consecutive epochs with partial_batches="carry_over"."""
+    buckets = {Resolution(256, 768): list(range(7)), Resolution(768, 256): list(range(7, 17))}
+    sampler = AspectRatioBucketBatchSampler(
+        buckets=buckets, batch_size=3, shuffle=True, seed=0, partial_batches="carry_over"
+    )
+
+    for _ in range(3):
+        batches = list(sampler)
+        assert len(batches) == len(sampler) == 5
+        assert all(len(batch) == 3 for batch in batches)
+        carried_over = {i for bucket_images in sampler._carried_over.values() for i in bucket_images}
+        # Every example is either sampled in this epoch, or carried over to the next one.
+        assert sorted([i for batch in batches for i in batch] + list(carried_over)) == list(range(17))
+
+
+def test_aspect_ratio_bucket_batch_sampler_drop_last():
+    """Test that partial_batches="drop_last" drops the partial batches, and rotates the dropped examples."""
+    sampler = AspectRatioBucketBatchSampler(
+        buckets={Resolution(256, 768): [0, 1, 2, 3, 4], Resolution(768, 256): [5]},
+        batch_size=2,
+        partial_batches="drop_last",
+    )
+
+    assert len(sampler) == 3
+    assert sampler.get_num_dropped_examples() == 1
+    assert list(sampler) == [[0, 1], [2, 3], [5]]
+    assert list(sampler) == [[1, 2], [3, 4], [5]]
+    assert list(sampler) == [[2, 3], [4, 0], [5]]
+
+
+def test_merge_underfilled_buckets():
+    buckets = {
+        Resolution(256, 768): [0, 1, 2],
+        Resolution(384, 640): [3],
+        Resolution(512, 512): [4, 5, 6, 7],
+        Resolution(768, 256): [8],
+    }
+
+    merged_buckets = merge_underfilled_buckets(buckets, lambda _: 2)
+
+    assert merged_buckets == {
+        Resolution(256, 768): [0, 1, 2],
+        Resolution(384, 640): [],
+        Resolution(512, 512): [4, 5, 6, 7, 3, 8],
+        Resolution(768, 256): [],
+    }
+
+
+def test_merge_underfilled_buckets_single_bucket():
+    """Test that a single under-filled bucket is left as is."""
+    buckets = {Resolution(256, 768): [0], Resolution(512, 512): []}
+    assert merge_underfilled_buckets(buckets, lambda _: 2) == buckets
+
+
+def test_aspect_ratio_bucket_batch_sampler_merge_adjacent():
+    """Test that partial_batches="merge_adjacent" merges under-filled buckets, and updates the bucket assignment."""
+    sampler = AspectRatioBucketBatchSampler(
+        buckets={Resolution(384, 640): [0, 2], Resolution(512, 512): [1, 3, 4], Resolution(768, 256): [5]},
+        batch_size=3,
+        bucket_assignment=None,
+        partial_batches="merge_adjacent",
+    )
+
+    # The smallest bucket is merged first. (768, 256) has a single neighbor. (384, 640) is then merged into the (512,
+    # 512) bucket, which has the closest aspect ratio.
+    assert list(sampler) == [[1, 3, 4], [5, 0, 2]]
+    assert sampler.get_num_partial_batches() == 0
+    assert sampler.get_num_avoided_partial_batches() == 2
+    assert all(sampler.bucket_assignment[i] == Resolution(512, 512) for i in range(6))
+
+
+@pytest.mark.parametrize("partial_batches", ["keep", "carry_over", "drop_last", "merge_adjacent"])
+def test_log_aspect_ratio_buckets_partial_batches(partial_batches, caplog):
+    sampler = AspectRatioBucketBatchSampler(
+        buckets={Resolution(256, 768): [0, 1, 2], Resolution(768, 256): [3, 4, 5]},
+        batch_size=2,
+        partial_batches=partial_batches,
+    )
+
+    with caplog.at_level(logging.INFO):
+        log_aspect_ratio_buckets(logging.getLogger(__name__), sampler)
+
+    assert f"Partial batches per epoch: {sampler.get_num_partial_batches()}" in caplog.text
+    if partial_batches != "keep":
+        assert f"{sampler.get_num_avoided_partial_batches()} avoided" in caplog.text
+
+
+@pytest.mark.parametrize("partial_batches", ["keep", "carry_over"])
+def test_aspect_ratio_bucket_batch_sampler_num_replicas(partial_batches: str):
+    """Test that the batches of a sampler that is split between replicas are in lockstep across replicas."""
+    buckets = {
+        Resolution(256, 768): list(range(0, 7)),
+        Resolution(512, 512): list(range(7, 10)),
+        Resolution(768, 256): list(range(10, 21)),
+    }
+    num_replicas = 3
+    samplers = [
+        AspectRatioBucketBatchSampler(
+            buckets=buckets,
+            batch_size=2,
+            shuffle=True,
+            seed=0,
+            partial_batches=partial_batches,
+            num_replicas=num_replicas,
+            rank=rank,
+        )
+        for rank in range(num_replicas)
+    ]
+    bucket_assignment = samplers[0].bucket_assignment
+
+    epoch_samples = []
+    for _ in range(2):
+        replica_samples = [list(sampler) for sampler in samplers]
+        # All replicas take the same number of steps.
+        assert all(len(samples) == len(samplers[0]) for samples in replica_samples)
+        # In each step, all replicas sample from the same bucket.
+        for step_batches in zip(*replica_samples):
+            assert len({bucket_assignment[i] for batch in step_batches for i in batch}) == 1
+        # Every example is sampled by some replica.
+        if partial_batches == "keep":
+            assert {i for samples in replica_samples for batch in samples for i in batch} == set(range(21))
+        epoch_samples.append(replica_samples)
+
+    # The batches are reshuffled in each epoch.
+    assert epoch_samples[0] != epoch_samples[1]
+
+
+def test_aspect_ratio_bucket_batch_sampler_num_replicas_len():
+    """Test that incomplete groups of batches are filled, so that the length is rounded up per bucket."""
+    buckets = {Resolution(256, 768): [0, 1, 2, 3, 4], Resolution(768, 256): [5]}
+    sampler = AspectRatioBucketBatchSampler(buckets=buckets, batch_size=2, seed=0, num_replicas=2, rank=1)
+
+    # Bucket (256, 768) has 3 batches -> 2 groups. Bucket (768, 256) has 1 batch -> 1 group.
+    assert len(sampler) == 3
+    assert list(sampler) == [[2, 3], [0, 1], [5]]
+
+
+def test_aspect_ratio_bucket_batch_sampler_num_replicas_requires_seed():
+    with pytest.raises(ValueError, match="seed"):
+        AspectRatioBucketBatchSampler(buckets={Resolution(512, 512): [0, 1]}, batch_size=1, num_replicas=2, rank=0)
@@ -0,0 +1,21 @@
+from invoke_training._shared.data.transforms.caption_cache_key_transform import (
+    CaptionCacheKeyTransform,
+    get_caption_cache_key,
+)
+
+
+def test_get_caption_cache_key():
+    assert get_caption_cache_key("a photo of sks dog") == get_caption_cache_key("a photo of sks dog")
+    assert get_caption_cache_key("a photo of sks dog") != get_caption_cache_key("a photo of a dog")
+
+
+def test_caption_cache_key_transform():
+    tf = CaptionCacheKeyTransform()
+
+    out_example = tf({"id": "0", "caption": "a photo of sks dog"})
+
+    assert out_example == {
+        "id": "0",
+        "caption": "a photo of sks dog",
+        "caption_cache_key": get_caption_cache_key("a photo of sks dog"),
+    }
@@ -20,3 +20,22 @@ def test_load_cache_transform():
 
     mock_cache.load.assert_called_once_with(1)
     assert out_example["output"] is cached_tensor
+
+
+def test_load_cache_transform_optional_fields():
+    """Test that optional cache fields are loaded if they are present, and skipped otherwise."""
+    cached_tensor = torch.Tensor([1.0, 2.0, 3.0])
+    mock_cache = unittest.mock.MagicMock()
+    mock_cache.load.return_value = {"cached_tensor": cached_tensor}
+
+    tf = LoadCacheTransform(
+        cache=mock_cache,
+        cache_key_field="cache_key",
+        cache_field_to_output_field={},
+        optional_cache_field_to_output_field={"cached_tensor": "output", "missing_tensor": "missing_output"},
+    )
+
+    out_example = tf({"cache_key": 1})
+
+    assert out_example["output"] is cached_tensor
+    assert "missing_output" not in out_example
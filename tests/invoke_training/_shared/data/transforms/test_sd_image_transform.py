@@ -299,6 +299,24 @@ def test_sd_image_transform_aspect_ratio_bucket_manager():
     assert np.allclose(denormalize_mask(out_mask_np), in_mask_np[3:-3, :])
 
 
+def test_sd_image_transform_aspect_ratio_bucket_field():
+    """Test that a pre-computed aspect ratio bucket field takes precedence over a bucket lookup."""
+    aspect_ratio_bucket_manager = unittest.mock.MagicMock()
+    tf = SDImageTransform(
+        image_field_names=["image"],
+        fields_to_normalize_to_range_minus_one_to_one=["image"],
+        resolution=None,
+        aspect_ratio_bucket_manager=aspect_ratio_bucket_manager,
+    )
+
+    in_image_pil = Image.fromarray(np.zeros((9, 5, 3), dtype=np.uint8))
+    out_example = tf({"image": in_image_pil, "aspect_ratio_bucket": Resolution(3, 5)})
+
+    aspect_ratio_bucket_manager.get_aspect_ratio_bucket.assert_not_called()
+    assert out_example["image"].shape == (3, 3, 5)
+    assert "aspect_ratio_bucket" not in out_example
+
+
 @pytest.mark.parametrize(
     ["resolution", "aspect_ratio_bucket_manager"],
     [
@@ -316,3 +334,95 @@ def test_sd_image_transform_resolution_input_validation(
             resolution=resolution,
             aspect_ratio_bucket_manager=aspect_ratio_bucket_manager,
         )
+
+
+def test_sd_image_transform_num_crop_variants():
+    """Test that SDImageTransform produces every crop/flip variant when num_crop_variants is set."""
+    # Input image is 5 x 9.
+    in_image_np = np.arange(5 * 9 * 3, dtype=np.uint8).reshape((5, 9, 3))
+    in_image_pil = Image.fromarray(np.copy(in_image_np))
+
+    in_mask_np = np.arange(5 * 9, dtype=np.uint8).reshape((5, 9))
+    in_mask_pil = Image.fromarray(np.copy(in_mask_np))
+
+    # The target resolution is 5x3 (with random cropping and horizontal flipping).
+    resolution = Resolution(5, 3)
+    tf = SDImageTransform(
+        image_field_names=["image", "mask"],
+        fields_to_normalize_to_range_minus_one_to_one=["image"],
+        resolution=resolution,
+        center_crop=False,
+        random_flip=True,
+        num_crop_variants=3,
+    )
+
+    out_example = tf({"image": in_image_pil, "mask": in_mask_pil})
+
+    # 3 crops x 2 flips.
+    assert out_example["image"].shape == (6, 3, 5, 3)
+    assert out_example["mask"].shape == (6, 1, 5, 3)
+    assert len(out_example["crop_top_left_yx"]) == 6
+    assert out_example["original_size_hw"] == (5, 9)
+
+    # Variants alternate between unflipped and flipped.
+    for variant_idx in range(6):
+        flipped = variant_idx % 2 == 1
+        src_image_np = in_image_np[:, ::-1, :] if flipped else in_image_np
+        src_mask_np = in_mask_np[:, ::-1] if flipped else in_mask_np
+        crop_y, crop_x = out_example["crop_top_left_yx"][variant_idx]
+        assert np.allclose(
+            denormalize_image(np.array(out_example["image"][variant_idx])),
+            src_image_np[crop_y : crop_y + resolution.height, crop_x : crop_x + resolution.width, :],
+        )
+        assert np.allclose(
+            denormalize_mask(np.array(out_example["mask"][variant_idx])),
+            src_mask_np[crop_y : crop_y + resolution.height, crop_x : crop_x + resolution.width],
+        )
+
+
+def test_sd_image_transform_num_crop_variants_center_crop():
+    """Test that SDImageTransform produces a single crop position when num_crop_variants is set with center_crop."""
+    in_image_pil = Image.fromarray(np.arange(9 * 5 * 3, dtype=np.uint8).reshape((9, 5, 3)))
+
+    tf = SDImageTransform(
+        image_field_names=["image"],
+        fields_to_normalize_to_range_minus_one_to_one=["image"],
+        resolution=Resolution(3, 5),
+        center_crop=True,
+        random_flip=False,
+        num_crop_variants=4,
+    )
+
+    out_example = tf({"image": in_image_pil})
+
+    assert out_example["image"].shape == (1, 3, 3, 5)
+    assert out_example["crop_top_left_yx"] == [(3, 0)]
+
+
+def test_sd_image_transform_tensor_input_matches_pil():
+    """Test that uint8 image tensors (from the torchvision decode backend) produce the same result as PIL images."""
+    rng = np.random.default_rng(0)
+    image_np = rng.integers(0, 256, (256, 128, 3), dtype=np.uint8)
+    mask_np = rng.integers(0, 256, (256, 128), dtype=np.uint8)
+    pil_example = {"image": Image.fromarray(image_np), "mask": Image.fromarray(mask_np)}
+    tensor_example = {
+        "image": torch.from_numpy(image_np).permute(2, 0, 1),
+        "mask": torch.from_numpy(mask_np).unsqueeze(0),
+    }
+
+    tf = SDImageTransform(
+        image_field_names=["image", "mask"],
+        fields_to_normalize_to_range_minus_one_to_one=["image"],
+        resolution=Resolution(128, 96),
+        center_crop=True,
+    )
+    pil_out = tf(pil_example)
+    tensor_out = tf(tensor_example)
+
+    assert tensor_out["original_size_hw"] == pil_out["original_size_hw"] == (256, 128)
+    assert tensor_out["crop_top_left_yx"] == pil_out["crop_top_left_yx"]
+    for field_name in ["image", "mask"]:
+        assert tensor_out[field_name].shape == pil_out[field_name].shape
+        assert tensor_out[field_name].dtype == torch.float32
+        # PIL and torchvision resize implementations differ by rounding.
+        assert torch.allclose(tensor_out[field_name], pil_out[field_name], atol=0.02)
@@ -0,0 +1,48 @@
+import unittest.mock
+
+import pytest
+import torch
+
+from invoke_training._shared.data.transforms.select_random_variant_transform import SelectRandomVariantTransform
+
+
+def test_select_random_variant_transform():
+    tf = SelectRandomVariantTransform(["latents", "crop"])
+
+    in_example = {"id": "0", "latents": torch.arange(3).reshape((3, 1)), "crop": [(0, 0), (1, 1), (2, 2)]}
+
+    with unittest.mock.patch("random.randrange", return_value=1):
+        out_example = tf(in_example)
+
+    assert out_example["id"] == "0"
+    torch.testing.assert_close(out_example["latents"], torch.tensor([1]))
+    assert out_example["crop"] == (1, 1)
+
+
+def test_select_random_variant_transform_mismatched_lengths():
+    tf = SelectRandomVariantTransform(["latents", "crop"])
+
+    with pytest.raises(ValueError):
+        tf({"latents": torch.zeros((3, 1)), "crop": [(0, 0), (1, 1)]})
+
+
+def test_select_random_variant_transform_optional_field():
+    tf = SelectRandomVariantTransform(["latents", "mask"])
+
+    with unittest.mock.patch("random.randrange", return_value=2):
+        out_example = tf({"latents": torch.arange(3).reshape((3, 1))})
+
+    torch.testing.assert_close(out_example["latents"], torch.tensor([2]))
+    assert "mask" not in out_example
+
+
+def test_select_random_variant_transform_missing_field():
+    tf = SelectRandomVariantTransform(["latents", "crop"])
+
+    with pytest.raises(ValueError, match="'latents'"):
+        tf({"crop": [(0, 0), (1, 1)]})
+
+
+def test_select_random_variant_transform_no_fields():
+    with pytest.raises(ValueError):
+        SelectRandomVariantTransform([])
@@ -0,0 +1,201 @@
+import pickle
+from pathlib import Path
+
+import pytest
+import torch
+
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import (
+    ShardedTensorDiskCache,
+    open_tensor_disk_cache,
+)
+from invoke_training._shared.data.transforms.tensor_disk_cache import TensorDiskCache
+
+
+def test_sharded_tensor_disk_cache_roundtrip(tmp_path: Path):
+    """Test a ShardedTensorDiskCache cache roundtrip."""
+    cache = ShardedTensorDiskCache(str(tmp_path))
+
+    in_dict = {
+        "test_tensor": torch.rand((1, 2, 3)),
+        "test_bf16_tensor": torch.rand((4, 5)).to(torch.bfloat16),
+        "test_scalar_tensor": torch.tensor(7),
+        "test_tuple": (1, 2),
+        "test_list": [3, 4],
+        "test_scalar": 1,
+    }
+
+    cache.save(0, in_dict)
+    cache.mark_complete()
+
+    # Load from a fresh instance to verify that the data was persisted to disk.
+    out_dict = ShardedTensorDiskCache(str(tmp_path)).load(0)
+
+    assert set(in_dict.keys()) == set(out_dict.keys())
+    torch.testing.assert_close(out_dict["test_tensor"], in_dict["test_tensor"])
+    torch.testing.assert_close(out_dict["test_bf16_tensor"], in_dict["test_bf16_tensor"])
+    torch.testing.assert_close(out_dict["test_scalar_tensor"], in_dict["test_scalar_tensor"])
+    assert out_dict["test_tuple"] == in_dict["test_tuple"]
+    assert isinstance(out_dict["test_tuple"], tuple)
+    assert out_dict["test_list"] == in_dict["test_list"]
+    assert out_dict["test_scalar"] == in_dict["test_scalar"]
+
+
+def test_sharded_tensor_disk_cache_load_without_index(tmp_path: Path):
+    """Test that loading from a cache that was populated without calling mark_complete() raises a clear error."""
+    cache = ShardedTensorDiskCache(str(tmp_path))
+    cache.save(0, {"test_tensor": torch.rand((1, 2, 3))})
+
+    with pytest.raises(RuntimeError, match="mark_complete"):
+        ShardedTensorDiskCache(str(tmp_path)).load(0)
+
+
+def test_sharded_tensor_disk_cache_compressed_roundtrip(tmp_path: Path):
+    """Test a ShardedTensorDiskCache cache roundtrip with compression enabled."""
+    cache = ShardedTensorDiskCache(str(tmp_path), compress=True)
+
+    in_dict = {
+        "test_tensor": torch.rand((1, 2, 3)),
+        "test_bf16_tensor": torch.rand((4, 5)).to(torch.bfloat16),
+        "test_empty_tensor": torch.zeros((0, 4)),
+        "test_non_contiguous_tensor": torch.rand((4, 6)).t(),
+        "test_list": [3, 4],
+    }
+
+    cache.save(0, in_dict)
+    cache.mark_complete()
+
+    out_dict = ShardedTensorDiskCache(str(tmp_path)).load(0)
+
+    assert set(in_dict.keys()) == set(out_dict.keys())
+    for key in ["test_tensor", "test_bf16_tensor", "test_empty_tensor", "test_non_contiguous_tensor"]:
+        assert out_dict[key].dtype == in_dict[key].dtype
+        torch.testing.assert_close(out_dict[key], in_dict[key], atol=0, rtol=0)
+    assert out_dict["test_list"] == in_dict["test_list"]
+
+
+def test_sharded_tensor_disk_cache_compressed_is_smaller(tmp_path: Path):
+    """Test that compression reduces the size of the shards for compressible data."""
+    # Low-entropy fp16 data, similar to smooth latents.
+    in_tensor = torch.linspace(0, 1, 4096).to(torch.float16).reshape(4, 32, 32)
+
+    for compress in [False, True]:
+        cache = ShardedTensorDiskCache(str(tmp_path / str(compress)), compress=compress)
+        cache.save(0, {"t": in_tensor})
+        cache.mark_complete()
+
+    uncompressed_size = sum(p.stat().st_size for p in (tmp_path / "False").glob("shard_*.bin"))
+    compressed_size = sum(p.stat().st_size for p in (tmp_path / "True").glob("shard_*.bin"))
+    assert compressed_size < uncompressed_size
+    torch.testing.assert_close(ShardedTensorDiskCache(str(tmp_path / "True")).load(0)["t"], in_tensor)
+
+
+def test_sharded_tensor_disk_cache_multiple_shards(tmp_path: Path):
+    """Test that entries are split across multiple shard files when the shard size is exceeded."""
+    cache = ShardedTensorDiskCache(str(tmp_path), shard_size_bytes=100)
+
+    in_tensors = [torch.rand((10,)) for _ in range(5)]
+    for i, t in enumerate(in_tensors):
+        cache.save(i, {"t": t})
+    cache.mark_complete()
+
+    assert len(list(tmp_path.glob("shard_*.bin"))) > 1
+
+    cache = ShardedTensorDiskCache(str(tmp_path))
+    for i, t in enumerate(in_tensors):
+        torch.testing.assert_close(cache.load(i)["t"], t)
+
+
+def test_sharded_tensor_disk_cache_fail_overwrite(tmp_path: Path):
+    cache = ShardedTensorDiskCache(str(tmp_path))
+    in_dict = {"test_tensor": torch.rand((1, 2, 3))}
+    cache.save(0, in_dict)
+
+    with pytest.raises(AssertionError):
+        cache.save(0, in_dict)
+
+
+def test_sharded_tensor_disk_cache_multiple_writers(tmp_path: Path):
+    """Test that entries written by multiple writers are readable after their index parts are merged."""
+    writers = [ShardedTensorDiskCache(str(tmp_path), writer_rank=rank) for rank in range(2)]
+    in_tensors = [torch.rand((2, 3)) for _ in range(6)]
+    for i, t in enumerate(in_tensors):
+        writers[i % 2].save(i, {"t": t})
+
+    for writer in writers:
+        writer.write_index_part()
+    writers[0].merge_index_parts()
+
+    assert not list(tmp_path.glob("index_part_*.pt"))
+    cache = open_tensor_disk_cache(str(tmp_path))
+    assert cache.is_complete()
+    for i, t in enumerate(in_tensors):
+        torch.testing.assert_close(cache.load(i)["t"], t)
+
+
+def test_sharded_tensor_disk_cache_multiple_writers_duplicate_key(tmp_path: Path):
+    """Test that merging index parts fails if the same key was written by more than one writer."""
+    for rank in range(2):
+        writer = ShardedTensorDiskCache(str(tmp_path), writer_rank=rank)
+        writer.save(0, {"t": torch.rand((2, 3))})
+        writer.write_index_part()
+
+    with pytest.raises(AssertionError):
+        ShardedTensorDiskCache(str(tmp_path)).merge_index_parts()
+
+
+def test_sharded_tensor_disk_cache_multiple_writers_allow_duplicate_keys(tmp_path: Path):
+    """Test that merging index parts keeps the first writer's entry for a key saved by more than one writer, if
+    allow_duplicate_keys is True.
+    """
+    in_tensors = [torch.rand((2, 3)) for _ in range(2)]
+    for rank in range(2):
+        writer = ShardedTensorDiskCache(str(tmp_path), writer_rank=rank)
+        writer.save(0, {"t": in_tensors[rank]})
+        writer.write_index_part()
+
+    ShardedTensorDiskCache(str(tmp_path)).merge_index_parts(allow_duplicate_keys=True)
+
+    cache = ShardedTensorDiskCache(str(tmp_path))
+    assert len(cache) == 1
+    torch.testing.assert_close(cache.load(0)["t"], in_tensors[0])
+
+
+def test_sharded_tensor_disk_cache_pickle(tmp_path: Path):
+    """Test that a ShardedTensorDiskCache can be pickled after it has been read from (e.g. to be sent to a spawned
+    DataLoader worker).
+    """
+    cache = ShardedTensorDiskCache(str(tmp_path))
+    in_tensor = torch.rand((1, 2, 3))
+    cache.save(0, {"test_tensor": in_tensor})
+    cache.mark_complete()
+    cache.load(0)
+
+    unpickled_cache: ShardedTensorDiskCache = pickle.loads(pickle.dumps(cache))
+    torch.testing.assert_close(unpickled_cache.load(0)["test_tensor"], in_tensor)
+
+
+def test_sharded_tensor_disk_cache_clear(tmp_path: Path):
+    cache = ShardedTensorDiskCache(str(tmp_path))
+    cache.save(0, {"test_tensor": torch.rand((1, 2, 3))})
+    cache.mark_complete()
+    assert cache.is_complete()
+
+    cache.clear()
+    assert not cache.is_complete()
+    assert not ShardedTensorDiskCache.is_sharded_cache_dir(str(tmp_path))
+    cache.save(0, {"test_tensor": torch.rand((1, 2, 3))})
+
+
+def test_open_tensor_disk_cache(tmp_path: Path):
+    sharded_dir = tmp_path / "sharded"
+    sharded_cache = ShardedTensorDiskCache(str(sharded_dir))
+    sharded_cache.save(0, {"test_tensor": torch.rand((1, 2, 3))})
+    sharded_cache.mark_complete()
+
+    unsharded_dir = tmp_path / "unsharded"
+    unsharded_cache = TensorDiskCache(str(unsharded_dir))
+    unsharded_cache.save(0, {"test_tensor": torch.rand((1, 2, 3))})
+    unsharded_cache.mark_complete()
+
+    assert isinstance(open_tensor_disk_cache(str(sharded_dir)), ShardedTensorDiskCache)
+    assert not isinstance(open_tensor_disk_cache(str(unsharded_dir)), ShardedTensorDiskCache)
@@ -31,3 +31,21 @@ def test_tensor_disk_cache_fail_overwrite(tmp_path):
 
     with pytest.raises(AssertionError):
         cache.save(0, in_dict)
+
+
+def test_tensor_disk_cache_complete_marker(tmp_path: Path):
+    """Test that a cache is only complete after mark_complete() is called, and that clear() resets it."""
+    cache = TensorDiskCache(str(tmp_path))
+    assert not cache.is_complete()
+
+    cache.save(0, {"test_tensor": torch.rand((1, 2, 3))})
+    cache.mark_complete()
+    assert cache.is_complete()
+
+    # The complete marker should be visible to other TensorDiskCache instances for the same directory.
+    assert TensorDiskCache(str(tmp_path)).is_complete()
+
+    cache.clear()
+    assert not cache.is_complete()
+    # After clearing, it should be possible to re-populate the cache.
+    cache.save(0, {"test_tensor": torch.rand((1, 2, 3))})
@@ -1,5 +1,6 @@
 from contextlib import nullcontext
 
+import numpy as np
 import pytest
 
 from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketManager
@@ -84,3 +85,55 @@ def test_get_aspect_ratio_bucket(resolution: Resolution, expected_bucket: Resolu
     nearest_bucket = arbm.get_aspect_ratio_bucket(resolution)
 
     assert nearest_bucket == expected_bucket
+
+
+def test_get_aspect_ratio_bucket_matches_linear_search():
+    """Test that the bisect lookup selects a bucket with the closest aspect ratio, as a linear search would."""
+    arbm = AspectRatioBucketManager.from_constraints(
+        target_resolution=1024, start_dim=512, end_dim=2048, divisible_by=64
+    )
+    rng = np.random.default_rng(0)
+    for height, width in rng.integers(16, 4096, size=(1000, 2)):
+        resolution = Resolution(int(height), int(width))
+        bucket = arbm.get_aspect_ratio_bucket(resolution)
+        min_distance = min(abs(b.aspect_ratio() - resolution.aspect_ratio()) for b in arbm.buckets)
+        assert abs(bucket.aspect_ratio() - resolution.aspect_ratio()) == min_distance
+
+
+def test_get_aspect_ratio_bucket_tie_break():
+    """Test that the bucket with the smaller aspect ratio is selected when two buckets are equally close."""
+    arbm = AspectRatioBucketManager({Resolution(512, 1024), Resolution(1024, 512), Resolution(768, 768)})
+
+    # Aspect ratio 0.75 is equally close to 0.5 and 1.0.
+    assert arbm.get_aspect_ratio_bucket(Resolution(300, 400)) == Resolution(512, 1024)
+    assert arbm.get_aspect_ratio_bucket_indices([Resolution(300, 400)]).tolist() == [0]
+
+
+def test_get_aspect_ratio_bucket_duplicate_aspect_ratios():
+    arbm = AspectRatioBucketManager({Resolution(512, 512), Resolution(256, 256)})
+
+    assert arbm.sorted_buckets == [Resolution(256, 256)]
+    assert arbm.get_aspect_ratio_bucket(Resolution(100, 120)) == Resolution(256, 256)
+
+
+def test_get_aspect_ratio_bucket_indices_matches_get_aspect_ratio_bucket():
+    arbm = AspectRatioBucketManager.from_constraints(
+        target_resolution=1024, start_dim=512, end_dim=2048, divisible_by=64
+    )
+    rng = np.random.default_rng(0)
+    sizes = rng.integers(16, 4096, size=(1000, 2))
+    # Include exact bucket matches and out-of-range aspect ratios.
+    sizes = np.concatenate([sizes, [b.to_tuple() for b in arbm.buckets], [[1, 10000], [10000, 1]]])
+
+    indices = arbm.get_aspect_ratio_bucket_indices(sizes)
+    indices_from_resolutions = arbm.get_aspect_ratio_bucket_indices([Resolution(int(h), int(w)) for h, w in sizes])
+
+    expected = [arbm.get_aspect_ratio_bucket(Resolution(int(h), int(w))) for h, w in sizes]
+    assert [arbm.sorted_buckets[i] for i in indices] == expected
+    np.testing.assert_array_equal(indices, indices_from_resolutions)
+
+
+def test_get_aspect_ratio_bucket_indices_empty():
+    arbm = AspectRatioBucketManager({Resolution(512, 512)})
+
+    assert arbm.get_aspect_ratio_bucket_indices([]).shape == (0,)
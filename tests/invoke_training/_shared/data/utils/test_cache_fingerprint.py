@@ -0,0 +1,142 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from invoke_training._shared.data.datasets.image_dir_dataset import ImageDirDataset
+from invoke_training._shared.data.utils.cache_fingerprint import (
+    compute_cache_key,
+    get_path_fingerprint,
+    get_persistent_cache_dir,
+)
+from invoke_training._shared.utils.jsonl import save_jsonl
+from invoke_training.config.data.data_loader_config import ImageCaptionSDDataLoaderConfig
+from invoke_training.config.data.dataset_config import (
+    HFHubImageCaptionDatasetConfig,
+    ImageCaptionDirDatasetConfig,
+    ImageCaptionJsonlDatasetConfig,
+)
+
+
+def test_get_path_fingerprint_non_existent_path():
+    """Test that a path that does not exist (e.g. a HF Hub model name) is returned unchanged."""
+    assert get_path_fingerprint("runwayml/stable-diffusion-v1-5") == "runwayml/stable-diffusion-v1-5"
+
+
+def test_get_path_fingerprint_changes_when_file_is_modified(tmp_path: Path):
+    (tmp_path / "a.txt").write_text("a")
+    fingerprint_1 = get_path_fingerprint(str(tmp_path))
+
+    # No change.
+    assert get_path_fingerprint(str(tmp_path)) == fingerprint_1
+
+    # Modified file.
+    (tmp_path / "a.txt").write_text("aa")
+    fingerprint_2 = get_path_fingerprint(str(tmp_path))
+    assert fingerprint_2 != fingerprint_1
+
+    # Added file.
+    (tmp_path / "b.txt").write_text("b")
+    assert get_path_fingerprint(str(tmp_path)) != fingerprint_2
+
+
+def test_get_path_fingerprint_ignores_image_dimension_index(tmp_path: Path):
+    """Test that building the image dimension index of a dataset directory does not change its fingerprint."""
+    Image.fromarray(np.zeros((16, 8, 3), dtype=np.uint8)).save(tmp_path / "0.png")
+    fingerprint = get_path_fingerprint(str(tmp_path))
+
+    dataset = ImageDirDataset(str(tmp_path))
+    assert [(r.height, r.width) for r in dataset.get_image_dimensions()] == [(16, 8)]
+    # The index was written to the dataset directory.
+    assert len(list(tmp_path.iterdir())) == 2
+
+    assert get_path_fingerprint(str(tmp_path)) == fingerprint
+
+
+def test_compute_cache_key_is_deterministic():
+    assert compute_cache_key(model="a", weight_dtype="float16") == compute_cache_key(weight_dtype="float16", model="a")
+    assert compute_cache_key(model="a", weight_dtype="float16") != compute_cache_key(model="a", weight_dtype="bfloat16")
+
+
+def test_compute_cache_key_ignores_dataloader_num_workers(tmp_path: Path):
+    config_1 = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionDirDatasetConfig(dataset_dir=str(tmp_path)), dataloader_num_workers=0
+    )
+    config_2 = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionDirDatasetConfig(dataset_dir=str(tmp_path)), dataloader_num_workers=4
+    )
+    config_3 = ImageCaptionSDDataLoaderConfig(
+        dataset=ImageCaptionDirDatasetConfig(dataset_dir=str(tmp_path)), resolution=1024
+    )
+
+    assert compute_cache_key(data_loader=config_1) == compute_cache_key(data_loader=config_2)
+    assert compute_cache_key(data_loader=config_1) != compute_cache_key(data_loader=config_3)
+
+
+def test_compute_cache_key_jsonl_dataset_image_modified(tmp_path: Path):
+    """Test that modifying an image referenced by a JSONL dataset changes the cache key."""
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    image_path = image_dir / "0.jpg"
+    image_path.write_bytes(b"0")
+    jsonl_path = tmp_path / "data.jsonl"
+    save_jsonl([{"image": "images/0.jpg", "text": "caption 0"}], jsonl_path)
+
+    config = ImageCaptionJsonlDatasetConfig(jsonl_path=str(jsonl_path))
+    key_1 = compute_cache_key(dataset=config)
+
+    # Update the image modification time.
+    stat = os.stat(image_path)
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert compute_cache_key(dataset=config) != key_1
+
+
+def test_compute_cache_key_only_fingerprints_path_fields(tmp_path: Path):
+    """Test that only the strings in path fields are fingerprinted as paths."""
+    (tmp_path / "a.txt").write_text("a")
+    model_key = compute_cache_key(model=str(tmp_path))
+    other_key = compute_cache_key(cache_key=str(tmp_path))
+
+    (tmp_path / "a.txt").write_text("aa")
+
+    assert compute_cache_key(model=str(tmp_path)) != model_key
+    assert compute_cache_key(cache_key=str(tmp_path)) == other_key
+
+
+def test_compute_cache_key_hf_hub_dataset_unpinned():
+    """Test that a cache key can't be computed for a HF Hub dataset that is not pinned to a commit hash."""
+    for revision in [None, "main"]:
+        config = HFHubImageCaptionDatasetConfig(dataset_name="owner/dataset", revision=revision)
+        with pytest.raises(ValueError, match="not pinned"):
+            compute_cache_key(dataset=config)
+
+
+def test_compute_cache_key_hf_hub_dataset_pinned():
+    config_1 = HFHubImageCaptionDatasetConfig(dataset_name="owner/dataset", revision="0" * 40)
+    config_2 = HFHubImageCaptionDatasetConfig(dataset_name="owner/dataset", revision="1" * 40)
+
+    assert compute_cache_key(dataset=config_1) == compute_cache_key(dataset=config_1)
+    assert compute_cache_key(dataset=config_1) != compute_cache_key(dataset=config_2)
+
+
+def test_compute_cache_key_hf_local_dataset(tmp_path: Path):
+    """Test that a HF dataset loaded from a local directory does not need to be pinned."""
+    config = HFHubImageCaptionDatasetConfig(dataset_name=str(tmp_path))
+    key_1 = compute_cache_key(dataset=config)
+
+    (tmp_path / "data.parquet").write_bytes(b"0")
+
+    assert compute_cache_key(dataset=config) != key_1
+
+
+def test_get_persistent_cache_dir(tmp_path: Path):
+    cache_dir_1 = get_persistent_cache_dir(str(tmp_path), "vae_output", model="a")
+    cache_dir_2 = get_persistent_cache_dir(str(tmp_path), "vae_output", model="b")
+    cache_dir_3 = get_persistent_cache_dir(str(tmp_path), "text_encoder_output", model="a")
+
+    assert os.path.dirname(cache_dir_1) == str(tmp_path / "vae_output")
+    assert cache_dir_1 == get_persistent_cache_dir(str(tmp_path), "vae_output", model="a")
+    assert len({cache_dir_1, cache_dir_2, cache_dir_3}) == 3
@@ -0,0 +1,268 @@
+import threading
+from pathlib import Path
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from invoke_training._shared.data.transforms.caption_cache_key_transform import get_caption_cache_key
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import open_tensor_disk_cache
+from invoke_training._shared.data.utils.cache_population import get_caption_cache_keys, populate_tensor_disk_caches
+
+
+class _CountingDataset(Dataset):
+    """A dataset that counts the number of times each example is loaded."""
+
+    def __init__(self, num_examples: int, num_captions: int | None = None):
+        self.num_loads = [0] * num_examples
+        self._num_captions = num_captions or num_examples
+
+    def __len__(self):
+        return len(self.num_loads)
+
+    def __getitem__(self, idx: int):
+        self.num_loads[idx] += 1
+        return {
+            "id": str(idx),
+            "image": torch.full((3, 4, 4), float(idx)),
+            "caption": f"caption {idx % self._num_captions}",
+        }
+
+
+def _collate_fn(examples):
+    return {
+        "id": [e["id"] for e in examples],
+        "image": torch.stack([e["image"] for e in examples]),
+        "caption": [e["caption"] for e in examples],
+    }
+
+
+def test_populate_tensor_disk_caches_single_pass(tmp_path: Path):
+    """Test that populate_tensor_disk_caches(...) populates multiple caches while loading each example only once."""
+    dataset = _CountingDataset(5)
+    data_loader = DataLoader(dataset, batch_size=2, shuffle=False, collate_fn=_collate_fn)
+
+    image_cache_dir = str(tmp_path / "image")
+    caption_cache_dir = str(tmp_path / "caption")
+    populate_tensor_disk_caches(
+        data_loader,
+        {
+            image_cache_dir: lambda batch: {"image_sum": batch["image"].sum(dim=(1, 2, 3))},
+            caption_cache_dir: lambda batch: {"caption_len": [len(c) for c in batch["caption"]]},
+        },
+    )
+
+    assert dataset.num_loads == [1] * 5
+
+    image_cache = open_tensor_disk_cache(image_cache_dir)
+    caption_cache = open_tensor_disk_cache(caption_cache_dir)
+    assert image_cache.is_complete()
+    assert caption_cache.is_complete()
+    for idx in range(5):
+        torch.testing.assert_close(image_cache.load(str(idx))["image_sum"], torch.tensor(48.0 * idx))
+        assert caption_cache.load(str(idx))["caption_len"] == len(f"caption {idx}")
+
+
+def test_populate_tensor_disk_caches_clears_partial_cache(tmp_path: Path):
+    """Test that populate_tensor_disk_caches(...) discards stale files left in the cache directory."""
+    stale_file = tmp_path / "stale.pt"
+    stale_file.touch()
+
+    data_loader = DataLoader(_CountingDataset(2), batch_size=2, collate_fn=_collate_fn)
+    populate_tensor_disk_caches(data_loader, {str(tmp_path): lambda batch: {"image": batch["image"]}})
+
+    assert not stale_file.exists()
+    assert open_tensor_disk_cache(str(tmp_path)).is_complete()
+
+
+def test_populate_tensor_disk_caches_write_error(tmp_path: Path):
+    """Test that an error raised while writing on the background thread is propagated to the caller."""
+    data_loader = DataLoader(_CountingDataset(4), batch_size=2, collate_fn=_collate_fn)
+
+    def build_fn(batch):
+        # Re-use the same id for every example, so that the cache rejects the second save.
+        batch["id"][:] = ["0"] * len(batch["id"])
+        return {"image": batch["image"]}
+
+    with pytest.raises(RuntimeError):
+        populate_tensor_disk_caches(data_loader, {str(tmp_path): build_fn})
+
+    assert not open_tensor_disk_cache(str(tmp_path)).is_complete()
+
+
+def test_populate_tensor_disk_caches_error_not_masked_by_write_error(tmp_path: Path):
+    """Test that an error raised while computing the outputs is not replaced by a pending write error."""
+    data_loader = DataLoader(_CountingDataset(4), batch_size=2, collate_fn=_collate_fn)
+
+    num_calls = 0
+
+    def build_fn(batch):
+        nonlocal num_calls
+        num_calls += 1
+        if num_calls > 1:
+            raise ValueError("Failed to compute outputs.")
+        # Re-use the same id for every example, so that the cache rejects the second save.
+        batch["id"][:] = ["0"] * len(batch["id"])
+        return {"image": batch["image"]}
+
+    with pytest.raises(ValueError, match="Failed to compute outputs."):
+        populate_tensor_disk_caches(data_loader, {str(tmp_path): build_fn})
+
+
+def test_populate_tensor_disk_caches_deduplicated_by_caption(tmp_path: Path):
+    """Test that a cache keyed by caption only computes and stores the outputs for each distinct caption once."""
+    data_loader = DataLoader(_CountingDataset(7, num_captions=2), batch_size=3, collate_fn=_collate_fn)
+
+    num_computed = 0
+
+    def build_fn(batch):
+        nonlocal num_computed
+        num_computed += len(batch["caption"])
+        return {"caption_len": torch.tensor([len(c) for c in batch["caption"]])}
+
+    populate_tensor_disk_caches(
+        data_loader, {str(tmp_path): build_fn}, cache_key_fns={str(tmp_path): get_caption_cache_keys}
+    )
+
+    assert num_computed == 2
+    cache = open_tensor_disk_cache(str(tmp_path))
+    assert cache.is_complete()
+    assert len(cache) == 2
+    for caption_idx in range(2):
+        caption = f"caption {caption_idx}"
+        assert cache.load(get_caption_cache_key(caption))["caption_len"].item() == len(caption)
+
+
+class _ThreadAccelerator:
+    """A minimal stand-in for an Accelerator, where each 'process' is a thread."""
+
+    def __init__(self, process_index: int, num_processes: int, barrier: threading.Barrier, reduce_buffer: dict):
+        self.process_index = process_index
+        self.num_processes = num_processes
+        self.device = torch.device("cpu")
+        self._barrier = barrier
+        self._reduce_buffer = reduce_buffer
+
+    def wait_for_everyone(self):
+        self._barrier.wait()
+
+    def reduce(self, tensor: torch.Tensor, reduction: str) -> torch.Tensor:
+        assert reduction == "sum"
+        self._reduce_buffer[self.process_index] = tensor
+        self._barrier.wait()
+        result = sum(self._reduce_buffer[i] for i in range(self.num_processes))
+        # Wait for all threads to read the buffer before it can be re-used.
+        self._barrier.wait()
+        return result
+
+
+def test_populate_tensor_disk_caches_multi_process(tmp_path: Path):
+    """Test that populate_tensor_disk_caches(...) splits the work between processes, and merges their results."""
+    num_processes = 3
+    dataset = _CountingDataset(7)
+    barrier = threading.Barrier(num_processes, timeout=30)
+    reduce_buffer = {}
+    errors = []
+
+    def run(process_index: int):
+        try:
+            data_loader = DataLoader(dataset, batch_size=2, shuffle=False, collate_fn=_collate_fn)
+            populate_tensor_disk_caches(
+                data_loader,
+                {str(tmp_path): lambda batch: {"image": batch["image"]}},
+                _ThreadAccelerator(process_index, num_processes, barrier, reduce_buffer),
+            )
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_processes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    # Each example is loaded by exactly one process.
+    assert dataset.num_loads == [1] * 7
+
+    cache = open_tensor_disk_cache(str(tmp_path))
+    assert cache.is_complete()
+    for idx in range(7):
+        torch.testing.assert_close(cache.load(str(idx))["image"], torch.full((3, 4, 4), float(idx)))
+
+
+def test_populate_tensor_disk_caches_multi_process_deduplicated_by_caption(tmp_path: Path):
+    """Test that the per-process results of a cache keyed by caption are merged, even if multiple processes computed the
+    outputs for the same caption.
+    """
+    num_processes = 2
+    dataset = _CountingDataset(6, num_captions=2)
+    barrier = threading.Barrier(num_processes, timeout=30)
+    reduce_buffer = {}
+    errors = []
+
+    def run(process_index: int):
+        try:
+            data_loader = DataLoader(dataset, batch_size=2, shuffle=False, collate_fn=_collate_fn)
+            populate_tensor_disk_caches(
+                data_loader,
+                {str(tmp_path): lambda batch: {"image": batch["image"]}},
+                _ThreadAccelerator(process_index, num_processes, barrier, reduce_buffer),
+                cache_key_fns={str(tmp_path): get_caption_cache_keys},
+            )
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_processes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    cache = open_tensor_disk_cache(str(tmp_path))
+    assert cache.is_complete()
+    assert len(cache) == 2
+    # Examples 0 and 1 are the first examples with each caption.
+    for idx in range(2):
+        torch.testing.assert_close(
+            cache.load(get_caption_cache_key(f"caption {idx}"))["image"], torch.full((3, 4, 4), float(idx))
+        )
+
+
+def test_populate_tensor_disk_caches_multi_process_error(tmp_path: Path):
+    """Test that if one process fails, then all processes raise instead of waiting for it."""
+    num_processes = 2
+    # The barrier is not aborted on error, so a process that waits for the failed process would time out.
+    barrier = threading.Barrier(num_processes, timeout=30)
+    reduce_buffer = {}
+    errors = {}
+
+    def build_fn(batch, process_index: int):
+        if process_index == 1:
+            raise ValueError("Failed to compute outputs.")
+        return {"image": batch["image"]}
+
+    def run(process_index: int):
+        try:
+            data_loader = DataLoader(_CountingDataset(4), batch_size=1, shuffle=False, collate_fn=_collate_fn)
+            populate_tensor_disk_caches(
+                data_loader,
+                {str(tmp_path): lambda batch: build_fn(batch, process_index)},
+                _ThreadAccelerator(process_index, num_processes, barrier, reduce_buffer),
+            )
+        except Exception as e:
+            errors[process_index] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_processes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert isinstance(errors[0], RuntimeError)
+    assert "other process" in str(errors[0])
+    assert isinstance(errors[1], ValueError)
+    assert not open_tensor_disk_cache(str(tmp_path)).is_complete()
@@ -0,0 +1,37 @@
+import logging
+from pathlib import Path
+
+import pytest
+import torch
+
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import ShardedTensorDiskCache
+from invoke_training._shared.data.utils.cache_stats import get_dir_size_bytes, log_cache_stats, measure_cache_load_time
+
+
+def test_get_dir_size_bytes(tmp_path: Path):
+    (tmp_path / "a.bin").write_bytes(b"0" * 10)
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "b.bin").write_bytes(b"0" * 5)
+
+    assert get_dir_size_bytes(str(tmp_path)) == 15
+
+
+def test_measure_cache_load_time_empty_cache(tmp_path: Path):
+    cache = ShardedTensorDiskCache(str(tmp_path))
+    cache.mark_complete()
+
+    assert measure_cache_load_time(ShardedTensorDiskCache(str(tmp_path))) == 0.0
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_log_cache_stats(tmp_path: Path, compress: bool, caplog: pytest.LogCaptureFixture):
+    cache = ShardedTensorDiskCache(str(tmp_path), compress=compress)
+    for i in range(3):
+        cache.save(i, {"t": torch.rand((4, 8, 8))})
+    cache.mark_complete()
+
+    logger = logging.getLogger("test_log_cache_stats")
+    with caplog.at_level(logging.INFO, logger="test_log_cache_stats"):
+        log_cache_stats(logger, "VAE output", str(tmp_path))
+
+    assert "VAE output cache: 3 entries" in caplog.text
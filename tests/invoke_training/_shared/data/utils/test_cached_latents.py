@@ -0,0 +1,25 @@
+import torch
+
+from invoke_training._shared.data.utils.cached_latents import sample_cached_latents
+
+
+def test_sample_cached_latents_mean_only():
+    """Test that the cached latents are cast to the requested dtype, if the latent distribution was not cached."""
+    vae_output = torch.rand((2, 4, 8, 8)).to(torch.float16)
+
+    latents = sample_cached_latents({"vae_output": vae_output}, torch.float32)
+
+    assert latents.dtype == torch.float32
+    torch.testing.assert_close(latents, vae_output.to(torch.float32))
+
+
+def test_sample_cached_latents_distribution():
+    """Test that a new latent sample is drawn if the latent distribution was cached."""
+    data_batch = {"vae_output": torch.zeros((2, 4, 8, 8)), "vae_output_std": torch.full((2, 4, 8, 8), 2.0)}
+
+    latents_1 = sample_cached_latents(data_batch, torch.float32)
+    latents_2 = sample_cached_latents(data_batch, torch.float32)
+
+    assert latents_1.shape == (2, 4, 8, 8)
+    assert not torch.equal(latents_1, latents_2)
+    assert 1.5 < latents_1.std().item() < 2.5
@@ -0,0 +1,50 @@
+import pickle
+
+import pytest
+
+from invoke_training._shared.data.utils.compact_string_array import CompactStringArray
+
+
+def test_compact_string_array_roundtrip():
+    values = ["a", None, "", "😀 unicode", "a/b/c.jpg"]
+
+    array = CompactStringArray.from_strings(values)
+
+    assert len(array) == len(values)
+    assert [array[i] for i in range(len(values))] == values
+    assert array[-1] == "a/b/c.jpg"
+
+
+def test_compact_string_array_empty():
+    array = CompactStringArray.from_strings([])
+
+    assert len(array) == 0
+    with pytest.raises(IndexError):
+        array[0]
+
+
+def test_compact_string_array_out_of_range():
+    array = CompactStringArray.from_strings(["a", "b"])
+
+    with pytest.raises(IndexError):
+        array[2]
+    with pytest.raises(IndexError):
+        array[-3]
+
+
+def test_compact_string_array_num_bytes():
+    """Test that the storage size is the UTF-8 size of the strings plus a small fixed per-string overhead."""
+    values = [f"images/{i:06d}.jpg" for i in range(1000)]
+
+    array = CompactStringArray.from_strings(values)
+
+    # 17 bytes of UTF-8 per string + 8 bytes per offset + 1 byte per None flag.
+    assert array.num_bytes == 1000 * 17 + 1001 * 8 + 1000
+
+
+def test_compact_string_array_pickle():
+    array = CompactStringArray.from_strings(["a", None, "c"])
+
+    unpickled = pickle.loads(pickle.dumps(array))
+
+    assert [unpickled[i] for i in range(3)] == ["a", None, "c"]
@@ -0,0 +1,40 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from invoke_training._shared.data.utils.image_decode_backend import (
+    decode_image_tensor,
+    get_image_size_hw,
+    to_float_tensor,
+)
+
+
+@pytest.fixture
+def image_path(tmp_path: Path) -> str:
+    """A 20x10 (HxW) RGBA PNG image."""
+    path = str(tmp_path / "image.png")
+    rng = np.random.default_rng(0)
+    Image.fromarray(rng.integers(0, 256, (20, 10, 4), dtype=np.uint8)).save(path)
+    return path
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L"])
+def test_decode_image_tensor_matches_pil(image_path: str, mode: str):
+    image = decode_image_tensor(image_path, mode)
+
+    pil_image = Image.open(image_path).convert(mode)
+    assert image.dtype == torch.uint8
+    assert get_image_size_hw(image) == get_image_size_hw(pil_image) == (20, 10)
+    if mode == "RGB":
+        # Greyscale conversion formulas differ slightly between PIL and torchvision.
+        assert torch.equal(to_float_tensor(image), to_float_tensor(pil_image))
+    else:
+        assert image.shape == (1, 20, 10)
+
+
+def test_decode_image_tensor_unsupported_mode(image_path: str):
+    with pytest.raises(ValueError, match="Unsupported image mode"):
+        decode_image_tensor(image_path, "CMYK")
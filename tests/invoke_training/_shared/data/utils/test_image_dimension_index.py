@@ -0,0 +1,82 @@
+import os
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+from invoke_training._shared.data.utils import image_probing
+from invoke_training._shared.data.utils.image_dimension_index import ImageDimensionIndex, get_image_file_dimensions
+from invoke_training._shared.data.utils.resolution import Resolution
+
+
+def _save_image(path: Path, height: int, width: int):
+    Image.fromarray(np.zeros((height, width, 3), dtype=np.uint8)).save(path)
+
+
+def test_image_dimension_index_roundtrip(tmp_path: Path):
+    index_path = str(tmp_path / "index.jsonl")
+    index = ImageDimensionIndex(index_path)
+    index.update("a.png", Resolution(10, 20), file_size=100, mtime_ns=5)
+    index.update("b.png", Resolution(30, 40))
+    index.save()
+
+    index = ImageDimensionIndex(index_path)
+    assert len(index) == 2
+    assert index.lookup("a.png", file_size=100, mtime_ns=5) == Resolution(10, 20)
+    assert index.lookup("b.png") == Resolution(30, 40)
+    # Entries are invalidated if the file size or modification time changed.
+    assert index.lookup("a.png", file_size=101, mtime_ns=5) is None
+    assert index.lookup("a.png", file_size=100, mtime_ns=6) is None
+    assert index.lookup("c.png") is None
+
+
+def test_image_dimension_index_unreadable(tmp_path: Path):
+    """Test that a corrupt index file is ignored rather than raising."""
+    index_path = tmp_path / "index.jsonl"
+    index_path.write_text("not json\n")
+
+    assert len(ImageDimensionIndex(str(index_path))) == 0
+
+
+def test_get_image_file_dimensions_incremental(tmp_path: Path):
+    """Test that get_image_file_dimensions(...) only opens images that are new or were modified since the index was
+    written.
+    """
+    image_paths = [str(tmp_path / f"{i}.png") for i in range(3)]
+    for i, image_path in enumerate(image_paths):
+        _save_image(image_path, 8, 8 + i)
+    index_path = str(tmp_path / ".image_dimensions.jsonl")
+
+    with mock.patch.object(
+        image_probing, "read_image_header_dimensions", wraps=image_probing.read_image_header_dimensions
+    ) as mock_read:
+        assert get_image_file_dimensions(image_paths, index_path=index_path) == [Resolution(8, 8 + i) for i in range(3)]
+        assert mock_read.call_count == 3
+
+        # No images are opened if none have changed.
+        mock_read.reset_mock()
+        get_image_file_dimensions(image_paths, index_path=index_path)
+        assert mock_read.call_count == 0
+
+        # Only the modified image is opened.
+        _save_image(image_paths[1], 16, 4)
+        stat = os.stat(image_paths[1])
+        os.utime(image_paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        mock_read.reset_mock()
+        image_dims = get_image_file_dimensions(image_paths, index_path=index_path)
+        assert mock_read.call_count == 1
+        assert image_dims[1] == Resolution(16, 4)
+
+    # Entries for images that are no longer requested are dropped.
+    get_image_file_dimensions(image_paths[:1], index_path=index_path)
+    assert len(ImageDimensionIndex(index_path)) == 1
+
+
+def test_get_image_file_dimensions_read_only_index_dir(tmp_path: Path):
+    """Test that failing to write the index does not cause get_image_file_dimensions(...) to fail."""
+    image_path = str(tmp_path / "0.png")
+    _save_image(image_path, 8, 16)
+
+    index_path = str(tmp_path / "missing_dir" / ".image_dimensions.jsonl")
+    assert get_image_file_dimensions([image_path], index_path=index_path) == [Resolution(8, 16)]
@@ -0,0 +1,102 @@
+import multiprocessing
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from invoke_training._shared.data.utils.image_memory_cache import (
+    LRUImageCache,
+    SharedMemoryImageCache,
+    build_image_memory_cache,
+)
+
+
+@pytest.fixture
+def image_paths(tmp_path: Path) -> list[str]:
+    """Four 8x8 RGB PNG images (192 bytes each when decoded)."""
+    paths = []
+    for i in range(4):
+        path = str(tmp_path / f"{i}.png")
+        Image.fromarray(np.full((8, 8, 3), i * 10, dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_lru_image_cache_evicts_least_recently_used(image_paths: list[str]):
+    cache = LRUImageCache(max_bytes=2 * 192)
+
+    image_0 = cache.load(0, image_paths[0])
+    cache.load(1, image_paths[1])
+    # Access image 0, so that image 1 is the least-recently-used.
+    assert cache.load(0, image_paths[0]) is image_0
+    cache.load(2, image_paths[2])
+
+    assert 0 in cache
+    assert 1 not in cache
+    assert 2 in cache
+    assert cache.num_bytes == 2 * 192
+
+
+def test_lru_image_cache_unbounded(image_paths: list[str]):
+    cache = LRUImageCache()
+    for i, image_path in enumerate(image_paths):
+        cache.load(i, image_path)
+
+    assert len(cache) == 4
+
+
+def test_lru_image_cache_encoded(image_paths: list[str]):
+    cache = LRUImageCache(cache_format="encoded")
+
+    image = cache.load(0, image_paths[0], mode="L")
+
+    assert image.mode == "L"
+    assert image.size == (8, 8)
+    assert cache.num_bytes == Path(image_paths[0]).stat().st_size
+
+
+@pytest.mark.parametrize("cache_format", ["decoded", "encoded"])
+def test_shared_memory_image_cache_roundtrip(image_paths: list[str], cache_format: str):
+    cache = SharedMemoryImageCache(num_entries=4, max_bytes=4096, cache_format=cache_format)
+
+    image = cache.load(0, image_paths[1])
+    assert 0 in cache
+    cached_image = cache.load(0, "missing_path.png")
+
+    assert cached_image.mode == "RGB"
+    np.testing.assert_array_equal(np.asarray(cached_image), np.asarray(image))
+
+
+def test_shared_memory_image_cache_evicts_first_in_first_out(image_paths: list[str]):
+    cache = SharedMemoryImageCache(num_entries=4, max_bytes=2 * 192 + 100)
+
+    for i in range(3):
+        cache.load(i, image_paths[i])
+
+    # The third image did not fit at the end of the ring buffer, so it overwrote the first image.
+    assert 0 not in cache
+    assert 1 in cache
+    assert 2 in cache
+
+
+def _load_in_subprocess(cache: SharedMemoryImageCache, image_path: str):
+    cache.load(3, image_path)
+
+
+def test_shared_memory_image_cache_shared_between_processes(image_paths: list[str]):
+    cache = SharedMemoryImageCache(num_entries=4, max_bytes=4096)
+
+    process = multiprocessing.get_context("fork").Process(target=_load_in_subprocess, args=(cache, image_paths[3]))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    # The image that was loaded by the other process is cached.
+    assert 3 in cache
+    np.testing.assert_array_equal(np.asarray(cache.load(3, "missing_path.png")), np.full((8, 8, 3), 30))
+
+
+def test_build_image_memory_cache_shared_requires_budget():
+    with pytest.raises(ValueError):
+        build_image_memory_cache(num_entries=4, shared=True)
@@ -0,0 +1,55 @@
+import io
+import logging
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from invoke_training._shared.data.utils.image_probing import probe_image_dimensions, read_image_header_dimensions
+from invoke_training._shared.data.utils.resolution import Resolution
+
+
+def _make_image(height: int, width: int) -> Image.Image:
+    return Image.fromarray(np.zeros((height, width, 3), dtype=np.uint8))
+
+
+def test_read_image_header_dimensions_from_path(tmp_path: Path):
+    image_path = str(tmp_path / "image.jpg")
+    _make_image(8, 16).save(image_path)
+
+    assert read_image_header_dimensions(image_path) == Resolution(8, 16)
+
+
+def test_read_image_header_dimensions_from_bytes():
+    buffer = io.BytesIO()
+    _make_image(8, 16).save(buffer, format="PNG")
+
+    assert read_image_header_dimensions(buffer.getvalue()) == Resolution(8, 16)
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_probe_image_dimensions(tmp_path: Path, executor: str, caplog: pytest.LogCaptureFixture):
+    """Test that probe_image_dimensions(...) preserves the order of the images across chunks, and logs its
+    throughput.
+    """
+    image_paths = []
+    for i in range(5):
+        image_path = str(tmp_path / f"{i}.png")
+        _make_image(8, 8 + i).save(image_path)
+        image_paths.append(image_path)
+
+    with caplog.at_level(logging.INFO):
+        image_dims = probe_image_dimensions(iter(image_paths), num_workers=2, executor=executor, chunk_size=2)
+
+    assert image_dims == [Resolution(8, 8 + i) for i in range(5)]
+    assert "Read 5 image headers" in caplog.text
+
+
+def test_probe_image_dimensions_empty():
+    assert probe_image_dimensions([]) == []
+
+
+def test_probe_image_dimensions_invalid_executor():
+    with pytest.raises(ValueError):
+        probe_image_dimensions([], executor="invalid")
@@ -0,0 +1,95 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from invoke_training._shared.data.utils.aspect_ratio_bucket_manager import AspectRatioBucketManager
+from invoke_training._shared.data.utils.pre_resized_image_cache import (
+    PreResizedImageCache,
+    build_pre_resized_image_cache,
+    get_original_size_hw,
+)
+from invoke_training._shared.data.utils.resize import resize_to_cover
+from invoke_training._shared.data.utils.resolution import Resolution
+
+
+@pytest.fixture
+def image_path(tmp_path: Path) -> str:
+    """A 200x100 (HxW) RGB PNG image."""
+    path = str(tmp_path / "image.png")
+    rng = np.random.default_rng(0)
+    Image.fromarray(rng.integers(0, 256, (200, 100, 3), dtype=np.uint8)).save(path)
+    return path
+
+
+def _get_cache_files(cache_dir: Path) -> list[Path]:
+    return list(cache_dir.glob("*/*.png"))
+
+
+def test_pre_resized_image_cache_miss_and_hit(image_path: str, tmp_path: Path):
+    cache_dir = tmp_path / "cache"
+    cache = PreResizedImageCache(str(cache_dir), lambda size: Resolution(64, 64))
+
+    image = cache.load(image_path)
+    expected = resize_to_cover(Image.open(image_path).convert("RGB"), Resolution(64, 64))
+    assert image.size == (64, 128)
+    assert get_original_size_hw(image) == (200, 100)
+    np.testing.assert_array_equal(np.array(image), np.array(expected))
+    assert len(_get_cache_files(cache_dir)) == 1
+
+    # The second load should read the cached image, which is stored losslessly.
+    cached_image = cache.load(image_path)
+    assert get_original_size_hw(cached_image) == (200, 100)
+    np.testing.assert_array_equal(np.array(cached_image), np.array(expected))
+
+
+def test_pre_resized_image_cache_invalidated_on_change(image_path: str, tmp_path: Path):
+    cache_dir = tmp_path / "cache"
+    cache = PreResizedImageCache(str(cache_dir), lambda size: Resolution(64, 64))
+    cache.load(image_path)
+
+    Image.fromarray(np.zeros((100, 100, 3), dtype=np.uint8)).save(image_path)
+    # Make sure that the modification time changes, even on file systems with a coarse timestamp resolution.
+    stat = os.stat(image_path)
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    image = cache.load(image_path)
+    assert get_original_size_hw(image) == (100, 100)
+    assert image.size == (64, 64)
+    assert len(_get_cache_files(cache_dir)) == 2
+
+
+def test_pre_resized_image_cache_does_not_upscale(image_path: str, tmp_path: Path):
+    cache = PreResizedImageCache(str(tmp_path / "cache"), lambda size: Resolution(512, 512))
+
+    image = cache.load(image_path)
+
+    assert image.size == (100, 200)
+    assert get_original_size_hw(image) == (200, 100)
+
+
+def test_pre_resized_image_cache_mode(image_path: str, tmp_path: Path):
+    cache = PreResizedImageCache(str(tmp_path / "cache"), lambda size: Resolution(64, 64))
+
+    assert cache.load(image_path, "L").mode == "L"
+    assert cache.load(image_path, "RGB").mode == "RGB"
+    # Modes are cached separately.
+    assert cache.load(image_path, "L").mode == "L"
+
+
+def test_get_original_size_hw_without_cache(image_path: str):
+    assert get_original_size_hw(Image.open(image_path)) == (200, 100)
+
+
+def test_build_pre_resized_image_cache_namespaced_by_resolution_config(image_path: str, tmp_path: Path):
+    bucket_manager = AspectRatioBucketManager({Resolution(64, 32), Resolution(32, 64)})
+    fixed_cache = build_pre_resized_image_cache(str(tmp_path), resolution=64, aspect_ratio_bucket_manager=None)
+    bucket_cache = build_pre_resized_image_cache(
+        str(tmp_path), resolution=None, aspect_ratio_bucket_manager=bucket_manager
+    )
+
+    assert fixed_cache.load(image_path).size == (64, 128)
+    assert bucket_cache.load(image_path).size == (32, 64)
+    assert len(list(tmp_path.glob("*/*/*.png"))) == 2
@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from invoke_training._shared.data.utils.pre_resized_image_cache import get_original_size_hw
+from invoke_training._shared.data.utils.reduced_size_decoding import open_image_reduced, open_mask_reduced
+from invoke_training._shared.data.utils.resize import resize_to_cover
+from invoke_training._shared.data.utils.resolution import Resolution
+
+
+def _save_image(path: Path, height: int, width: int) -> str:
+    rng = np.random.default_rng(0)
+    Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8)).save(path)
+    return str(path)
+
+
+@pytest.mark.parametrize(
+    ["target_resolution", "expected_size_hw"],
+    [
+        # 1/4 scale is the largest reduction that covers 256x128.
+        (Resolution(256, 128), (400, 200)),
+        # 1/8 scale covers 64x64.
+        (Resolution(64, 64), (200, 100)),
+        # 1/2 scale covers 512x256.
+        (Resolution(512, 256), (800, 400)),
+        # Covering 512x512 requires a 1024x512 image, so no reduction is possible.
+        (Resolution(512, 512), (1600, 800)),
+    ],
+)
+def test_open_image_reduced_jpeg(tmp_path: Path, target_resolution: Resolution, expected_size_hw: tuple[int, int]):
+    image_path = _save_image(tmp_path / "image.jpg", 1600, 800)
+
+    image = open_image_reduced(image_path, "RGB", lambda size: target_resolution)
+
+    assert (image.height, image.width) == expected_size_hw
+    assert get_original_size_hw(image) == (1600, 800)
+    # The reduced image must still cover the target resolution, so that it is never upscaled.
+    resized_image = resize_to_cover(image, target_resolution)
+    assert resized_image.height <= image.height and resized_image.width <= image.width
+
+
+def test_open_image_reduced_png_is_not_reduced(tmp_path: Path):
+    image_path = _save_image(tmp_path / "image.png", 160, 80)
+
+    image = open_image_reduced(image_path, "RGB", lambda size: Resolution(16, 16))
+
+    assert image.size == (80, 160)
+    assert get_original_size_hw(image) == (160, 80)
+
+
+def test_open_image_reduced_without_target(tmp_path: Path):
+    image_path = _save_image(tmp_path / "image.jpg", 160, 80)
+
+    image = open_image_reduced(image_path, "L")
+
+    assert image.mode == "L"
+    assert image.size == (80, 160)
+
+
+@pytest.mark.parametrize("mask_extension", ["png", "jpg"])
+def test_open_mask_reduced(tmp_path: Path, mask_extension: str):
+    image_path = _save_image(tmp_path / "image.jpg", 1600, 800)
+    mask_path = _save_image(tmp_path / f"mask.{mask_extension}", 1600, 800)
+    image = open_image_reduced(image_path, "RGB", lambda size: Resolution(256, 128))
+
+    mask = open_mask_reduced(mask_path, image, "L")
+
+    assert mask.mode == "L"
+    assert mask.size == image.size == (200, 400)
+    assert get_original_size_hw(mask) == (1600, 800)
@@ -0,0 +1,36 @@
+from pathlib import Path
+from unittest import mock
+
+import torch
+
+from invoke_training._shared.data.transforms.sharded_tensor_disk_cache import ShardedTensorDiskCache
+from invoke_training._shared.data.utils.resident_tensor_cache import build_resident_tensor_cache
+
+
+def test_resident_tensor_cache_load_batch(tmp_path: Path):
+    """Test that ResidentTensorCache stacks entries into a batch, and only loads each entry from disk once."""
+    cache = ShardedTensorDiskCache(str(tmp_path))
+    in_tensors = {"a": torch.rand((2, 3)), "b": torch.rand((2, 3))}
+    for key, t in in_tensors.items():
+        cache.save(key, {"t": t})
+    cache.mark_complete()
+
+    resident_cache = build_resident_tensor_cache(str(tmp_path), "cpu")
+    assert resident_cache is not None
+
+    with mock.patch.object(ShardedTensorDiskCache, "load", wraps=resident_cache._cache.load) as mock_load:
+        batch = resident_cache.load_batch(["a", "b", "a"])
+        batch = resident_cache.load_batch(["b", "a"])
+
+    assert mock_load.call_count == 2
+    torch.testing.assert_close(batch["t"], torch.stack([in_tensors["b"], in_tensors["a"]]))
+
+
+def test_build_resident_tensor_cache_too_many_entries(tmp_path: Path):
+    cache = ShardedTensorDiskCache(str(tmp_path))
+    for key in range(3):
+        cache.save(key, {"t": torch.rand((2, 3))})
+    cache.mark_complete()
+
+    assert build_resident_tensor_cache(str(tmp_path), "cpu", max_entries=2) is None
+    assert build_resident_tensor_cache(str(tmp_path), "cpu", max_entries=3) is not None
@@ -1,6 +1,17 @@
+import pickle
 from pathlib import Path
+from unittest import mock
 
-from invoke_training._shared.utils.jsonl import load_jsonl, save_jsonl
+import numpy as np
+import pytest
+
+from invoke_training._shared.utils.jsonl import (
+    IndexedJsonlFile,
+    build_jsonl_line_index,
+    iter_jsonl,
+    load_jsonl,
+    save_jsonl,
+)
 
 
 def test_jsonl_roundtrip(tmp_path: Path):
@@ -11,3 +22,71 @@ def test_jsonl_roundtrip(tmp_path: Path):
     out_objs = load_jsonl(jsonl_path)
 
     assert in_objs == out_objs
+
+
+def test_iter_jsonl_skips_blank_lines(tmp_path: Path):
+    jsonl_path = tmp_path / "test.jsonl"
+    jsonl_path.write_text('{"a": 1}\n\n{"a": 2}\n')
+
+    assert list(iter_jsonl(jsonl_path)) == [{"a": 1}, {"a": 2}]
+
+
+@pytest.mark.parametrize("chunk_size", [3, 2**20])
+def test_build_jsonl_line_index(tmp_path: Path, chunk_size: int):
+    jsonl_path = tmp_path / "test.jsonl"
+    jsonl_path.write_text('{"a": 1}\n\n{"a": 22}\n{"a": 3}')
+
+    with mock.patch("invoke_training._shared.utils.jsonl._LINE_INDEX_CHUNK_SIZE", chunk_size):
+        spans = build_jsonl_line_index(jsonl_path)
+
+    np.testing.assert_array_equal(spans, [[0, 8], [10, 19], [20, 28]])
+
+
+@pytest.mark.parametrize("chunk_size", [3, 2**20])
+def test_build_jsonl_line_index_skips_whitespace_lines(tmp_path: Path, chunk_size: int):
+    """Test that lines that only contain whitespace (e.g. blank lines with CRLF line endings) are not indexed."""
+    jsonl_path = tmp_path / "test.jsonl"
+    jsonl_path.write_bytes(b'{"a":1}\r\n\r\n{"a":2}\r\n \t\n')
+
+    with mock.patch("invoke_training._shared.utils.jsonl._LINE_INDEX_CHUNK_SIZE", chunk_size):
+        spans = build_jsonl_line_index(jsonl_path)
+        rows = IndexedJsonlFile(jsonl_path)
+
+    np.testing.assert_array_equal(spans, [[0, 8], [11, 19]])
+    assert len(rows) == len(list(iter_jsonl(jsonl_path))) == 2
+    assert [rows[0], rows[1]] == [{"a": 1}, {"a": 2}]
+
+
+def test_indexed_jsonl_file(tmp_path: Path):
+    in_objs = [{"a": i, "b": "x" * i} for i in range(10)]
+    jsonl_path = tmp_path / "test.jsonl"
+    save_jsonl(in_objs, jsonl_path)
+
+    rows = IndexedJsonlFile(jsonl_path)
+
+    assert len(rows) == 10
+    assert [rows[i] for i in [3, 0, 9]] == [in_objs[3], in_objs[0], in_objs[9]]
+    assert list(rows) == in_objs
+    # The index is cached next to the jsonl file.
+    assert (tmp_path / ".test.line_index.npz").is_file()
+
+    # The rows can still be read after pickling (e.g. in a spawned DataLoader worker).
+    assert pickle.loads(pickle.dumps(rows))[5] == in_objs[5]
+
+
+def test_indexed_jsonl_file_cached_index(tmp_path: Path):
+    """Test that the cached index is re-used if the jsonl file is unchanged, and rebuilt if it is modified."""
+    jsonl_path = tmp_path / "test.jsonl"
+    save_jsonl([{"a": 1}, {"a": 2}], jsonl_path)
+    IndexedJsonlFile(jsonl_path)
+
+    with mock.patch(
+        "invoke_training._shared.utils.jsonl.build_jsonl_line_index", wraps=build_jsonl_line_index
+    ) as mock_build:
+        assert len(IndexedJsonlFile(jsonl_path)) == 2
+        assert mock_build.call_count == 0
+
+        save_jsonl([{"a": 1}, {"a": 2}, {"a": 3}], jsonl_path)
+        rows = IndexedJsonlFile(jsonl_path)
+        assert mock_build.call_count == 1
+        assert rows[2] == {"a": 3}